@@ -11,9 +11,6 @@ from uuid import uuid4
 import json
 import platform
 
-import time
-import board
-import adafruit_am2320
 
 # This sample uses the Message Broker for AWS IoT to send and receive messages
 # through an MQTT connection. On startup, the device connects to the server,
@@ -44,6 +41,10 @@ parser.add_argument('--proxy-port', type=int, default=8080, help="Port of proxy
 parser.add_argument('--verbosity', choices=[x.name for x in io.LogLevel], default=io.LogLevel.NoLogs.name,
     help='Logging level')
 parser.add_argument('--timeout', default=5, type=int, help="Time between publishing new data")
+parser.add_argument('--deadband', default=0, type=float, help="Only publish when the temperature moved more than " +
+                                                              "this from the last value sent. 0 publishes every sample")
+parser.add_argument('--max-silence', default=300, type=float, help="With --deadband, publish at least this often " +
+                                                                  "in seconds even if nothing changed")
 
 parser.add_argument('--datasource', default='Cow01', type=str)
 parser.add_argument('--measures', default=['Temperature'], nargs='+')
@@ -56,9 +57,19 @@ io.init_logging(getattr(io.LogLevel, args.verbosity), 'stderr')
 received_count = 0
 received_all_event = threading.Event()
 
-# Configure Temp Sensor
-i2c = board.I2C()  # uses board.SCL and board.SDA
-am = adafruit_am2320.AM2320(i2c)
+am = None
+
+
+def get_sensor():
+    # Configure Temp Sensor on first use, so --help and a failed connection
+    # don't have to wait for the I2C bus
+    global am
+    if am is None:
+        import board
+        import adafruit_am2320
+        i2c = board.I2C()  # uses board.SCL and board.SDA
+        am = adafruit_am2320.AM2320(i2c)
+    return am
 
 
 # Callback when connection is accidentally lost.
@@ -164,12 +175,21 @@ if __name__ == '__main__':
         print ("Sending {} message(s)".format(args.count))
 
     publish_count = 1
+    last_sent = None
+    last_sent_at = 0
     while (publish_count <= args.count) or (args.count == 0):
         try:
+            temperature = float(get_sensor().temperature)
+            if (args.deadband and last_sent is not None and abs(temperature - last_sent) <= args.deadband
+                    and time.monotonic() - last_sent_at < args.max_silence):
+                # Report by exception, the cloud keeps the last value sent
+                time.sleep(args.timeout)
+                continue
+            last_sent, last_sent_at = temperature, time.monotonic()
             message = {
                 'Device_ID': platform.node(),
                 'Data': {
-                    'Tempurature': float(am.temperature)
+                    'Tempurature': temperature
                 }
             }
             print("Publishing message to topic '{}': {}".format(args.topic, message))
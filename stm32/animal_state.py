@@ -0,0 +1,256 @@
+# Per-animal state kept by the gateway, keyed by Device_ID.
+#
+# Collars come in and out of range all day, so whatever the gateway
+# remembers about them (last values sent, sample rates, baselines, ...) has
+# to stay within a fixed amount of memory. AnimalStateStore keeps one entry
+# per animal in least recently used order. An animal not seen for
+# ANIMAL_STATE_TTL seconds is dropped, and when the entries add up to more
+# than ANIMAL_STATE_MAX_BYTES the least recently seen animals are dropped
+# until they fit.
+#
+# Each user of the store gets its own namespace, which behaves like a dict
+# keyed by Device_ID:
+#
+#   state = AnimalStateStore()
+#   last_sent = state.namespace('report')
+#   last_sent.setdefault(8, {})['Temperature'] = ...
+#
+# The whole store is pickled to ANIMAL_STATE_FILE every
+# ANIMAL_STATE_SNAPSHOT_INTERVAL seconds and on shutdown, and loaded back
+# on start, so a restart keeps what was learned about every animal.
+
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from gateway_paths import data_path
+
+DEFAULT_STATE_FILE = 'animal_state.pickle'
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_SNAPSHOT_INTERVAL = 60
+# Entry sizes are re-measured and the limits applied every this many writes
+ENFORCE_EVERY = 64
+SNAPSHOT_VERSION = 1
+
+
+def deep_size(obj):
+    # Rough number of bytes held by obj and everything it contains
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item) for item in obj)
+    return size
+
+
+class _Entry:
+    __slots__ = ('namespaces', 'last_seen', 'size')
+
+    def __init__(self, namespaces, last_seen):
+        self.namespaces = namespaces
+        self.last_seen = last_seen
+        self.size = 0
+
+
+class Namespace:
+    # One user's view of the store, a mapping of Device_ID -> value. Reading
+    # or writing an animal's value marks the animal as recently seen.
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def __getitem__(self, device_id):
+        value = self.store._lookup(device_id, self.name)
+        if value is _MISSING:
+            raise KeyError(device_id)
+        return value
+
+    def __setitem__(self, device_id, value):
+        self.store._assign(device_id, self.name, value)
+
+    def __contains__(self, device_id):
+        return self.store._peek(device_id, self.name) is not _MISSING
+
+    def get(self, device_id, default=None):
+        value = self.store._lookup(device_id, self.name)
+        return default if value is _MISSING else value
+
+    def setdefault(self, device_id, default=None):
+        value = self.store._lookup(device_id, self.name)
+        if value is _MISSING:
+            self.store._assign(device_id, self.name, default)
+            return default
+        return value
+
+    def pop(self, device_id, default=None):
+        return self.store._remove(device_id, self.name, default)
+
+
+_MISSING = object()
+
+
+class AnimalStateStore:
+    def __init__(self, path=None, max_bytes=None, ttl=None, snapshot_interval=None):
+        self.path = path or os.getenv('ANIMAL_STATE_FILE') or data_path(DEFAULT_STATE_FILE)
+        self.max_bytes = max_bytes or int(os.getenv('ANIMAL_STATE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        self.ttl = ttl or float(os.getenv('ANIMAL_STATE_TTL', DEFAULT_TTL))
+        self.snapshot_interval = snapshot_interval or float(
+            os.getenv('ANIMAL_STATE_SNAPSHOT_INTERVAL', DEFAULT_SNAPSHOT_INTERVAL))
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # device_id -> _Entry, least recently seen first
+        self._bytes = 0
+        # Entries that may have changed size since they were last measured
+        self._dirty = set()
+        self._writes = 0
+        self._timer = None
+        self.evicted = 0
+        self.expired = 0
+
+    def namespace(self, name):
+        return Namespace(self, name)
+
+    def _touch(self, device_id, create):
+        entry = self._entries.get(device_id)
+        if entry is None:
+            if not create:
+                return None
+            entry = self._entries[device_id] = _Entry({}, time.time())
+        else:
+            entry.last_seen = time.time()
+            self._entries.move_to_end(device_id)
+        # Values handed out are mutable, so any access may change the size
+        self._dirty.add(device_id)
+        self._writes += 1
+        if self._writes % ENFORCE_EVERY == 0:
+            self._enforce_limits()
+        return entry
+
+    def _lookup(self, device_id, name):
+        with self._lock:
+            entry = self._touch(device_id, create=False)
+            return _MISSING if entry is None else entry.namespaces.get(name, _MISSING)
+
+    def _peek(self, device_id, name):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            return _MISSING if entry is None else entry.namespaces.get(name, _MISSING)
+
+    def _assign(self, device_id, name, value):
+        with self._lock:
+            self._touch(device_id, create=True).namespaces[name] = value
+
+    def _remove(self, device_id, name, default):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is None or name not in entry.namespaces:
+                return default
+            self._dirty.add(device_id)
+            return entry.namespaces.pop(name)
+
+    def _measure(self):
+        for device_id in self._dirty:
+            entry = self._entries.get(device_id)
+            if entry is not None:
+                size = deep_size(entry.namespaces)
+                self._bytes += size - entry.size
+                entry.size = size
+        self._dirty.clear()
+
+    def _drop_oldest(self):
+        _, entry = self._entries.popitem(last=False)
+        self._bytes -= entry.size
+
+    def _enforce_limits(self, now=None):
+        now = time.time() if now is None else now
+        while self._entries and next(iter(self._entries.values())).last_seen < now - self.ttl:
+            self._drop_oldest()
+            self.expired += 1
+        self._measure()
+        while self._entries and self._bytes > self.max_bytes:
+            self._drop_oldest()
+            self.evicted += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, device_id):
+        return device_id in self._entries
+
+    def forget(self, device_id):
+        with self._lock:
+            entry = self._entries.pop(device_id, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def snapshot(self):
+        # Pickles every entry, least recently seen first, and swaps the file
+        # in with a single rename
+        with self._lock:
+            self._enforce_limits()
+            entries = [(device_id, entry.last_seen, entry.namespaces)
+                       for device_id, entry in self._entries.items()]
+            data = pickle.dumps({'version': SNAPSHOT_VERSION, 'saved': time.time(), 'entries': entries},
+                                protocol=pickle.HIGHEST_PROTOCOL)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.animal_state.', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        return len(entries)
+
+    def restore(self):
+        # Loads the last snapshot, skipping animals that expired since.
+        # Returns the number of animals restored.
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+            if saved.get('version') != SNAPSHOT_VERSION:
+                return 0
+            cutoff = time.time() - self.ttl
+            entries = [(device_id, last_seen, namespaces) for device_id, last_seen, namespaces in saved['entries']
+                       if last_seen >= cutoff]
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            # Not only a damaged file: a snapshot from another release can
+            # hold classes whose slots have changed since, or that need a
+            # module (numpy) that isn't installed. Starting empty beats
+            # failing to start at all.
+            print("Ignoring unreadable animal state snapshot {}: {!r}".format(self.path, e))
+            return 0
+        with self._lock:
+            for device_id, last_seen, namespaces in entries:
+                self._entries[device_id] = _Entry(namespaces, last_seen)
+                self._dirty.add(device_id)
+            self._enforce_limits()
+            return len(self._entries)
+
+    def start_snapshots(self):
+        self._timer = threading.Timer(self.snapshot_interval, self._periodic_snapshot)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _periodic_snapshot(self):
+        # Whatever goes wrong with this snapshot, there is another one next time
+        try:
+            self.snapshot()
+        except Exception as e:
+            print("Failed to save animal state: {!r}".format(e))
+        finally:
+            self.start_snapshots()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.snapshot()
+
+    def stats(self):
+        with self._lock:
+            self._measure()
+            return {'animals': len(self._entries), 'bytes': self._bytes,
+                    'evicted': self.evicted, 'expired': self.expired}
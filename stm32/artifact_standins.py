@@ -0,0 +1,168 @@
+# Checks artifacts.py against the local HTTP stand-in (http_standin.py).
+#
+#   1. a cold download with --threads parallel chunks, against one chunk at
+#      a time, on a link that paces each connection to --rate bytes/s
+#   2. asking for the same file again, by another URL, is a cache hit that
+#      sends nothing
+#   3. the link breaks partway: the download fails, and once the link is
+#      back it carries on instead of starting over
+#   4. a file that doesn't match its SHA-256 is rejected and not cached
+#   5. a server without Range support still works, in one piece
+#   6. several threads asking for the same new file download it once
+#   7. the cache stays under its size limit, dropping the least recently
+#      used file
+#   8. on a link that drops every quarter chunk, the download still gets
+#      there in one go, each retry carrying on where the last one stopped
+#
+# Example:
+#   python artifact_standins.py --size-mb 8 --rate 2000000 --threads 4
+
+import argparse
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from artifacts import ArtifactCache, ArtifactError
+from http_standin import HttpStandIn
+
+parser = argparse.ArgumentParser(description="Check the artifact cache against a local HTTP server.")
+parser.add_argument('--size-mb', type=float, default=8, help='size of each test file')
+parser.add_argument('--rate', type=float, default=2000000, help='bytes/s per connection')
+parser.add_argument('--threads', type=int, default=4, help='ARTIFACT_DOWNLOAD_THREADS')
+parser.add_argument('--chunk-kb', type=int, default=512, help='ARTIFACT_CHUNK_SIZE in KiB')
+
+
+def make_file(size, seed):
+    block = hashlib.sha256(str(seed).encode()).digest() * 2048
+    data = (block * (size // len(block) + 1))[:size]
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def main():
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+    if size < 2:
+        parser.error('--size-mb is too small to break a download in the middle')
+    chunk_size = args.chunk_kb * 1024
+    files = {'/firmware-{}.bin'.format(n): make_file(size, n) for n in range(4)}
+    standin = HttpStandIn(files={path: data for path, (data, _) in files.items()}, rate=args.rate)
+    standin.files['/mirror/firmware-0.bin'] = files['/firmware-0.bin'][0]
+    standin.start()
+    plain = HttpStandIn(files=standin.files, rate=args.rate, ranges=False)
+    plain.start()
+    directory = tempfile.mkdtemp()
+    problems = []
+
+    def cache(name, threads=args.threads, max_bytes=10 * size):
+        return ArtifactCache(os.path.join(directory, name), max_bytes=max_bytes,
+                             chunk_size=chunk_size, threads=threads, timeout=10)
+
+    def sent_during(server, action):
+        before = server.counts['bytes_sent']
+        started = time.monotonic()
+        result = action()
+        return result, server.counts['bytes_sent'] - before, time.monotonic() - started
+
+    data, digest = files['/firmware-0.bin']
+    _, _, serial = sent_during(standin, lambda: cache('serial', threads=1).fetch(
+        standin.url('/firmware-0.bin'), digest))
+    parallel_cache = cache('parallel')
+    path, sent, parallel = sent_during(standin, lambda: parallel_cache.fetch(standin.url('/firmware-0.bin'), digest))
+    print("1. {:.1f} MiB: {:.2f}s in one chunk at a time, {:.2f}s with {} threads ({:.1f}x)".format(
+        size / 2 ** 20, serial, parallel, args.threads, serial / parallel))
+    with open(path, 'rb') as f:
+        if f.read() != data:
+            problems.append('cached file differs')
+    # Only if there are several chunks to fetch at once
+    if min(args.threads, -(-size // chunk_size)) > 1 and parallel > serial / 1.5:
+        problems.append('parallel chunks were not faster')
+
+    output = os.path.join(directory, 'installed.bin')
+    _, sent, _ = sent_during(standin, lambda: parallel_cache.fetch(standin.url('/mirror/firmware-0.bin'), digest,
+                                                                   output=output))
+    print("2. again from another URL: {} bytes sent, hits {}".format(sent, parallel_cache.counts['hits']))
+    if sent or not parallel_cache.counts['hits'] or os.path.getsize(output) != size:
+        problems.append('second fetch was not a cache hit')
+
+    data, digest = files['/firmware-1.bin']
+    resuming = cache('resume')
+    standin.break_after(size // 2)
+    try:
+        resuming.fetch(standin.url('/firmware-1.bin'), digest)
+        problems.append('download through a broken link succeeded')
+    except ArtifactError as e:
+        print("3. link broke: {}".format(e))
+    standin.heal()
+    _, sent, _ = sent_during(standin, lambda: resuming.fetch(standin.url('/firmware-1.bin'), digest))
+    print("   link back: {} of {} bytes sent to finish it, {} resumed".format(
+        sent, size, resuming.counts['bytes_resumed']))
+    if sent >= size or not resuming.counts['bytes_resumed'] or resuming.get(digest) is None:
+        problems.append('download started over instead of resuming')
+
+    corrupt = cache('corrupt')
+    try:
+        corrupt.fetch(standin.url('/firmware-2.bin'), files['/firmware-3.bin'][1])
+        problems.append('file with the wrong hash was accepted')
+    except ArtifactError as e:
+        print("4. wrong hash: {}".format(e))
+    if corrupt.entries():
+        problems.append('file with the wrong hash was cached')
+
+    data, digest = files['/firmware-2.bin']
+    _, sent, seconds = sent_during(plain, lambda: cache('plain').fetch(plain.url('/firmware-2.bin'), digest))
+    print("5. no Range support: {} bytes in one request, {:.2f}s".format(sent, seconds))
+    if sent != size:
+        problems.append('download without Range support failed')
+
+    shared = cache('shared')
+    before = standin.counts['bytes_sent']
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(shared.fetch(standin.url('/firmware-3.bin'),
+                                                                           files['/firmware-3.bin'][1])))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sent = standin.counts['bytes_sent'] - before
+    print("6. four at once: {} bytes sent, {} download(s)".format(sent, shared.counts['misses']))
+    if len(results) != 4 or shared.counts['misses'] != 1 or sent != size:
+        problems.append('concurrent fetches downloaded more than once')
+
+    small = cache('small', max_bytes=int(2.5 * size))
+    for name in ('/firmware-0.bin', '/firmware-1.bin', '/firmware-0.bin', '/firmware-2.bin'):
+        small.fetch(standin.url(name), files[name][1])
+        # The file times only have to tell the fetches apart
+        time.sleep(0.05)
+    kept = sorted(os.path.basename(path) for path, _, _ in small.entries())
+    expected = sorted(files[name][1] for name in ('/firmware-0.bin', '/firmware-2.bin'))
+    print("7. limit {} bytes: {} kept, {}".format(small.max_bytes, len(kept), small.stats()))
+    if kept != expected:
+        problems.append('eviction kept the wrong files')
+
+    data, digest = files['/firmware-2.bin']
+    flaky = cache('flaky')
+    standin.drop_every = max(1, chunk_size // 4)
+    dropped = standin.counts['dropped']
+    try:
+        _, sent, _ = sent_during(standin, lambda: flaky.fetch(standin.url('/firmware-2.bin'), digest))
+        print("8. dropping every {} bytes: {} of {} bytes sent, {} connections dropped".format(
+            standin.drop_every, sent, size, standin.counts['dropped'] - dropped))
+        if sent > size:
+            problems.append('the flaky link sent more than the file')
+    except ArtifactError as e:
+        print("8. dropping every {} bytes: {}".format(standin.drop_every, e))
+        problems.append('no download over a link that keeps dropping')
+    standin.drop_every = 0
+
+    standin.stop()
+    plain.stop()
+    print('ok' if not problems else '; '.join(problems))
+    if problems:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
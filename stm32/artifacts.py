@@ -0,0 +1,376 @@
+# Local cache for the files jobs download: firmware images, behaviour
+# models, packages.
+#
+# Files are kept by their SHA-256 under ARTIFACT_CACHE_DIR, so a job asking
+# for a file the gateway already has gets it from the cache instead of
+# downloading it again, whichever URL it was asked for by. Downloads:
+#
+#   - The server is asked for the size first. If it takes Range requests
+#     the file is fetched ARTIFACT_CHUNK_SIZE at a time by
+#     ARTIFACT_DOWNLOAD_THREADS threads, each chunk written straight into
+#     place in a partial file.
+#   - How far each chunk got is noted next to it, once the bytes are on
+#     the card, so a download cut off by the network, a reboot or a job
+#     timeout carries on from there, mid-chunk, the next time it is asked
+#     for. A dropped connection is retried from where it stopped, too.
+#   - The whole file is checked against the SHA-256 the job gave before it
+#     goes into the cache. A mismatch throws it away.
+#   - Servers without Range support get one plain GET, started over if it
+#     is cut off.
+#
+# The cache is kept under ARTIFACT_CACHE_BYTES by removing the least
+# recently used files. Several processes can share it; two asking for the
+# same file at once download it once.
+#
+# From a job document, as a step of its own (test_jobs.py runs these):
+#
+#   {"action": {"name": "model", "type": "downloadArtifact",
+#               "input": {"url": "https://.../behavior-v3.bin",
+#                         "sha256": "9f86d08...", "output": "/home/pi/models/behavior.bin"}}}
+#
+# or through runHandler:
+#
+#   python artifacts.py fetch https://.../behavior-v3.bin --sha256 9f86d08... --output /home/pi/models/
+#   python artifacts.py list
+#   python artifacts.py evict --max-bytes 0
+#
+# Settings (.env): ARTIFACT_CACHE_DIR, ARTIFACT_CACHE_BYTES, ARTIFACT_CHUNK_SIZE,
+#                  ARTIFACT_DOWNLOAD_THREADS, ARTIFACT_TIMEOUT
+
+import argparse
+import collections
+import fcntl
+import hashlib
+import http.client
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/gateway-artifacts')
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_THREADS = 4
+DEFAULT_TIMEOUT = 30
+READ_SIZE = 64 * 1024
+# Tries in a row without getting any further before a chunk gives up (and
+# the download keeps what it has)
+CHUNK_ATTEMPTS = 3
+# Bytes of a chunk written between notes in the journal
+JOURNAL_EVERY = 256 * 1024
+RETRY_DELAY = 1
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json(path, value):
+    # Replaced in one go, so a crash leaves the old version or the new one
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f)
+    os.replace(path + '.tmp', path)
+
+
+class ArtifactCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES, chunk_size=DEFAULT_CHUNK_SIZE,
+                 threads=DEFAULT_THREADS, timeout=DEFAULT_TIMEOUT):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.timeout = timeout
+        self._objects = os.path.join(directory, 'sha256')
+        self._partial = os.path.join(directory, 'partial')
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._partial, exist_ok=True)
+        self.counts = collections.Counter()
+        self._counts_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(directory=os.getenv('ARTIFACT_CACHE_DIR', DEFAULT_CACHE_DIR),
+                   max_bytes=int(os.getenv('ARTIFACT_CACHE_BYTES', DEFAULT_CACHE_BYTES)),
+                   chunk_size=int(os.getenv('ARTIFACT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)),
+                   threads=int(os.getenv('ARTIFACT_DOWNLOAD_THREADS', DEFAULT_THREADS)),
+                   timeout=float(os.getenv('ARTIFACT_TIMEOUT', DEFAULT_TIMEOUT)))
+
+    def _count(self, name, amount=1):
+        with self._counts_lock:
+            self.counts[name] += amount
+
+    def path(self, sha256):
+        return os.path.join(self._objects, sha256[:2], sha256)
+
+    def get(self, sha256):
+        # The cached file's path, None if it isn't cached
+        path = self.path(sha256.lower())
+        try:
+            # Its modification time is when it was last used, for evict()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fetch(self, url, sha256=None, output=None):
+        # Returns the path of the file in the cache, after copying it to
+        # `output` (a file, or a directory to put it in by the URL's file
+        # name) if given. Without sha256 the file is always downloaded and
+        # nothing is verified.
+        if sha256 is not None:
+            sha256 = sha256.lower()
+            if not SHA256.match(sha256):
+                raise ArtifactError('Not a SHA-256: {!r}'.format(sha256))
+        path = self.get(sha256) if sha256 else None
+        if path is not None:
+            self._count('hits')
+        else:
+            name = sha256 or hashlib.sha256(url.encode()).hexdigest()
+            with open(os.path.join(self._partial, name + '.lock'), 'w') as lock:
+                # Whoever got here first downloads it, the others wait and
+                # then find it cached
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                path = self.get(sha256) if sha256 else None
+                if path is not None:
+                    self._count('hits')
+                else:
+                    self._count('misses')
+                    path = self._download(url, sha256, name)
+            self.evict(keep=path)
+        if output:
+            self.install(path, output, url)
+        return path
+
+    def install(self, path, output, url=''):
+        if os.path.isdir(output):
+            output = os.path.join(output, os.path.basename(urllib.parse.urlparse(url).path) or os.path.basename(path))
+        # Copied, so changing the installed file can't change the cache
+        shutil.copyfile(path, output + '.tmp')
+        os.replace(output + '.tmp', output)
+        return output
+
+    def _download(self, url, sha256, name):
+        part = os.path.join(self._partial, name + '.part')
+        journal_path = os.path.join(self._partial, name + '.json')
+        size, ranges, etag = self._probe(url)
+        started = time.monotonic()
+        if size is None or not ranges:
+            self._download_whole(url, part)
+        else:
+            self._download_chunks(url, part, journal_path, size, etag)
+        digest = file_sha256(part)
+        if sha256 is not None and digest != sha256:
+            os.remove(part)
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+            self._count('corrupt')
+            raise ArtifactError('{} has SHA-256 {}, expected {}'.format(url, digest, sha256))
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(part, path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        print("Downloaded {} ({} bytes) in {:.1f}s".format(url, os.path.getsize(path), time.monotonic() - started))
+        return path
+
+    def _probe(self, url):
+        # (size, whether Range requests work, ETag) from a HEAD request
+        request = urllib.request.Request(url, method='HEAD')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                headers = response.headers
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            raise ArtifactError('Cannot reach {}: {}'.format(url, e))
+        size = headers.get('Content-Length')
+        ranges = headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return (int(size) if size is not None else None), ranges, headers.get('ETag')
+
+    def _download_whole(self, url, part):
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response, open(part, 'wb') as f:
+                for block in iter(lambda: response.read(READ_SIZE), b''):
+                    f.write(block)
+                    self._count('bytes_downloaded', len(block))
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            raise ArtifactError('Download of {} failed: {}'.format(url, e))
+
+    def _download_chunks(self, url, part, journal_path, size, etag):
+        chunks = [(str(index), start, min(start + self.chunk_size, size) - 1)
+                  for index, start in enumerate(range(0, size, self.chunk_size))]
+        # written: chunk index -> bytes of it on the card, from its start
+        journal = {'url': url, 'size': size, 'etag': etag, 'chunk_size': self.chunk_size, 'written': {}}
+        try:
+            with open(journal_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        if saved is not None and all(saved.get(key) == journal[key] for key in ('size', 'etag', 'chunk_size')) \
+                and 'written' in saved and os.path.exists(part):
+            journal['written'] = saved['written']
+        else:
+            # A different file or nothing to carry on from
+            with open(part, 'wb') as f:
+                f.truncate(size)
+        written = journal['written']
+        for index, _, _ in chunks:
+            written.setdefault(index, 0)
+        todo = [chunk for chunk in chunks if chunk[1] + written[chunk[0]] <= chunk[2]]
+        resumed = sum(written.values())
+        if resumed:
+            self._count('bytes_resumed', resumed)
+            print("Resuming {}: {} of {} bytes already here".format(url, resumed, size))
+        journal_lock = threading.Lock()
+        failed = threading.Event()
+
+        def note(index, nbytes):
+            with journal_lock:
+                written[index] += nbytes
+                _write_json(journal_path, journal)
+
+        def fetch_chunk(chunk):
+            index, start, end = chunk
+            attempts = 0
+            while start + written[index] <= end:
+                if failed.is_set():
+                    return
+                before = written[index]
+                try:
+                    self._fetch_range(url, part, start + before, end, lambda nbytes: note(index, nbytes))
+                except (urllib.error.URLError, http.client.HTTPException, OSError, ArtifactError) as e:
+                    # Only tries that got nowhere count against it
+                    attempts = 0 if written[index] > before else attempts + 1
+                    if attempts == CHUNK_ATTEMPTS:
+                        failed.set()
+                        raise ArtifactError('Download of {} failed at byte {}: {}'.format(
+                            url, start + written[index], e))
+                    time.sleep(RETRY_DELAY * attempts)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.threads), thread_name_prefix='artifact') as pool:
+            futures = [pool.submit(fetch_chunk, chunk) for chunk in todo]
+            wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                raise ArtifactError('{} ({} of {} bytes kept for next time)'.format(
+                    future.exception(), sum(written.values()), size))
+
+    def _fetch_range(self, url, part, start, end, on_written):
+        # on_written(nbytes) is called once nbytes more are on the card, also
+        # when the connection breaks partway
+        request = urllib.request.Request(url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response, open(part, 'r+b') as f:
+            if response.status != 206:
+                raise ArtifactError('Server ignored the Range request')
+            f.seek(start)
+            remaining = end - start + 1
+            unsynced = 0
+            try:
+                while remaining:
+                    block = response.read(min(READ_SIZE, remaining))
+                    if not block:
+                        raise ArtifactError('Connection closed {} bytes short'.format(remaining))
+                    f.write(block)
+                    remaining -= len(block)
+                    unsynced += len(block)
+                    self._count('bytes_downloaded', len(block))
+                    if unsynced >= JOURNAL_EVERY:
+                        self._sync(f)
+                        on_written(unsynced)
+                        unsynced = 0
+            finally:
+                if unsynced:
+                    # On the card before the journal says it is
+                    self._sync(f)
+                    on_written(unsynced)
+
+    @staticmethod
+    def _sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def entries(self):
+        # [(path, size, last used)], least recently used first
+        entries = []
+        for directory, _, names in os.walk(self._objects):
+            for name in names:
+                path = os.path.join(directory, name)
+                status = os.stat(path)
+                entries.append((path, status.st_size, status.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, max_bytes=None, keep=None):
+        # Removes least recently used files until the cache fits. Returns the
+        # bytes freed.
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            freed += size
+            self._count('evicted')
+        return freed
+
+    def stats(self):
+        stats = dict(self.counts)
+        entries = self.entries()
+        stats['files'] = len(entries)
+        stats['bytes'] = sum(size for _, size, _ in entries)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch files through the gateway's artifact cache.")
+    commands = parser.add_subparsers(dest='command')
+    fetch = commands.add_parser('fetch', help='download a file, or take it from the cache')
+    fetch.add_argument('url')
+    fetch.add_argument('--sha256', help='expected SHA-256, also what the cache looks it up by')
+    fetch.add_argument('--output', help='copy it to this file or directory')
+    commands.add_parser('list', help='list the cached files')
+    evict = commands.add_parser('evict', help='shrink the cache')
+    evict.add_argument('--max-bytes', type=int, help='default ARTIFACT_CACHE_BYTES')
+    args = parser.parse_args()
+
+    cache = ArtifactCache.from_env()
+    if args.command == 'fetch':
+        try:
+            path = cache.fetch(args.url, args.sha256, args.output)
+        except ArtifactError as e:
+            print(e)
+            raise SystemExit(1)
+        print("{} {}".format(path, cache.stats()))
+    elif args.command == 'list':
+        for path, size, used in cache.entries():
+            print("{}  {:>12}  {}".format(os.path.basename(path), size,
+                                          time.strftime('%Y-%m-%d %H:%M', time.localtime(used))))
+    elif args.command == 'evict':
+        print("Freed {} bytes".format(cache.evict(args.max_bytes)))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+# Behaviour labels (lying, standing, walking, ruminating) worked out on the
+# gateway from each collar's accelerometer samples.
+#
+#   behavior = BehaviorClassifier.from_env(windows=animal_state.namespace('behavior'))
+#   behavior.add(8, '1.16 -1.91 0.2')       # as it comes out of the packet
+#   ...
+#   behavior.classify()                     # -> [{'Device_ID': 8, 'Label': 'walking', 'Confidence': 0.9}]
+#
+# Samples are kept in a sliding window per animal (BEHAVIOR_WINDOW samples).
+# Every time BEHAVIOR_HOP new samples have arrived the window is due, and
+# classify() handles all due windows in one go: the windows are stacked into
+# one array and the features and labels computed for all of them at once,
+# which keeps the per-animal cost to a few array operations.
+#
+# An Acceleration field may carry one x y z sample or a burst of several
+# (x1 y1 z1 x2 y2 z2 ...). Features per window:
+#   mean_magnitude  average |a|, ~1 g when still
+#   magnitude_var   variance of |a|, how much the animal moves
+#   odba            overall dynamic body acceleration
+#   dominant_hz     strongest frequency in |a|, assuming samples are
+#                   ACCEL_SAMPLE_HZ apart (e.g. within collar bursts)
+#   pitch, roll     posture of the collar from the mean gravity vector
+#
+# The classifier is a nearest centroid on standardized features, so the
+# whole model is a few numbers in a JSON file (BEHAVIOR_MODEL). The built in
+# DEFAULT_MODEL is a rough starting point, train one from labelled data
+# from the herd with
+#
+#   python behavior.py --train labelled.csv --model behavior_model.json
+#
+# where labelled.csv has label,x,y,z rows in the order they were sampled.
+#
+# Settings (.env): BEHAVIOR_WINDOW, BEHAVIOR_HOP, ACCEL_SAMPLE_HZ, BEHAVIOR_MODEL
+
+import argparse
+import csv
+import json
+import os
+import threading
+
+import numpy as np
+
+DEFAULT_WINDOW = 32
+DEFAULT_SAMPLE_HZ = 10.0
+# g, standard deviation of |a| an animal at rest doesn't reach
+MIN_MOTION = 0.02
+
+FEATURES = ['mean_magnitude', 'magnitude_var', 'odba', 'dominant_hz', 'pitch', 'roll']
+DEFAULT_MODEL = {
+    'features': FEATURES,
+    'labels': ['lying', 'standing', 'walking', 'ruminating'],
+    # Features are divided by these before measuring distances
+    'scale': [0.05, 0.01, 0.05, 0.5, 20.0, 20.0],
+    'centroids': [
+        [1.0, 0.002, 0.03, 0.0, 40.0, 60.0],
+        [1.0, 0.003, 0.04, 0.0, 0.0, 0.0],
+        [1.05, 0.05, 0.25, 1.0, -10.0, 0.0],
+        [1.0, 0.008, 0.08, 1.2, 10.0, 0.0],
+    ],
+}
+
+
+def acceleration_samples(value):
+    # '1.16 -1.91 0.2' or {'x': 1.16, 'y': -1.91, 'z': 0.2} -> array of shape (n, 3)
+    if isinstance(value, dict):
+        return np.array([[value['x'], value['y'], value['z']]], dtype=float)
+    values = np.array(value.split(), dtype=float)
+    return values[:len(values) // 3 * 3].reshape(-1, 3)
+
+
+def extract_features(windows, sample_hz):
+    # windows: (animals, samples, 3) -> (animals, len(FEATURES))
+    magnitude = np.linalg.norm(windows, axis=2)
+    gravity = windows.mean(axis=1)
+    dynamic = windows - gravity[:, np.newaxis, :]
+    spectrum = np.abs(np.fft.rfft(magnitude - magnitude.mean(axis=1, keepdims=True), axis=1))
+    # Bin 0 is the mean, which was just removed
+    peak = spectrum[:, 1:].argmax(axis=1) + 1
+    # Below MIN_MOTION the peak is just sensor noise, report 0 Hz instead
+    # so still animals look alike
+    dominant_hz = np.where(magnitude.std(axis=1) > MIN_MOTION, peak * sample_hz / windows.shape[1], 0.0)
+    pitch = np.degrees(np.arctan2(gravity[:, 0], np.hypot(gravity[:, 1], gravity[:, 2])))
+    roll = np.degrees(np.arctan2(gravity[:, 1], gravity[:, 2]))
+    return np.column_stack([
+        magnitude.mean(axis=1),
+        magnitude.var(axis=1),
+        np.abs(dynamic).sum(axis=2).mean(axis=1),
+        dominant_hz,
+        pitch,
+        roll,
+    ])
+
+
+class NearestCentroid:
+    def __init__(self, labels, centroids, scale):
+        self.labels = list(labels)
+        self.scale = np.asarray(scale, dtype=float)
+        self.centroids = np.asarray(centroids, dtype=float) / self.scale
+
+    @classmethod
+    def load(cls, path=None):
+        model = DEFAULT_MODEL
+        if path:
+            with open(path) as f:
+                model = json.load(f)
+        if model['features'] != FEATURES:
+            raise ValueError('Model {} was trained on features {}'.format(path, model['features']))
+        return cls(model['labels'], model['centroids'], model['scale'])
+
+    def predict(self, features):
+        # (n, features) -> label indices and a 0..1 confidence for each
+        scaled = features / self.scale
+        distances = ((scaled[:, np.newaxis, :] - self.centroids[np.newaxis, :, :]) ** 2).sum(axis=2)
+        # Softmax over negative distances
+        weights = np.exp(-(distances - distances.min(axis=1, keepdims=True)))
+        confidence = weights.max(axis=1) / weights.sum(axis=1)
+        return distances.argmin(axis=1), confidence
+
+
+def train(rows, window, hop, sample_hz):
+    # rows: (label, x, y, z) in sampling order. Every run of one label is cut
+    # into windows the same way the gateway does it.
+    runs = []
+    for label, x, y, z in rows:
+        if not runs or runs[-1][0] != label:
+            runs.append((label, []))
+        runs[-1][1].append((x, y, z))
+    windows = {}
+    for label, samples in runs:
+        samples = np.array(samples, dtype=float)
+        for start in range(0, len(samples) - window + 1, hop):
+            windows.setdefault(label, []).append(samples[start:start + window])
+    if not windows:
+        raise ValueError('Not enough samples for a single window of {}'.format(window))
+    labels = sorted(windows)
+    features = {label: extract_features(np.array(windows[label]), sample_hz) for label in labels}
+    everything = np.concatenate(list(features.values()))
+    scale = everything.std(axis=0)
+    scale[scale == 0] = 1.0
+    return {
+        'features': FEATURES,
+        'labels': labels,
+        'scale': scale.round(6).tolist(),
+        'centroids': [features[label].mean(axis=0).round(6).tolist() for label in labels],
+        'windows': {label: len(windows[label]) for label in labels},
+    }
+
+
+class _Window:
+    # Ring buffer of the last `size` samples of one animal
+    __slots__ = ('samples', 'filled', 'position', 'since_classified', 'label')
+
+    def __init__(self, size):
+        self.samples = np.zeros((size, 3))
+        self.filled = 0
+        self.position = 0
+        self.since_classified = 0
+        # Last label given to this animal
+        self.label = None
+
+    def add(self, samples):
+        size = len(self.samples)
+        for start in range(0, len(samples), size):
+            chunk = samples[start:start + size]
+            end = self.position + len(chunk)
+            if end <= size:
+                self.samples[self.position:end] = chunk
+            else:
+                split = size - self.position
+                self.samples[self.position:] = chunk[:split]
+                self.samples[:end - size] = chunk[split:]
+            self.position = end % size
+        self.filled = min(size, self.filled + len(samples))
+        self.since_classified += len(samples)
+
+    def __sizeof__(self):
+        # Counted by AnimalStateStore's byte limit
+        return object.__sizeof__(self) + self.samples.nbytes
+
+    def ordered(self):
+        return np.roll(self.samples, -self.position, axis=0)
+
+
+class BehaviorClassifier:
+    def __init__(self, model, window=DEFAULT_WINDOW, hop=None, sample_hz=DEFAULT_SAMPLE_HZ, windows=None):
+        self.model = model
+        self.window = window
+        self.hop = hop or max(1, window // 2)
+        self.sample_hz = sample_hz
+        # Device_ID -> _Window, normally a namespace of the AnimalStateStore
+        self.windows = {} if windows is None else windows
+        self._due = set()
+        self._lock = threading.Lock()
+        self.classified = 0
+        self.batches = 0
+
+    @classmethod
+    def from_env(cls, windows=None):
+        window = int(os.getenv('BEHAVIOR_WINDOW', DEFAULT_WINDOW))
+        return cls(model=NearestCentroid.load(os.getenv('BEHAVIOR_MODEL')),
+                   window=window,
+                   hop=int(os.getenv('BEHAVIOR_HOP', 0)) or None,
+                   sample_hz=float(os.getenv('ACCEL_SAMPLE_HZ', DEFAULT_SAMPLE_HZ)),
+                   windows=windows)
+
+    def add(self, device_id, acceleration):
+        # acceleration as found in the packet. Returns False if it couldn't
+        # be read.
+        try:
+            samples = acceleration_samples(acceleration)
+        except (ValueError, KeyError):
+            return False
+        with self._lock:
+            window = self.windows.get(device_id)
+            if window is None:
+                window = self.windows[device_id] = _Window(self.window)
+            window.add(samples)
+            if window.filled == self.window and window.since_classified >= self.hop:
+                self._due.add(device_id)
+        return True
+
+    def due(self):
+        with self._lock:
+            return len(self._due)
+
+    def classify(self, changed_only=False):
+        # Labels every window that is due, in one batch. With changed_only,
+        # animals whose label is the same as last time are left out.
+        with self._lock:
+            windows = []
+            stacked = []
+            for device_id in self._due:
+                window = self.windows.get(device_id)
+                if window is None:
+                    # Dropped from the state store meanwhile
+                    continue
+                windows.append((device_id, window))
+                stacked.append(window.ordered())
+                window.since_classified = 0
+            self._due.clear()
+        if not stacked:
+            return []
+        features = extract_features(np.array(stacked), self.sample_hz)
+        labels, confidence = self.model.predict(features)
+        self.classified += len(windows)
+        self.batches += 1
+        results = []
+        for (device_id, window), label, c in zip(windows, labels, confidence):
+            label = self.model.labels[label]
+            if changed_only and label == window.label:
+                continue
+            window.label = label
+            results.append({'Device_ID': device_id, 'Label': label, 'Confidence': round(float(c), 2)})
+        return results
+
+    def stats(self):
+        return {'due': self.due(), 'classified': self.classified, 'batches': self.batches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the behaviour model from labelled accelerometer samples.")
+    parser.add_argument('--train', required=True, help="CSV of label,x,y,z rows in sampling order")
+    parser.add_argument('--model', default='behavior_model.json', help="Where to write the model")
+    parser.add_argument('--window', type=int, default=int(os.getenv('BEHAVIOR_WINDOW', DEFAULT_WINDOW)))
+    parser.add_argument('--hop', type=int, default=int(os.getenv('BEHAVIOR_HOP', 0)) or None)
+    parser.add_argument('--sample-hz', type=float, default=float(os.getenv('ACCEL_SAMPLE_HZ', DEFAULT_SAMPLE_HZ)))
+    args = parser.parse_args()
+
+    with open(args.train, newline='') as f:
+        rows = [(row[0], float(row[1]), float(row[2]), float(row[3]))
+                for row in csv.reader(f) if row and not row[0].startswith('#') and row[0] != 'label']
+    model = train(rows, args.window, args.hop or max(1, args.window // 2), args.sample_hz)
+    with open(args.model, 'w') as f:
+        json.dump(model, f, indent=2)
+    print("Trained on {} windows: {}".format(sum(model['windows'].values()), model['windows']))
+    print("Saved model to {}".format(args.model))
+
+
+if __name__ == '__main__':
+    main()
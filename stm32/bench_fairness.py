@@ -0,0 +1,167 @@
+# What one flooding collar does to everyone else's latency, with and
+# without the per-collar fairness in fair_queue.py.
+#
+# --animals well-behaved collars send a reading every --interval seconds
+# and one collar sends --flood-rate lines a second. The lines go the way
+# publishUARTData.py takes them: a queue between the UART reader and the
+# main loop, then the telemetry lane of a LaneScheduler, which hands them to
+# a publisher allowed --publish-rate messages a second (the uplink quota).
+# Three set-ups are compared:
+#
+#   fifo       plain queues, as before fair_queue.py
+#   drr        per-collar deficit round robin in both queues, no rate limit
+#   drr+guard  the same with FloodGuard in front, as publishUARTData.py runs
+#
+# For the well-behaved collars the table shows the latency from the line
+# being read to its publish and how many of their readings were lost. For
+# drr the worst case should stay within one round of every collar (the
+# bound column) however long the flood goes on.
+#
+# Example:
+#   python bench_fairness.py --animals 50 --flood-rate 2000 --seconds 10
+
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+
+from fair_queue import DEFAULT_QUANTUM, FairQueue, FloodGuard, device_of_line
+from inflight_publisher import percentile
+from priority_lanes import Lane, LaneScheduler
+from rate_limit import TokenBucket
+
+FLOODER = 99
+
+parser = argparse.ArgumentParser(description="Latency of well-behaved collars while one collar floods.")
+parser.add_argument('--animals', type=int, default=50)
+parser.add_argument('--interval', type=float, default=1, help='seconds between readings of a well-behaved collar')
+parser.add_argument('--flood-rate', type=float, default=2000, help='lines/s from the flooding collar')
+parser.add_argument('--publish-rate', type=float, default=100, help='messages/s the uplink allows')
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--quantum', type=int, default=DEFAULT_QUANTUM)
+
+
+class QuotaPublisher:
+    # Takes publishes at the uplink's rate and notes when each one went
+    def __init__(self, rate):
+        self.bucket = TokenBucket(rate, burst=1)
+        self.outbox = None
+        self.drain_gate = None
+        self.published = []
+
+    def publish(self, topic, payload, qos=None, on_done=None, key=None):
+        self.bucket.acquire()
+        self.published.append((key, json.loads(payload)['Read'], time.monotonic()))
+
+
+def run(mode, args):
+    fair = mode != 'fifo'
+    guard = FloodGuard() if mode == 'drr+guard' else None
+    # (line, when it was read)
+    if fair:
+        lines = FairQueue(key=lambda item: device_of_line(item[0]), cost=lambda item: len(item[0]),
+                          quantum=args.quantum)
+    else:
+        lines = queue.Queue()
+    publisher = QuotaPublisher(args.publish_rate)
+    lanes = LaneScheduler(publisher, [Lane('telemetry', max_queue=10000, fair=fair, quantum=args.quantum)])
+    lanes.start()
+    stop = threading.Event()
+    finished = threading.Event()
+    sent = collections.Counter()
+    # Well-behaved readings a full lane dropped, and those still queued at
+    # the end with how long they had waited by then
+    lost = []
+    waiting = []
+
+    def dropped(error, read, device_id):
+        if device_id == FLOODER:
+            return
+        (waiting if finished.is_set() else lost).append(time.monotonic() - read)
+
+    def receive(device_id, seq):
+        line = 'I{:02d} T38.6 N{}\n'.format(device_id, seq).encode()
+        sent[device_id] += 1
+        if guard is None or guard.admit(device_id, len(line)):
+            lines.put((line, time.monotonic()))
+
+    def collars():
+        # The well-behaved collars spread over each interval, the flooder in
+        # between them
+        started = time.monotonic()
+        next_reading = [started + args.interval * i / args.animals for i in range(args.animals)]
+        flood_bucket = TokenBucket(args.flood_rate, burst=1)
+        seq = 0
+        while not stop.is_set():
+            now = time.monotonic()
+            for index, due in enumerate(next_reading):
+                if due <= now:
+                    receive(index + 1, seq)
+                    next_reading[index] += args.interval
+                    seq += 1
+            while flood_bucket.try_acquire():
+                receive(FLOODER, seq)
+                seq += 1
+            time.sleep(0.001)
+
+    def main_loop():
+        while not stop.is_set() or (len(lines) if fair else lines.qsize()):
+            try:
+                line, read = lines.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            device_id = device_of_line(line)
+            lanes.submit('telemetry', 'dairy/north/telemetry', json.dumps({'Device_ID': device_id, 'Read': read}),
+                         on_done=lambda error, read=read, device_id=device_id: dropped(error, read, device_id),
+                         key=device_id)
+
+    threads = [threading.Thread(target=collars, daemon=True), threading.Thread(target=main_loop, daemon=True)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    finished.set()
+    lanes.stop()
+    # What is still queued has waited at least this long
+    latencies = [published - read for key, read, published in publisher.published if key != FLOODER] + waiting
+    good_sent = sum(count for device_id, count in sent.items() if device_id != FLOODER)
+    return {
+        'p50': percentile(latencies, 0.5) if latencies else None,
+        'p99': percentile(latencies, 0.99) if latencies else None,
+        'max': max(latencies) if latencies else None,
+        'lost': len(lost),
+        'queued': len(waiting),
+        'good_sent': good_sent,
+        'flood_sent': sent[FLOODER],
+        'flood_published': sum(1 for key, _, _ in publisher.published if key == FLOODER),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    # One round: every collar's quantum worth of ~40 byte readings
+    per_turn = max(1, args.quantum // 40)
+    bound = (args.animals + 1) * per_turn / args.publish_rate
+    print("{} collars every {}s, one flooding at {}/s, uplink {}/s, {}s each".format(
+        args.animals, args.interval, args.flood_rate, args.publish_rate, args.seconds))
+    print("{:>10}  {:>8}  {:>8}  {:>8}  {:>8}  {:>6}  {:>6}  {:>8}  {:>16}".format(
+        '', 'p50 s', 'p99 s', 'max s', 'bound s', 'lost', 'queued', 'readings', 'flood published'))
+    failed = False
+    for mode in ('fifo', 'drr', 'drr+guard'):
+        result = run(mode, args)
+        print("{:>10}  {:>8.3f}  {:>8.3f}  {:>8.3f}  {:>8}  {:>6}  {:>6}  {:>8}  {:>7} of {:<7}".format(
+            mode, result['p50'], result['p99'], result['max'], '{:.2f}'.format(bound) if mode != 'fifo' else '-',
+            result['lost'], result['queued'], result['good_sent'], result['flood_published'], result['flood_sent']),
+            flush=True)
+        if mode != 'fifo' and (result['max'] > bound + 0.5 or result['lost']):
+            failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
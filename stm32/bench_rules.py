@@ -0,0 +1,157 @@
+# Speed of the edge rules (edge_rules.py) on made-up readings.
+#
+# The same rules are run three ways: the compiled closures one reading at a
+# time (RuleSet.apply, what publishUARTData.py does), the compiled closures
+# over a batch (RuleSet.apply_batch), and for comparison a plain interpreter
+# that walks the parse tree for every reading. Each way has to come to the
+# same decisions. The table shows readings and rule evaluations per second;
+# run it on the Pi for the numbers that matter there.
+#
+# Example:
+#   python bench_rules.py --readings 100000 --rules my_rules.txt
+
+import argparse
+import random
+import time
+
+from edge_rules import ARITHMETIC, COMPARISONS, DEFAULT_DESTINATION, EVALUATION_ERRORS, FUNCTIONS, RuleSet
+
+RULES = '''
+drop when Device_ID in (90, 91, 92)
+sample 0.2 when Temperature < 38 and RSSI < -110
+enrich Fever = Temperature >= 39.5, Heat = Temperature - 38.5
+route alert when Fever and RSSI > -120
+route behavior when abs(Acceleration_x) > 1.5 or abs(Acceleration_y) > 1.5
+route telemetry when Device_ID % 10 != 3
+route 'dairy/research/{Device_ID}' when Device_ID between 200 and 220
+'''
+
+parser = argparse.ArgumentParser(description="Benchmark the edge rules engine.")
+parser.add_argument('--readings', type=int, default=100000)
+parser.add_argument('--animals', type=int, default=300)
+parser.add_argument('--batch', type=int, default=100, help='readings per apply_batch() call')
+parser.add_argument('--rules', help='file with the rules to run, one per line (default: a built-in set)')
+
+
+def make_readings(count, animals):
+    rng = random.Random(1)
+    return [{'Device_ID': rng.randint(1, animals),
+             'RSSI': rng.randint(-125, -60),
+             'Temperature': round(rng.gauss(38.6, 0.6), 1),
+             'Acceleration_x': round(rng.gauss(0, 1), 2),
+             'Acceleration_y': round(rng.gauss(0, 1), 2)} for _ in range(count)]
+
+
+def evaluate(node, fields):
+    # What the closures replace: the tree looked at again for every reading
+    kind = node[0]
+    if kind == 'const':
+        return node[1]
+    if kind == 'field':
+        value = fields
+        for part in node[1].split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+    if kind == 'not':
+        return not evaluate(node[1], fields)
+    if kind == 'and':
+        return bool(evaluate(node[1], fields)) and bool(evaluate(node[2], fields))
+    if kind == 'or':
+        return bool(evaluate(node[1], fields)) or bool(evaluate(node[2], fields))
+    if kind in ('compare', 'arith'):
+        a, b = evaluate(node[2], fields), evaluate(node[3], fields)
+        if a is None or b is None:
+            return False if kind == 'compare' else None
+        return (COMPARISONS if kind == 'compare' else ARITHMETIC)[node[1]](a, b)
+    if kind == 'neg':
+        value = evaluate(node[1], fields)
+        return None if value is None else -value
+    if kind == 'in':
+        return evaluate(node[1], fields) in [evaluate(value, fields) for value in node[2]]
+    if kind == 'between':
+        value, low, high = (evaluate(n, fields) for n in node[1:])
+        return value is not None and low is not None and high is not None and low <= value <= high
+    if kind == 'null':
+        return evaluate(node[1], fields) is None
+    values = [evaluate(arg, fields) for arg in node[2]]
+    return None if None in values else FUNCTIONS[node[1]](*values)
+
+
+class Interpreter:
+    def __init__(self, rules):
+        self.rules = rules
+        self.seen = [{} for _ in rules]
+
+    def apply(self, fields):
+        destinations = []
+        for index, (_, action, argument, condition) in enumerate(self.rules):
+            try:
+                if condition is not None and not evaluate(condition, fields):
+                    continue
+                if action == 'drop':
+                    return []
+                if action == 'sample':
+                    every = max(1, int(round(1 / argument)))
+                    seen = self.seen[index]
+                    seen[fields.get('Device_ID')] = count = seen.get(fields.get('Device_ID'), 0) + 1
+                    if count % every != 1 % every:
+                        return []
+                elif action == 'route':
+                    destinations.append(argument[1].format_map(fields) if argument[0] == 'topic' else argument[1])
+                else:
+                    for name, value in argument:
+                        fields[name] = evaluate(value, fields)
+            except EVALUATION_ERRORS:
+                pass
+        return list(dict.fromkeys(destinations)) or [DEFAULT_DESTINATION]
+
+
+def timed(function, readings):
+    copies = [dict(fields) for fields in readings]
+    started = time.perf_counter()
+    decisions = function(copies)
+    return time.perf_counter() - started, decisions
+
+
+def main():
+    args = parser.parse_args()
+    text = RULES
+    if args.rules:
+        with open(args.rules) as f:
+            text = f.read()
+    rules = RuleSet.parse(text)
+    readings = make_readings(args.readings, args.animals)
+    print("{} rules, {} readings from {} animals".format(len(rules.rules), args.readings, args.animals))
+
+    def per_reading(copies):
+        ruleset = RuleSet.parse(text)
+        return [ruleset.apply(fields).destinations for fields in copies]
+
+    def batched(copies):
+        ruleset = RuleSet.parse(text)
+        decisions = []
+        for start in range(0, len(copies), args.batch):
+            decisions.extend(decision.destinations for decision in ruleset.apply_batch(copies[start:start + args.batch]))
+        return decisions
+
+    def interpreted(copies):
+        interpreter = Interpreter(rules.rules)
+        return [interpreter.apply(fields) for fields in copies]
+
+    results = [(name, timed(function, readings)) for name, function in
+               (('compiled', per_reading), ('compiled, batch', batched), ('tree walk', interpreted))]
+    expected = results[0][1][1]
+    print("{:>16}  {:>8}  {:>12}  {:>14}  {:>8}".format('', 'seconds', 'readings/s', 'rule evals/s', 'speedup'))
+    slowest = max(seconds for _, (seconds, _) in results)
+    for name, (seconds, decisions) in results:
+        print("{:>16}  {:>8.3f}  {:>12,.0f}  {:>14,.0f}  {:>7.2f}x{}".format(
+            name, seconds, args.readings / seconds, args.readings * len(rules.rules) / seconds, slowest / seconds,
+            '' if decisions == expected else '  DIFFERENT DECISIONS'))
+    dropped = sum(1 for destinations in expected if not destinations)
+    print("{} dropped, {} sent as alerts".format(dropped, sum('alert' in d for d in expected)))
+    if any(decisions != expected for _, (_, decisions) in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
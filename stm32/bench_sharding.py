@@ -0,0 +1,141 @@
+# Throughput of ShardedPublisher (sharded_publisher.py) against the local
+# broker stand-in, with the stand-in holding each connection to
+# --publish-rate publishes per second like AWS IoT Core's per-connection
+# limit.
+#
+# For each shard count the same readings from --animals collars are
+# published from one thread, as the lane dispatcher does, and the run ends
+# when the broker has acknowledged all of them. The table shows messages
+# per second and how close that is to N times one connection. A run lasts
+# as long as its busiest shard, and with a few hundred animals the hash
+# can't split them exactly evenly, so the busiest shard's share over the
+# average (imbalance) is shown too: speedup times imbalance is what the
+# connections managed between them. Every run
+# also checks that the broker got each reading, and each animal's readings
+# in the order they were sent.
+#
+# The failover run uses --failover-shards connections and, a third of the
+# way in, drops one of them and turns it away for --outage seconds. Its
+# animals move to the others and what it had in flight is re-sent, so
+# nothing is lost; duplicates and animals whose backlog arrived after
+# newer readings are counted, not treated as failures.
+#
+# Example:
+#   python bench_sharding.py --shards 1,2,4,8 --messages 2000 --publish-rate 100
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+from broker_standin import BrokerStandIn
+from connection_builder import build_connection, mqtt_version
+from outbox import Outbox
+from sharded_publisher import ShardedPublisher
+
+TOPIC = 'dairy/north/telemetry'
+
+parser = argparse.ArgumentParser(description="Benchmark ShardedPublisher against a rate limited local broker.")
+parser.add_argument('--shards', default='1,2,4,8', help='comma separated shard counts')
+parser.add_argument('--messages', type=int, default=2000)
+parser.add_argument('--animals', type=int, default=200)
+parser.add_argument('--publish-rate', type=float, default=100, help='publishes/s the broker allows per connection')
+parser.add_argument('--window', type=int, default=100, help='messages in flight per shard')
+parser.add_argument('--failover-shards', type=int, default=4, help='shards in the failover run, 0 to skip it')
+parser.add_argument('--outage', type=float, default=3, help='seconds the dropped shard is refused')
+
+
+def connect_shards(publisher, broker, name):
+    connections = []
+    for index in range(len(publisher.shards)):
+        connection = build_connection(
+            '{}-{}'.format(name, index), endpoint='127.0.0.1', port=broker.port, tls=False,
+            on_connection_interrupted=lambda connection, error, index=index, **kwargs:
+                publisher.on_connection_interrupted(index),
+            on_connection_resumed=lambda connection, return_code, session_present, index=index, **kwargs:
+                publisher.on_connection_resumed(index))
+        connection.connect().result(10)
+        publisher.shards[index].mqtt_connection = connection
+        publisher.start(index)
+        connections.append(connection)
+    return connections
+
+
+def check(broker, messages):
+    # Per animal, the sequence numbers in the order the broker got them
+    seen = defaultdict(list)
+    for _, _, payload in broker.received:
+        message = json.loads(payload)
+        seen[message['Device_ID']].append(message['Seq'])
+    received = sum(len(seqs) for seqs in seen.values())
+    unique = len(set((device_id, seq) for device_id, seqs in seen.items() for seq in seqs))
+    reordered = 0
+    for seqs in seen.values():
+        first = []
+        for seq in seqs:
+            if seq not in first:
+                first.append(seq)
+        reordered += first != sorted(first)
+    return {'missing': messages - unique, 'duplicates': received - unique, 'reordered_animals': reordered}
+
+
+def run(shards, args, drop=None):
+    # drop: (client ID, after how many messages)
+    broker = BrokerStandIn(publish_rate=args.publish_rate, record=True)
+    broker.start()
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = Outbox(os.path.join(directory, 'outbox.db'))
+        publisher = ShardedPublisher.from_env(outbox=outbox, shards=shards, window=args.window)
+        name = 'bench-{}{}'.format(shards, 'f' if drop else '')
+        connections = connect_shards(publisher, broker, name)
+        started = time.monotonic()
+        for seq in range(args.messages):
+            if drop is not None and seq == drop[1]:
+                broker.drop('{}-{}'.format(name, drop[0]), refuse_for=args.outage)
+            device_id = seq % args.animals + 1
+            publisher.publish(TOPIC, json.dumps({'Device_ID': device_id, 'Seq': seq}), key=device_id)
+        while publisher.in_flight() or outbox.count():
+            time.sleep(0.01)
+        elapsed = time.monotonic() - started
+        stats = publisher.stats()
+        for connection in connections:
+            connection.disconnect().result(10)
+        outbox.close()
+    broker.stop()
+    result = {'shards': shards, 'seconds': round(elapsed, 2), 'per_s': round(args.messages / elapsed, 1)}
+    result.update(check(broker, args.messages))
+    result.update({'rerouted': stats.get('rerouted', 0),
+                   'per_shard_sent': [s['sent'] for s in stats['shards']],
+                   'interruptions': sum(s['interruptions'] for s in stats['shards'])})
+    return result
+
+
+def main():
+    args = parser.parse_args()
+    print("{} messages from {} animals, broker allows {}/s per connection, MQTT {}".format(
+        args.messages, args.animals, args.publish_rate, mqtt_version()))
+    print("{:>6}  {:>7}  {:>8}  {:>8}  {:>10}  {:>9}  {}".format('shards', 'seconds', 'msg/s', 'speedup',
+                                                                 'efficiency', 'imbalance', 'checks'))
+    base = None
+    failed = False
+    for shards in [int(n) for n in args.shards.split(',')]:
+        result = run(shards, args)
+        base = base or result['per_s'] / shards
+        speedup = result['per_s'] / base
+        failed = failed or result['missing'] or result['reordered_animals']
+        imbalance = max(result['per_shard_sent']) * shards / args.messages
+        print("{:>6}  {:>7}  {:>8}  {:>7.2f}x  {:>9.0%}  {:>9.2f}  missing {} duplicates {} reordered {}".format(
+            shards, result['seconds'], result['per_s'], speedup, speedup / shards, imbalance, result['missing'],
+            result['duplicates'], result['reordered_animals']), flush=True)
+    if args.failover_shards:
+        result = run(args.failover_shards, args, drop=(1, args.messages // 3))
+        failed = failed or result['missing']
+        print("\nfailover, {} shards, shard 1 dropped for {}s: {}".format(args.failover_shards, args.outage, result))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,477 @@
+# A local MQTT broker stand-in that counts bytes, to compare the topic
+# routing and publish modes of topic_routing.py / connection_builder.py.
+#
+# It speaks just enough MQTT 3.1.1 and 5 for the awscrt clients the gateway
+# uses, over plain TCP: CONNECT, PUBLISH at QoS 0/1 (with MQTT 5 topic
+# aliases, up to --aliases per connection like AWS IoT Core's 8), SUBSCRIBE,
+# UNSUBSCRIBE, PING and DISCONNECT. Publishes to $aws/rules/<rule>/... are
+# counted as Basic Ingest and not delivered to anyone, as on AWS IoT.
+#
+# Run on its own it publishes the same readings with each configuration
+# below and reports the bytes per reading in each direction, from the
+# gateway's side of the connection:
+#
+#   legacy         MQTT 3.1.1, everything to PUBLISH_TOPIC, which the gateway
+#                  also subscribes to, so every reading comes back down
+#   no-echo        the same without the subscription
+#   per-animal     TOPIC_TEMPLATE=dairy/{barn}/{animal}/{kind}
+#   per-animal-5   the same over MQTT 5 with topic aliases
+#   per-barn-5     TOPIC_TEMPLATE=dairy/{barn}/{kind} over MQTT 5
+#   basic-ingest   per-barn-5 with PUBLISH_MODE=basic_ingest
+#
+# --publish-rate caps the publishes per second each connection may send,
+# as AWS IoT Core does (100/s), by reading no faster than that: the client
+# sees TCP backpressure and its PUBACKs slow down. bench_sharding.py uses it.
+# --latency holds back every packet the broker sends by that many seconds,
+# like a far away endpoint (see endpoint_failover.py).
+#
+# With --serve it just runs the broker and prints each client's counts every
+# few seconds, for pointing publishUARTData.py at it (AWS_ENDPOINT=127.0.0.1,
+# MQTT_TLS=0, MQTT_PORT=<port>).
+#
+# Example:
+#   python broker_standin.py --readings 2000 --animals 50
+#   python broker_standin.py --serve 1883
+
+import argparse
+import json
+import random
+import socket
+import queue
+import struct
+import threading
+import time
+from collections import Counter
+
+from connection_builder import build_connection
+from rate_limit import TokenBucket
+from topic_routing import TopicRouter
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+# MQTT 5 property ids and how long their values are ('s' string, 'b'
+# binary, 'p' string pair, 'v' variable byte integer, or a byte count)
+PROPERTIES = {0x01: 1, 0x02: 4, 0x03: 's', 0x08: 's', 0x09: 'b', 0x0b: 'v', 0x11: 4, 0x17: 1,
+              0x19: 1, 0x21: 2, 0x22: 2, 0x23: 2, 0x26: 'p', 0x27: 4}
+TOPIC_ALIAS = 0x23
+TOPIC_ALIAS_MAXIMUM = 0x22
+
+
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte, value = value % 128, value // 128
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def read_string(data, offset):
+    length = struct.unpack_from('>H', data, offset)[0]
+    return data[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+def read_properties(data, offset):
+    length, offset = read_varint(data, offset)
+    end = offset + length
+    properties = {}
+    while offset < end:
+        key = data[offset]
+        offset += 1
+        kind = PROPERTIES[key]
+        if kind == 'v':
+            value, offset = read_varint(data, offset)
+        elif kind in ('s', 'b'):
+            value, offset = read_string(data, offset)
+        elif kind == 'p':
+            _, offset = read_string(data, offset)
+            value, offset = read_string(data, offset)
+        else:
+            value = int.from_bytes(data[offset:offset + kind], 'big')
+            offset += kind
+        properties[key] = value
+    return properties, end
+
+
+def packet(kind, flags, body):
+    return bytes([kind << 4 | flags]) + encode_varint(len(body)) + body
+
+
+def string(value):
+    return struct.pack('>H', len(value)) + value
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(levels) or (level != '+' and level != levels[i]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+class _Client:
+    def __init__(self, sock, publish_rate=0, latency=0):
+        self.sock = sock
+        self.bucket = TokenBucket(publish_rate, burst=1)
+        self.latency = latency
+        self.client_id = None
+        self.version = 4
+        self.aliases = {}
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.next_packet_id = 0
+        self.counts = Counter()
+
+        if latency:
+            self._outgoing = queue.Queue()
+            threading.Thread(target=self._send_delayed, daemon=True).start()
+
+    def send(self, data):
+        if self.latency:
+            self._outgoing.put((time.monotonic() + self.latency, data))
+            return
+        self._send(data)
+
+    def _send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+            self.counts['bytes_out'] += len(data)
+
+    def _send_delayed(self):
+        # Every reply goes out `latency` seconds late, in order
+        while True:
+            due, data = self._outgoing.get()
+            if data is None:
+                return
+            time.sleep(max(0, due - time.monotonic()))
+            try:
+                self._send(data)
+            except OSError:
+                return
+
+    def close(self):
+        self.sock.close()
+        self.subscriptions.clear()
+        if self.latency:
+            self._outgoing.put((0, None))
+
+
+class BrokerStandIn:
+    def __init__(self, host='127.0.0.1', port=0, topic_alias_maximum=8, publish_rate=0, record=False, latency=0):
+        self.topic_alias_maximum = topic_alias_maximum
+        self.publish_rate = publish_rate
+        self.latency = latency
+        # With record, every publish as (client ID, topic, payload)
+        self.received = [] if record else None
+        self._refused = {}  # client ID -> refused until
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen()
+        self.port = self._server.getsockname()[1]
+        self._clients = []
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.retained = {}
+
+    def start(self):
+        threading.Thread(target=self._accept, name='broker', daemon=True).start()
+
+    def stop(self):
+        # Like the broker becoming unreachable: nothing new gets in and the
+        # connected clients are cut off. shutdown() wakes the blocked accept().
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            clients = {}
+            for client in self._clients:
+                clients.setdefault(client.client_id, Counter()).update(client.counts)
+        return {client_id: dict(counts) for client_id, counts in clients.items()}
+
+    def drop(self, client_id, refuse_for=0):
+        # Closes the client's connection as a network fault would, and turns
+        # it away for `refuse_for` seconds when it tries to reconnect
+        self._refused[client_id] = time.monotonic() + refuse_for
+        with self._lock:
+            clients = [c for c in self._clients if c.client_id == client_id]
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def client_counts(self, client_id):
+        with self._lock:
+            total = Counter()
+            for client in self._clients:
+                if client.client_id == client_id:
+                    total.update(client.counts)
+            return total
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(sock, self.publish_rate, self.latency)
+            with self._lock:
+                self._clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _read_packet(self, client):
+        def read(n):
+            data = b''
+            while len(data) < n:
+                chunk = client.sock.recv(n - len(data))
+                if not chunk:
+                    raise ConnectionError
+                data += chunk
+            return data
+        header = read(1)[0]
+        length = shift = 0
+        raw = 1
+        while True:
+            byte = read(1)[0]
+            raw += 1
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = read(length)
+        client.counts['bytes_in'] += raw + length
+        return header >> 4, header & 0x0f, body
+
+    def _serve(self, client):
+        try:
+            while True:
+                kind, flags, body = self._read_packet(client)
+                if kind == CONNECT:
+                    self._on_connect(client, body)
+                elif kind == PUBLISH:
+                    self._on_publish(client, flags, body)
+                elif kind == SUBSCRIBE:
+                    self._on_subscribe(client, body)
+                elif kind == UNSUBSCRIBE:
+                    self._on_unsubscribe(client, body)
+                elif kind == PINGREQ:
+                    client.send(packet(PINGRESP, 0, b''))
+                elif kind == DISCONNECT:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            client.close()
+
+    def _on_connect(self, client, body):
+        _, offset = read_string(body, 0)
+        client.version = body[offset]
+        offset += 4  # level, flags, keep alive
+        if client.version == 5:
+            _, offset = read_properties(body, offset)
+        client_id, _ = read_string(body, offset)
+        client.client_id = client_id.decode()
+        if time.monotonic() < self._refused.get(client.client_id, 0):
+            raise ConnectionError
+        if client.version == 5:
+            properties = bytes([TOPIC_ALIAS_MAXIMUM]) + struct.pack('>H', self.topic_alias_maximum)
+            client.send(packet(CONNACK, 0, b'\x00\x00' + encode_varint(len(properties)) + properties))
+        else:
+            client.send(packet(CONNACK, 0, b'\x00\x00'))
+
+    def _on_publish(self, client, flags, body):
+        client.bucket.acquire()
+        qos = (flags >> 1) & 3
+        topic, offset = read_string(body, 0)
+        packet_id = None
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+        if client.version == 5:
+            properties, offset = read_properties(body, offset)
+            alias = properties.get(TOPIC_ALIAS)
+            if alias is not None:
+                if topic:
+                    client.aliases[alias] = topic
+                else:
+                    topic = client.aliases[alias]
+                    client.counts['aliased'] += 1
+        payload = body[offset:]
+        topic = topic.decode()
+        client.counts['publishes'] += 1
+        if self.received is not None:
+            with self._lock:
+                self.received.append((client.client_id, topic, payload))
+        if qos:
+            client.send(packet(PUBACK, 0, packet_id))
+        if topic.startswith('$aws/rules/'):
+            self.counts['basic_ingest'] += 1
+            return
+        if flags & 1:
+            self.retained[topic] = payload
+        with self._lock:
+            subscribers = [c for c in self._clients if any(topic_matches(f, topic) for f in c.subscriptions)]
+        for subscriber in subscribers:
+            try:
+                self._deliver(subscriber, topic, payload)
+            except OSError:
+                # Went away meanwhile
+                pass
+
+    def _deliver(self, client, topic, payload):
+        client.next_packet_id = client.next_packet_id % 0xffff + 1
+        body = string(topic.encode()) + struct.pack('>H', client.next_packet_id)
+        if client.version == 5:
+            body += b'\x00'
+        client.send(packet(PUBLISH, 0x02, body + payload))
+        client.counts['delivered'] += 1
+        self.counts['delivered'] += 1
+
+    def _on_subscribe(self, client, body):
+        packet_id = body[:2]
+        offset = 2
+        if client.version == 5:
+            _, offset = read_properties(body, offset)
+        granted = bytearray()
+        while offset < len(body):
+            topic_filter, offset = read_string(body, offset)
+            granted.append(min(body[offset] & 3, 1))
+            offset += 1
+            client.subscriptions.add(topic_filter.decode())
+        properties = b'\x00' if client.version == 5 else b''
+        client.send(packet(SUBACK, 0, packet_id + properties + bytes(granted)))
+
+    def _on_unsubscribe(self, client, body):
+        packet_id = body[:2]
+        offset = 2
+        if client.version == 5:
+            _, offset = read_properties(body, offset)
+        count = 0
+        while offset < len(body):
+            topic_filter, offset = read_string(body, offset)
+            client.subscriptions.discard(topic_filter.decode())
+            count += 1
+        extra = b'\x00' + b'\x00' * count if client.version == 5 else b''
+        client.send(packet(UNSUBACK, 0, packet_id + extra))
+
+
+CONFIGURATIONS = [
+    # name, MQTT version, settings, subscribe to the publish topic
+    ('legacy', 3, {}, True),
+    ('no-echo', 3, {}, False),
+    ('per-animal', 3, {'TOPIC_TEMPLATE': 'dairy/{barn}/{animal}/{kind}'}, False),
+    ('per-animal-5', 5, {'TOPIC_TEMPLATE': 'dairy/{barn}/{animal}/{kind}'}, False),
+    ('per-barn-5', 5, {'TOPIC_TEMPLATE': 'dairy/{barn}/{kind}'}, False),
+    ('basic-ingest', 5, {'TOPIC_TEMPLATE': 'dairy/{barn}/{kind}', 'PUBLISH_MODE': 'basic_ingest',
+                         'INGEST_RULE': 'dairy_telemetry'}, False),
+]
+
+
+def run(broker, name, version, settings, echo, readings):
+    settings = dict({'BARN_ID': 'north'}, **settings)
+    router = TopicRouter(lambda key, default=None: settings.get(key, default))
+    client_id = 'standin-{}'.format(name)
+    connection = build_connection(client_id, endpoint='127.0.0.1', port=broker.port, tls=False, version=version)
+    connection.connect().result(10)
+    from awscrt import mqtt
+    if echo:
+        connection.subscribe(topic=router.topic('telemetry'), qos=mqtt.QoS.AT_LEAST_ONCE,
+                             callback=lambda **kwargs: None)[0].result(10)
+    before = broker.client_counts(client_id)
+    futures = []
+    started = time.monotonic()
+    for device_id, data in readings:
+        message = {'Device_ID': device_id, 'Data': data}
+        future, _ = connection.publish(topic=router.topic('telemetry', device_id=device_id),
+                                       payload=json.dumps(message), qos=mqtt.QoS.AT_LEAST_ONCE)
+        futures.append(future)
+    for future in futures:
+        future.result(30)
+    elapsed = time.monotonic() - started
+    deadline = time.monotonic() + 5
+    while echo and time.monotonic() < deadline:
+        if broker.client_counts(client_id)['delivered'] - before['delivered'] >= len(readings):
+            break
+        time.sleep(0.05)
+    time.sleep(0.2)
+    after = broker.client_counts(client_id)
+    connection.disconnect().result(10)
+    return {
+        'up_per_reading': round((after['bytes_in'] - before['bytes_in']) / len(readings), 1),
+        'down_per_reading': round((after['bytes_out'] - before['bytes_out']) / len(readings), 1),
+        'aliased': after['aliased'] - before['aliased'],
+        'echoed': after['delivered'] - before['delivered'],
+        'readings_per_s': int(len(readings) / elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare topic routing and publish modes against a local broker.")
+    parser.add_argument('--readings', type=int, default=2000)
+    parser.add_argument('--animals', type=int, default=50)
+    parser.add_argument('--aliases', type=int, default=8, help='topic alias maximum the broker allows')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--serve', type=int, metavar='PORT', help='only run the broker, on this port')
+    parser.add_argument('--publish-rate', type=float, default=0, help='publishes/s allowed per connection, 0 for any')
+    parser.add_argument('--latency', type=float, default=0, help='seconds every reply is held back')
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        broker = BrokerStandIn(port=args.serve, topic_alias_maximum=args.aliases, publish_rate=args.publish_rate,
+                               latency=args.latency)
+        broker.start()
+        print("Listening on 127.0.0.1:{}".format(broker.port), flush=True)
+        try:
+            while True:
+                time.sleep(5)
+                print("{} {}".format(dict(broker.counts), broker.stats()), flush=True)
+        except KeyboardInterrupt:
+            broker.stop()
+        return
+
+    rng = random.Random(args.seed)
+    readings = [(rng.randrange(1, args.animals + 1),
+                 {'Temperature': round(rng.uniform(37.5, 40), 1),
+                  'Acceleration': '{:.2f} {:.2f} {:.2f}'.format(*(rng.uniform(-2, 2) for _ in range(3)))})
+                for _ in range(args.readings)]
+    payload = sum(len(json.dumps({'Device_ID': d, 'Data': data})) for d, data in readings) / len(readings)
+    print("{} readings from {} animals, {:.1f} byte payloads".format(args.readings, args.animals, payload))
+    broker = BrokerStandIn(topic_alias_maximum=args.aliases)
+    broker.start()
+    for name, version, settings, echo in CONFIGURATIONS:
+        print("{:<14} {}".format(name, run(broker, name, version, settings, echo, readings)))
+    print("broker: {}".format(dict(broker.counts)))
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
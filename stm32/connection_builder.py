@@ -0,0 +1,137 @@
+# Builds the MQTT connection publishUARTData.py publishes through.
+#
+# Where the installed awscrt/awsiot have MQTT 5 (awscrt 0.16 and later), the
+# connection is an MQTT 5 client behind the usual awscrt.mqtt.Connection
+# interface (connect, publish, subscribe, disconnect and the
+# interrupted/resumed callbacks), so callers don't change. It uses outbound
+# topic aliases: after the first publish to a topic, further publishes carry
+# a 2 byte alias instead of the topic name. AWS IoT Core allows up to 8
+# aliases per connection, MQTT_TOPIC_ALIASES sets how many are used (least
+# recently used topics give theirs up). With an older awscrt, or
+# MQTT_VERSION=3, the connection is MQTT 3.1.1 as before.
+#
+# MQTT_TLS=0 and MQTT_PORT point the gateway at a plain TCP broker instead,
+# such as broker_standin.py --serve.
+#
+# With more than one endpoint in AWS_ENDPOINTS the connection is a
+# FailoverConnection (endpoint_failover.py), which picks the fastest of
+# them and moves to another when it goes down.
+#
+# awscrt is imported when a connection is built, not when this module is
+# imported, so callers can keep it off their startup path.
+#
+# Settings (.env): AWS_ENDPOINT, AWS_ENDPOINTS, CERT_FILE, PRI_KEY_FILE,
+# ROOT_CA_FILE, MQTT_VERSION, MQTT_TOPIC_ALIASES, MQTT_TLS, MQTT_PORT
+
+import os
+
+from endpoint_failover import FailoverConnection, parse_endpoints
+
+DEFAULT_TOPIC_ALIASES = 8
+KEEP_ALIVE_SECS = 30
+# How long AWS IoT keeps a disconnected client's session, its maximum
+SESSION_EXPIRY_SECS = 3600
+
+
+def mqtt5_available():
+    try:
+        from awscrt import mqtt5  # noqa: F401
+        from awsiot import mqtt5_client_builder  # noqa: F401
+    except ImportError:
+        return False
+    return hasattr(mqtt5.Client, 'new_connection')
+
+
+def mqtt_version():
+    # 5 if MQTT 5 can and may be used, otherwise 3
+    if os.getenv('MQTT_VERSION', '5') == '3' or not mqtt5_available():
+        return 3
+    return 5
+
+
+def build_connection(client_id, on_connection_interrupted=None, on_connection_resumed=None,
+                     endpoint=None, port=None, tls=None, version=None, topic_aliases=None,
+                     client_bootstrap=None, will=None):
+    # An awscrt.mqtt.Connection, not yet connected. endpoint defaults to
+    # AWS_ENDPOINTS or AWS_ENDPOINT; tls=False connects in plain TCP, for a
+    # local broker. will is an awscrt.mqtt.Will.
+    from awscrt import io, mqtt
+
+    port = port or int(os.getenv('MQTT_PORT', 0)) or None
+    if tls is None:
+        tls = os.getenv('MQTT_TLS', '1') != '0'
+    version = version or mqtt_version()
+    if topic_aliases is None:
+        topic_aliases = int(os.getenv('MQTT_TOPIC_ALIASES', DEFAULT_TOPIC_ALIASES))
+    if client_bootstrap is None:
+        event_loop_group = io.EventLoopGroup(1)
+        host_resolver = io.DefaultHostResolver(event_loop_group)
+        client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
+
+    if endpoint is None:
+        endpoints = parse_endpoints(os.getenv('AWS_ENDPOINTS'), port)
+        if len(endpoints) > 1:
+            def build(target, interrupted, resumed):
+                return build_connection(client_id, interrupted, resumed, endpoint=target.host, port=target.port,
+                                        tls=tls, version=version, topic_aliases=topic_aliases,
+                                        client_bootstrap=client_bootstrap, will=will)
+            return FailoverConnection(endpoints, build, client_id, on_connection_interrupted=on_connection_interrupted,
+                                      on_connection_resumed=on_connection_resumed, tls=tls)
+        if endpoints:
+            endpoint, port = endpoints[0]
+    endpoint = endpoint or os.getenv('AWS_ENDPOINT')
+
+    if version == 3:
+        if not tls:
+            client = mqtt.Client(client_bootstrap, None)
+            return mqtt.Connection(client, endpoint, port or 1883, client_id, clean_session=False,
+                                   on_connection_interrupted=on_connection_interrupted,
+                                   on_connection_resumed=on_connection_resumed,
+                                   keep_alive_secs=KEEP_ALIVE_SECS, will=will)
+        from awsiot import mqtt_connection_builder
+        extra = {} if port is None else {'port': port}
+        return mqtt_connection_builder.mtls_from_path(
+            endpoint=endpoint,
+            cert_filepath=os.getenv('CERT_FILE'),
+            pri_key_filepath=os.getenv('PRI_KEY_FILE'),
+            client_bootstrap=client_bootstrap,
+            ca_filepath=os.getenv('ROOT_CA_FILE'),
+            on_connection_interrupted=on_connection_interrupted,
+            on_connection_resumed=on_connection_resumed,
+            client_id=client_id,
+            clean_session=False,
+            keep_alive_secs=KEEP_ALIVE_SECS,
+            will=will,
+            http_proxy_options=None,
+            **extra)
+
+    from awscrt import mqtt5
+    if will is not None:
+        will = mqtt5.PublishPacket(topic=will.topic, payload=will.payload, qos=mqtt5.QoS(will.qos.value),
+                                   retain=will.retain)
+    options = {
+        'connect_options': mqtt5.ConnectPacket(client_id=client_id, keep_alive_interval_sec=KEEP_ALIVE_SECS,
+                                               session_expiry_interval_sec=SESSION_EXPIRY_SECS, will=will),
+        # Like clean_session=False: pick the session up again after a reconnect
+        'session_behavior': mqtt5.ClientSessionBehaviorType.REJOIN_POST_SUCCESS,
+        'topic_aliasing_options': mqtt5.TopicAliasingOptions(
+            outbound_behavior=(mqtt5.OutboundTopicAliasBehaviorType.LRU if topic_aliases
+                               else mqtt5.OutboundTopicAliasBehaviorType.DISABLED),
+            outbound_cache_max_size=topic_aliases or None),
+    }
+    if not tls:
+        client = mqtt5.Client(mqtt5.ClientOptions(host_name=endpoint, port=port or 1883,
+                                                  bootstrap=client_bootstrap, **options))
+    else:
+        from awsiot import mqtt5_client_builder
+        extra = {} if port is None else {'port': port}
+        client = mqtt5_client_builder.mtls_from_path(
+            endpoint=endpoint,
+            cert_filepath=os.getenv('CERT_FILE'),
+            pri_key_filepath=os.getenv('PRI_KEY_FILE'),
+            ca_filepath=os.getenv('ROOT_CA_FILE'),
+            client_bootstrap=client_bootstrap,
+            client_id=client_id,
+            **dict(options, **extra))
+    return client.new_connection(on_connection_interrupted=on_connection_interrupted,
+                                 on_connection_resumed=on_connection_resumed)
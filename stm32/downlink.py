@@ -0,0 +1,240 @@
+# Downlink scheduling: commands from the gateway to the collars.
+#
+# A collar only listens for a short while after each of its uplinks, the
+# receive window, DOWNLINK_RX_DELAY seconds after the uplink for
+# DOWNLINK_RX_WINDOW seconds. Anything sent at another time is lost, and
+# every transmission keeps the gateway's radio off receive and counts
+# against the band's duty-cycle limit (10% per hour at 433 MHz in the EU).
+# So commands are not sent when they are made but queued per collar:
+#
+#   downlink = DownlinkScheduler.from_env()
+#   downlink.start(transmit)                  # transmit(frame bytes)
+#   downlink.queue(8, 'sample_interval', 600)
+#   ...
+#   downlink.on_uplink(8)                     # from the receive loop
+#
+# When a collar with something queued is heard, one frame carrying all of
+# its commands is sent in its receive window. A newer command of the same
+# kind replaces the queued one, so a collar that's been out of range only
+# gets the latest sample interval. The frame is skipped (and the commands
+# kept for the collar's next uplink) if the radio is still busy past the
+# window, or if it would take the airtime of the last DUTY_WINDOW seconds
+# over DUTY_CYCLE.
+#
+# Airtime is worked out with the LoRa time-on-air formula from the radio
+# settings (LORA_SF, LORA_BW, LORA_CR, LORA_PREAMBLE), see lora_airtime().
+#
+# Settings (.env): DOWNLINK_RX_DELAY, DOWNLINK_RX_WINDOW, DOWNLINK_ATTEMPTS,
+# DUTY_CYCLE, DUTY_WINDOW, LORA_SF, LORA_BW, LORA_CR, LORA_PREAMBLE,
+# LORA_HEADER_BYTES
+
+import heapq
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+from inflight_publisher import percentile
+from lora_packet import build_downlink
+
+DEFAULT_RX_DELAY = 1.0
+DEFAULT_RX_WINDOW = 0.5
+DEFAULT_ATTEMPTS = 1
+DEFAULT_DUTY_CYCLE = 0.10
+DEFAULT_DUTY_WINDOW = 3600
+# Match rfm96/radio_rfm9x.py
+DEFAULT_SF = 7
+DEFAULT_BW = 125000
+DEFAULT_CR = 5
+DEFAULT_PREAMBLE = 8
+# The RadioHead header the RFM9x library puts in front of every payload
+DEFAULT_HEADER_BYTES = 4
+
+
+def lora_airtime(payload_bytes, sf=DEFAULT_SF, bw=DEFAULT_BW, cr=DEFAULT_CR, preamble=DEFAULT_PREAMBLE,
+                 explicit_header=True, crc=True):
+    # Seconds on air for one LoRa packet (Semtech AN1200.13). cr is the
+    # coding rate denominator, 5-8 for 4/5-4/8.
+    symbol = (2 ** sf) / bw
+    # Low data rate optimisation is on when a symbol takes over 16 ms
+    low_data_rate = symbol > 0.016
+    numerator = 8 * payload_bytes - 4 * sf + 28 + (16 if crc else 0) - (0 if explicit_header else 20)
+    payload_symbols = 8 + max(math.ceil(numerator / (4 * (sf - (2 if low_data_rate else 0)))) * cr, 0)
+    return (preamble + 4.25) * symbol + payload_symbols * symbol
+
+
+class DutyCycleLedger:
+    # Airtime used over the last `window` seconds
+    def __init__(self, duty_cycle, window):
+        self.budget = duty_cycle * window
+        self.window = window
+        self._sent = deque()  # (time, airtime)
+        self._used = 0.0
+
+    def used(self, now):
+        while self._sent and self._sent[0][0] <= now - self.window:
+            self._used -= self._sent.popleft()[1]
+        return max(0.0, self._used)
+
+    def allows(self, airtime, now):
+        return self.used(now) + airtime <= self.budget
+
+    def add(self, airtime, now):
+        self._sent.append((now, airtime))
+        self._used += airtime
+
+
+class _Command:
+    __slots__ = ('value', 'queued_at', 'attempts_left')
+
+    def __init__(self, value, queued_at, attempts):
+        self.value = value
+        self.queued_at = queued_at
+        self.attempts_left = attempts
+
+
+class DownlinkScheduler:
+    def __init__(self, rx_delay=DEFAULT_RX_DELAY, rx_window=DEFAULT_RX_WINDOW, attempts=DEFAULT_ATTEMPTS,
+                 duty_cycle=DEFAULT_DUTY_CYCLE, duty_window=DEFAULT_DUTY_WINDOW, header_bytes=DEFAULT_HEADER_BYTES,
+                 airtime=lora_airtime):
+        self.rx_delay = rx_delay
+        self.rx_window = rx_window
+        self.attempts = attempts
+        self.header_bytes = header_bytes
+        self.airtime = airtime
+        self.ledger = DutyCycleLedger(duty_cycle, duty_window)
+        self._queues = {}  # device_id -> OrderedDict(kind -> _Command)
+        self._due = []  # heap of (send at, window closes, device_id)
+        self._busy_until = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._stopped = False
+        self._latencies = deque(maxlen=1000)
+        self.counts = Counter()
+        self.tx_seconds = 0.0
+
+    @classmethod
+    def from_env(cls):
+        settings = {
+            'sf': int(os.getenv('LORA_SF', DEFAULT_SF)),
+            'bw': int(os.getenv('LORA_BW', DEFAULT_BW)),
+            'cr': int(os.getenv('LORA_CR', DEFAULT_CR)),
+            'preamble': int(os.getenv('LORA_PREAMBLE', DEFAULT_PREAMBLE)),
+        }
+        return cls(rx_delay=float(os.getenv('DOWNLINK_RX_DELAY', DEFAULT_RX_DELAY)),
+                   rx_window=float(os.getenv('DOWNLINK_RX_WINDOW', DEFAULT_RX_WINDOW)),
+                   attempts=int(os.getenv('DOWNLINK_ATTEMPTS', DEFAULT_ATTEMPTS)),
+                   duty_cycle=float(os.getenv('DUTY_CYCLE', DEFAULT_DUTY_CYCLE)),
+                   duty_window=float(os.getenv('DUTY_WINDOW', DEFAULT_DUTY_WINDOW)),
+                   header_bytes=int(os.getenv('LORA_HEADER_BYTES', DEFAULT_HEADER_BYTES)),
+                   airtime=lambda payload_bytes: lora_airtime(payload_bytes, **settings))
+
+    def queue(self, device_id, kind, value, now=None):
+        # Replaces a queued command of the same kind for this collar
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            commands = self._queues.setdefault(device_id, OrderedDict())
+            if kind in commands:
+                self.counts['superseded'] += 1
+            commands[kind] = _Command(value, now, self.attempts)
+            self.counts['queued'] += 1
+
+    def confirm(self, device_id, kind):
+        # For commands the collar acknowledges, stops further attempts
+        with self._lock:
+            commands = self._queues.get(device_id)
+            if commands is not None and commands.pop(kind, None) is not None:
+                self.counts['confirmed'] += 1
+                if not commands:
+                    del self._queues[device_id]
+
+    def on_uplink(self, device_id, now=None):
+        # Call as soon as an uplink from device_id has been received
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if device_id not in self._queues:
+                return
+            opens = now + self.rx_delay
+            heapq.heappush(self._due, (opens, opens + self.rx_window, device_id))
+            self._wake.notify()
+
+    def queued(self):
+        with self._lock:
+            return sum(len(commands) for commands in self._queues.values())
+
+    def next_due(self):
+        with self._lock:
+            return self._due[0][0] if self._due else None
+
+    def pop_due(self, now=None):
+        # Frames to transmit now, as a list of (device_id, frame bytes).
+        # Marks them as sent, so the caller must send them straight away.
+        now = time.monotonic() if now is None else now
+        frames = []
+        with self._lock:
+            while self._due and self._due[0][0] <= now:
+                opens, closes, device_id = heapq.heappop(self._due)
+                commands = self._queues.get(device_id)
+                if not commands:
+                    continue
+                start = max(now, self._busy_until)
+                if start > closes:
+                    # Still sending to another collar when this one stopped listening
+                    self.counts['missed_window'] += 1
+                    continue
+                frame = build_downlink(device_id, [(kind, c.value) for kind, c in commands.items()]).encode()
+                airtime = self.airtime(len(frame) + self.header_bytes)
+                if not self.ledger.allows(airtime, start):
+                    self.counts['deferred_duty'] += 1
+                    continue
+                self.ledger.add(airtime, start)
+                self._busy_until = start + airtime
+                self.tx_seconds += airtime
+                self.counts['frames'] += 1
+                for kind, command in list(commands.items()):
+                    self._latencies.append(start - command.queued_at)
+                    self.counts['sent'] += 1
+                    command.attempts_left -= 1
+                    if command.attempts_left <= 0:
+                        del commands[kind]
+                if not commands:
+                    del self._queues[device_id]
+                frames.append((device_id, frame))
+        return frames
+
+    def start(self, transmit):
+        # Sends due frames through transmit(frame) on a background thread
+        threading.Thread(target=self._run, args=(transmit,), name='downlink', daemon=True).start()
+
+    def _run(self, transmit):
+        while True:
+            with self._lock:
+                while not self._stopped and (not self._due or self._due[0][0] > time.monotonic()):
+                    self._wake.wait(None if not self._due else self._due[0][0] - time.monotonic())
+                if self._stopped:
+                    return
+            for device_id, frame in self.pop_due():
+                try:
+                    transmit(frame)
+                except Exception as e:
+                    self.counts['transmit_errors'] += 1
+                    print("Downlink to {} failed: {!r}".format(device_id, e))
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wake.notify_all()
+
+    def stats(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = dict(self.counts)
+            stats.update({
+                'queued_now': sum(len(commands) for commands in self._queues.values()),
+                'tx_seconds': round(self.tx_seconds, 3),
+                'duty_used': round(self.ledger.used(now) / self.ledger.window, 6),
+                'latency_p50_s': None if not latencies else round(percentile(latencies, 0.5), 1),
+            })
+        return stats
@@ -0,0 +1,504 @@
+# Rules applied to each reading on the gateway before it is published.
+#
+# Without rules every reading goes to the telemetry topic unchanged. A rule
+# is an action with an optional condition over the reading's fields
+# (Device_ID, RSSI and everything in Data, Acceleration.x for a nested one):
+#
+#   drop when Device_ID in (90, 91, 92)                # calibration collars
+#   sample 0.1 when Temperature < 38                   # 1 in 10 of those
+#   enrich Fever = Temperature >= 39.5, Barn = 'north'
+#   route alert when Fever and RSSI > -120
+#   route telemetry
+#   route 'dairy/research/{Device_ID}' when Device_ID between 200 and 220
+#
+#   drop           the reading is not published at all
+#   sample F       keeps every (1/F)th matching reading of each collar and
+#                  drops the rest
+#   enrich A = e   adds fields to the reading, later rules can use them
+#   route D        publishes the reading to D: a message kind from
+#                  topic_routing.py (telemetry, alert, ...) or a quoted
+#                  topic, which can use the reading's fields as {Field}
+#
+# Rules run in order and a drop (or a sample that drops) ends it. A reading
+# that no route matched goes to telemetry, as without rules.
+#
+# Conditions have and/or/not, = != < <= > >=, in (...), between x and y,
+# is [not] null, + - * / %, parentheses, 'strings', true/false/null and
+# abs() min() max() round() hour(). A field the reading doesn't have is
+# null, and comparing null or doing arithmetic with it is never true.
+#
+# Each rule is parsed once into nested Python closures, so a reading costs
+# a few function calls per rule rather than a walk over the parse tree.
+#
+#   rules = RuleSet.parse("drop when Device_ID = 90; route alert when Temperature >= 39.5")
+#   decision = rules.apply({'Device_ID': 8, 'Temperature': 39.7})
+#   decision.destinations    # ['alert'], [] if dropped
+#
+# The rules come from EDGE_RULES in .env (rules separated by ';'), which a
+# job or the Device Shadow can set, or from the file EDGE_RULES_FILE, one
+# rule per line and # comments.
+#
+# Settings (.env): EDGE_RULES, EDGE_RULES_FILE
+
+import collections
+import operator
+import os
+import re
+import time
+
+from topic_routing import KINDS
+
+DEFAULT_DESTINATION = 'telemetry'
+
+Decision = collections.namedtuple('Decision', 'destinations fields')
+
+TOKEN = re.compile(r'''
+    (?P<space>[ \t\r]+|\#[^\n]*)
+  | (?P<separator>[;\n])
+  | (?P<number>\d+\.\d*|\.\d+|\d+)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)
+  | (?P<operator><=|>=|!=|<>|[=<>+\-*/%(),])
+''', re.VERBOSE)
+KEYWORDS = {'and', 'or', 'not', 'in', 'between', 'is', 'null', 'true', 'false', 'when',
+            'drop', 'route', 'sample', 'enrich'}
+COMPARISONS = {'=': operator.eq, '!=': operator.ne, '<>': operator.ne, '<': operator.lt, '<=': operator.le,
+               '>': operator.gt, '>=': operator.ge}
+ARITHMETIC = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv,
+              '%': operator.mod}
+FUNCTIONS = {'abs': abs, 'min': min, 'max': max, 'round': round,
+             'hour': lambda: time.localtime().tm_hour}
+# Not folded into a constant when their arguments are
+VOLATILE_FUNCTIONS = {'hour'}
+# Raised by a condition that compares a string with a number and the like,
+# or a topic naming a field the reading doesn't have. The rule then doesn't
+# apply to that reading.
+EVALUATION_ERRORS = (TypeError, ValueError, ZeroDivisionError, OverflowError, KeyError)
+
+
+class RuleError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise RuleError('Unexpected {!r} at {}'.format(text[position], position))
+        kind = match.lastgroup
+        value = match.group()
+        position = match.end()
+        if kind == 'space':
+            continue
+        if kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'string':
+            value = value[1:-1].replace('\\' + value[0], value[0])
+        elif kind == 'name' and value.lower() in KEYWORDS:
+            kind, value = 'keyword', value.lower()
+        tokens.append((kind, value, match.start()))
+    tokens.append(('end', None, len(text)))
+    return tokens
+
+
+class _Parser:
+    # Recursive descent over the tokens, producing tuples:
+    # ('const', v) ('field', name) ('not', a) ('and', a, b) ('or', a, b)
+    # ('compare', op, a, b) ('arith', op, a, b) ('neg', a) ('in', a, values)
+    # ('between', a, low, high) ('null', a) ('call', name, args)
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.index = 0
+
+    def peek(self, kind=None, value=None):
+        token_kind, token_value, _ = self.tokens[self.index]
+        return (kind is None or token_kind == kind) and (value is None or token_value == value)
+
+    def take(self, kind=None, value=None):
+        if not self.peek(kind, value):
+            token_kind, token_value, position = self.tokens[self.index]
+            raise RuleError('Expected {} at {}, found {!r}'.format(
+                value or kind, position, token_value if token_value is not None else 'the end'))
+        token = self.tokens[self.index]
+        self.index += 1
+        return token[1]
+
+    def accept(self, kind=None, value=None):
+        if self.peek(kind, value):
+            return self.take(kind, value)
+        return None
+
+    def rules(self):
+        # [(rule text, action, argument, condition)]
+        rules = []
+        while not self.peek('end'):
+            if self.accept('separator'):
+                continue
+            start = self.tokens[self.index][2]
+            rule = self.rule()
+            rules.append((self.text[start:self.tokens[self.index][2]].strip(),) + rule)
+            if not self.peek('end'):
+                self.take('separator')
+        return rules
+
+    def rule(self):
+        action = self.take('keyword')
+        if action == 'drop':
+            argument = None
+        elif action == 'route':
+            if self.peek('string'):
+                argument = ('topic', self.take('string'))
+            else:
+                argument = ('kind', self.take('name'))
+                if argument[1] not in KINDS:
+                    raise RuleError('Unknown message kind {!r}, quote a topic'.format(argument[1]))
+        elif action == 'sample':
+            argument = self.take('number')
+            if not 0 < argument <= 1:
+                raise RuleError('sample takes a fraction between 0 and 1, not {}'.format(argument))
+        elif action == 'enrich':
+            argument = [self.assignment()]
+            while self.accept('operator', ','):
+                argument.append(self.assignment())
+        else:
+            raise RuleError('Unknown action {!r}'.format(action))
+        condition = self.expression() if self.accept('keyword', 'when') else None
+        return action, argument, condition
+
+    def assignment(self):
+        name = self.take('name')
+        self.take('operator', '=')
+        return name, self.expression()
+
+    def expression(self):
+        node = self.conjunction()
+        while self.accept('keyword', 'or'):
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.accept('keyword', 'and'):
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self):
+        if self.accept('keyword', 'not'):
+            return ('not', self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        node = self.additive()
+        if self.peek('operator') and self.tokens[self.index][1] in COMPARISONS:
+            return ('compare', self.take(), node, self.additive())
+        negate = self.accept('keyword', 'not')
+        if self.accept('keyword', 'in'):
+            self.take('operator', '(')
+            values = [self.additive()]
+            while self.accept('operator', ','):
+                values.append(self.additive())
+            self.take('operator', ')')
+            node = ('in', node, values)
+        elif self.accept('keyword', 'between'):
+            low = self.additive()
+            self.take('keyword', 'and')
+            node = ('between', node, low, self.additive())
+        elif negate:
+            raise RuleError('Expected in or between after not at {}'.format(self.tokens[self.index][2]))
+        elif self.accept('keyword', 'is'):
+            negate = self.accept('keyword', 'not')
+            self.take('keyword', 'null')
+            node = ('null', node)
+        return ('not', node) if negate else node
+
+    def additive(self):
+        node = self.term()
+        while self.peek('operator') and self.tokens[self.index][1] in '+-':
+            node = ('arith', self.take(), node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek('operator') and self.tokens[self.index][1] in ('*', '/', '%'):
+            node = ('arith', self.take(), node, self.unary())
+        return node
+
+    def unary(self):
+        if self.accept('operator', '-'):
+            return ('neg', self.unary())
+        return self.primary()
+
+    def primary(self):
+        if self.peek('number') or self.peek('string'):
+            return ('const', self.take())
+        if self.accept('operator', '('):
+            node = self.expression()
+            self.take('operator', ')')
+            return node
+        for keyword, value in (('true', True), ('false', False), ('null', None)):
+            if self.accept('keyword', keyword):
+                return ('const', value)
+        name = self.take('name')
+        if self.accept('operator', '('):
+            if name.lower() not in FUNCTIONS:
+                raise RuleError('Unknown function {}()'.format(name))
+            args = []
+            if not self.accept('operator', ')'):
+                args.append(self.expression())
+                while self.accept('operator', ','):
+                    args.append(self.expression())
+                self.take('operator', ')')
+            return ('call', name.lower(), args)
+        return ('field', name)
+
+
+def parse(text):
+    # [(rule text, action, argument, condition tree)]
+    return _Parser(text).rules()
+
+
+def _is_constant(node):
+    kind = node[0]
+    if kind == 'const':
+        return True
+    if kind == 'field' or (kind == 'call' and node[1] in VOLATILE_FUNCTIONS):
+        return False
+    children = [child for child in node[1:] if isinstance(child, tuple)]
+    for child in node[1:]:
+        if isinstance(child, list):
+            children.extend(child)
+    return all(_is_constant(child) for child in children)
+
+
+def _field(name):
+    if '.' not in name:
+        def get(fields):
+            return fields.get(name)
+        return get
+    path = name.split('.')
+
+    def get_nested(fields):
+        value = fields
+        for part in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(part)
+        return value
+    return get_nested
+
+
+def compile_expression(node, fold=True):
+    # A closure fields -> value. Parts without fields are worked out here,
+    # once.
+    kind = node[0]
+    if kind == 'const':
+        constant = node[1]
+        return lambda fields: constant
+    if kind == 'field':
+        return _field(node[1])
+    if fold and _is_constant(node):
+        try:
+            constant = compile_expression(node, fold=False)({})
+        except RuleError:
+            raise
+        except EVALUATION_ERRORS as e:
+            raise RuleError('Cannot work out a constant: {!r}'.format(e))
+        return lambda fields: constant
+    if kind == 'not':
+        operand = compile_expression(node[1])
+        return lambda fields: not operand(fields)
+    if kind == 'and':
+        left, right = compile_expression(node[1]), compile_expression(node[2])
+        return lambda fields: bool(left(fields)) and bool(right(fields))
+    if kind == 'or':
+        left, right = compile_expression(node[1]), compile_expression(node[2])
+        return lambda fields: bool(left(fields)) or bool(right(fields))
+    if kind == 'compare':
+        return _compile_compare(COMPARISONS[node[1]], node[2], node[3])
+    if kind == 'arith':
+        function = ARITHMETIC[node[1]]
+        left, right = compile_expression(node[2]), compile_expression(node[3])
+        if _is_constant(node[3]):
+            constant = right({})
+
+            def arith_constant(fields):
+                value = left(fields)
+                return None if value is None or constant is None else function(value, constant)
+            return arith_constant
+
+        def arith(fields):
+            a, b = left(fields), right(fields)
+            return None if a is None or b is None else function(a, b)
+        return arith
+    if kind == 'neg':
+        operand = compile_expression(node[1])
+
+        def neg(fields):
+            value = operand(fields)
+            return None if value is None else -value
+        return neg
+    if kind == 'in':
+        operand = compile_expression(node[1])
+        if all(_is_constant(value) for value in node[2]):
+            values = frozenset(compile_expression(value)({}) for value in node[2])
+            if node[1][0] == 'field' and '.' not in node[1][1]:
+                name = node[1][1]
+                return lambda fields: fields.get(name) in values
+            return lambda fields: operand(fields) in values
+        values = [compile_expression(value) for value in node[2]]
+        return lambda fields: operand(fields) in [value(fields) for value in values]
+    if kind == 'between':
+        operand, low, high = (compile_expression(n) for n in node[1:])
+        if _is_constant(node[2]) and _is_constant(node[3]):
+            a, b = low({}), high({})
+            if a is None or b is None:
+                return lambda fields: False
+
+            def between_constants(fields):
+                value = operand(fields)
+                return value is not None and a <= value <= b
+            return between_constants
+
+        def between(fields):
+            value, a, b = operand(fields), low(fields), high(fields)
+            return value is not None and a is not None and b is not None and a <= value <= b
+        return between
+    if kind == 'null':
+        operand = compile_expression(node[1])
+        return lambda fields: operand(fields) is None
+    if kind == 'call':
+        function = FUNCTIONS[node[1]]
+        args = [compile_expression(arg) for arg in node[2]]
+        if len(args) == 1:
+            arg = args[0]
+
+            def call_one(fields):
+                value = arg(fields)
+                return None if value is None else function(value)
+            return call_one
+
+        def call(fields):
+            values = [arg(fields) for arg in args]
+            return None if None in values else function(*values)
+        return call
+    raise RuleError('Unknown expression {!r}'.format(kind))
+
+
+def _compile_compare(function, left_node, right_node):
+    left, right = compile_expression(left_node), compile_expression(right_node)
+    if not _is_constant(right_node):
+        def compare(fields):
+            a, b = left(fields), right(fields)
+            return a is not None and b is not None and function(a, b)
+        return compare
+    constant = right({})
+    if constant is None:
+        return lambda fields: False
+    # The usual case, a field against a number: one dict lookup
+    if left_node[0] == 'field' and '.' not in left_node[1]:
+        name = left_node[1]
+
+        def compare_field(fields):
+            value = fields.get(name)
+            return value is not None and function(value, constant)
+        return compare_field
+
+    def compare_constant(fields):
+        value = left(fields)
+        return value is not None and function(value, constant)
+    return compare_constant
+
+
+class RuleSet:
+    def __init__(self, rules):
+        # rules: what parse() returns
+        self.rules = rules
+        self.matched = [0] * len(rules)
+        self.errors = [0] * len(rules)
+        self._steps = [self._compile_rule(index, *rule[1:]) for index, rule in enumerate(rules)]
+
+    @classmethod
+    def parse(cls, text):
+        return cls(parse(text))
+
+    @classmethod
+    def from_config(cls, get=None):
+        # None when there are no rules. get(key) looks up a setting,
+        # LiveConfig.get or os.getenv.
+        get = get or os.getenv
+        path = get('EDGE_RULES_FILE')
+        if path:
+            with open(path) as f:
+                text = f.read()
+        else:
+            text = get('EDGE_RULES') or ''
+        if not text.strip():
+            return None
+        return cls.parse(text)
+
+    def _compile_rule(self, index, action, argument, condition):
+        matched, errors = self.matched, self.errors
+        if action == 'drop':
+            def act(fields, destinations, enriched):
+                return False
+        elif action == 'sample':
+            every = max(1, int(round(1 / argument)))
+            seen = collections.Counter()
+
+            def act(fields, destinations, enriched):
+                device_id = fields.get('Device_ID')
+                seen[device_id] += 1
+                return seen[device_id] % every == 1 % every
+        elif action == 'route':
+            kind, destination = argument
+            if kind == 'topic' and '{' in destination:
+                def act(fields, destinations, enriched):
+                    destinations.append(destination.format_map(fields))
+                    return True
+            else:
+                def act(fields, destinations, enriched):
+                    destinations.append(destination)
+                    return True
+        else:
+            assignments = [(name, compile_expression(value)) for name, value in argument]
+
+            def act(fields, destinations, enriched):
+                for name, value in assignments:
+                    fields[name] = enriched[name] = value(fields)
+                return True
+
+        test = None if condition is None else compile_expression(condition)
+
+        def step(fields, destinations, enriched):
+            # False once the reading is dropped
+            try:
+                if test is not None and not test(fields):
+                    return True
+                matched[index] += 1
+                return act(fields, destinations, enriched)
+            except EVALUATION_ERRORS:
+                errors[index] += 1
+                return True
+        return step
+
+    def apply(self, fields):
+        # fields: the reading as one flat dict, enrich adds to it
+        destinations = []
+        enriched = {}
+        for step in self._steps:
+            if not step(fields, destinations, enriched):
+                return Decision([], enriched)
+        if len(destinations) > 1:
+            destinations = list(collections.OrderedDict.fromkeys(destinations))
+        return Decision(destinations or [DEFAULT_DESTINATION], enriched)
+
+    def apply_batch(self, readings):
+        apply = self.apply
+        return [apply(fields) for fields in readings]
+
+    def stats(self):
+        return [{'rule': rule[0], 'matched': matched, 'errors': errors}
+                for rule, matched, errors in zip(self.rules, self.matched, self.errors)]
@@ -0,0 +1,418 @@
+# Several broker endpoints behind one MQTT connection.
+#
+# With AWS_ENDPOINTS set to more than one endpoint, build_connection()
+# (connection_builder.py) returns a FailoverConnection. It looks like an
+# awscrt.mqtt.Connection to the scripts but connects to whichever endpoint
+# answers fastest, and moves to another one when that endpoint goes away:
+#
+#   AWS_ENDPOINTS=abc123-ats.iot.eu-west-1.amazonaws.com, eu-central-1, 10.0.0.5:8883
+#
+# An entry is an endpoint, optionally with :port, or a bare region name,
+# which is the first endpoint with its region swapped (the thing and its
+# certificate have to be registered in that region too).
+#
+# Every ENDPOINT_PROBE_INTERVAL seconds, and before each connect, all
+# endpoints are probed: the time to TCP connect, TLS handshake (with the
+# device certificate) and MQTT CONNACK, with the client ID <client ID>-probe,
+# so the IoT policy has to allow that. An endpoint that doesn't answer
+# within ENDPOINT_CONNECT_TIMEOUT is unhealthy. The fastest healthy endpoint
+# wins, ties go to the one listed first.
+#
+# Failover: once the connection has been interrupted for
+# ENDPOINT_FAILOVER_AFTER seconds without the client getting it back, the
+# next best endpoint is connected. The switch happens at most
+# FAILOVER_AFTER + CONNECT_TIMEOUT (probing) + CONNECT_TIMEOUT per endpoint
+# tried after the interruption.
+#
+# Fail back: a healthy endpoint that is at least ENDPOINT_FAILBACK_MARGIN
+# (a fraction) faster than the current one in ENDPOINT_FAILBACK_PROBES
+# probes in a row takes over, connecting before the old connection is let
+# go. An endpoint that is only now and then faster never does.
+#
+# Across a switch the scripts see on_connection_interrupted and then
+# on_connection_resumed with session_present=False, as after a reconnect
+# that lost the session. InFlightPublisher saves what was in flight to the
+# outbox on the first and sends it over the new endpoint on the second, and
+# publishes still waiting on the old endpoint fail so their slots come
+# back. Subscriptions are made again by resubscribe_existing_topics().
+#
+# Settings (.env): AWS_ENDPOINTS, ENDPOINT_PROBE_INTERVAL,
+# ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_FAILOVER_AFTER,
+# ENDPOINT_FAILBACK_MARGIN, ENDPOINT_FAILBACK_PROBES
+
+import collections
+import os
+import re
+import socket
+import ssl
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+DEFAULT_PROBE_INTERVAL = 300
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_FAILOVER_AFTER = 15
+DEFAULT_FAILBACK_MARGIN = 0.3
+DEFAULT_FAILBACK_PROBES = 3
+# How long publishes still waiting on the old endpoint get to finish when
+# the switch is planned (a fail back)
+SWITCH_GRACE = 2
+REGION = re.compile(r'^[a-z]{2}(-gov)?-[a-z]+-\d+$')
+AWS_IOT_ENDPOINT = re.compile(r'^(?P<prefix>[^.]+\.iot\.)(?P<region>[a-z0-9-]+)(?P<suffix>\.amazonaws\.com.*)$')
+# ALPN protocol AWS IoT Core wants for MQTT with client certificates on 443
+AWS_IOT_ALPN = 'x-amzn-mqtt-ca'
+
+Endpoint = collections.namedtuple('Endpoint', 'host port')
+
+
+def parse_endpoints(value, default_port=None):
+    # 'host[:port]' and region names, comma separated
+    entries = [entry.strip() for entry in (value or '').split(',') if entry.strip()]
+    endpoints = []
+    template = None
+    for entry in entries:
+        if REGION.match(entry):
+            if template is None:
+                raise ValueError('Region {!r} needs an AWS IoT endpoint listed before it'.format(entry))
+            entry = template.expand(r'\g<prefix>{}\g<suffix>'.format(entry))
+        host, _, port = entry.partition(':')
+        if template is None:
+            template = AWS_IOT_ENDPOINT.match(host)
+        endpoints.append(Endpoint(host, int(port) if port else default_port))
+    return endpoints
+
+
+def _mqtt_connect_packet(client_id):
+    # MQTT 3.1.1 CONNECT, clean session, 30 s keep alive
+    client_id = client_id.encode()
+    body = b'\x00\x04MQTT\x04\x02' + struct.pack('>H', 30) + struct.pack('>H', len(client_id)) + client_id
+    return bytes([0x10, len(body)]) + body
+
+
+def probe(endpoint, client_id, tls=True, timeout=DEFAULT_CONNECT_TIMEOUT):
+    # Seconds until the endpoint accepted an MQTT connection, None if it
+    # didn't within `timeout`
+    started = time.monotonic()
+    port = endpoint.port or (8883 if tls else 1883)
+    try:
+        sock = socket.create_connection((endpoint.host, port), timeout=timeout)
+    except OSError:
+        return None
+    try:
+        if tls:
+            context = ssl.create_default_context(cafile=os.getenv('ROOT_CA_FILE'))
+            context.load_cert_chain(os.getenv('CERT_FILE'), os.getenv('PRI_KEY_FILE'))
+            if port == 443:
+                context.set_alpn_protocols([AWS_IOT_ALPN])
+            sock = context.wrap_socket(sock, server_hostname=endpoint.host)
+        sock.settimeout(max(0.01, timeout - (time.monotonic() - started)))
+        sock.sendall(_mqtt_connect_packet(client_id))
+        connack = b''
+        while len(connack) < 4:
+            chunk = sock.recv(4 - len(connack))
+            if not chunk:
+                return None
+            connack += chunk
+        if connack[0] >> 4 != 2 or connack[3] != 0:
+            return None
+        latency = time.monotonic() - started
+        sock.sendall(b'\xe0\x00')
+        return latency
+    except (OSError, ssl.SSLError):
+        return None
+    finally:
+        sock.close()
+
+
+class EndpointSelector:
+    # Probe results and the fail back hysteresis, without the connection
+    def __init__(self, endpoints, probe, failback_margin=DEFAULT_FAILBACK_MARGIN,
+                 failback_probes=DEFAULT_FAILBACK_PROBES):
+        # probe(endpoint) -> seconds or None
+        self.endpoints = list(endpoints)
+        self.probe = probe
+        self.failback_margin = failback_margin
+        self.failback_probes = failback_probes
+        self.latencies = {endpoint: None for endpoint in self.endpoints}
+        self.probes = 0
+        self._streak = (None, 0)
+
+    def probe_all(self):
+        # In parallel, so probing takes as long as the slowest endpoint
+        results = {}
+        threads = [threading.Thread(target=lambda e=endpoint: results.__setitem__(e, self.probe(e)), daemon=True)
+                   for endpoint in self.endpoints]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.latencies.update(results)
+        self.probes += 1
+        return dict(self.latencies)
+
+    def ranked(self, exclude=()):
+        # Healthy endpoints fastest first, then the unhealthy ones in list
+        # order as a last resort
+        order = {endpoint: i for i, endpoint in enumerate(self.endpoints)}
+        candidates = [e for e in self.endpoints if e not in exclude]
+        healthy = sorted((e for e in candidates if self.latencies[e] is not None),
+                         key=lambda e: (self.latencies[e], order[e]))
+        return healthy + [e for e in candidates if self.latencies[e] is None]
+
+    def fail_back_to(self, current):
+        # After a probe_all(): the endpoint to move to, once one has been
+        # better by the margin for failback_probes probes in a row
+        best = next(iter(self.ranked()), None)
+        current_latency = self.latencies.get(current)
+        better = (best is not None and best != current and self.latencies[best] is not None and
+                  (current_latency is None or
+                   self.latencies[best] < current_latency * (1 - self.failback_margin)))
+        if not better:
+            self._streak = (None, 0)
+            return None
+        streak = self._streak[1] + 1 if self._streak[0] == best else 1
+        self._streak = (best, streak)
+        if streak < self.failback_probes:
+            return None
+        self._streak = (None, 0)
+        return best
+
+
+class FailoverConnection:
+    def __init__(self, endpoints, build, client_id, on_connection_interrupted=None, on_connection_resumed=None,
+                 tls=True, probe_interval=None, connect_timeout=None, failover_after=None, selector=None):
+        # build(endpoint, on_connection_interrupted, on_connection_resumed)
+        # returns an awscrt.mqtt.Connection to that endpoint, not connected
+        getenv = os.getenv
+        self.build = build
+        self.client_id = client_id
+        self.on_connection_interrupted = on_connection_interrupted
+        self.on_connection_resumed = on_connection_resumed
+        self.probe_interval = probe_interval or float(getenv('ENDPOINT_PROBE_INTERVAL', DEFAULT_PROBE_INTERVAL))
+        self.connect_timeout = connect_timeout or float(getenv('ENDPOINT_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT))
+        self.failover_after = failover_after or float(getenv('ENDPOINT_FAILOVER_AFTER', DEFAULT_FAILOVER_AFTER))
+        self.selector = selector or EndpointSelector(
+            endpoints, lambda e: probe(e, client_id + '-probe', tls, self.connect_timeout),
+            failback_margin=float(getenv('ENDPOINT_FAILBACK_MARGIN', DEFAULT_FAILBACK_MARGIN)),
+            failback_probes=int(getenv('ENDPOINT_FAILBACK_PROBES', DEFAULT_FAILBACK_PROBES)))
+        self.endpoint = None
+        self._active = None
+        self._lock = threading.Lock()
+        self._pending = {}  # connection -> set of our publish futures
+        self._subscriptions = collections.OrderedDict()  # topic -> (qos, callback)
+        self._interrupted_at = None
+        self._reported_connected = False
+        self._stop = threading.Event()
+        self._monitor = None
+        self.counts = collections.Counter()
+        self.last_switch_seconds = None
+
+    # The parts of awscrt.mqtt.Connection the scripts use
+
+    def connect(self):
+        future = Future()
+        threading.Thread(target=self._connect, args=(future,), name='endpoint-connect', daemon=True).start()
+        return future
+
+    def _connect(self, future):
+        self.selector.probe_all()
+        error = None
+        for endpoint in self.selector.ranked():
+            try:
+                connection, result = self._open(endpoint)
+            except Exception as e:
+                error = e
+                continue
+            with self._lock:
+                self._active, self.endpoint = connection, endpoint
+                self._pending[connection] = set()
+            self._reported_connected = True
+            self._stop.clear()
+            if self._monitor is None or not self._monitor.is_alive():
+                self._monitor = threading.Thread(target=self._watch, name='endpoint-monitor', daemon=True)
+                self._monitor.start()
+            future.set_result(result)
+            return
+        future.set_exception(error or ConnectionError('No endpoints'))
+
+    def _open(self, endpoint):
+        print("Connecting to {}...".format(_name(endpoint)))
+        connection = self.build(endpoint,
+                                lambda connection, error, **kwargs: self._on_interrupted(connection, error),
+                                lambda connection, return_code, session_present, **kwargs:
+                                    self._on_resumed(connection, return_code, session_present))
+        try:
+            result = connection.connect().result(self.connect_timeout)
+        except Exception:
+            connection.disconnect()
+            raise
+        return connection, result
+
+    def disconnect(self):
+        self._stop.set()
+        with self._lock:
+            connection = self._active
+        if connection is None:
+            future = Future()
+            future.set_result({})
+            return future
+        return connection.disconnect()
+
+    def publish(self, topic, payload, qos, retain=False):
+        future = Future()
+        with self._lock:
+            connection = self._active
+            if connection is None:
+                raise ConnectionError('Not connected')
+            inner, packet_id = connection.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+            self._pending[connection].add(future)
+        inner.add_done_callback(lambda f: self._on_publish_done(connection, future, f))
+        return future, packet_id
+
+    def _on_publish_done(self, connection, future, inner):
+        with self._lock:
+            pending = self._pending.get(connection)
+            if pending is None or future not in pending:
+                # Already failed by a switch
+                return
+            pending.discard(future)
+            error = inner.exception()
+            if error is None:
+                future.set_result(inner.result())
+            else:
+                future.set_exception(error)
+
+    def subscribe(self, topic, qos, callback=None):
+        with self._lock:
+            self._subscriptions[topic] = (qos, callback)
+            connection = self._active
+        return connection.subscribe(topic=topic, qos=qos, callback=callback)
+
+    def unsubscribe(self, topic):
+        with self._lock:
+            self._subscriptions.pop(topic, None)
+            connection = self._active
+        return connection.unsubscribe(topic)
+
+    def resubscribe_existing_topics(self):
+        # The new endpoint has none of the old subscriptions, so they are
+        # made one by one. Resolves like awscrt's: {'packet_id', 'topics'}.
+        with self._lock:
+            connection = self._active
+            subscriptions = list(self._subscriptions.items())
+        future = Future()
+        topics = []
+        try:
+            for topic, (qos, callback) in subscriptions:
+                result = connection.subscribe(topic=topic, qos=qos, callback=callback)[0].result(self.connect_timeout)
+                topics.append((topic, result['qos']))
+        except Exception as e:
+            future.set_exception(e)
+            return future, None
+        future.set_result({'packet_id': None, 'topics': topics})
+        return future, None
+
+    # Health and switching
+
+    def _on_interrupted(self, connection, error):
+        if connection is not self._active:
+            return
+        self.counts['interruptions'] += 1
+        self._interrupted_at = time.monotonic()
+        self._report_interrupted(error)
+
+    def _on_resumed(self, connection, return_code, session_present):
+        if connection is not self._active:
+            return
+        self._interrupted_at = None
+        self._reported_connected = True
+        if self.on_connection_resumed:
+            self.on_connection_resumed(connection=self, return_code=return_code, session_present=session_present)
+
+    def _report_interrupted(self, error):
+        if self._reported_connected:
+            self._reported_connected = False
+            if self.on_connection_interrupted:
+                self.on_connection_interrupted(connection=self, error=error)
+
+    def _watch(self):
+        next_probe = time.monotonic() + self.probe_interval
+        while not self._stop.wait(1):
+            interrupted_at = self._interrupted_at
+            if interrupted_at is not None:
+                # The client is trying to get it back meanwhile
+                if time.monotonic() - interrupted_at >= self.failover_after:
+                    self.selector.probe_all()
+                    self._switch(self.selector.ranked(exclude=(self.endpoint,)), planned=False)
+                    next_probe = time.monotonic() + self.probe_interval
+            elif time.monotonic() >= next_probe:
+                self.selector.probe_all()
+                target = self.selector.fail_back_to(self.endpoint)
+                if target is not None and not self._stop.is_set():
+                    print("Endpoint {} is faster ({} vs {} ms), moving over".format(
+                        _name(target), _ms(self.selector.latencies[target]),
+                        _ms(self.selector.latencies.get(self.endpoint))))
+                    self._switch([target], planned=True)
+                next_probe = time.monotonic() + self.probe_interval
+
+    def _switch(self, candidates, planned):
+        from awscrt import mqtt
+        started = self._interrupted_at or time.monotonic()
+        for endpoint in candidates:
+            if self._stop.is_set():
+                return False
+            try:
+                connection, _ = self._open(endpoint)
+            except Exception as e:
+                print("Endpoint {} failed: {!r}".format(_name(endpoint), e))
+                continue
+            with self._lock:
+                old, old_endpoint = self._active, self.endpoint
+                self._active, self.endpoint = connection, endpoint
+                self._pending[connection] = set()
+            # Lets the publisher save what it has in flight before the old
+            # connection's publishes are failed
+            self._report_interrupted(None)
+            self._retire(old, SWITCH_GRACE if planned else 0)
+            self._interrupted_at = None
+            self.counts['fail_backs' if planned else 'failovers'] += 1
+            self.last_switch_seconds = round(time.monotonic() - started, 3)
+            print("Switched from {} to {} after {:.1f}s".format(
+                _name(old_endpoint), _name(endpoint), self.last_switch_seconds))
+            self._reported_connected = True
+            if self.on_connection_resumed:
+                self.on_connection_resumed(connection=self, return_code=mqtt.ConnectReturnCode.ACCEPTED,
+                                           session_present=False)
+            return True
+        return False
+
+    def _retire(self, connection, grace):
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._pending.get(connection):
+                    break
+            time.sleep(0.05)
+        with self._lock:
+            pending = self._pending.pop(connection, set())
+        for future in pending:
+            future.set_exception(ConnectionError('Moved to another endpoint'))
+        try:
+            connection.disconnect()
+        except Exception:
+            pass
+
+    def stats(self):
+        return dict(self.counts, endpoint=_name(self.endpoint), last_switch_seconds=self.last_switch_seconds,
+                    latency_ms={_name(e): _ms(latency) for e, latency in self.selector.latencies.items()})
+
+
+def _name(endpoint):
+    if endpoint is None:
+        return None
+    return endpoint.host if endpoint.port is None else '{}:{}'.format(endpoint.host, endpoint.port)
+
+
+def _ms(seconds):
+    return None if seconds is None else round(1000 * seconds, 1)
@@ -0,0 +1,181 @@
+# Checks endpoint_failover.py against several local broker stand-ins.
+#
+# Three stand-ins play endpoints in different places (--latencies holds
+# back each one's replies) and a fourth endpoint has nothing listening.
+# The connection is built the way the scripts build it, through
+# build_connection() with AWS_ENDPOINTS, and readings are published through
+# an InFlightPublisher with an outbox the whole time.
+#
+#   1. it has to pick the fastest endpoint, not the first listed
+#   2. the fastest is stopped: it has to move to the next fastest within
+#      FAILOVER_AFTER + the connect timeouts
+#   3. the fastest comes back: it has to move back, but only after
+#      ENDPOINT_FAILBACK_PROBES probes in a row saw it faster
+#   4. every reading has to reach one of the brokers
+#
+# A last check feeds EndpointSelector made up probe results where another
+# endpoint is faster only every other probe, which must never cause a move.
+#
+# Example:
+#   python failover_standins.py --latencies 0.12,0.01,0.05
+
+import argparse
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from broker_standin import BrokerStandIn
+from endpoint_failover import Endpoint, EndpointSelector
+from inflight_publisher import InFlightPublisher
+from outbox import Outbox
+
+parser = argparse.ArgumentParser(description="Check endpoint failover against local broker stand-ins.")
+parser.add_argument('--latencies', default='0.12,0.01,0.05', help='reply delay of each stand-in, seconds')
+parser.add_argument('--rate', type=float, default=100, help='readings published per second')
+parser.add_argument('--failover-after', type=float, default=2)
+parser.add_argument('--connect-timeout', type=float, default=1)
+parser.add_argument('--probe-interval', type=float, default=1)
+parser.add_argument('--failback-probes', type=int, default=3)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+class Publishing:
+    # Readings at a steady rate until stopped
+    def __init__(self, publisher, rate):
+        self.publisher = publisher
+        self.rate = rate
+        self.sent = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(1 / self.rate):
+            self.publisher.publish('dairy/north/telemetry', json.dumps({'Device_ID': 8, 'Seq': self.sent}))
+            self.sent += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def check_hysteresis(failback_probes):
+    # The other endpoint is faster every other probe only
+    current, other = Endpoint('current', 1), Endpoint('other', 2)
+    results = iter([{current: 0.1, other: 0.01}, {current: 0.1, other: 0.2}] * 10)
+    selector = EndpointSelector([current, other], probe=None, failback_probes=failback_probes)
+    for _ in range(20):
+        selector.latencies.update(next(results))
+        if selector.fail_back_to(current) is not None:
+            return 'moved on a flapping endpoint'
+    return 'ok'
+
+
+def main():
+    args = parser.parse_args()
+    latencies = [float(value) for value in args.latencies.split(',')]
+    brokers = [BrokerStandIn(latency=latency, record=True) for latency in latencies]
+    for broker in brokers:
+        broker.start()
+    ports = [broker.port for broker in brokers] + [free_port()]
+    os.environ.update({
+        'AWS_ENDPOINTS': ','.join('127.0.0.1:{}'.format(port) for port in ports),
+        'ENDPOINT_PROBE_INTERVAL': str(args.probe_interval),
+        'ENDPOINT_CONNECT_TIMEOUT': str(args.connect_timeout),
+        'ENDPOINT_FAILOVER_AFTER': str(args.failover_after),
+        'ENDPOINT_FAILBACK_PROBES': str(args.failback_probes),
+    })
+    from connection_builder import build_connection
+
+    ranked = sorted(range(len(brokers)), key=lambda i: latencies[i])
+    fastest, second = ranked[0], ranked[1]
+    problems = []
+    directory = tempfile.mkdtemp()
+    outbox = Outbox(os.path.join(directory, 'outbox.db'))
+    publisher = InFlightPublisher(None, outbox=outbox)
+    connection = build_connection(
+        'failover-check', tls=False,
+        on_connection_interrupted=lambda connection, error, **kwargs: publisher.on_connection_interrupted(),
+        on_connection_resumed=lambda connection, return_code, session_present, **kwargs:
+            publisher.on_connection_resumed())
+    connection.connect().result(30)
+    publisher.mqtt_connection = connection
+    publisher.start()
+    print("1. connected to port {} (fastest is {}), probes {}".format(
+        connection.endpoint.port, ports[fastest], connection.stats()['latency_ms']))
+    if connection.endpoint.port != ports[fastest]:
+        problems.append('did not pick the fastest endpoint')
+
+    publishing = Publishing(publisher, args.rate)
+    time.sleep(2)
+    stopped_at = time.monotonic()
+    brokers[fastest].stop()
+    bound = args.failover_after + args.connect_timeout * len(ports) + 1
+    moved = wait_for(lambda: connection.endpoint.port != ports[fastest] and publisher.connected, bound + 5)
+    took = time.monotonic() - stopped_at
+    print("2. stopped port {}: now on {} after {:.1f}s (bound {:.1f}s)".format(
+        ports[fastest], connection.endpoint.port, took, bound))
+    if not moved or connection.endpoint.port != ports[second]:
+        problems.append('did not fail over to the next fastest endpoint')
+    elif took > bound:
+        problems.append('failover took {:.1f}s'.format(took))
+
+    time.sleep(2)
+    replacement = BrokerStandIn(port=ports[fastest], latency=latencies[fastest], record=True)
+    replacement.start()
+    restarted_at = time.monotonic()
+    probes_before = connection.selector.probes
+    back = wait_for(lambda: connection.endpoint.port == ports[fastest] and publisher.connected,
+                    args.probe_interval * (args.failback_probes + 3) + 5)
+    probes = connection.selector.probes - probes_before
+    print("3. port {} back: moved back after {:.1f}s and {} probe(s)".format(
+        ports[fastest], time.monotonic() - restarted_at, probes))
+    if not back:
+        problems.append('did not fail back')
+    elif probes < args.failback_probes:
+        problems.append('failed back after {} probe(s)'.format(probes))
+
+    time.sleep(1)
+    publishing.stop()
+    wait_for(lambda: not publisher.in_flight() and not outbox.count(), 20)
+    seqs = [json.loads(payload)['Seq'] for broker in brokers + [replacement] for _, _, payload in broker.received]
+    missing = publishing.sent - len(set(seqs))
+    print("4. {} readings sent, {} received, {} missing, {} duplicate(s); {}".format(
+        publishing.sent, len(seqs), missing, len(seqs) - len(set(seqs)), connection.stats()))
+    if missing:
+        problems.append('{} readings missing'.format(missing))
+    hysteresis = check_hysteresis(args.failback_probes)
+    print("5. flapping endpoint: {}".format(hysteresis))
+    if hysteresis != 'ok':
+        problems.append(hysteresis)
+
+    connection.disconnect()
+    outbox.close()
+    for broker in brokers + [replacement]:
+        broker.stop()
+    print('ok' if not problems else '; '.join(problems))
+    if problems:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+# Per-collar fairness between the UART and the uplink.
+#
+# A collar with broken firmware that transmits all the time mustn't hold up
+# every other animal. Two things stop it:
+#
+# FloodGuard gives every Device_ID a token bucket of DEVICE_RATE bytes/s
+# with bursts of DEVICE_BURST bytes for its readings. Fragmented bursts
+# (see fragments.py) are admitted a whole burst at a time instead, up to
+# DEVICE_BURSTS_PER_MINUTE of them, and as many back to back: once a burst
+# is admitted its fragments don't count against the byte bucket, up to
+# twice the fragment count it declares since fragments may be repeated.
+# A collar that runs out of either is flagged as an offender and held to
+# FLOOD_OFFENDER_RATE bytes/s, fragments included, until it has stayed
+# within that for FLOOD_COOLDOWN seconds. What it sends beyond that is
+# dropped and counted per device.
+#
+# FairQueue is a queue kept per key (the Device_ID) and served by deficit
+# round robin: each collar with something queued gets `quantum` bytes per
+# round, so a reading waits behind at most one round's worth from each
+# other collar (about quantum x active collars bytes), however much one of
+# them has queued. publishUARTData.py puts the UART lines through one, and
+# the lanes listed in LANE_FAIR (see priority_lanes.py) queue by Device_ID
+# with one too. When a FairQueue is full it drops from the collar with the
+# most queued.
+#
+#   guard = FloodGuard.from_env()
+#   lines = FairQueue(key=device_of_line, max_per_key=100)
+#   if guard.admit_line(line):
+#       lines.put(line)
+#   ...
+#   line = lines.get(timeout=1)     # raises queue.Empty like queue.Queue
+#
+# Settings (.env): DEVICE_RATE, DEVICE_BURST, DEVICE_BURSTS_PER_MINUTE,
+#                  FLOOD_OFFENDER_RATE, FLOOD_COOLDOWN, DEVICE_QUEUE_LIMIT,
+#                  FAIR_QUANTUM
+
+import collections
+import os
+import queue
+import re
+import threading
+import time
+
+from fragments import MAX_FRAGMENTS, MAX_PACKET
+from rate_limit import TokenBucket
+
+# A reading is about 30 bytes; 200 bytes/s is far more than any collar's
+# sample rate needs
+DEFAULT_DEVICE_RATE = 200
+# A few seconds of readings at once, bursts are counted separately
+DEFAULT_DEVICE_BURST = 10 * MAX_PACKET
+# A collar uploads a few seconds of accelerometer samples at a time, this
+# leaves room for retries
+DEFAULT_BURSTS_PER_MINUTE = 6
+# Admitted bursts remembered per device; fragments of older ones are
+# charged as readings
+RECENT_BURSTS = 4
+DEFAULT_OFFENDER_RATE = 20
+DEFAULT_COOLDOWN = 300
+DEFAULT_QUEUE_LIMIT = 100
+# One LoRa packet's worth per collar per round
+DEFAULT_QUANTUM = 256
+# Devices tracked by FloodGuard, well above the collars in a barn; beyond it
+# the ones in good standing are forgotten
+MAX_DEVICES = 10000
+# Devices listed by name in stats()
+TOP_DEVICES = 10
+
+DEVICE_PREFIX = re.compile(br'\s*I(\d+)')
+# Enough of fragments.FRAGMENT_LINE to tell which burst a line belongs to
+FRAGMENT_PREFIX = re.compile(br'\s*I(\d+) B(\d+) P\d+/(\d+) ')
+
+
+def device_of_line(line):
+    # The Device_ID a UART line is from ('I08 T38.6 ...', 'I08 B17 P0/5 ...'),
+    # None if it doesn't start with one
+    match = DEVICE_PREFIX.match(line)
+    return None if match is None else int(match.group(1))
+
+
+class FloodGuard:
+    def __init__(self, rate=DEFAULT_DEVICE_RATE, burst=DEFAULT_DEVICE_BURST, bursts_per_minute=DEFAULT_BURSTS_PER_MINUTE,
+                 offender_rate=DEFAULT_OFFENDER_RATE, cooldown=DEFAULT_COOLDOWN):
+        self.rate = rate
+        self.burst = burst
+        self.bursts_per_minute = bursts_per_minute
+        self.offender_rate = offender_rate
+        self.cooldown = cooldown
+        self._buckets = {}
+        # Device_ID -> token bucket of whole bursts
+        self._burst_buckets = {}
+        # Device_ID -> {burst id: fragment lines it may still send}
+        self._bursts = {}
+        # Device_ID -> when it last went over its limit, while flagged
+        self.flagged = {}
+        self.dropped = collections.Counter()
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(rate=float(os.getenv('DEVICE_RATE', DEFAULT_DEVICE_RATE)),
+                   burst=float(os.getenv('DEVICE_BURST', DEFAULT_DEVICE_BURST)),
+                   bursts_per_minute=float(os.getenv('DEVICE_BURSTS_PER_MINUTE', DEFAULT_BURSTS_PER_MINUTE)),
+                   offender_rate=float(os.getenv('FLOOD_OFFENDER_RATE', DEFAULT_OFFENDER_RATE)),
+                   cooldown=float(os.getenv('FLOOD_COOLDOWN', DEFAULT_COOLDOWN)))
+
+    def admit_line(self, line):
+        # admit() for a UART line, telling fragments from readings
+        match = FRAGMENT_PREFIX.match(line)
+        if match is not None:
+            return self.admit(int(match.group(1)), len(line), burst=(int(match.group(2)), int(match.group(3))))
+        return self.admit(device_of_line(line), len(line))
+
+    def admit(self, device_id, size=1, burst=None):
+        # False if `size` bytes from `device_id` are over its limit. burst:
+        # (burst id, fragment count) if they are a fragment of one
+        if device_id is None or not self.rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(device_id)
+            if bucket is None:
+                if len(self._buckets) >= MAX_DEVICES:
+                    self._forget()
+                bucket = self._buckets[device_id] = TokenBucket(self.rate, max(self.burst, size))
+            elif device_id in self.flagged and now - self.flagged[device_id] >= self.cooldown:
+                del self.flagged[device_id]
+                bucket = self._buckets[device_id] = TokenBucket(self.rate, max(self.burst, size))
+                self.counts['cleared'] += 1
+                print("Device {} is within its rate again".format(device_id))
+            if burst is not None and device_id not in self.flagged and self._admit_fragment(device_id, *burst):
+                self.counts['admitted'] += 1
+                self.counts['fragments'] += 1
+                return True
+            if bucket.try_acquire(min(size, bucket.burst)):
+                self.counts['admitted'] += 1
+                return True
+            self.dropped[device_id] += 1
+            self.counts['dropped'] += 1
+            if device_id not in self.flagged:
+                # One packet at a time at most
+                self._buckets[device_id] = TokenBucket(self.offender_rate, MAX_PACKET)
+                self.counts['flagged'] += 1
+                print("Device {} is flooding, limiting it to {} bytes/s".format(device_id, self.offender_rate))
+            self.flagged[device_id] = now
+            return False
+
+    def _admit_fragment(self, device_id, burst_id, count):
+        # Called with the lock held
+        bursts = self._bursts.setdefault(device_id, collections.OrderedDict())
+        left = bursts.get(burst_id)
+        if left is None:
+            bucket = self._burst_buckets.get(device_id)
+            if bucket is None:
+                bucket = self._burst_buckets[device_id] = TokenBucket(self.bursts_per_minute / 60,
+                                                                      max(1, self.bursts_per_minute))
+            if not bucket.try_acquire():
+                return False
+            left = 2 * min(count, MAX_FRAGMENTS)
+            while len(bursts) >= RECENT_BURSTS:
+                bursts.popitem(last=False)
+            self.counts['bursts'] += 1
+        if left <= 0:
+            return False
+        bursts[burst_id] = left - 1
+        return True
+
+    def _forget(self):
+        # Called with the lock held
+        for device_id in list(self._buckets):
+            if device_id not in self.flagged:
+                del self._buckets[device_id]
+                self._burst_buckets.pop(device_id, None)
+                self._bursts.pop(device_id, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counts)
+            stats['flagged'] = sorted(self.flagged, key=str)
+            stats['dropped_by_device'] = dict(self.dropped.most_common(TOP_DEVICES))
+        return stats
+
+
+class FairQueue:
+    # Thread safe. append()/popleft()/len() as on a deque, for the lanes,
+    # and put()/get() as on a queue.Queue.
+    def __init__(self, key=None, cost=len, quantum=DEFAULT_QUANTUM, max_per_key=0):
+        # key(item) -> which queue the item joins, cost(item) -> its size.
+        # max_per_key: 0 for no limit, otherwise the key's oldest item is
+        # dropped to make room.
+        self.key = key or (lambda item: None)
+        self.cost = cost
+        self.quantum = quantum
+        self.max_per_key = max_per_key
+        self._queues = {}
+        self._deficits = {}
+        # Keys with something queued, in round robin order
+        self._active = collections.deque()
+        self._length = 0
+        self._not_empty = threading.Condition()
+        self.dropped = collections.Counter()
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def append(self, item):
+        # Returns the item dropped to make room, if any
+        key = self.key(item)
+        dropped = None
+        with self._not_empty:
+            items = self._queues.get(key)
+            if items is None:
+                items = self._queues[key] = collections.deque()
+                self._deficits[key] = self.quantum
+                self._active.append(key)
+            if self.max_per_key and len(items) >= self.max_per_key:
+                dropped = items.popleft()
+                self.dropped[key] += 1
+                self._length -= 1
+            items.append(item)
+            self._length += 1
+            self._not_empty.notify()
+        return dropped
+
+    put = append
+
+    def popleft(self):
+        with self._not_empty:
+            if not self._length:
+                raise IndexError('pop from an empty FairQueue')
+            while True:
+                key = self._active[0]
+                items = self._queues[key]
+                cost = self.cost(items[0])
+                if self._deficits[key] >= cost:
+                    break
+                # Its turn is over, it gets the next quantum for its next turn
+                self._active.rotate(-1)
+                self._deficits[key] += self.quantum
+            self._deficits[key] -= cost
+            item = items.popleft()
+            self._length -= 1
+            if not items:
+                self._active.popleft()
+                del self._queues[key]
+                del self._deficits[key]
+            return item
+
+    def get(self, timeout=None):
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._length, timeout):
+                raise queue.Empty
+            return self.popleft()
+
+    def evict(self):
+        # Removes the oldest item of the key with the most queued
+        with self._not_empty:
+            key = max(self._active, key=lambda key: len(self._queues[key]))
+            items = self._queues[key]
+            item = items.popleft()
+            self._length -= 1
+            self.dropped[key] += 1
+            if not items:
+                self._active.remove(key)
+                del self._queues[key]
+                del self._deficits[key]
+            return item
+
+    def stats(self):
+        with self._not_empty:
+            longest = sorted(self._queues.items(), key=lambda entry: -len(entry[1]))[:TOP_DEVICES]
+            return {
+                'queued': self._length,
+                'keys': len(self._active),
+                'longest': {key: len(items) for key, items in longest},
+                'dropped_by_key': dict(self.dropped.most_common(TOP_DEVICES)),
+            }
@@ -0,0 +1,177 @@
+# Bursts of data too big for one LoRa packet (252 bytes on the RFM9x), such
+# as a few seconds of high-rate accelerometer samples, are sent as a series
+# of fragment packets, one line each on the UART:
+#
+#   I08 B17 P0/5 K1a2b3c4d <base64>
+#   I08 B17 P1/5 <base64>
+#   ...
+#
+#   I   Device_ID
+#   B   burst id, 0-65535, a new one for every burst from the collar
+#   P   fragment index / number of fragments, at most MAX_FRAGMENTS
+#   K   CRC32 of the whole burst in hex, on fragment 0 only
+#
+# The payload is base64 since the line also goes through the text decoder's
+# log. Fragments may arrive in any order and more than once.
+#
+# Reassembler puts them back together, keyed by (Device_ID, burst id). A
+# burst that isn't complete within FRAGMENT_TIMEOUT seconds is dropped, and
+# so are the oldest incomplete bursts once they hold more than
+# FRAGMENT_BUFFER_BYTES, so a collar that keeps losing fragments can't use
+# up the gateway's memory.
+#
+#   reassembler = Reassembler.from_env()
+#   fragment = parse_fragment(line)
+#   if fragment is not None:
+#       blob = reassembler.add(*fragment)   # bytes once the burst is complete
+#
+# Settings (.env): FRAGMENT_TIMEOUT, FRAGMENT_BUFFER_BYTES
+
+import base64
+import binascii
+import os
+import re
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+MAX_PACKET = 252
+MAX_FRAGMENTS = 64
+MAX_BURST_ID = 0xffff
+DEFAULT_TIMEOUT = 30
+DEFAULT_BUFFER_BYTES = 1024 * 1024
+
+FRAGMENT_LINE = re.compile(r'^I(\d+) B(\d+) P(\d+)/(\d+)(?: K([0-9a-fA-F]{8}))? ([A-Za-z0-9+/=]+)\s*$')
+
+
+def parse_fragment(line):
+    # 'I08 B17 P0/5 K1a2b3c4d QUJD...' -> (8, 17, 0, 5, 0x1a2b3c4d, b'ABC...')
+    # None if the line isn't a fragment
+    match = FRAGMENT_LINE.match(line)
+    if match is None:
+        return None
+    device_id, burst_id, index, count, crc, payload = match.groups()
+    try:
+        data = base64.b64decode(payload, validate=True)
+    except binascii.Error:
+        return None
+    return int(device_id), int(burst_id), int(index), int(count), None if crc is None else int(crc, 16), data
+
+
+def fragment_burst(device_id, burst_id, blob, max_packet=MAX_PACKET):
+    # The collar's side, for tests and simulators. Returns the lines to send.
+    header = 'I{:02d} B{} P{}/{} K{:08x} '.format(device_id, burst_id, MAX_FRAGMENTS, MAX_FRAGMENTS, 0)
+    # Room left for base64 (4 characters per 3 bytes) and the newline
+    chunk_size = (max_packet - len(header) - 1) // 4 * 3
+    chunks = [blob[i:i + chunk_size] for i in range(0, len(blob), chunk_size)] or [b'']
+    if len(chunks) > MAX_FRAGMENTS:
+        raise ValueError('Burst of {} bytes needs more than {} fragments'.format(len(blob), MAX_FRAGMENTS))
+    crc = zlib.crc32(blob) & 0xffffffff
+    lines = []
+    for index, chunk in enumerate(chunks):
+        checksum = ' K{:08x}'.format(crc) if index == 0 else ''
+        lines.append('I{:02d} B{} P{}/{}{} {}\n'.format(
+            device_id, burst_id, index, len(chunks), checksum, base64.b64encode(chunk).decode()))
+    return lines
+
+
+class _Burst:
+    __slots__ = ('count', 'parts', 'size', 'crc', 'started')
+
+    def __init__(self, count, started):
+        self.count = count
+        self.parts = {}
+        self.size = 0
+        self.crc = None
+        self.started = started
+
+
+class Reassembler:
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_BUFFER_BYTES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        # (device_id, burst_id) -> _Burst, oldest first
+        self._bursts = OrderedDict()
+        self._bytes = 0
+        # Bursts completed recently, so late duplicates don't start them again
+        self._completed = OrderedDict()
+        self.counts = Counter()
+
+    @classmethod
+    def from_env(cls):
+        return cls(timeout=float(os.getenv('FRAGMENT_TIMEOUT', DEFAULT_TIMEOUT)),
+                   max_bytes=int(os.getenv('FRAGMENT_BUFFER_BYTES', DEFAULT_BUFFER_BYTES)))
+
+    def add(self, device_id, burst_id, index, count, crc, data, now=None):
+        # Returns the whole burst as bytes once its last fragment is in,
+        # otherwise None
+        now = time.monotonic() if now is None else now
+        self.counts['fragments'] += 1
+        self.expire(now)
+        key = (device_id, burst_id)
+        if not 0 < count <= MAX_FRAGMENTS or not 0 <= index < count:
+            self.counts['invalid'] += 1
+            return None
+        if key in self._completed:
+            self.counts['duplicates'] += 1
+            return None
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = self._bursts[key] = _Burst(count, now)
+        elif burst.count != count:
+            # Burst id reused with a different size, the old one is lost
+            self.counts['inconsistent'] += 1
+            self._drop(key)
+            burst = self._bursts[key] = _Burst(count, now)
+        if index in burst.parts:
+            self.counts['duplicates'] += 1
+            return None
+        burst.parts[index] = data
+        burst.size += len(data)
+        self._bytes += len(data)
+        if crc is not None:
+            burst.crc = crc
+        if len(burst.parts) < count:
+            self._enforce_limit(key)
+            return None
+
+        self._drop(key)
+        self._completed[key] = now
+        blob = b''.join(burst.parts[i] for i in range(count))
+        if burst.crc is not None and zlib.crc32(blob) & 0xffffffff != burst.crc:
+            self.counts['bad_crc'] += 1
+            return None
+        self.counts['bursts'] += 1
+        return blob
+
+    def _drop(self, key):
+        burst = self._bursts.pop(key)
+        self._bytes -= burst.size
+
+    def _enforce_limit(self, keep):
+        # Oldest incomplete bursts go first, never the one just added to
+        for key in list(self._bursts):
+            if self._bytes <= self.max_bytes:
+                break
+            if key != keep:
+                self._drop(key)
+                self.counts['evicted'] += 1
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self._bursts:
+            key, burst = next(iter(self._bursts.items()))
+            if now - burst.started < self.timeout:
+                break
+            self._drop(key)
+            self.counts['timed_out'] += 1
+        while self._completed:
+            key, completed_at = next(iter(self._completed.items()))
+            if now - completed_at < self.timeout:
+                break
+            self._completed.popitem(last=False)
+
+    def stats(self):
+        stats = dict(self.counts)
+        stats.update({'incomplete': len(self._bursts), 'buffered_bytes': self._bytes})
+        return stats
@@ -0,0 +1,279 @@
+# Cooperative forwarding between gateways that hear the same collars.
+#
+# With several gateways on one pasture every collar packet is usually heard
+# by more than one of them. Gateways on the same LAN announce each packet
+# they hear on a UDP multicast group, together with the RSSI they heard it
+# at, and only the one that heard it best forwards it to the cloud:
+#
+#   coordinator = Coordinator.from_env()
+#   coordinator.start()
+#   coordinator.offer(packet_key(packet), rssi, lambda: lanes.submit(...))
+#
+# offer() multicasts a claim and waits COORDINATION_WINDOW seconds for
+# other gateways' claims on the same packet. If none of them is stronger
+# (higher RSSI, ties go to the higher GATEWAY_ID), on_win() is called on the
+# coordinator's thread and a "won" notice tells any gateway that heard the
+# packet late not to bother. A gateway that already knows of a stronger
+# claim drops the packet straight away without announcing it.
+#
+# A gateway that hasn't heard from any peer for PEER_TIMEOUT seconds
+# forwards without waiting, so a lone gateway adds no latency. If the
+# multicast socket can't be opened every packet is forwarded, as before.
+#
+# Packets are matched by their content (packet_key), the RSSI field left
+# out, so readings must not repeat within KEY_TTL seconds, which collars
+# sampling every 30 s or slower don't.
+#
+# Settings (.env): GATEWAY_ID, COORDINATION_GROUP, COORDINATION_PORT,
+# COORDINATION_WINDOW, COORDINATION_INTERFACE
+
+import hashlib
+import heapq
+import json
+import os
+import platform
+import socket
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+from inflight_publisher import percentile
+from lora_packet import PACKET_FIELDS
+
+DEFAULT_GROUP = '239.255.67.1'
+DEFAULT_PORT = 47067
+DEFAULT_WINDOW = 0.15
+# How long claims for a packet are remembered
+KEY_TTL = 5
+PEER_TIMEOUT = 120
+# Packets with no RSSI lose to any that have one
+NO_RSSI = -1000
+LATENCY_SAMPLES = 1000
+RECV_SIZE = 2048
+
+
+def packet_key(packet):
+    # Same reading heard by different gateways -> same key. The RSSI field
+    # (R) differs between gateways so it is left out.
+    fields = ['{}{}'.format(label, data.strip()) for label, data in PACKET_FIELDS.findall(packet)
+              if label != 'R']
+    return hashlib.sha1(' '.join(fields).encode()).hexdigest()[:16]
+
+
+class _Offer:
+    __slots__ = ('key', 'rssi', 'on_win', 'offered_at', 'deadline', 'beaten')
+
+    def __init__(self, key, rssi, on_win, offered_at, deadline):
+        self.key = key
+        self.rssi = rssi
+        self.on_win = on_win
+        self.offered_at = offered_at
+        self.deadline = deadline
+        self.beaten = False
+
+
+class Coordinator:
+    def __init__(self, gateway_id, group=DEFAULT_GROUP, port=DEFAULT_PORT, window=DEFAULT_WINDOW,
+                 interface='0.0.0.0'):
+        self.gateway_id = gateway_id
+        self.group = group
+        self.port = port
+        self.window = window
+        self.interface = interface
+        self.sock = None
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # key -> (best remote score, when). Scores are (rssi, gateway_id).
+        self._remote = OrderedDict()
+        # key -> when, for packets some gateway already forwarded
+        self._taken = OrderedDict()
+        self._pending = {}  # key -> _Offer
+        self._deadlines = []  # heap of (deadline, key)
+        self._peers = {}  # gateway_id -> last heard
+        self._stopped = threading.Event()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.counts = Counter()
+
+    @classmethod
+    def from_env(cls):
+        return cls(gateway_id=os.getenv('GATEWAY_ID') or platform.node(),
+                   group=os.getenv('COORDINATION_GROUP', DEFAULT_GROUP),
+                   port=int(os.getenv('COORDINATION_PORT', DEFAULT_PORT)),
+                   window=float(os.getenv('COORDINATION_WINDOW', DEFAULT_WINDOW)),
+                   interface=os.getenv('COORDINATION_INTERFACE', '0.0.0.0'))
+
+    def start(self):
+        try:
+            self.sock = self._open_socket()
+        except OSError as e:
+            print("Can't join coordination group {}:{}, forwarding everything: {!r}".format(
+                self.group, self.port, e))
+            self.sock = None
+        else:
+            threading.Thread(target=self._listen, name='coordination-listen', daemon=True).start()
+        threading.Thread(target=self._decide, name='coordination-decide', daemon=True).start()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Several gateways on one host, see simulate_gateways.py
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.port))
+        membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton(self.interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+        # Stay on the local network
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sock.settimeout(1)
+        return sock
+
+    def _score(self, rssi, gateway_id):
+        return (NO_RSSI if rssi is None else rssi, gateway_id)
+
+    def _send(self, message):
+        if self.sock is None:
+            return
+        message['g'] = self.gateway_id
+        try:
+            self.sock.sendto(json.dumps(message, separators=(',', ':')).encode(), (self.group, self.port))
+            self.counts['sent'] += 1
+        except OSError as e:
+            self.counts['send_errors'] += 1
+            print("Coordination send failed: {!r}".format(e))
+
+    def _has_peers(self, now):
+        return any(now - heard < PEER_TIMEOUT for heard in self._peers.values())
+
+    def offer(self, key, rssi, on_win):
+        # Never blocks. on_win() is called later, on the coordinator's
+        # thread, if this gateway should forward the packet.
+        now = time.monotonic()
+        ours = self._score(rssi, self.gateway_id)
+        with self._lock:
+            self.counts['offered'] += 1
+            self._expire(now)
+            if key in self._taken:
+                self.counts['dropped_taken'] += 1
+                return
+            remote = self._remote.get(key)
+            if remote is not None and remote[0] > ours:
+                self.counts['dropped_weaker'] += 1
+                return
+            offer = _Offer(key, rssi, on_win, now, now + self.window if self._has_peers(now) else now)
+            self._pending[key] = offer
+            heapq.heappush(self._deadlines, (offer.deadline, key))
+            self._wake.notify()
+        self._send({'k': key, 'r': rssi})
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            try:
+                data, _ = self.sock.recvfrom(RECV_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stopped.is_set():
+                    return
+                raise
+            try:
+                message = json.loads(data)
+                gateway_id, key = message['g'], message['k']
+            except (ValueError, KeyError, TypeError):
+                self.counts['bad_messages'] += 1
+                continue
+            if gateway_id == self.gateway_id:
+                continue
+            self._on_message(gateway_id, key, message)
+
+    def _on_message(self, gateway_id, key, message):
+        now = time.monotonic()
+        with self._lock:
+            self.counts['received'] += 1
+            self._peers[gateway_id] = now
+            self._expire(now)
+            if message.get('won'):
+                self._taken[key] = now
+                pending = self._pending.get(key)
+                if pending is not None:
+                    pending.beaten = True
+                return
+            score = self._score(message.get('r'), gateway_id)
+            remote = self._remote.get(key)
+            if remote is None:
+                self._remote[key] = (score, now)
+            elif score > remote[0]:
+                self._remote[key] = (score, remote[1])
+            pending = self._pending.get(key)
+            if pending is not None and score > self._score(pending.rssi, self.gateway_id):
+                pending.beaten = True
+
+    def _expire(self, now):
+        # Called with the lock held. Both tables are in insertion order.
+        for table in (self._remote, self._taken):
+            while table:
+                key, value = next(iter(table.items()))
+                when = value[1] if isinstance(value, tuple) else value
+                if now - when < KEY_TTL:
+                    break
+                table.popitem(last=False)
+
+    def _decide(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                while not self._deadlines and not self._stopped.is_set():
+                    self._wake.wait(1)
+                if self._stopped.is_set():
+                    return
+                deadline, key = self._deadlines[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self._wake.wait(deadline - now)
+                    continue
+                heapq.heappop(self._deadlines)
+                offer = self._pending.pop(key, None)
+                if offer is None:
+                    continue
+                if offer.beaten:
+                    self.counts['lost'] += 1
+                    continue
+                self.counts['won'] += 1
+                self._taken[key] = now
+                self._latencies.append(now - offer.offered_at)
+            self._send({'k': key, 'won': 1})
+            try:
+                offer.on_win()
+            except Exception as e:
+                print("Forwarding packet {} failed: {!r}".format(key, e))
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, timeout=None):
+        # Waits for the decisions still pending. Returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            self._wake.notify_all()
+        if self.sock is not None:
+            self.sock.close()
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = dict(self.counts)
+            stats['peers'] = sorted(g for g, heard in self._peers.items()
+                                    if time.monotonic() - heard < PEER_TIMEOUT)
+        stats['decision_p50_ms'] = None if not latencies else round(1000 * percentile(latencies, 0.5), 1)
+        stats['decision_max_ms'] = None if not latencies else round(1000 * max(latencies), 1)
+        return stats
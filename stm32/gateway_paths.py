@@ -0,0 +1,41 @@
+# Where the gateway keeps the state that has to outlive a restart or an
+# update: the outbox, the readings database, the per-animal state, the
+# shadow cache, the supervisor's run directory and loraPackets.log.
+#
+# They all default to a file in GATEWAY_DATA_DIR. When the code runs from
+# a release unpacked by update_gateway.py (GATEWAY_HOME/releases/<commit>/)
+# that defaults to GATEWAY_HOME/data, which every release shares, so the
+# readings still in the outbox when `current` is switched are sent by the
+# new release instead of staying behind in the old one. Otherwise it is
+# the working directory, as before.
+#
+#   outbox = Outbox(os.getenv('OUTBOX_DB') or data_path(DEFAULT_OUTBOX_DB))
+#
+# Settings (.env): GATEWAY_DATA_DIR
+
+import os
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def data_dir(configured=None):
+    # '' for the working directory. Read on every call, the supervisor may
+    # have imported this module before the setting was loaded.
+    if configured is None:
+        configured = os.getenv('GATEWAY_DATA_DIR')
+    if configured:
+        return configured
+    # <GATEWAY_HOME>/releases/<commit>/stm32
+    release = os.path.dirname(SCRIPT_DIR)
+    releases = os.path.dirname(release)
+    if os.path.basename(releases) == 'releases':
+        return os.path.join(os.path.dirname(releases), 'data')
+    return ''
+
+
+def data_path(name, configured=None):
+    directory = data_dir(configured)
+    if not directory:
+        return name
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
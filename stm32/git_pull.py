@@ -1,8 +1,14 @@
-#import  git 
+# Kept so existing job documents that run git_pull.py still work. Updates now
+# go through update_gateway.py, which verifies the new version, switches to it
+# atomically and rolls back if it fails its health check.
+import subprocess
+import sys
 
-#repo = git.Repo('name_of_repo')
-#origin = repo.remote(name='origin')
-#origin.pull()
+from update_gateway import UpdateError, parser, update
 
-import subprocess
-subprocess.call(["git", "pull"])
\ No newline at end of file
+args = parser.parse_args()
+try:
+    update(args)
+except (UpdateError, subprocess.CalledProcessError) as e:
+    print("Update failed: {}".format(e))
+    sys.exit(1)
@@ -0,0 +1,32 @@
+# Liveness heartbeat for scripts run by supervisor.py.
+#
+# The supervisor passes each child a file in SUPERVISOR_HEARTBEAT_FILE. A
+# script calls beat() from its main loop, which touches that file at most
+# once a second. If the file goes stale the supervisor restarts the script,
+# so a main loop stuck on a dead port or a lock is caught as well as a
+# crash. Outside the supervisor beat() does nothing.
+
+import os
+import time
+
+MIN_INTERVAL = 1.0
+
+_last_beat = 0.0
+
+
+def beat():
+    global _last_beat
+    # Read on every call, the supervisor may have imported this module
+    # before forking the child that sets it
+    path = os.getenv('SUPERVISOR_HEARTBEAT_FILE')
+    if not path:
+        return
+    now = time.monotonic()
+    if now - _last_beat < MIN_INTERVAL:
+        return
+    _last_beat = now
+    try:
+        with open(path, 'a'):
+            os.utime(path)
+    except OSError:
+        pass
@@ -0,0 +1,191 @@
+# A local HTTP file server stand-in for trying out artifacts.py.
+#
+# Serves files from memory or a directory with HEAD, GET and single Range
+# requests (206 Partial Content), and can behave like the far end of a
+# poor uplink:
+#
+#   rate         bytes per second each connection is sent at most
+#   ranges       False to ignore Range headers and not advertise them,
+#                like some servers and proxies
+#   break_after  cut every connection once that many more bytes have been
+#                sent in total, and refuse new requests until heal()
+#   drop_every   cut each response after that many bytes, while new
+#                requests still go through, like a link that keeps dropping
+#
+# It counts requests and bytes sent, so a check can tell a download that
+# resumed from one that started over.
+#
+# Example:
+#   python http_standin.py --serve ./firmware --port 8000 --rate 500000
+
+import argparse
+import collections
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCK = 16 * 1024
+RANGE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+parser = argparse.ArgumentParser(description="Serve files over HTTP with Range requests and a slow link.")
+parser.add_argument('--serve', required=True, help='directory to serve')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--rate', type=float, default=0, help='bytes/s per connection, 0 for no limit')
+parser.add_argument('--no-ranges', action='store_true', help='ignore Range requests')
+parser.add_argument('--drop-every', type=int, default=0, help='cut each response after this many bytes')
+
+
+class HttpStandIn:
+    def __init__(self, files=None, directory=None, port=0, rate=0, ranges=True, drop_every=0):
+        # files: {'/path': bytes}, looked up before `directory`
+        self.files = dict(files or {})
+        self.directory = directory
+        self.rate = rate
+        self.ranges = ranges
+        self.drop_every = drop_every
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._budget = None
+        self._broken = False
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                standin._handle(self, body=False)
+
+            def do_GET(self):
+                standin._handle(self, body=True)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.port, path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='http-standin', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def break_after(self, nbytes):
+        with self._lock:
+            self._budget = nbytes
+
+    def heal(self):
+        with self._lock:
+            self._budget = None
+            self._broken = False
+
+    def _content(self, path):
+        if path in self.files:
+            return self.files[path]
+        if self.directory is not None:
+            local = os.path.normpath(os.path.join(self.directory, path.lstrip('/')))
+            if local.startswith(os.path.abspath(self.directory)) and os.path.isfile(local):
+                with open(local, 'rb') as f:
+                    return f.read()
+        return None
+
+    def _spend(self, nbytes):
+        # How many of nbytes may still be sent before the link breaks
+        with self._lock:
+            if self._budget is None:
+                return nbytes
+            allowed = min(nbytes, self._budget)
+            self._budget -= allowed
+            if not self._budget:
+                self._broken = True
+            return allowed
+
+    def _handle(self, request, body):
+        with self._lock:
+            broken = self._broken
+            self.counts['requests'] += 1
+        if broken:
+            self.counts['refused'] += 1
+            request.close_connection = True
+            return
+        content = self._content(request.path.split('?')[0])
+        if content is None:
+            request.send_error(404)
+            return
+        start, end = 0, len(content) - 1
+        match = RANGE.match(request.headers.get('Range', '')) if self.ranges else None
+        if match is not None:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            if start > end:
+                request.send_response(416)
+                request.send_header('Content-Range', 'bytes */{}'.format(len(content)))
+                request.end_headers()
+                return
+            request.send_response(206)
+            request.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(content)))
+            self.counts['range_requests'] += 1
+        else:
+            request.send_response(200)
+        if self.ranges:
+            request.send_header('Accept-Ranges', 'bytes')
+        request.send_header('Content-Length', str(end - start + 1))
+        request.send_header('ETag', '"{:x}"'.format(hash(content) & 0xffffffff))
+        request.end_headers()
+        if body:
+            self._send(request, content[start:end + 1])
+
+    def _send(self, request, data):
+        sent = 0
+        started = time.monotonic()
+        while sent < len(data):
+            block = data[sent:sent + BLOCK]
+            if self.drop_every:
+                block = block[:self.drop_every - sent]
+            allowed = self._spend(len(block))
+            try:
+                request.wfile.write(block[:allowed])
+            except OSError:
+                return
+            sent += allowed
+            with self._lock:
+                self.counts['bytes_sent'] += allowed
+            if allowed < len(block):
+                # The link broke in the middle of this response
+                request.close_connection = True
+                return
+            if self.drop_every and self.drop_every <= sent < len(data):
+                with self._lock:
+                    self.counts['dropped'] += 1
+                request.close_connection = True
+                return
+            if self.rate:
+                # Paced from the start of the response, not per block
+                delay = started + sent / self.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def main():
+    args = parser.parse_args()
+    standin = HttpStandIn(directory=os.path.abspath(args.serve), port=args.port, rate=args.rate,
+                          ranges=not args.no_ranges, drop_every=args.drop_every)
+    print("Serving {} on {}".format(args.serve, standin.url('/')))
+    standin.start()
+    try:
+        while True:
+            time.sleep(10)
+            print(dict(standin.counts))
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()
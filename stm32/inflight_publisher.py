@@ -0,0 +1,300 @@
+# QoS 1 publishing with a bounded number of messages in flight.
+#
+# mqtt_connection.publish() returns straight away and the client queues
+# whatever it can't send yet, so on a slow link readings pile up in memory
+# and nothing tells the caller. InFlightPublisher keeps at most `window`
+# messages waiting for their PUBACK. Once the window is full, publish()
+# blocks until a slot frees up (backpressure), or after `timeout` seconds
+# writes the message to the outbox instead.
+#
+# When the connection drops, everything still waiting on a PUBACK is written
+# to the outbox (outbox.py) and new messages go straight there. After the
+# connection resumes the outbox is drained through the same window. A
+# message saved to the outbox while connected (it timed out of the window,
+# or a full lane made room, see priority_lanes.py) starts a drain too. A
+# message is deleted from the outbox once the broker acknowledges it.
+#
+#   publisher = InFlightPublisher(mqtt_connection, outbox=Outbox())
+#   publisher.start()
+#   publisher.publish('test/temp', json.dumps(message))
+#   ...
+#   publisher.close(timeout=10)
+#
+# Settings (.env): PUBLISH_WINDOW
+
+import collections
+import os
+import threading
+import time
+
+from lazy_import import lazy_import
+
+mqtt = lazy_import('awscrt.mqtt')
+
+DEFAULT_WINDOW = 100
+LATENCY_SAMPLES = 1000
+
+
+class _Pending:
+    __slots__ = ('topic', 'payload', 'qos', 'outbox_id', 'on_done', 'sent_at')
+
+    def __init__(self, topic, payload, qos, outbox_id, on_done):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.outbox_id = outbox_id
+        self.on_done = on_done
+        self.sent_at = time.monotonic()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class InFlightPublisher:
+    def __init__(self, mqtt_connection, window=None, outbox=None):
+        self.mqtt_connection = mqtt_connection
+        self.window = window or int(os.getenv('PUBLISH_WINDOW', DEFAULT_WINDOW))
+        self.outbox = outbox
+        self._slots = threading.BoundedSemaphore(self.window)
+        self._lock = threading.Lock()
+        self._in_flight = {}  # seq -> _Pending
+        self._next_seq = 0
+        self._connected = threading.Event()
+        self._closed = False
+        self._drain_thread = None
+        # Set by drain() while a drain is under way, so rows saved after it
+        # last looked aren't left behind
+        self._drain_requested = False
+        # Optional Event, the outbox is only drained while it is set (see
+        # priority_lanes.py)
+        self.drain_gate = None
+        # For sharded_publisher.py: whether this publisher drains the outbox
+        # when its connection resumes, and the other publishers sharing the
+        # outbox, whose rows are left alone while they are connected
+        self.drains_outbox = True
+        self.outbox_peers = ()
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.counts = collections.Counter()
+        self.blocked_seconds = 0.0
+
+    def start(self):
+        # Call once connected. Sends anything left in the outbox by a
+        # previous run.
+        self.on_connection_resumed()
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def publish(self, topic, payload, qos=None, on_done=None, timeout=None, key=None):
+        # Returns True once the message is handed to the client, False if it
+        # went to the outbox instead. on_done(error) is called when the
+        # broker acknowledges it (error is None) or the publish fails.
+        # qos defaults to AT_LEAST_ONCE. key is only used by
+        # ShardedPublisher, everything here goes over one connection.
+        if qos is None:
+            qos = mqtt.QoS.AT_LEAST_ONCE
+        if self.outbox is not None and not self._connected.is_set():
+            self.spool(topic, payload, qos)
+            return False
+        if not self._slots.acquire(blocking=False):
+            self.counts['blocked'] += 1
+            waited_from = time.monotonic()
+            # Without an outbox there is nowhere else to put it, so wait
+            acquired = self._slots.acquire(timeout=timeout if self.outbox is not None else None)
+            self.blocked_seconds += time.monotonic() - waited_from
+            if not acquired:
+                self.spool(topic, payload, qos)
+                return False
+        self._send(topic, payload, qos, None, on_done)
+        return True
+
+    def _send(self, topic, payload, qos, outbox_id, on_done):
+        # The caller holds a slot
+        pending = _Pending(topic, payload, qos, outbox_id, on_done)
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._in_flight[seq] = pending
+        try:
+            publish_future, _ = self.mqtt_connection.publish(topic=topic, payload=payload, qos=qos)
+        except Exception as e:
+            with self._lock:
+                self._in_flight.pop(seq, None)
+            self._slots.release()
+            self._failed(pending, e)
+            return
+        self.counts['sent'] += 1
+        publish_future.add_done_callback(lambda f, seq=seq: self._on_publish_done(seq, f))
+
+    def _on_publish_done(self, seq, publish_future):
+        # Runs on the connection's event loop thread
+        error = publish_future.exception()
+        with self._lock:
+            pending = self._in_flight.pop(seq, None)
+            # Deleted under the lock so the outbox drain never sees a row
+            # that is neither in flight nor waiting to be sent
+            if pending is not None and error is None and pending.outbox_id is not None:
+                self.outbox.delete([pending.outbox_id])
+        self._slots.release()
+        if pending is None:
+            return
+        if error is not None:
+            self._failed(pending, error)
+            return
+        self.counts['acked'] += 1
+        self._latencies.append(time.monotonic() - pending.sent_at)
+        if pending.on_done:
+            pending.on_done(None)
+
+    def _failed(self, pending, error):
+        self.counts['failed'] += 1
+        print("Publish to '{}' failed: {!r}".format(pending.topic, error))
+        # Already in the outbox if it was spooled, it stays there for the
+        # next drain
+        if self.outbox is not None and pending.outbox_id is None:
+            self.spool(pending.topic, pending.payload, pending.qos)
+        if pending.on_done:
+            pending.on_done(error)
+
+    def spool(self, topic, payload, qos):
+        if self.outbox is None:
+            raise RuntimeError('No outbox to hold the message for {}'.format(topic))
+        self.outbox.put(topic, payload, mqtt.QoS.AT_LEAST_ONCE if qos is None else qos)
+        self.counts['spooled'] += 1
+        if self._connected.is_set():
+            # Otherwise nothing sends it before the next reconnect
+            drainer = self if self.drains_outbox else next(
+                (peer for peer in self.outbox_peers if peer.drains_outbox and peer.connected), None)
+            if drainer is not None:
+                drainer.drain()
+
+    def _spool_in_flight(self):
+        # Writes everything still waiting on a PUBACK to the outbox. The
+        # messages stay in flight, an ack that arrives later deletes them.
+        with self._lock:
+            unsaved = [p for p in self._in_flight.values() if p.outbox_id is None]
+            if not unsaved or self.outbox is None:
+                return 0
+            ids = self.outbox.put_many([(p.topic, p.payload, p.qos) for p in unsaved])
+            for pending, outbox_id in zip(unsaved, ids):
+                pending.outbox_id = outbox_id
+        self.counts['spooled'] += len(unsaved)
+        return len(unsaved)
+
+    def on_connection_interrupted(self):
+        self._connected.clear()
+        saved = self._spool_in_flight()
+        if saved:
+            print("Saved {} unacknowledged message(s) to the outbox".format(saved))
+
+    def on_connection_resumed(self):
+        self._connected.set()
+        if self.drains_outbox:
+            self.drain()
+
+    def drain(self):
+        # Starts sending the outbox, unless that is already under way
+        if self.outbox is None or not self._connected.is_set():
+            return
+        with self._lock:
+            if self._closed:
+                return
+            self._drain_requested = True
+            if self._drain_thread is not None:
+                return
+            self._drain_thread = threading.Thread(target=self._drain_outbox, name='outbox-drain', daemon=True)
+            self._drain_thread.start()
+
+    def _drain_outbox(self):
+        try:
+            self._drain_rows()
+        finally:
+            with self._lock:
+                if self._drain_thread is threading.current_thread():
+                    self._drain_thread = None
+
+    def _drain_rows(self):
+        after_id = 0
+        drained = 0
+        while self._connected.is_set() and not self._closed:
+            # Taken before the peek: a row a peer acknowledges in between is
+            # gone from the outbox by the time it is read
+            peer_ids = set()
+            for peer in self.outbox_peers:
+                if peer.connected:
+                    peer_ids.update(peer.outbox_ids_in_flight())
+            with self._lock:
+                if after_id == 0:
+                    self._drain_requested = False
+                rows = self.outbox.peek(self.window, after_id)
+                # Messages saved at the interruption are still in flight and
+                # the client retries them itself. A disconnected peer's are
+                # taken over.
+                in_flight_ids = set(p.outbox_id for p in self._in_flight.values()) | peer_ids
+            if not rows:
+                with self._lock:
+                    if not self._drain_requested:
+                        # drain() starts a new thread from here on
+                        self._drain_thread = None
+                        break
+                # Rows were saved since this pass started, go round again
+                after_id = 0
+                continue
+            for outbox_id, topic, payload, qos in rows:
+                after_id = outbox_id
+                if outbox_id in in_flight_ids:
+                    continue
+                while self.drain_gate is not None and not self.drain_gate.wait(timeout=1):
+                    if not self._connected.is_set() or self._closed:
+                        return
+                while not self._slots.acquire(timeout=1):
+                    if not self._connected.is_set() or self._closed:
+                        return
+                self._send(topic, payload, mqtt.QoS(qos), outbox_id, None)
+                drained += 1
+        if drained:
+            print("Re-sent {} message(s) from the outbox".format(drained))
+
+    def outbox_ids_in_flight(self):
+        with self._lock:
+            return set(p.outbox_id for p in self._in_flight.values() if p.outbox_id is not None)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def wait(self, timeout=None):
+        # Waits until nothing is in flight. Returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.in_flight():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout=None):
+        # Waits up to `timeout` for outstanding PUBACKs, then saves whatever
+        # is left to the outbox. Returns the number of messages saved.
+        self._closed = True
+        self.wait(timeout)
+        return self._spool_in_flight()
+
+    def stats(self):
+        latencies = list(self._latencies)
+        stats = dict(self.counts)
+        stats.update({
+            'in_flight': self.in_flight(),
+            'window': self.window,
+            'blocked_seconds': round(self.blocked_seconds, 3),
+            'ack_p50_ms': None if not latencies else round(1000 * percentile(latencies, 0.5), 1),
+            'ack_p95_ms': None if not latencies else round(1000 * percentile(latencies, 0.95), 1),
+            'ack_max_ms': None if not latencies else round(1000 * max(latencies), 1),
+        })
+        if self.outbox is not None:
+            stats['outbox'] = self.outbox.count()
+        return stats
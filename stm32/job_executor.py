@@ -0,0 +1,277 @@
+# Runs AWS IoT job documents on a bounded worker pool.
+#
+# A job document is a list of steps (see test_jobs.py). Each step runs to
+# completion before the steps that depend on it start, its stdout/stderr is
+# streamed to the console as it is produced, and its real exit code and
+# duration are collected so the job can be reported as SUCCEEDED or FAILED.
+#
+# Several jobs can run at the same time. The pool size caps the total, and
+# an optional per-job-type limit stops e.g. two package installs from
+# running at once while config changes still go through in parallel.
+#
+#   {
+#       "jobType": "install",
+#       "steps": [
+#           {"action": {"name": "fetch", "type": "runHandler",
+#                       "input": {"handler": "git_pull.py"}}},
+#           {"action": {"name": "restart", "type": "runHandler",
+#                       "input": {"handler": "restart.py", "args": ["uart"]},
+#                       "dependsOn": ["fetch"]}}
+#       ]
+#   }
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+DEFAULT_JOB_TYPE = 'default'
+DEFAULT_MAX_WORKERS = 4
+# Number of trailing output lines kept per step for the job status report
+OUTPUT_TAIL_LINES = 20
+# AWS IoT limits the size of each statusDetails value
+MAX_STATUS_DETAIL_LENGTH = 1024
+# Finished executions remembered so a stale request for one is not run again
+FINISHED_JOBS_REMEMBERED = 256
+
+
+def parse_concurrency_limits(spec):
+    # 'install=1, config=4' -> {'install': 1, 'config': 4}
+    limits = {}
+    if not spec:
+        return limits
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        job_type, _, limit = entry.partition('=')
+        if not limit:
+            raise ValueError("Concurrency limit '{}' must look like <jobType>=<count>".format(entry))
+        limits[job_type.strip()] = int(limit)
+    return limits
+
+
+def job_type_of(job_document):
+    return job_document.get('jobType') or DEFAULT_JOB_TYPE
+
+
+def order_steps(steps):
+    # Returns the steps sorted so that every step comes after the steps named
+    # in its 'dependsOn' list. Steps without a name are referred to by their
+    # position, and steps without dependencies keep their document order.
+    named = []
+    for index, step in enumerate(steps):
+        action = step['action']
+        name = action.get('name') or str(index)
+        depends_on = action.get('dependsOn') or step.get('dependsOn') or []
+        named.append((name, depends_on, step))
+
+    names = [name for name, _, _ in named]
+    if len(set(names)) != len(names):
+        raise ValueError('Job document has duplicate step names: {}'.format(names))
+    for name, depends_on, _ in named:
+        for dependency in depends_on:
+            if dependency not in names:
+                raise ValueError("Step '{}' depends on unknown step '{}'".format(name, dependency))
+
+    ordered = []
+    done = set()
+    remaining = list(named)
+    while remaining:
+        ready = [item for item in remaining if all(d in done for d in item[1])]
+        if not ready:
+            raise ValueError('Job document steps have a dependency cycle: {}'.format(
+                [name for name, _, _ in remaining]))
+        for item in ready:
+            ordered.append((item[0], item[2]))
+            done.add(item[0])
+            remaining.remove(item)
+    return ordered
+
+
+def handler_command(action_input):
+    command = [sys.executable, action_input['handler']]
+    args = action_input.get('args')
+    if isinstance(args, str):
+        command.extend(shlex.split(args))
+    elif args:
+        command.extend(str(arg) for arg in args)
+    return command
+
+
+class StepResult:
+    def __init__(self, name, exit_code, duration, output_tail):
+        self.name = name
+        self.exit_code = exit_code
+        self.duration = duration
+        self.output_tail = output_tail
+
+    @property
+    def succeeded(self):
+        return self.exit_code == 0
+
+
+class JobResult:
+    def __init__(self, job_id, job_type):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.steps = []
+        self.error = None
+        self.duration = 0.0
+
+    @property
+    def succeeded(self):
+        return self.error is None and all(step.succeeded for step in self.steps)
+
+    @property
+    def exit_code(self):
+        for step in self.steps:
+            if not step.succeeded:
+                return step.exit_code
+        return 0 if self.error is None else -1
+
+    def status_details(self):
+        # statusDetails in UpdateJobExecutionRequest only accepts string values
+        details = {
+            'exitCode': str(self.exit_code),
+            'durationSeconds': '{:.3f}'.format(self.duration),
+            'stepsRun': str(len(self.steps)),
+        }
+        failed = [step for step in self.steps if not step.succeeded]
+        if failed:
+            details['failedStep'] = failed[0].name
+            details['output'] = failed[0].output_tail[-MAX_STATUS_DETAIL_LENGTH:]
+        if self.error is not None:
+            details['error'] = str(self.error)[:MAX_STATUS_DETAIL_LENGTH]
+        return details
+
+
+def run_handler_step(job_id, name, action_input):
+    # Runs a python handler, echoing its output line by line as it arrives
+    command = handler_command(action_input)
+    timeout = action_input.get('timeoutSeconds')
+    print("[{}/{}] Running: {}".format(job_id, name, command))
+    proc = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(float(timeout), proc.kill)
+        timer.start()
+
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    try:
+        for line in proc.stdout:
+            line = line.rstrip('\n')
+            tail.append(line)
+            print("[{}/{}] {}".format(job_id, name, line), flush=True)
+        exit_code = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        proc.stdout.close()
+    return exit_code, '\n'.join(tail)
+
+
+class JobExecutor:
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, type_limits=None, step_runners=None):
+        self.max_workers = max_workers
+        self.type_limits = dict(type_limits or {})
+        self.step_runners = {'runHandler': run_handler_step}
+        if step_runners:
+            self.step_runners.update(step_runners)
+        self._lock = threading.Lock()
+        self._running = {}  # job_id -> job_type
+        # (job_id, execution number) of finished jobs. A retry of a FAILED
+        # or TIMED_OUT job keeps its job_id but gets the next number.
+        self._finished = deque(maxlen=FINISHED_JOBS_REMEMBERED)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+
+    @classmethod
+    def from_env(cls, step_runners=None):
+        return cls(
+            max_workers=int(os.getenv('MAX_CONCURRENT_JOBS', DEFAULT_MAX_WORKERS)),
+            type_limits=parse_concurrency_limits(os.getenv('JOB_CONCURRENCY_LIMITS')),
+            step_runners=step_runners)
+
+    def running_job_ids(self):
+        with self._lock:
+            return set(self._running)
+
+    def is_known(self, job_id, execution_number=None):
+        # True if the job is running or this execution of it finished
+        # recently. A pending list or job document requested before a job
+        # finished can arrive after it.
+        with self._lock:
+            return job_id in self._running or (job_id, execution_number) in self._finished
+
+    def has_capacity(self, job_type=None):
+        with self._lock:
+            return self._has_capacity_locked(job_type)
+
+    def _has_capacity_locked(self, job_type):
+        if len(self._running) >= self.max_workers:
+            return False
+        if job_type is None or job_type not in self.type_limits:
+            return True
+        running_of_type = sum(1 for t in self._running.values() if t == job_type)
+        return running_of_type < self.type_limits[job_type]
+
+    def submit(self, job_id, job_document, on_done, on_start=None, execution_number=None):
+        # Starts the job if a slot is free for its type. Returns False (and does
+        # nothing) otherwise so the caller can leave the job queued in the cloud.
+        # on_start(job_id) and on_done(JobResult) are called from the worker
+        # thread, on_start before the first step runs.
+        job_type = job_type_of(job_document)
+        with self._lock:
+            if job_id in self._running or (job_id, execution_number) in self._finished:
+                return False
+            if not self._has_capacity_locked(job_type):
+                return False
+            self._running[job_id] = job_type
+        self._pool.submit(self._run_job, job_id, execution_number, job_type, job_document, on_done, on_start)
+        return True
+
+    def _run_job(self, job_id, execution_number, job_type, job_document, on_done, on_start):
+        result = JobResult(job_id, job_type)
+        start = time.monotonic()
+        try:
+            if on_start is not None:
+                on_start(job_id)
+            for name, step in order_steps(job_document['steps']):
+                step_result = self._run_step(job_id, name, step['action'])
+                result.steps.append(step_result)
+                if not step_result.succeeded:
+                    print("[{}/{}] Failed with exit code {}, skipping remaining steps".format(
+                        job_id, name, step_result.exit_code))
+                    break
+        except Exception as e:
+            result.error = e
+        result.duration = time.monotonic() - start
+
+        with self._lock:
+            self._running.pop(job_id, None)
+            self._finished.append((job_id, execution_number))
+        on_done(result)
+
+    def _run_step(self, job_id, name, action):
+        runner = self.step_runners.get(action['type'])
+        start = time.monotonic()
+        if runner is None:
+            return StepResult(name, -1, 0.0, "Unsupported action type '{}'".format(action['type']))
+        try:
+            exit_code, output = runner(job_id, name, action.get('input', {}))
+        except Exception as e:
+            exit_code, output = -1, '{}: {}'.format(type(e).__name__, e)
+        return StepResult(name, exit_code, time.monotonic() - start, output)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,52 @@
+# Deferred imports for heavy modules.
+#
+#   mqtt = lazy_import('awscrt.mqtt')
+#   ...
+#   mqtt.QoS.AT_LEAST_ONCE      # awscrt.mqtt is actually imported here
+#
+# The module is only imported on first attribute access, so a script can
+# open its serial port and start reading before paying for awscrt and
+# friends. If the module is already imported (e.g. preloaded by
+# supervisor.py) that module is returned as is.
+#
+# The first access imports the module under a lock, so several threads
+# reaching for it at once all wait for the import to finish instead of
+# seeing a half initialised module (importlib's LazyLoader isn't safe for
+# that before Python 3.12). Call load() to get the import out of the way
+# at a convenient moment.
+
+import importlib
+import importlib.util
+import sys
+import threading
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return module
+
+    def __getattr__(self, attribute):
+        # Only called for attributes the proxy itself doesn't have
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return '<lazy module {!r}{}>'.format(self._name, '' if self._module is None else ', loaded')
+
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError('No module named {!r}'.format(name), name=name)
+    return LazyModule(name)
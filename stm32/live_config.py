@@ -0,0 +1,251 @@
+# Live view of the .env configuration shared by the gateway scripts.
+#
+# The scripts used to read .env once through load_dotenv(), so any change
+# meant restarting them, which costs a new TLS handshake and whatever was
+# sitting in the UART buffer. LiveConfig keeps the current values in memory,
+# watches .env for changes (inotify on Linux, mtime polling elsewhere) and
+# calls back into the running script with just the keys that changed.
+#
+# Writers (updateConfiguration.py, the job agent, shadow sync) go through
+# update_env_file(), which rewrites the whole file in one os.replace() so a
+# reader never sees half of a multi-key change.
+#
+#   config = LiveConfig()
+#   config.subscribe(on_config_changed, keys=['SAMPLE_FREQUENCY'])
+#   config.start_watching()
+#   ...
+#   timeout = config.get_float('SAMPLE_FREQUENCY', 5)
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import tempfile
+import threading
+
+import dotenv
+
+POLL_INTERVAL = 1.0
+
+# Keys that need a new MQTT connection to take effect. They are still
+# reloaded, but the scripts only pick them up when they next connect.
+RESTART_REQUIRED_KEYS = ('AWS_ENDPOINT', 'AWS_ENDPOINTS', 'CERT_FILE', 'PRI_KEY_FILE', 'ROOT_CA_FILE',
+                         'THING_NAME', 'MQTT_VERSION', 'MQTT_TOPIC_ALIASES', 'MQTT_TLS', 'MQTT_PORT', 'SUBSCRIBE_ECHO',
+                         'PUBLISH_SHARDS')
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _quote(value):
+    value = str(value)
+    return "'{}'".format(value.replace("'", "\\'"))
+
+
+def update_env_file(path, updates):
+    # Writes all updates to the .env file at once. Existing lines and comments
+    # are kept, changed keys are rewritten in place and new keys are appended.
+    updates = {str(key): value for key, value in updates.items()}
+    # A release's .env links to the shared one (see update_gateway.py),
+    # which is the file to change, not the link
+    if os.path.islink(path):
+        path = os.path.realpath(path)
+    lines = []
+    if os.path.exists(path):
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+    remaining = dict(updates)
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#') or '=' not in stripped:
+            continue
+        key = stripped.split('=', 1)[0].strip()
+        if key.startswith('export '):
+            key = key[len('export '):].strip()
+        if key in remaining:
+            lines[i] = '{}={}'.format(key, _quote(remaining.pop(key)))
+    for key, value in remaining.items():
+        lines.append('{}={}'.format(key, _quote(value)))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.env.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class _Inotify:
+    # Just enough of inotify(7) through ctypes to wait for one directory
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, directory.encode(), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        # Returns the names of the files touched, or [] after the timeout
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+            _, _, _, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            names.append(data[offset:offset + length].rstrip(b'\0').decode(errors='replace'))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LiveConfig:
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path or dotenv.find_dotenv(usecwd=True) or '.env')
+        self._lock = threading.Lock()
+        self._values = self._read()
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, key, default=None):
+        value = self._values.get(key)
+        if value is None or value == '':
+            return os.getenv(key, default)
+        return value
+
+    def get_float(self, key, default=None):
+        value = self.get(key)
+        return default if value is None else float(value)
+
+    def get_int(self, key, default=None):
+        value = self.get(key)
+        return default if value is None else int(value)
+
+    def snapshot(self):
+        return dict(self._values)
+
+    def subscribe(self, callback, keys=None):
+        # callback(changes) where changes maps key -> (old, new). With keys
+        # given, only changes that touch one of them are passed on.
+        with self._lock:
+            self._subscribers.append((callback, set(keys) if keys else None))
+
+    def _read(self):
+        return dict(dotenv.dotenv_values(self.path)) if os.path.exists(self.path) else {}
+
+    def reload(self):
+        return self._swap(self._read())
+
+    def apply(self, updates, persist=True):
+        # Applies updates from a job or shadow message. The file is written
+        # first so the new values survive a restart and reach the other scripts.
+        updates = {key: str(value) for key, value in updates.items()}
+        if persist:
+            update_env_file(self.path, updates)
+        values = self.snapshot()
+        values.update(updates)
+        return self._swap(values)
+
+    def _swap(self, values):
+        with self._lock:
+            old = self._values
+            changes = {
+                key: (old.get(key), values.get(key))
+                for key in set(old) | set(values)
+                if old.get(key) != values.get(key)}
+            # One assignment, so readers see either the old or the new values
+            self._values = values
+            subscribers = list(self._subscribers)
+
+        for key, (_, new) in changes.items():
+            if new is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = new
+        if not changes:
+            return changes
+
+        print("Configuration changed: {}".format(
+            {key: new for key, (_, new) in changes.items()}))
+        restart_keys = [key for key in changes if key in RESTART_REQUIRED_KEYS]
+        if restart_keys:
+            print("Changes to {} take effect on the next connection.".format(restart_keys))
+        for callback, keys in subscribers:
+            relevant = changes if keys is None else {k: v for k, v in changes.items() if k in keys}
+            if relevant:
+                try:
+                    callback(relevant)
+                except Exception as e:
+                    print("Configuration callback failed: {!r}".format(e))
+        return changes
+
+    def start_watching(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='config_watch', daemon=True)
+            self._thread.start()
+
+    def stop_watching(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        name = os.path.basename(self.path)
+        try:
+            notifier = _Inotify(os.path.dirname(self.path))
+        except (OSError, AttributeError):
+            notifier = None
+            print("inotify unavailable, polling {} every {}s".format(self.path, POLL_INTERVAL))
+
+        last_mtime = self._mtime()
+        try:
+            while not self._stop.is_set():
+                if notifier is not None:
+                    if name not in notifier.wait(POLL_INTERVAL):
+                        continue
+                else:
+                    self._stop.wait(POLL_INTERVAL)
+                    mtime = self._mtime()
+                    if mtime == last_mtime:
+                        continue
+                    last_mtime = mtime
+                try:
+                    self.reload()
+                except Exception as e:
+                    print("Failed to reload {}: {!r}".format(self.path, e))
+        finally:
+            if notifier is not None:
+                notifier.close()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
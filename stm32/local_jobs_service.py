@@ -0,0 +1,287 @@
+# In-memory stand-in for the AWS IoT Jobs service.
+#
+# LocalJobsClient has the same subscribe_to_*/publish_* methods that
+# test_jobs.py uses on iotjobs.IotJobsClient, and hands back the same
+# iotjobs request/response objects, so the real callback chain in
+# test_jobs.py can be driven without a network connection or an AWS account.
+#
+# Responses and events are not delivered inline. They go through a small pool
+# of delivery threads with a random per-message delay, so replies to requests
+# can arrive out of order and concurrently, the same way they can over MQTT.
+# The service also checks a few invariants as it goes (a job started twice,
+# updates to a job that already finished) so callers can spot races in the
+# device-side state machine.
+
+from awsiot import iotjobs
+from concurrent.futures import Future
+import heapq
+import itertools
+import random
+import threading
+import time
+
+QUEUED = 'QUEUED'
+IN_PROGRESS = 'IN_PROGRESS'
+TERMINAL_STATUSES = ('SUCCEEDED', 'FAILED', 'REJECTED', 'CANCELED', 'REMOVED', 'TIMED_OUT')
+
+
+class LocalJobExecution:
+    def __init__(self, thing_name, job_id, job_document):
+        self.thing_name = thing_name
+        self.job_id = job_id
+        self.job_document = job_document
+        self.status = QUEUED
+        self.version = 1
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.status_details = None
+        self.start_count = 0
+
+    def data(self, include_job_document=True):
+        return iotjobs.JobExecutionData(
+            thing_name=self.thing_name,
+            job_id=self.job_id,
+            job_document=self.job_document if include_job_document else None,
+            status=self.status,
+            status_details=self.status_details,
+            version_number=self.version)
+
+    def summary(self):
+        return iotjobs.JobExecutionSummary(
+            job_id=self.job_id,
+            version_number=self.version)
+
+
+class Delivery:
+    # Runs callbacks on a pool of threads after a random delay
+    def __init__(self, threads=4, max_delay=0.0, seed=None):
+        self.max_delay = max_delay
+        self._random = random.Random(seed)
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._run, name='delivery-{}'.format(i), daemon=True)
+            for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def post(self, callback, arg):
+        with self._cond:
+            delay = self._random.uniform(0, self.max_delay) if self.max_delay else 0.0
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), callback, arg))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._heap:
+                        wait = self._heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    return
+                _, _, callback, arg = heapq.heappop(self._heap)
+            try:
+                callback(arg)
+            except Exception as e:
+                print("Delivery callback raised: {!r}".format(e))
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+class LocalJobsService:
+    def __init__(self, delivery_threads=4, max_delay=0.0, duplicate_event_rate=0.0, seed=None):
+        self.delivery = Delivery(threads=delivery_threads, max_delay=max_delay, seed=seed)
+        self.duplicate_event_rate = duplicate_event_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._executions = {}  # thing_name -> {job_id: LocalJobExecution}, in creation order
+        self._subscriptions = {}  # (thing_name, topic) -> callback
+        self.violations = []
+
+    def subscribe(self, thing_name, topic, callback):
+        with self._lock:
+            self._subscriptions[(thing_name, topic)] = callback
+
+    def _send(self, thing_name, topic, message):
+        callback = self._subscriptions.get((thing_name, topic))
+        if callback is not None:
+            self.delivery.post(callback, message)
+
+    def _violation(self, message):
+        self.violations.append(message)
+
+    def _next_execution_locked(self, thing_name):
+        # Same rule as the real service: oldest IN_PROGRESS first, then oldest QUEUED
+        executions = list(self._executions.get(thing_name, {}).values())
+        for status in (IN_PROGRESS, QUEUED):
+            for execution in executions:
+                if execution.status == status:
+                    return execution
+        return None
+
+    def _notify_next_changed_locked(self, thing_name):
+        execution = self._next_execution_locked(thing_name)
+        event = iotjobs.NextJobExecutionChangedEvent(
+            execution=execution.data() if execution else None,
+            timestamp=time.time())
+        copies = 1
+        while self._random.random() < self.duplicate_event_rate:
+            copies += 1
+        for _ in range(copies):
+            self._send(thing_name, 'next_changed', event)
+
+    def create_job(self, thing_name, job_id, job_document):
+        with self._lock:
+            executions = self._executions.setdefault(thing_name, {})
+            previous_next = self._next_execution_locked(thing_name)
+            executions[job_id] = LocalJobExecution(thing_name, job_id, job_document)
+            if previous_next is None:
+                self._notify_next_changed_locked(thing_name)
+
+    def executions(self, thing_name=None):
+        with self._lock:
+            if thing_name is not None:
+                return list(self._executions.get(thing_name, {}).values())
+            return [e for by_job in self._executions.values() for e in by_job.values()]
+
+    def get_pending(self, thing_name):
+        with self._lock:
+            executions = list(self._executions.get(thing_name, {}).values())
+            response = iotjobs.GetPendingJobExecutionsResponse(
+                in_progress_jobs=[e.summary() for e in executions if e.status == IN_PROGRESS],
+                queued_jobs=[e.summary() for e in executions if e.status == QUEUED],
+                timestamp=time.time())
+        self._send(thing_name, 'get_pending_accepted', response)
+
+    def describe(self, thing_name, request):
+        with self._lock:
+            execution = self._executions.get(thing_name, {}).get(request.job_id)
+            if execution is not None:
+                data = execution.data(include_job_document=bool(request.include_job_document))
+        if execution is None:
+            self._send(thing_name, 'describe_rejected', iotjobs.RejectedError(
+                client_token=request.client_token,
+                code='ResourceNotFound',
+                message='Job execution {} not found'.format(request.job_id)))
+        else:
+            self._send(thing_name, 'describe_accepted', iotjobs.DescribeJobExecutionResponse(
+                client_token=request.client_token,
+                execution=data,
+                timestamp=time.time()))
+
+    def update(self, thing_name, request):
+        status = str(request.status)
+        with self._lock:
+            execution = self._executions.get(thing_name, {}).get(request.job_id)
+            rejection = None
+            if execution is None:
+                rejection = ('ResourceNotFound', 'Job execution {} not found'.format(request.job_id))
+            elif execution.status in TERMINAL_STATUSES:
+                rejection = ('InvalidStateTransition', 'Job execution {} is already {}'.format(
+                    request.job_id, execution.status))
+                self._violation('{}/{}: update to {} after job was {}'.format(
+                    thing_name, request.job_id, status, execution.status))
+            else:
+                if status == IN_PROGRESS:
+                    execution.start_count += 1
+                    if execution.status == IN_PROGRESS:
+                        self._violation('{}/{}: started again while already IN_PROGRESS'.format(
+                            thing_name, request.job_id))
+                    else:
+                        execution.started_at = time.monotonic()
+                elif status in TERMINAL_STATUSES:
+                    execution.finished_at = time.monotonic()
+                previous_next = self._next_execution_locked(thing_name)
+                execution.status = status
+                execution.status_details = request.status_details
+                execution.version += 1
+                if self._next_execution_locked(thing_name) is not previous_next:
+                    self._notify_next_changed_locked(thing_name)
+
+        if rejection is not None:
+            code, message = rejection
+            self._send(thing_name, 'update_rejected', iotjobs.RejectedError(
+                client_token=request.client_token, code=code, message=message))
+        else:
+            self._send(thing_name, 'update_accepted', iotjobs.UpdateJobExecutionResponse(
+                client_token=request.client_token, timestamp=time.time()))
+
+    def stop(self):
+        self.delivery.stop()
+
+
+class LocalConnection:
+    # Minimal stand-in for the mqtt_connection that test_jobs.py disconnects on exit
+    def __init__(self, service, thing_name):
+        self.service = service
+        self.thing_name = thing_name
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+        future = Future()
+        future.set_result({})
+        return future
+
+
+def _done_future(result=None):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class LocalJobsClient:
+    # Drop-in for iotjobs.IotJobsClient, bound to one thing on a LocalJobsService
+    def __init__(self, connection):
+        self._service = connection.service
+        self._thing_name = connection.thing_name
+
+    def _subscribe(self, topic, callback):
+        self._service.subscribe(self._thing_name, topic, callback)
+        return _done_future({'qos': 1}), 0
+
+    def subscribe_to_next_job_execution_changed_events(self, request, qos, callback):
+        return self._subscribe('next_changed', callback)
+
+    def subscribe_to_get_pending_job_executions_accepted(self, request, qos, callback):
+        return self._subscribe('get_pending_accepted', callback)
+
+    def subscribe_to_get_pending_job_executions_rejected(self, request, qos, callback):
+        return self._subscribe('get_pending_rejected', callback)
+
+    def subscribe_to_describe_job_execution_accepted(self, request, qos, callback):
+        return self._subscribe('describe_accepted', callback)
+
+    def subscribe_to_describe_job_execution_rejected(self, request, qos, callback):
+        return self._subscribe('describe_rejected', callback)
+
+    def subscribe_to_update_job_execution_accepted(self, request, qos, callback):
+        return self._subscribe('update_accepted', callback)
+
+    def subscribe_to_update_job_execution_rejected(self, request, qos, callback):
+        return self._subscribe('update_rejected', callback)
+
+    def publish_get_pending_job_executions(self, request, qos):
+        self._service.get_pending(self._thing_name)
+        return _done_future()
+
+    def publish_describe_job_execution(self, request, qos):
+        self._service.describe(self._thing_name, request)
+        return _done_future()
+
+    def publish_update_job_execution(self, request, qos):
+        self._service.update(self._thing_name, request)
+        return _done_future()
@@ -0,0 +1,68 @@
+import re
+
+# Decoder for the text packets the STM32 receiver forwards over UART, shared by
+# publishUARTData.py, stm32_UART.py and replay_packets.py.
+#   'I08 T34.1 A1.16 -1.91 0.2' -> {'Device_ID': 8, 'Temperature': 34.1, 'Acceleration': '1.16 -1.91 0.2'}
+#   'I08 T34.1 R-87' -> {'Device_ID': 8, 'Temperature': 34.1, 'RSSI': -87}
+
+PACKET_FIELDS = re.compile(r'([a-zA-Z])+([^(a-zA-Z\n)]*)')
+
+
+def split_acceleration(accel_data):
+    return {datum: float(val) for datum, val in zip(['x', 'y', 'z'], accel_data.split())}
+
+
+def parse_lora_packet(packet_str, acceleration_as_dict=False):
+    map_message_ids = {
+        'I': {
+            'cast_func': int,
+            'full_name': 'Device_ID'
+        },
+        'T': {
+            'cast_func': float,
+            'full_name': 'Temperature'
+        },
+        'A': {
+            'cast_func': split_acceleration if acceleration_as_dict else str,
+            'full_name': 'Acceleration'
+        },
+        # Signal strength the receiver heard the packet at, if it adds one
+        'R': {
+            'cast_func': int,
+            'full_name': 'RSSI'
+        }
+    }
+    # Goal is to split a string with letters and data into two lists to build
+    # a dictionary from the packet. i.e. I08 T34.1 A1.16 -1.91 becomes
+    # {'Device_Id': 08, 'Temperature': 34.1, 'Acceleration': 1.16, -1.91}
+
+    # 'I08 T34.1 A1.16 -1.91' -> [('I', '08'), ('T', '34.1 '), ('A', '1.16 -1.91)]
+    data_points = PACKET_FIELDS.findall(packet_str)
+    # Build a dictionary by mapping letters to full labels and casting data based on given cast_func in map above
+    return {map_message_ids[label]['full_name']: map_message_ids[label]['cast_func'](data) for label, data in data_points}
+
+
+def build_message(data):
+    # Shape of the message published for each reading
+    data = dict(data)
+    return {
+        'Device_ID': data.pop('Device_ID'),
+        'Data': data
+    }
+
+
+# Downlink command kinds and the letter each is sent as
+DOWNLINK_FIELDS = {
+    'sample_interval': 'S',  # seconds between samples
+    'spreading_factor': 'D',  # LoRa data rate, 7-12
+    'ack': 'C',  # burst id received in full
+}
+
+
+def build_downlink(device_id, commands):
+    # Downlink to one collar in the same letter-prefixed format as the
+    # uplink: (8, [('sample_interval', 600), ('ack', 17)]) -> 'I08 S600 C17\n'
+    fields = ['I{:02d}'.format(int(device_id))]
+    fields += ['{}{}'.format(DOWNLINK_FIELDS[kind], int(round(value))) for kind, value in commands]
+    return ' '.join(fields) + '\n'
+
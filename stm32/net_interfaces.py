@@ -0,0 +1,238 @@
+# Network interfaces and their addresses, read straight from the kernel.
+#
+#   read_interfaces()
+#   -> {'wlan0': {'up': True, 'mac': 'b8:27:eb:12:34:56',
+#                 'addresses': ['192.168.1.20/24', 'fe80::ba27:ebff:fe12:3456/64']}}
+#
+# On Linux this is one rtnetlink dump of links and one of addresses, no
+# `hostname -I` or `ip` subprocess. Elsewhere, or if netlink is refused, it
+# falls back to ioctl() on each interface, which only sees one IPv4 address
+# per interface. Loopback and temporary (privacy) IPv6 addresses, which
+# rotate on their own, are left out so the result only changes when the
+# network does.
+#
+# ChangeWatcher subscribes to the kernel's link and address notifications so
+# a caller can sleep until something changes instead of polling.
+
+import fcntl
+import ipaddress
+import select
+import socket
+import struct
+import time
+
+# linux/netlink.h, linux/rtnetlink.h, linux/if_link.h, linux/if_addr.h
+NLMSG_HEADER = struct.Struct('=LHHLL')
+RTATTR_HEADER = struct.Struct('=HH')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+IFA_F_TEMPORARY = 0x01
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+# linux/if.h, linux/sockios.h
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_RUNNING = 0x40
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+SIOCGIFHWADDR = 0x8927
+
+RECV_SIZE = 65536
+
+_seq = 0
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _attributes(data, offset, end):
+    # rtattr list -> {type: value bytes}
+    attrs = {}
+    while offset + RTATTR_HEADER.size <= end:
+        length, kind = RTATTR_HEADER.unpack_from(data, offset)
+        if length < RTATTR_HEADER.size:
+            break
+        attrs[kind] = data[offset + RTATTR_HEADER.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _netlink_dump(sock, msg_type, body):
+    # Sends one dump request and yields (type, message bytes) until NLMSG_DONE
+    global _seq
+    _seq = (_seq + 1) & 0xffffffff
+    seq = _seq
+    sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(body), msg_type, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + body)
+    while True:
+        data = sock.recv(RECV_SIZE)
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+            if kind == NLMSG_DONE:
+                return
+            if kind == NLMSG_ERROR:
+                error, = struct.unpack_from('=i', data, offset + NLMSG_HEADER.size)
+                raise OSError(-error, 'netlink request {} failed'.format(msg_type))
+            yield kind, data[offset:offset + length]
+            offset += _align(length)
+
+
+def _format_mac(raw):
+    return ':'.join('{:02x}'.format(b) for b in raw)
+
+
+def read_interfaces_netlink():
+    interfaces = {}
+    names = {}
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        for kind, message in _netlink_dump(sock, RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+            if kind != RTM_NEWLINK:
+                continue
+            _, _, index, flags, _ = IFINFOMSG.unpack_from(message, NLMSG_HEADER.size)
+            if flags & IFF_LOOPBACK:
+                continue
+            attrs = _attributes(message, NLMSG_HEADER.size + IFINFOMSG.size, len(message))
+            name = attrs.get(IFLA_IFNAME, b'').rstrip(b'\0').decode()
+            names[index] = name
+            interfaces[name] = {
+                'up': bool(flags & IFF_UP and flags & IFF_RUNNING),
+                'mac': _format_mac(attrs[IFLA_ADDRESS]) if IFLA_ADDRESS in attrs else None,
+                'addresses': [],
+            }
+
+        for kind, message in _netlink_dump(sock, RTM_GETADDR, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+            if kind != RTM_NEWADDR:
+                continue
+            family, prefix, flags, _, index = IFADDRMSG.unpack_from(message, NLMSG_HEADER.size)
+            if index not in names:
+                continue
+            attrs = _attributes(message, NLMSG_HEADER.size + IFADDRMSG.size, len(message))
+            if IFA_FLAGS in attrs:
+                flags, = struct.unpack('=I', attrs[IFA_FLAGS])
+            if flags & IFA_F_TEMPORARY:
+                continue
+            # For IPv4 IFA_LOCAL is the interface's own address, IFA_ADDRESS
+            # the peer on point-to-point links
+            raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if raw is None:
+                continue
+            address = socket.inet_ntop(family, raw)
+            interfaces[names[index]]['addresses'].append('{}/{}'.format(address, prefix))
+
+    for interface in interfaces.values():
+        interface['addresses'].sort(key=_address_sort_key)
+    return interfaces
+
+
+def _ifreq(sock, request, name):
+    # struct ifreq is a 16 byte name followed by a 24 byte union
+    return fcntl.ioctl(sock.fileno(), request, struct.pack('16s24x', name.encode()[:15]))
+
+
+def read_interfaces_ioctl():
+    interfaces = {}
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            flags, = struct.unpack_from('=H', _ifreq(sock, SIOCGIFFLAGS, name), 16)
+            if flags & IFF_LOOPBACK:
+                continue
+            try:
+                mac = _format_mac(_ifreq(sock, SIOCGIFHWADDR, name)[18:24])
+            except OSError:
+                mac = None
+            addresses = []
+            try:
+                address = socket.inet_ntoa(_ifreq(sock, SIOCGIFADDR, name)[20:24])
+                netmask = socket.inet_ntoa(_ifreq(sock, SIOCGIFNETMASK, name)[20:24])
+                prefix = ipaddress.IPv4Network('0.0.0.0/{}'.format(netmask)).prefixlen
+                addresses.append('{}/{}'.format(address, prefix))
+            except OSError:
+                # No IPv4 address assigned
+                pass
+            interfaces[name] = {'up': bool(flags & IFF_UP and flags & IFF_RUNNING), 'mac': mac,
+                                'addresses': addresses}
+    return interfaces
+
+
+def read_interfaces():
+    if hasattr(socket, 'AF_NETLINK'):
+        try:
+            return read_interfaces_netlink()
+        except OSError as e:
+            print("Reading interfaces over netlink failed, using ioctl: {!r}".format(e))
+    return read_interfaces_ioctl()
+
+
+def _address_sort_key(address):
+    # IPv4 first, then global IPv6, then link-local
+    ip = ipaddress.ip_interface(address).ip
+    return (ip.version, ip.is_link_local, ip)
+
+
+def routable_addresses(interfaces):
+    # Addresses of interfaces that are up, without link-local ones, roughly
+    # what `hostname -I` prints
+    addresses = []
+    for interface in interfaces.values():
+        if not interface['up']:
+            continue
+        for address in interface['addresses']:
+            ip = ipaddress.ip_interface(address).ip
+            if not ip.is_link_local:
+                addresses.append(str(ip))
+    return sorted(addresses, key=lambda a: (ipaddress.ip_address(a).version, ipaddress.ip_address(a)))
+
+
+class ChangeWatcher:
+    # Wakes up on link and address changes. Without netlink wait() simply
+    # sleeps out its timeout, so callers still poll.
+    def __init__(self):
+        self.sock = None
+        if hasattr(socket, 'AF_NETLINK'):
+            try:
+                self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+                self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+                self.sock.setblocking(False)
+            except OSError as e:
+                print("Can't watch interfaces over netlink, polling instead: {!r}".format(e))
+                self.close()
+
+    def wait(self, timeout):
+        # Returns True if the kernel reported a change within timeout seconds
+        if self.sock is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+        # Several notifications usually arrive together, the caller re-reads
+        # everything anyway
+        try:
+            while self.sock.recv(RECV_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,88 @@
+# Local on-disk queue for messages that could not be delivered yet.
+#
+# Messages are written here when the connection drops while they are still
+# waiting on their PUBACK, or when they are published while offline. They
+# are sent again once the connection is back and deleted when acknowledged,
+# so a reading is only ever lost if the SD card is. The oldest messages are
+# dropped once the queue holds OUTBOX_MAX_MESSAGES.
+#
+#   outbox = Outbox()
+#   outbox_id = outbox.put('test/temp', '{"Device_ID": 8, ...}')
+#   for outbox_id, topic, payload, qos in outbox.peek(100): ...
+#   outbox.delete([outbox_id])
+
+import os
+import sqlite3
+import threading
+import time
+
+from gateway_paths import data_path
+
+DEFAULT_OUTBOX_DB = 'outbox.db'
+DEFAULT_MAX_MESSAGES = 1000000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    qos INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+'''
+
+
+class Outbox:
+    def __init__(self, path=None, max_messages=None):
+        self.path = path or os.getenv('OUTBOX_DB') or data_path(DEFAULT_OUTBOX_DB)
+        if max_messages is None:
+            max_messages = int(os.getenv('OUTBOX_MAX_MESSAGES', DEFAULT_MAX_MESSAGES))
+        self.max_messages = max_messages
+        self.dropped = 0
+        # Used from the main loop and the MQTT event loop thread, so one
+        # connection behind a lock rather than one per thread
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def put(self, topic, payload, qos=1):
+        return self.put_many([(topic, payload, qos)])[0]
+
+    def put_many(self, messages):
+        # messages: iterable of (topic, payload, qos). Returns the new ids.
+        now = time.time()
+        ids = []
+        with self._lock, self._db:
+            for topic, payload, qos in messages:
+                cursor = self._db.execute(
+                    'INSERT INTO outbox (topic, payload, qos, created) VALUES (?, ?, ?, ?)',
+                    (topic, payload, int(qos), now))
+                ids.append(cursor.lastrowid)
+            if self.max_messages:
+                cursor = self._db.execute(
+                    'DELETE FROM outbox WHERE id <= (SELECT MAX(id) FROM outbox) - ?', (self.max_messages,))
+                if cursor.rowcount > 0:
+                    self.dropped += cursor.rowcount
+                    print("Outbox full, dropped {} oldest message(s)".format(cursor.rowcount))
+        return ids
+
+    def peek(self, limit, after_id=0):
+        # Oldest first: [(id, topic, payload, qos), ...]
+        with self._lock:
+            return self._db.execute(
+                'SELECT id, topic, payload, qos FROM outbox WHERE id > ? ORDER BY id LIMIT ?',
+                (after_id, limit)).fetchall()
+
+    def delete(self, ids):
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in ids])
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,243 @@
+# Outbound priority lanes in front of InFlightPublisher.
+#
+# Every message is submitted to a named lane. A dispatcher thread takes
+# messages from the lanes and hands them to the publisher, so when the
+# uplink is congested an alert waits for one free window slot and not
+# behind every routine reading queued before it.
+#
+#   strict    always the highest priority lane that has something to send
+#   weighted  lanes share the uplink in proportion to their weight
+#             (smooth weighted round robin), so bulk traffic can't starve
+#
+# Each lane has its own rate limit (messages/s, 0 for none) and queue
+# bound. When a lane's queue is full, the oldest message goes to the outbox
+# if the publisher has one, or is dropped otherwise. Draining the outbox
+# after an outage only uses the uplink while every lane is empty, so a
+# multi-hour backlog never delays live traffic.
+#
+# In the lanes listed in LANE_FAIR (telemetry by default) each Device_ID
+# queues separately and the collars take turns (see fair_queue.py), so one
+# collar with a backlog doesn't hold up the others, and a full lane makes
+# room by dropping from the collar with the most queued.
+#
+#   lanes = LaneScheduler.from_env(publisher)
+#   lanes.start()
+#   lanes.submit('alert', 'alerts/temp', json.dumps(message))
+#
+# Settings (.env):
+#   PUBLISH_LANE_MODE    strict (default) or weighted
+#   LANE_RATES           e.g. "telemetry=50"
+#   LANE_QUEUE_LIMITS    e.g. "telemetry=20000, alert=1000"
+#   LANE_WEIGHTS         e.g. "alert=8, control=4, telemetry=1"
+#   LANE_FAIR            e.g. "telemetry, alert", "" for none
+#   FAIR_QUANTUM         bytes per collar per turn
+
+import collections
+import os
+import threading
+import time
+
+from fair_queue import DEFAULT_QUANTUM, FairQueue
+from inflight_publisher import percentile
+from rate_limit import TokenBucket
+
+STRICT = 'strict'
+WEIGHTED = 'weighted'
+DEFAULT_MAX_QUEUE = 1000
+WAIT_SAMPLES = 1000
+DEFAULT_FAIR_LANES = 'telemetry'
+
+# (name, priority, weight, max queue), lower priority numbers go first
+DEFAULT_LANES = (
+    ('alert', 0, 8, 1000),
+    ('control', 1, 4, 1000),
+    ('telemetry', 2, 1, 10000),
+)
+
+
+def parse_lane_settings(spec, cast=int):
+    # 'telemetry=50, alert=0' -> {'telemetry': 50, 'alert': 0}
+    settings = {}
+    if not spec:
+        return settings
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        lane, _, value = entry.partition('=')
+        if not value:
+            raise ValueError("Lane setting '{}' must look like <lane>=<value>".format(entry))
+        settings[lane.strip()] = cast(value)
+    return settings
+
+
+class Lane:
+    def __init__(self, name, priority=0, weight=1, rate=None, max_queue=DEFAULT_MAX_QUEUE, fair=False,
+                 quantum=DEFAULT_QUANTUM):
+        self.name = name
+        self.priority = priority
+        self.weight = weight
+        self.max_queue = max_queue
+        self.bucket = TokenBucket(rate)
+        self.fair = fair
+        if fair:
+            # Queued per key, each message's size is its payload's
+            self.queue = FairQueue(key=lambda message: message[5], cost=lambda message: len(message[1]),
+                                   quantum=quantum)
+        else:
+            self.queue = collections.deque()
+        self.current_weight = 0
+        self.counts = collections.Counter()
+        self.waits = collections.deque(maxlen=WAIT_SAMPLES)
+
+    def ready(self):
+        return bool(self.queue) and self.bucket.wait_time() == 0
+
+    def evict(self):
+        # The message to drop when the lane is full
+        return self.queue.evict() if self.fair else self.queue.popleft()
+
+    def stats(self):
+        waits = list(self.waits)
+        stats = dict(self.counts)
+        stats['queued'] = len(self.queue)
+        stats['wait_p95_ms'] = None if not waits else round(1000 * percentile(waits, 0.95), 1)
+        if self.fair:
+            stats['overflowed_by_key'] = dict(self.queue.dropped.most_common(10))
+        return stats
+
+
+class LaneScheduler:
+    def __init__(self, publisher, lanes, mode=STRICT):
+        if mode not in (STRICT, WEIGHTED):
+            raise ValueError("Unknown lane mode '{}'".format(mode))
+        self.publisher = publisher
+        self.mode = mode
+        self.lanes = {lane.name: lane for lane in lanes}
+        self._by_priority = sorted(lanes, key=lambda lane: lane.priority)
+        self._condition = threading.Condition()
+        # Set while every lane is empty, the outbox drain waits for it
+        self.idle = threading.Event()
+        self.idle.set()
+        self._stopped = False
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, publisher, lanes=DEFAULT_LANES):
+        rates = parse_lane_settings(os.getenv('LANE_RATES'), float)
+        queue_limits = parse_lane_settings(os.getenv('LANE_QUEUE_LIMITS'))
+        weights = parse_lane_settings(os.getenv('LANE_WEIGHTS'))
+        fair = {name.strip() for name in os.getenv('LANE_FAIR', DEFAULT_FAIR_LANES).split(',')}
+        quantum = int(os.getenv('FAIR_QUANTUM', DEFAULT_QUANTUM))
+        return cls(publisher, [
+            Lane(name, priority,
+                 weight=weights.get(name, weight),
+                 rate=rates.get(name),
+                 max_queue=queue_limits.get(name, max_queue),
+                 fair=name in fair,
+                 quantum=quantum)
+            for name, priority, weight, max_queue in lanes
+        ], mode=os.getenv('PUBLISH_LANE_MODE', STRICT))
+
+    def start(self):
+        self.publisher.drain_gate = self.idle
+        self._thread = threading.Thread(target=self._dispatch, name='lane-dispatch', daemon=True)
+        self._thread.start()
+
+    def submit(self, lane_name, topic, payload, qos=None, on_done=None, key=None):
+        # Never blocks. Returns False if the lane was full and its oldest
+        # message had to be moved out of the way. key is passed on to the
+        # publisher (the Device_ID, for ShardedPublisher).
+        lane = self.lanes[lane_name]
+        overflow = None
+        with self._condition:
+            if lane.max_queue and len(lane.queue) >= lane.max_queue:
+                overflow = lane.evict()
+                lane.counts['overflowed'] += 1
+            lane.queue.append((topic, payload, qos, on_done, time.monotonic(), key))
+            lane.counts['submitted'] += 1
+            self.idle.clear()
+            self._condition.notify()
+        if overflow is not None:
+            self._overflow(overflow)
+        return overflow is None
+
+    def _overflow(self, message):
+        topic, payload, qos, on_done, _, _ = message
+        if self.publisher.outbox is not None:
+            self.publisher.spool(topic, payload, qos)
+        elif on_done:
+            on_done(OverflowError('Lane queue full'))
+
+    def _pick(self):
+        # Called with the condition held. Returns a lane or None.
+        ready = [lane for lane in self._by_priority if lane.ready()]
+        if not ready:
+            return None
+        if self.mode == STRICT:
+            return ready[0]
+        total = sum(lane.weight for lane in ready)
+        for lane in ready:
+            lane.current_weight += lane.weight
+        chosen = max(ready, key=lambda lane: lane.current_weight)
+        chosen.current_weight -= total
+        return chosen
+
+    def _next_message(self):
+        with self._condition:
+            while not self._stopped:
+                lane = self._pick()
+                if lane is not None:
+                    lane.bucket.try_acquire()
+                    return lane, lane.queue.popleft()
+                # Queued lanes are all waiting on their rate limit
+                waits = [lane.bucket.wait_time() for lane in self._by_priority if lane.queue]
+                self._condition.wait(min(waits) if waits else None)
+        return None, None
+
+    def _dispatch(self):
+        while True:
+            lane, message = self._next_message()
+            if lane is None:
+                return
+            topic, payload, qos, on_done, queued_at, key = message
+            lane.waits.append(time.monotonic() - queued_at)
+            lane.counts['sent'] += 1
+            # Blocks while the window is full, which is where the lanes get
+            # their chance to reorder what goes next
+            try:
+                self.publisher.publish(topic, payload, qos, on_done=on_done, key=key)
+            except Exception as e:
+                # This is the only dispatch thread, it has to keep going
+                lane.counts['failed'] += 1
+                print("Publishing to '{}' failed: {!r}".format(topic, e))
+                if on_done:
+                    on_done(e)
+            with self._condition:
+                if not any(lane.queue for lane in self._by_priority):
+                    self.idle.set()
+
+    def alive(self):
+        # False once the dispatch thread has stopped
+        return self._thread is not None and self._thread.is_alive()
+
+    def queued(self):
+        with self._condition:
+            return sum(len(lane.queue) for lane in self._by_priority)
+
+    def flush(self, timeout=None):
+        # Waits until every lane has been handed to the publisher. Returns
+        # False on timeout.
+        return self.idle.wait(timeout)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        # Anything still queued goes to the outbox
+        for lane in self._by_priority:
+            while lane.queue:
+                self._overflow(lane.queue.popleft())
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
@@ -3,9 +3,12 @@
 
 import argparse
 from multiprocessing import connection
-from awscrt import io, mqtt, exceptions
-from awsiot import mqtt_connection_builder
+from awscrt import mqtt, exceptions
+from connection_builder import build_connection
 from dotenv import load_dotenv
+from live_config import LiveConfig
+import heartbeat
+from report_by_exception import REPORT_EXCEPTION, ReportByException
 import sys
 import threading
 import time
@@ -19,6 +22,9 @@ import time
 # a .env file must be located in the directory and include definitions for:
 # AWS_ENDPOINT, CERT_FILE, PRI_KEY_FILE, and ROOT_CA_FILE as 
 load_dotenv()
+# Values that can change while running: PUBLISH_TOPIC, SAMPLE_FREQUENCY
+config = LiveConfig()
+config_changed = threading.Event()
 
 parser = argparse.ArgumentParser(description="Send and receive messages through and MQTT connection.")
 parser.add_argument('--sample_frequency',type=float, help='how often messages are generated and sent to AWS in seconds')
@@ -55,6 +61,22 @@ def on_message_received(topic, payload, dup, qos, retain, **kwargs):
     print("Received message from topic '{}': {}".format(topic, payload))
 
 
+def on_config_changed(changes):
+    global TOPIC, timeout
+    if 'SAMPLE_FREQUENCY' in changes:
+        timeout = config.get_float('SAMPLE_FREQUENCY', DEFAULT_TIMEOUT)
+    if 'PUBLISH_TOPIC' in changes:
+        # Move the subscription over, the connection itself stays up
+        mqtt_connection.unsubscribe(TOPIC)
+        TOPIC = config.get('PUBLISH_TOPIC', DEFAULT_TOPIC)
+        mqtt_connection.subscribe(
+            topic=TOPIC,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_message_received)
+    # Cut the current wait short so a new frequency applies straight away
+    config_changed.set()
+
+
 def gen_fake_data(start=20.0, min=20.0, max=25.0):
     trending_up = True
     cur = start
@@ -79,34 +101,23 @@ if __name__ == '__main__':
     args, unknown = parser.parse_known_args()
 
     CLIENT_ID = 'test' + str(uuid4())
-    TOPIC = 'test/temp'
+    DEFAULT_TOPIC = 'test/temp'
     DEFAULT_TIMEOUT = 5
-    timeout = args.sample_frequency if args.sample_frequency else DEFAULT_TIMEOUT
-
-    # Spin up resources
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint=os.getenv('AWS_ENDPOINT'),
-        port=443,
-        cert_filepath=os.getenv('CERT_FILE'),
-        pri_key_filepath=os.getenv('PRI_KEY_FILE'),
-        client_bootstrap=client_bootstrap,
-        ca_filepath=os.getenv('ROOT_CA_FILE'),
-        on_connection_interrupted=on_connection_interrupted,
-        on_connection_resumed=on_connection_resumed,
-        client_id=CLIENT_ID,
-        clean_session=False,
-        keep_alive_secs=30,
-        http_proxy_options=None)
-
-    print(f"Connecting to {os.getenv('AWS_ENDPOINT')} with client ID '{CLIENT_ID}'...")
-
-    connection_attempts = 0
-    while connection_attempts < 6:
-        connection_attempts += 1
+    TOPIC = config.get('PUBLISH_TOPIC', DEFAULT_TOPIC)
+    # --sample_frequency sets the starting value, later .env changes override it
+    timeout = args.sample_frequency if args.sample_frequency else config.get_float('SAMPLE_FREQUENCY', DEFAULT_TIMEOUT)
+
+    # AWS_ENDPOINTS may list several endpoints to fail over between, see
+    # endpoint_failover.py
+    mqtt_connection = build_connection(CLIENT_ID, port=443,
+                                       on_connection_interrupted=on_connection_interrupted,
+                                       on_connection_resumed=on_connection_resumed)
+
+    print(f"Connecting to {os.getenv('AWS_ENDPOINTS') or os.getenv('AWS_ENDPOINT')} with client ID '{CLIENT_ID}'...")
+
+    # Subscribing needs the connection, so keep trying rather than carry on
+    # without one
+    while True:
         try:
             connect_future = mqtt_connection.connect()
             connect_future.result()
@@ -131,18 +142,31 @@ if __name__ == '__main__':
     # This step is skipped if message is blank.
     # This step loops forever if count was set to 0.
  
+    config.subscribe(on_config_changed, keys=['PUBLISH_TOPIC', 'SAMPLE_FREQUENCY'])
+    config.start_watching()
+
+    # With REPORT_MODE=exception a sample is only sent when it moved past
+    # its deadband or REPORT_MAX_SILENCE has passed
+    report_filter = ReportByException.from_env() if config.get('REPORT_MODE') == REPORT_EXCEPTION else None
+
     data_gen = gen_fake_data()
     while (True):
+        heartbeat.beat()
         message = {
             'Device_ID': platform.node(),
             'Data': {
                 'Tempurature': next(data_gen)
             }
         }
+        if report_filter is not None and not report_filter.filter(message['Device_ID'], message['Data']):
+            config_changed.wait(timeout)
+            config_changed.clear()
+            continue
         print("Publishing message to topic '{}': {}".format(TOPIC, message))
         message_json = json.dumps(message)
         mqtt_connection.publish(
             topic=TOPIC,
             payload=message_json,
             qos=mqtt.QoS.AT_LEAST_ONCE)
-        time.sleep(timeout)
\ No newline at end of file
+        config_changed.wait(timeout)
+        config_changed.clear()
\ No newline at end of file
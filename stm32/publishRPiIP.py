@@ -1,167 +1,241 @@
-
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
 from uuid import uuid4
-from awscrt import io, mqtt, exceptions
-from awsiot import mqtt_connection_builder
+from awscrt import mqtt, exceptions
+from connection_builder import build_connection
 from dotenv import load_dotenv
+from gateway_paths import data_path
+import heartbeat
+from inflight_publisher import InFlightPublisher
+from net_interfaces import ChangeWatcher, read_interfaces, routable_addresses
 import json
 import os
 import platform
-import re
-import serial
-import serial.tools.list_ports
+import shutil
+import signal
 import sys
 import threading
 import time
-import subprocess
 
 
 # Load local configuration settings
 # a .env file must be located in the directory and include definitions for:
-# AWS_ENDPOINT, CERT_FILE, PRI_KEY_FILE, and ROOT_CA_FILE as 
+# AWS_ENDPOINT, CERT_FILE, PRI_KEY_FILE, and ROOT_CA_FILE as
 load_dotenv()
 
-# This sample uses the Message Broker for AWS IoT to send and receive messages
-# through an MQTT connection. On startup, the device connects to the server,
-# subscribes to a topic, and begins publishing messages to that topic.
-# The device should receive those same messages back from the message broker,
-# since it is subscribed to that same topic.
+# Keeps the cloud's view of this gateway current. Runs for as long as the
+# gateway does and publishes:
+#   <topic>            retained, hostname, addresses and link state of every
+#                      interface. Only sent when one of those changes.
+#   <topic>/heartbeat  every PRESENCE_HEARTBEAT_INTERVAL seconds, uptime and
+#                      load of the gateway and its supervised components
+#   <topic>/status     retained {"Online": true/false}. The broker publishes
+#                      the false one itself (last will) if the gateway
+#                      disappears without saying goodbye.
+# Changes are picked up from the kernel's netlink notifications as they
+# happen and sent once they have settled for PRESENCE_SETTLE seconds, so a
+# DHCP renewal or a Wi-Fi reconnect is one message, not a dozen.
+#
+# Settings (.env): PRESENCE_TOPIC, PRESENCE_HEARTBEAT_INTERVAL,
+# PRESENCE_SETTLE, PRESENCE_POLL_INTERVAL, SUPERVISOR_RUN_DIR
+
+DEFAULT_TOPIC = 'test/RPiIP'
+DEFAULT_HEARTBEAT_INTERVAL = 900
+DEFAULT_SETTLE = 2
+# Interfaces are re-read at least this often in case a change notification
+# was missed (or netlink isn't available)
+DEFAULT_POLL_INTERVAL = 30
+DRAIN_TIMEOUT = 10
+RECONNECT_DELAY = 10
+
+stop_requested = threading.Event()
+publisher = None
 
-received_count = 0
-received_all_event = threading.Event()
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     print("Connection interrupted. error: {}".format(error))
+    if publisher is not None:
+        publisher.on_connection_interrupted()
 
 
 # Callback when an interrupted connection is re-established.
 def on_connection_resumed(connection, return_code, session_present, **kwargs):
     print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
-
-    if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
-        print("Session did not persist. Resubscribing to existing topics...")
-        resubscribe_future, _ = connection.resubscribe_existing_topics()
-
-        # Cannot synchronously wait for resubscribe result because we're on the connection's event-loop thread,
-        # evaluate result with a callback instead.
-        resubscribe_future.add_done_callback(on_resubscribe_complete)
-
-
-def on_resubscribe_complete(resubscribe_future):
-        resubscribe_results = resubscribe_future.result()
-        print("Resubscribe results: {}".format(resubscribe_results))
-
-        for topic, qos in resubscribe_results['topics']:
-            if qos is None:
-                sys.exit("Server rejected resubscribe to topic: {}".format(topic))
-
-
-# Callback when the subscribed topic receives a message
-def on_message_received(topic, payload, dup, qos, retain, **kwargs):
-    print("Received message from topic '{}': {}".format(topic, payload))
-    global received_count
-    received_count += 1
-
-
-
-
-def parse_lora_packet(packet_str):
-    map_message_ids = {
-        'I': {
-            'cast_func': int,
-            'full_name': 'Device_ID'
-        },
-        'T': {
-            'cast_func': float,
-            'full_name': 'Temperature'
-        },
-        'A': {
-            'cast_func': str,
-            'full_name': 'Acceleration'
-        }
+    if publisher is not None:
+        publisher.on_connection_resumed()
+
+
+def on_sigterm(signum, frame):
+    print("Stop requested, finishing up...")
+    stop_requested.set()
+
+
+def read_uptime():
+    with open('/proc/uptime') as f:
+        return float(f.read().split()[0])
+
+
+def read_meminfo():
+    # kB values from /proc/meminfo we care about, in MB
+    wanted = {'MemTotal', 'MemAvailable'}
+    values = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in wanted:
+                values[key] = round(int(rest.split()[0]) / 1024)
+    return values
+
+
+def read_cpu_temperature():
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp') as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def read_components():
+    # What supervisor.py last reported, trimmed to what the cloud needs
+    path = os.path.join(os.getenv('SUPERVISOR_RUN_DIR') or data_path('.supervisor'), 'status.json')
+    try:
+        with open(path) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {name: {'running': c['running'], 'uptime': c['uptime'], 'restarts': c['restarts']}
+            for name, c in status.get('components', {}).items()}
+
+
+def build_presence_message(interfaces):
+    return {
+        'Hostname': platform.node(),
+        'IP Address': ' '.join(routable_addresses(interfaces)),
+        'Interfaces': interfaces,
+        'Timestamp': int(time.time()),
     }
-    # Goal is to split a string with letters and data into two lists to build
-    # a dictionary from the packet. i.e. I08 T34.1 A1.16 -1.91 becomes
-    # {'Device_Id': 08, 'Temperature': 34.1, 'Acceleration': 1.16, -1.91}
 
-    # 'I08 T34.1 A1.16 -1.91' -> [('I', '08'), ('T', '34.1 '), ('A', '1.16 -1.91)]
-    data_points = re.findall(r'([a-zA-Z])+([^(a-zA-Z\n)]*)', packet_str) 
-    # Build a dictionary by mapping letters to full labels and casting data based on given cast_func in map above
-    return {map_message_ids[label]['full_name']: map_message_ids[label]['cast_func'](data) for label, data in data_points}
 
-
-if __name__ == '__main__':
-    CLIENT_ID = 'test' + str(uuid4())
-    TOPIC = 'test/RPiIP'
-    TIMEOUT = 5
-
-    # Spin up resources
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-
-
-
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint= os.getenv('AWS_ENDPOINT'),
-        cert_filepath= os.getenv('CERT_FILE'),
-        pri_key_filepath= os.getenv('PRI_KEY_FILE'),
-        client_bootstrap=client_bootstrap,
-        ca_filepath= os.getenv('ROOT_CA_FILE'),
+def build_heartbeat_message(started_at):
+    message = {
+        'Hostname': platform.node(),
+        'Timestamp': int(time.time()),
+        'Uptime': round(read_uptime()),
+        'Service_Uptime': round(time.monotonic() - started_at),
+        'Load': [round(load, 2) for load in os.getloadavg()],
+        'CPUs': os.cpu_count(),
+        'Memory_MB': read_meminfo(),
+        'Disk_Free_MB': shutil.disk_usage('.').free // (1024 * 1024),
+    }
+    cpu_temperature = read_cpu_temperature()
+    if cpu_temperature is not None:
+        message['CPU_Temperature'] = cpu_temperature
+    components = read_components()
+    if components is not None:
+        message['Components'] = components
+    return message
+
+
+def publish(topic, message, retain=False):
+    print("Publishing message to topic '{}': {}".format(topic, message))
+    if retain:
+        # Retained messages go straight to the client, InFlightPublisher
+        # doesn't carry the flag
+        return mqtt_connection.publish(topic=topic, payload=json.dumps(message),
+                                       qos=mqtt.QoS.AT_LEAST_ONCE, retain=True)[0]
+    publisher.publish(topic, json.dumps(message))
+
+
+def wait_for_change(watcher, timeout):
+    # watcher.wait() in steps of a second at most, so SIGTERM and the
+    # supervisor's heartbeat aren't kept waiting
+    deadline = time.monotonic() + timeout
+    while not stop_requested.is_set():
+        heartbeat.beat()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if watcher.wait(min(1, remaining)):
+            return True
+    return False
+
+
+def connect(client_id, topic):
+    status_topic = '{}/status'.format(topic)
+    offline = json.dumps({'Hostname': platform.node(), 'Online': False})
+
+    # AWS_ENDPOINTS may list several endpoints to fail over between, see
+    # endpoint_failover.py
+    connection = build_connection(
+        client_id,
         on_connection_interrupted=on_connection_interrupted,
         on_connection_resumed=on_connection_resumed,
-        client_id=CLIENT_ID,
-        clean_session=False,
-        keep_alive_secs=30,
-        http_proxy_options=None)
+        will=mqtt.Will(topic=status_topic, qos=mqtt.QoS.AT_LEAST_ONCE, payload=offline.encode(), retain=True))
 
     print("Connecting to {} with client ID '{}'...".format(
-        os.getenv('AWS_ENDPOINT'), CLIENT_ID))
+        os.getenv('AWS_ENDPOINTS') or os.getenv('AWS_ENDPOINT'), client_id))
 
-    connection_attempts = 0
-    while connection_attempts < 6:
-        connection_attempts += 1
+    while not stop_requested.is_set():
         try:
-            connect_future = mqtt_connection.connect()
+            connect_future = connection.connect()
             connect_future.result()
             print("Connected!")
-            break
+            return connection
         except exceptions.AwsCrtError:
             print("Connection Failed, retring...")
-            mqtt_connection.disconnect()
-            time.sleep(10)
-
-    # Subscribe
-    print("Subscribing to topic '{}'...".format(TOPIC))
-    subscribe_future, packet_id = mqtt_connection.subscribe(
-        topic=TOPIC,
-        qos=mqtt.QoS.AT_LEAST_ONCE,
-        callback=on_message_received)
-
-    subscribe_result = subscribe_future.result()
-    print("Subscribed with {}".format(str(subscribe_result['qos'])))
-
-    i = 0
-    while i < 1:
-        # try:
-            hostnameProc = subprocess.run(["hostname", "-I"], stdout=subprocess.PIPE, encoding='utf-8')
-            myIP = hostnameProc.stdout.strip()
-
-            message = {
-                'Hostname': platform.node(),
-                'IP Address': myIP
-            }
-            print("Publishing message to topic '{}': {}".format(TOPIC, message))
-            i += 1
-            message_json = json.dumps(message)
-            mqtt_connection.publish(
-                topic=TOPIC,
-                payload=message_json,
-                qos=mqtt.QoS.AT_LEAST_ONCE)
-        # except Exception:
-        #     print('Exception occured, retrying...')
-        #     time.sleep(TIMEOUT)
+            connection.disconnect()
+            stop_requested.wait(RECONNECT_DELAY)
+    return None
+
 
+if __name__ == '__main__':
+    CLIENT_ID = 'test' + str(uuid4())
+    TOPIC = os.getenv('PRESENCE_TOPIC', DEFAULT_TOPIC)
+    HEARTBEAT_TOPIC = '{}/heartbeat'.format(TOPIC)
+    STATUS_TOPIC = '{}/status'.format(TOPIC)
+    HEARTBEAT_INTERVAL = float(os.getenv('PRESENCE_HEARTBEAT_INTERVAL', DEFAULT_HEARTBEAT_INTERVAL))
+    SETTLE = float(os.getenv('PRESENCE_SETTLE', DEFAULT_SETTLE))
+    POLL_INTERVAL = float(os.getenv('PRESENCE_POLL_INTERVAL', DEFAULT_POLL_INTERVAL))
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    started_at = time.monotonic()
+    # Subscribed before the first read so a change during connecting isn't missed
+    watcher = ChangeWatcher()
+
+    mqtt_connection = connect(CLIENT_ID, TOPIC)
+    if mqtt_connection is None:
+        sys.exit(0)
+    publisher = InFlightPublisher(mqtt_connection, window=4)
+    publisher.start()
+    publish(STATUS_TOPIC, {'Hostname': platform.node(), 'Online': True}, retain=True)
+
+    last_interfaces = None
+    next_heartbeat = time.monotonic()
+    while not stop_requested.is_set():
+        heartbeat.beat()
+        interfaces = read_interfaces()
+        if interfaces != last_interfaces:
+            publish(TOPIC, build_presence_message(interfaces), retain=True)
+            last_interfaces = interfaces
+        if time.monotonic() >= next_heartbeat:
+            publish(HEARTBEAT_TOPIC, build_heartbeat_message(started_at))
+            next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+        timeout = max(0, min(POLL_INTERVAL, next_heartbeat - time.monotonic()))
+        if wait_for_change(watcher, timeout):
+            # Let the rest of the burst arrive before reading
+            while wait_for_change(watcher, SETTLE):
+                pass
+
+    watcher.close()
+    goodbye = publish(STATUS_TOPIC, {'Hostname': platform.node(), 'Online': False}, retain=True)
+    publisher.close(timeout=DRAIN_TIMEOUT)
+    try:
+        goodbye.result(timeout=DRAIN_TIMEOUT)
+    except Exception as e:
+        print("Failed to publish offline status: {!r}".format(e))
+    print("Publish stats: {}".format(publisher.stats()))
+    print("Disconnecting...")
+    mqtt_connection.disconnect().result()
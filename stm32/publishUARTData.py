@@ -2,15 +2,36 @@
 # SPDX-License-Identifier: Apache-2.0.
 
 from uuid import uuid4
-from awscrt import io, mqtt, exceptions
-from awsiot import mqtt_connection_builder
 from dotenv import load_dotenv
+from animal_state import AnimalStateStore
+from connection_builder import build_connection, mqtt_version
+from downlink import DownlinkScheduler
+from edge_rules import DEFAULT_DESTINATION, RuleError, RuleSet
+from endpoint_failover import FailoverConnection
+from fair_queue import DEFAULT_QUEUE_LIMIT, FairQueue, FloodGuard, device_of_line
+from fragments import Reassembler, parse_fragment
+from gateway_coordination import Coordinator, packet_key
+from gateway_paths import data_path
+import heartbeat
+from inflight_publisher import InFlightPublisher
+from lazy_import import lazy_import
+from live_config import LiveConfig
+from lora_packet import build_message, parse_lora_packet
+from outbox import Outbox
+from priority_lanes import LaneScheduler
+from report_by_exception import REPORT_EXCEPTION, ReportByException, SampleRateAdvisor
+from sharded_publisher import ShardedPublisher
+from timeseries_store import TimeSeriesStore
+from topic_routing import DEFAULT_TOPIC, KINDS, TopicRouter
+from uart_protocol import UartLink
+import importlib
 import json
 import os
 import platform
-import re
+import queue
 import serial
 import serial.tools.list_ports
+import signal
 import sys
 import threading
 import time
@@ -20,37 +41,96 @@ import time
 # a .env file must be located in the directory and include definitions for:
 # AWS_ENDPOINT, CERT_FILE, PRI_KEY_FILE, and ROOT_CA_FILE as 
 load_dotenv()
-
-# Searches for available ports for UART (i.e. /dev/ttyACM0, /dev/ttyACM1)
-# If there are multiple, defaults to the first one
-ports = list(serial.tools.list_ports.grep('ACM'))
-if len(ports) == 0:
-    print('Cannot find UART port, exiting...')
-    exit(-1)
-UART_PORT = ports[0].device
-BAUD_RATE = 115200
-# Initialize the UART connection
-ser = serial.Serial(port=UART_PORT, baudrate=BAUD_RATE)
+# awscrt takes a while to import on a Pi and isn't needed until the
+# connection is made, which happens while the UART is already being read
+mqtt = lazy_import('awscrt.mqtt')
+# Values that can change while running: PUBLISH_TOPIC, UART_PORT, BAUD_RATE,
+# ALERT_TOPIC, ALERT_TEMPERATURE, EDGE_RULES and the rest of the topic settings
+config = LiveConfig()
+# Where each message goes, see topic_routing.py
+router = TopicRouter(config.get)
+
+# Readings at or above this temperature are also published as alerts, ahead
+# of routine telemetry
+DEFAULT_ALERT_TEMPERATURE = 39.5
+DEFAULT_BAUD_RATE = 115200
+# readline() returns at least this often so configuration changes are noticed
+# even when the receiver is quiet
+UART_READ_TIMEOUT = 1
+# Complete lines read from the UART, waiting for the main loop. Reading starts
+# before the MQTT connection is up, so nothing is lost while it connects.
+# Each collar queues separately and they take turns, and one that floods the
+# receiver is held to a trickle (see fair_queue.py), so it can't delay the
+# other animals' readings.
+uart_lines = FairQueue(key=device_of_line, max_per_key=int(os.getenv('DEVICE_QUEUE_LIMIT', DEFAULT_QUEUE_LIMIT)))
+flood_guard = FloodGuard.from_env()
+RECONNECT_DELAY = 10
+# Every packet received, see replay_packets.py
+PACKET_LOG = data_path('loraPackets.log')
+
+
+def find_uart_port():
+    # UART_PORT in .env wins. Otherwise searches for available ports for UART
+    # (i.e. /dev/ttyACM0, /dev/ttyACM1). If there are multiple, defaults to the first one
+    if config.get('UART_PORT'):
+        return config.get('UART_PORT')
+    ports = list(serial.tools.list_ports.grep('ACM'))
+    if len(ports) == 0:
+        print('Cannot find UART port, exiting...')
+        exit(-1)
+    return ports[0].device
+
+
+ser = None
+# Text lines or binary frames, whichever the receiver's firmware speaks,
+# see uart_protocol.py
+link = None
+uart_reopen_requested = threading.Event()
+
+# On SIGTERM (e.g. a restart after update_gateway.py) the main loop finishes
+# the line it is on, then waits up to DRAIN_TIMEOUT seconds for publishes
+# still waiting on their PUBACK before disconnecting. Anything still unacked
+# is kept in the outbox and sent on the next start.
+DRAIN_TIMEOUT = 10
+stop_requested = threading.Event()
+STATS_INTERVAL = 60
+mqtt_connection = None
+# With PUBLISH_SHARDS above 1, the connections after mqtt_connection, see
+# sharded_publisher.py
+shard_connections = []
+publisher = None
+report_filter = None
+coordinator = None
+behavior = None
+downlink = None
+# EDGE_RULES, see edge_rules.py. None runs every reading as before.
+rules = None
+DEFAULT_BEHAVIOR_INTERVAL = 60
 
 # This sample uses the Message Broker for AWS IoT to send and receive messages
-# through an MQTT connection. On startup, the device connects to the server,
-# subscribes to a topic, and begins publishing messages to that topic.
-# The device should receive those same messages back from the message broker,
-# since it is subscribed to that same topic.
+# through an MQTT connection. With SUBSCRIBE_ECHO=1 the gateway also
+# subscribes to PUBLISH_TOPIC and receives every reading back from the
+# broker, handy when trying things out but it doubles the traffic on the
+# gateway's link, so it's off by default.
 
 received_count = 0
 received_all_event = threading.Event()
+echo_subscribed = False
 
 # Callback when connection is accidentally lost.
 def on_connection_interrupted(connection, error, **kwargs):
     print("Connection interrupted. error: {}".format(error))
+    if publisher is not None:
+        publisher.on_connection_interrupted()
 
 
 # Callback when an interrupted connection is re-established.
 def on_connection_resumed(connection, return_code, session_present, **kwargs):
     print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
+    if publisher is not None:
+        publisher.on_connection_resumed()
 
-    if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
+    if echo_subscribed and return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
         print("Session did not persist. Resubscribing to existing topics...")
         resubscribe_future, _ = connection.resubscribe_existing_topics()
 
@@ -59,6 +139,18 @@ def on_connection_resumed(connection, return_code, session_present, **kwargs):
         resubscribe_future.add_done_callback(on_resubscribe_complete)
 
 
+def shard_callbacks(index):
+    # For the connections after the first, which only publish
+    def interrupted(connection, error, **kwargs):
+        print("Connection {} interrupted. error: {}".format(index, error))
+        publisher.on_connection_interrupted(index)
+
+    def resumed(connection, return_code, session_present, **kwargs):
+        print("Connection {} resumed. return_code: {}".format(index, return_code))
+        publisher.on_connection_resumed(index)
+    return interrupted, resumed
+
+
 def on_resubscribe_complete(resubscribe_future):
         resubscribe_results = resubscribe_future.result()
         print("Resubscribe results: {}".format(resubscribe_results))
@@ -77,103 +169,404 @@ def on_message_received(topic, payload, dup, qos, retain, **kwargs):
 
 
 
-def parse_lora_packet(packet_str):
-    map_message_ids = {
-        'I': {
-            'cast_func': int,
-            'full_name': 'Device_ID'
-        },
-        'T': {
-            'cast_func': float,
-            'full_name': 'Temperature'
-        },
-        'A': {
-            'cast_func': str,
-            'full_name': 'Acceleration'
-        }
-    }
-    # Goal is to split a string with letters and data into two lists to build
-    # a dictionary from the packet. i.e. I08 T34.1 A1.16 -1.91 becomes
-    # {'Device_Id': 08, 'Temperature': 34.1, 'Acceleration': 1.16, -1.91}
-
-    # 'I08 T34.1 A1.16 -1.91' -> [('I', '08'), ('T', '34.1 '), ('A', '1.16 -1.91)]
-    data_points = re.findall(r'([a-zA-Z])+([^(a-zA-Z\n)]*)', packet_str) 
-    # Build a dictionary by mapping letters to full labels and casting data based on given cast_func in map above
-    return {map_message_ids[label]['full_name']: map_message_ids[label]['cast_func'](data) for label, data in data_points}
-
-
-def save_packet_to_file(data):
-    with open(file='loraPackets.log', mode='a') as f:
-        f.write(data)
-
+def open_uart():
+    global ser, link
+    port = find_uart_port()
+    baud_rate = config.get_int('BAUD_RATE', DEFAULT_BAUD_RATE)
+    ser = serial.Serial(port=port, baudrate=baud_rate, timeout=UART_READ_TIMEOUT)
+    link = UartLink.from_env(ser)
+
+
+def read_uart():
+    # Runs on its own thread from the moment the port is open and hands
+    # complete lines to the main loop
+    while not stop_requested.is_set():
+        if uart_reopen_requested.is_set():
+            uart_reopen_requested.clear()
+            reopen_uart()
+        for line in link.read_lines():
+            if flood_guard.admit_line(line):
+                uart_lines.put(line)
+
+
+def on_uart_config_changed(changes):
+    # Runs on the config watcher thread, the reader thread does the actual switch
+    uart_reopen_requested.set()
+
+
+def load_rules(changes=None):
+    # Rules that don't parse are reported and the ones before them stay
+    global rules
+    try:
+        rules = RuleSet.from_config(config.get)
+    except (RuleError, OSError) as e:
+        print("Keeping the current edge rules, the new ones don't work: {}".format(e))
+        return
+    print("Edge rules: {}".format([rule[0] for rule in rules.rules] if rules is not None else 'none'))
+
+
+def reopen_uart():
+    # A new baud rate is applied to the open port in place. A new port is
+    # opened before the old one is closed. Either way the link starts over
+    # in text mode, dropping half a line from before, and asks for the
+    # binary protocol again.
+    global ser
+    port = find_uart_port()
+    baud_rate = config.get_int('BAUD_RATE', DEFAULT_BAUD_RATE)
+    if port == ser.port:
+        print("Changing UART baud rate to {}".format(baud_rate))
+        ser.baudrate = baud_rate
+        link.attach(ser)
+        return
+    print("Switching UART to {} at {}".format(port, baud_rate))
+    old = ser
+    ser = serial.Serial(port=port, baudrate=baud_rate, timeout=UART_READ_TIMEOUT)
+    link.attach(ser)
+    old.close()
+
+
+def connect():
+    # Runs on its own thread so the UART is read and readings are stored
+    # (and queued in the outbox) while the TLS connection is set up. The
+    # awscrt/awsiot imports happen here for the same reason.
+    global mqtt_connection, echo_subscribed
 
-if __name__ == '__main__':
     CLIENT_ID = 'test' + str(uuid4())
-    TOPIC = 'test/temp'
-    TIMEOUT = 5
-
-    # Spin up resources
-    event_loop_group = io.EventLoopGroup(1)
-    host_resolver = io.DefaultHostResolver(event_loop_group)
-    client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
-
-
-
-    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-        endpoint= os.getenv('AWS_ENDPOINT'),
-        cert_filepath= os.getenv('CERT_FILE'),
-        pri_key_filepath= os.getenv('PRI_KEY_FILE'),
-        client_bootstrap=client_bootstrap,
-        ca_filepath= os.getenv('ROOT_CA_FILE'),
-        on_connection_interrupted=on_connection_interrupted,
-        on_connection_resumed=on_connection_resumed,
-        client_id=CLIENT_ID,
-        clean_session=False,
-        keep_alive_secs=30,
-        http_proxy_options=None)
-
-    print("Connecting to {} with client ID '{}'...".format(
-        os.getenv('AWS_ENDPOINT'), CLIENT_ID))
-
-    connection_attempts = 0
-    while connection_attempts < 6:
-        connection_attempts += 1
+    topic = config.get('PUBLISH_TOPIC', DEFAULT_TOPIC)
+
+    if isinstance(publisher, ShardedPublisher):
+        # One client ID per connection, each shard starts publishing as soon
+        # as its own connection is up
+        for index in range(1, len(publisher.shards)):
+            threading.Thread(target=connect_shard, args=(index, '{}-{}'.format(CLIENT_ID, index)),
+                             name='mqtt-connect-{}'.format(index), daemon=True).start()
+        CLIENT_ID += '-0'
+
+    connection = open_connection(CLIENT_ID, on_connection_interrupted, on_connection_resumed)
+    if connection is None:
+        return
+    mqtt_connection = connection
+
+    if config.get('SUBSCRIBE_ECHO', '0').lower() in ('1', 'true', 'yes'):
+        print("Subscribing to topic '{}'...".format(topic))
+        subscribe_future, packet_id = mqtt_connection.subscribe(
+            topic=topic,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_message_received)
+
+        subscribe_result = subscribe_future.result()
+        print("Subscribed with {}".format(str(subscribe_result['qos'])))
+        echo_subscribed = True
+        config.subscribe(on_topic_changed, keys=['PUBLISH_TOPIC'])
+
+    if isinstance(publisher, ShardedPublisher):
+        publisher.shards[0].mqtt_connection = mqtt_connection
+    else:
+        publisher.mqtt_connection = mqtt_connection
+    publisher.start()
+    if report_filter is not None:
+        publish_reporting_declaration()
+
+
+def open_connection(client_id, interrupted, resumed):
+    # Returns the connected connection, or None if stopped first
+    from awscrt import exceptions
+
+    # MQTT 5 with topic aliases where awscrt has it, see connection_builder.py
+    connection = build_connection(client_id, on_connection_interrupted=interrupted, on_connection_resumed=resumed)
+
+    print("Connecting to {} with client ID '{}' over MQTT {}...".format(
+        os.getenv('AWS_ENDPOINTS') or os.getenv('AWS_ENDPOINT'), client_id, mqtt_version()))
+
+    # Readings wait in the outbox until this succeeds, so keep trying
+    while not stop_requested.is_set():
         try:
-            connect_future = mqtt_connection.connect()
+            connect_future = connection.connect()
             connect_future.result()
             print("Connected!")
-            break
+            return connection
         except exceptions.AwsCrtError:
             print("Connection Failed, retring...")
-            mqtt_connection.disconnect()
-            time.sleep(10)
-
-    # Subscribe
-    print("Subscribing to topic '{}'...".format(TOPIC))
-    subscribe_future, packet_id = mqtt_connection.subscribe(
-        topic=TOPIC,
+            connection.disconnect()
+            stop_requested.wait(RECONNECT_DELAY)
+    return None
+
+
+def connect_shard(index, client_id):
+    connection = open_connection(client_id, *shard_callbacks(index))
+    if connection is None:
+        return
+    shard_connections.append(connection)
+    publisher.shards[index].mqtt_connection = connection
+    publisher.start(index)
+
+
+def on_topic_changed(changes):
+    # Move the subscription over, the connection itself stays up
+    old_topic, new_topic = changes['PUBLISH_TOPIC']
+    mqtt_connection.unsubscribe(old_topic or DEFAULT_TOPIC)
+    mqtt_connection.subscribe(
+        topic=new_topic or DEFAULT_TOPIC,
         qos=mqtt.QoS.AT_LEAST_ONCE,
         callback=on_message_received)
 
-    subscribe_result = subscribe_future.result()
-    print("Subscribed with {}".format(str(subscribe_result['qos'])))
 
-    while True:
+def on_sigterm(signum, frame):
+    print("Stop requested, finishing up...")
+    stop_requested.set()
+
+
+def drain_and_disconnect():
+    print("Waiting for {} queued and {} in-flight message(s)...".format(lanes.queued(), publisher.in_flight()))
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    lanes.flush(timeout=DRAIN_TIMEOUT)
+    lanes.stop()
+    saved = publisher.close(timeout=max(0, deadline - time.monotonic()))
+    if saved:
+        print("Saved {} unacknowledged message(s) to the outbox".format(saved))
+    print("Publish stats: {} lanes: {}".format(publisher.stats(), lanes.stats()))
+    if mqtt_connection is not None:
+        print("Disconnecting...")
+        mqtt_connection.disconnect().result()
+    for connection in shard_connections:
+        connection.disconnect().result()
+    ser.close()
+
+
+def save_reading_to_store(store, device_id, data):
+    # The local history is a convenience, never let it stop publishing
+    try:
+        store.add(device_id, data)
+    except Exception as e:
+        print("Failed to store reading locally: {!r}".format(e))
+
+
+def publish_reporting_declaration():
+    # Retained, so a consumer subscribing later still learns the error bound
+    mqtt_connection.publish(
+        topic=router.topic('reporting', retained=True),
+        payload=json.dumps(report_filter.declaration()),
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        retain=True)
+
+
+def send_rate_command(device_id, interval):
+    # Sent in the collar's receive window after its next uplink, see downlink.py
+    print("Asking device {} to sample every {}s".format(device_id, interval))
+    downlink.queue(device_id, 'sample_interval', interval)
+
+
+def destination_submission(destination, message):
+    # A rule's route: a message kind or a topic of its own
+    if destination in KINDS:
+        topic = router.topic(destination, device_id=message['Device_ID'])
+    else:
+        topic = destination
+    return 'telemetry', topic, json.dumps(message), message['Device_ID']
+
+
+def is_alert(data):
+    temperature = data.get('Temperature')
+    return temperature is not None and temperature >= config.get_float('ALERT_TEMPERATURE', DEFAULT_ALERT_TEMPERATURE)
+
+
+def publish_behavior():
+    # Labels for every animal whose window filled up since last time, in
+    # one message. Only labels that changed are sent, the cloud keeps the
+    # last one it got for each animal.
+    interval = config.get_float('BEHAVIOR_INTERVAL', DEFAULT_BEHAVIOR_INTERVAL)
+    while not stop_requested.wait(interval):
+        labels = behavior.classify(changed_only=True)
+        if not labels:
+            continue
+        topic = router.topic('behavior')
+        message = {'Timestamp': int(time.time()), 'Behavior': labels}
+        print("Publishing {} behaviour label(s) to topic '{}'".format(len(labels), topic))
+        lanes.submit('telemetry', topic, json.dumps(message))
+
+
+def handle_fragment(fragment):
+    # Bursts are published as they arrived from the collar, one binary
+    # message per burst, e.g. <PUBLISH_TOPIC>/bursts/<Device_ID>/<burst id>
+    device_id, burst_id = fragment[0], fragment[1]
+    blob = reassembler.add(*fragment)
+    if blob is None:
+        return
+    topic = router.topic('bursts', device_id=device_id, suffix=burst_id)
+    print("Publishing {} byte burst to topic '{}'".format(len(blob), topic))
+    submissions = [('telemetry', topic, blob, device_id)]
+    if coordinator is None:
+        submit_all(submissions)
+    else:
+        # Fragments carry no RSSI, any gateway that got the whole burst will do
+        coordinator.offer('burst {} {} {}'.format(device_id, burst_id, len(blob)), None,
+                          lambda: submit_all(submissions))
+
+
+def submit_all(submissions):
+    # key: the Device_ID, which connection it goes over with PUBLISH_SHARDS
+    for lane, topic, payload, key in submissions:
+        lanes.submit(lane, topic, payload, key=key)
+
+
+def save_packet_to_file(data):
+    with open(file=PACKET_LOG, mode='a') as f:
+        f.write(data)
+
+
+if __name__ == '__main__':
+    # Start reading straight away, the receiver doesn't wait for us
+    open_uart()
+    uart_thread = threading.Thread(target=read_uart, name='uart-reader', daemon=True)
+    uart_thread.start()
+    # The UART is being read, so now is the time to pay for awscrt, here
+    # rather than on whichever publish or connect thread reaches it first
+    importlib.import_module('awscrt.mqtt')
+
+    # Fails here rather than on the first reading if the topic settings don't add up
+    router.topic('telemetry')
+    config.subscribe(on_uart_config_changed, keys=['UART_PORT', 'BAUD_RATE'])
+    # Applied to each reading before it is published, see edge_rules.py
+    load_rules()
+    config.subscribe(load_rules, keys=['EDGE_RULES', 'EDGE_RULES_FILE'])
+    config.start_watching()
+    # Local history for query_server.py
+    store = TimeSeriesStore()
+    # Puts multi-packet bursts back together, see fragments.py
+    reassembler = Reassembler.from_env()
+    # Messages go to the outbox until connect() has a connection. With
+    # PUBLISH_SHARDS=N they are spread over N connections by Device_ID,
+    # for barns that outgrow AWS IoT's per-connection publish limit.
+    if config.get_int('PUBLISH_SHARDS', 1) > 1:
+        publisher = ShardedPublisher.from_env(outbox=Outbox(), shards=config.get_int('PUBLISH_SHARDS', 1))
+    else:
+        publisher = InFlightPublisher(None, outbox=Outbox())
+    # Outbound messages are queued per lane and never block the UART loop
+    lanes = LaneScheduler.from_env(publisher)
+    lanes.start()
+    last_stats = time.monotonic()
+    # Per-animal state, restored from the last snapshot so a restart keeps
+    # what was already sent and each collar's sample rate
+    animal_state = AnimalStateStore()
+    print("Restored state for {} animal(s)".format(animal_state.restore()))
+    animal_state.start_snapshots()
+    # With REPORT_MODE=exception only readings that changed are published,
+    # everything still goes to the log file and the local store
+    if config.get('REPORT_MODE') == REPORT_EXCEPTION:
+        report_filter = ReportByException.from_env(last_sent=animal_state.namespace('report'))
+        rate_advisor = SampleRateAdvisor.from_env(devices=animal_state.namespace('sample_rate'))
+    # With BEHAVIOR_MODE=labels the raw acceleration stays on the gateway
+    # (loraPackets.log and the local store) and only behaviour labels are
+    # published, see behavior.py. Needs numpy.
+    if config.get('BEHAVIOR_MODE') == 'labels':
+        from behavior import BehaviorClassifier
+        behavior = BehaviorClassifier.from_env(windows=animal_state.namespace('behavior'))
+        threading.Thread(target=publish_behavior, name='behavior', daemon=True).start()
+    # With GATEWAY_COORDINATION=multicast, gateways on the same LAN agree on
+    # which of them forwards each packet (the one that heard it best)
+    if config.get('GATEWAY_COORDINATION') == 'multicast':
+        coordinator = Coordinator.from_env()
+        coordinator.start()
+    # Commands to the collars wait for their receive windows and the duty
+    # cycle
+    downlink = DownlinkScheduler.from_env()
+    downlink.start(link.send)
+    signal.signal(signal.SIGTERM, on_sigterm)
+    threading.Thread(target=connect, name='mqtt-connect', daemon=True).start()
+
+    while not stop_requested.is_set():
         # try:
-            packet = str(ser.readline(), 'utf8')
+            # The queue wait times out every UART_READ_TIMEOUT, so this runs
+            # at least once a second while the loop, the reader and the lane
+            # dispatcher are healthy
+            if uart_thread.is_alive() and lanes.alive():
+                heartbeat.beat()
+            try:
+                line = uart_lines.get(timeout=UART_READ_TIMEOUT)
+            except queue.Empty:
+                continue
+            packet = str(line, 'utf8')
             save_packet_to_file(packet)
-            data = parse_lora_packet(packet)
-            message = {
-                'Device_ID': data.pop('Device_ID'),
-                'Data': data
-            }
-            print("Publishing message to topic '{}': {}".format(TOPIC, message))
-            message_json = json.dumps(message)
-            mqtt_connection.publish(
-                topic=TOPIC,
-                payload=message_json,
-                qos=mqtt.QoS.AT_LEAST_ONCE)
+            fragment = parse_fragment(packet)
+            if fragment is not None:
+                downlink.on_uplink(fragment[0])
+                handle_fragment(fragment)
+                continue
+            try:
+                data = parse_lora_packet(packet)
+                rssi = data.pop('RSSI', None)
+                message = build_message(data)
+            except (KeyError, ValueError) as e:
+                # Garbled over the air or cut off by a port switch, it's
+                # still in loraPackets.log
+                print("Skipping undecodable packet {!r}: {!r}".format(packet, e))
+                continue
+            # First, the collar's receive window opens DOWNLINK_RX_DELAY after the uplink
+            downlink.on_uplink(message['Device_ID'])
+            save_reading_to_store(store, message['Device_ID'], message['Data'])
+            if behavior is not None and 'Acceleration' in message['Data']:
+                behavior.add(message['Device_ID'], message['Data'].pop('Acceleration'))
+            if time.monotonic() - last_stats >= STATS_INTERVAL:
+                print("Publish stats: {} lanes: {}".format(publisher.stats(), lanes.stats()))
+                if report_filter is not None:
+                    print("Report by exception: {}".format(report_filter.stats()))
+                print("Animal state: {}".format(animal_state.stats()))
+                print("Fragments: {}".format(reassembler.stats()))
+                print("UART: {}".format(link.stats()))
+                print("Downlink: {}".format(downlink.stats()))
+                print("Flood guard: {} UART queue: {}".format(flood_guard.stats(), uart_lines.stats()))
+                if isinstance(mqtt_connection, FailoverConnection):
+                    print("Endpoint: {}".format(mqtt_connection.stats()))
+                if coordinator is not None:
+                    print("Coordination: {}".format(coordinator.stats()))
+                if behavior is not None:
+                    print("Behaviour: {}".format(behavior.stats()))
+                if rules is not None:
+                    print("Edge rules: {}".format(rules.stats()))
+                last_stats = time.monotonic()
+            destinations = [DEFAULT_DESTINATION]
+            current_rules = rules
+            if current_rules is not None:
+                fields = dict(message['Data'], Device_ID=message['Device_ID'], RSSI=rssi)
+                decision = current_rules.apply(fields)
+                if not decision.destinations:
+                    continue
+                message['Data'].update(decision.fields)
+                destinations = decision.destinations
+            submissions = []
+            if is_alert(message['Data']) or 'alert' in destinations:
+                submissions.append(('alert', router.topic('alert', device_id=message['Device_ID']),
+                                    json.dumps(message), message['Device_ID']))
+            # Runs on every gateway whether or not it ends up forwarding the
+            # reading, so all of them agree on what the cloud last received
+            if report_filter is not None:
+                changed = report_filter.filter(message['Device_ID'], message['Data'])
+                interval = rate_advisor.observe(message['Device_ID'], report_filter.last_changed)
+                if interval is not None:
+                    send_rate_command(message['Device_ID'], interval)
+                message = {'Device_ID': message['Device_ID'], 'Data': changed} if changed else None
+            # Nothing left once the acceleration went to the behaviour windows
+            if message is not None and message['Data']:
+                for destination in destinations:
+                    # The alert went out above, unfiltered
+                    if destination == 'alert':
+                        continue
+                    submission = destination_submission(destination, message)
+                    print("Publishing message to topic '{}': {}".format(submission[1], message))
+                    submissions.append(submission)
+            if not submissions:
+                continue
+            if coordinator is None:
+                submit_all(submissions)
+            else:
+                coordinator.offer(packet_key(packet), rssi, lambda submissions=submissions: submit_all(submissions))
         # except Exception:
         #     print('Exception occured, retrying...')
         #     time.sleep(TIMEOUT)
 
+    downlink.stop()
+    animal_state.close()
+    if coordinator is not None:
+        coordinator.flush(timeout=1)
+        coordinator.stop()
+    drain_and_disconnect()
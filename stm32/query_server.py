@@ -0,0 +1,111 @@
+# Small HTTP API over the gateway's local time-series store, so farm staff
+# can look at recent history without going through the cloud.
+#
+#   python query_server.py                       # http://127.0.0.1:8080
+#   python query_server.py --unix /run/gateway-query.sock
+#
+#   GET /devices
+#       {"devices": {"8": 1697700000, ...}}          Device_ID -> last hour seen
+#   GET /latest?device=8
+#       {"device": 8, "latest": {"Temperature": {"ts": ..., "value": 38.6}, ...}}
+#   GET /series?device=8&field=Temperature&hours=48[&start=..&end=..&resolution=raw|5m|1h]
+#       {"device": 8, "field": "Temperature", "resolution": "5m",
+#        "points": [[ts, avg, min, max, count], ...]}
+#
+# Timestamps are Unix seconds. The resolution is picked from the range
+# length unless given.
+
+import argparse
+import json
+import os
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from dotenv import load_dotenv
+
+from timeseries_store import TimeSeriesStore
+
+load_dotenv()
+
+DEFAULT_PORT = 8080
+
+parser = argparse.ArgumentParser(description="Serve the local reading history over HTTP.")
+parser.add_argument('--host', default=os.getenv('QUERY_HOST', '127.0.0.1'), help='address to listen on')
+parser.add_argument('--port', type=int, default=int(os.getenv('QUERY_PORT', DEFAULT_PORT)))
+parser.add_argument('--unix', default=os.getenv('QUERY_SOCKET'), help='listen on this Unix socket instead of TCP')
+parser.add_argument('--db', default=None, help='path to the readings database')
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def address_string(self):
+        # client_address is an empty string for Unix socket connections
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        start = time.perf_counter()
+        try:
+            if url.path == '/devices':
+                body = {'devices': {str(k): v for k, v in self.store.devices().items()}}
+            elif url.path == '/latest':
+                device = int(params['device'])
+                body = {'device': device, 'latest': self.store.latest(device)}
+            elif url.path == '/series':
+                body = self.series(params)
+            else:
+                return self.reply(404, {'error': 'Unknown path {}'.format(url.path)})
+        except (KeyError, ValueError) as e:
+            return self.reply(400, {'error': 'Bad request: {}'.format(e)})
+        body['elapsed_ms'] = round(1000 * (time.perf_counter() - start), 3)
+        self.reply(200, body)
+
+    def series(self, params):
+        device = int(params['device'])
+        field = params.get('field', 'Temperature')
+        end = float(params['end']) if 'end' in params else time.time()
+        if 'start' in params:
+            start = float(params['start'])
+        else:
+            start = end - float(params.get('hours', 24)) * 3600
+        resolution, rows = self.store.query(device, field, start, end, params.get('resolution'))
+        return {
+            'device': device,
+            'field': field,
+            'resolution': resolution,
+            'points': [list(row) for row in rows],
+        }
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    QueryHandler.store = TimeSeriesStore(args.db)
+
+    if args.unix:
+        server = UnixHTTPServer(args.unix, QueryHandler)
+        print("Serving reading history on unix:{}".format(args.unix))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+        print("Serving reading history on http://{}:{}".format(args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1,40 @@
+import threading
+import time
+
+
+class TokenBucket:
+    # Allows `rate` operations per second on average, with bursts of up to
+    # `burst`. A rate of 0 or None means unlimited.
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        if not self.rate:
+            return True
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        # Seconds until `tokens` would be available, 0 if they are now
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def acquire(self, tokens=1):
+        # Blocks until the tokens are available
+        while not self.try_acquire(tokens):
+            time.sleep(self.wait_time(tokens))
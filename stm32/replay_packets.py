@@ -0,0 +1,225 @@
+# Re-publishes archived packets from loraPackets.log, e.g. after an outage or
+# when the cloud side needs data re-ingested.
+#
+#   python replay_packets.py loraPackets.log.3.gz loraPackets.log.2.gz loraPackets.log.1 loraPackets.log
+#   python replay_packets.py --rate 100 --batch-size 50 --topic backfill/temp loraPackets.log*
+#
+# Segments are read in the order given and may be gzip, bz2 or xz compressed.
+# Every line goes through the same decoder as publishUARTData.py. Up to
+# --window QoS 1 publishes are in flight at once, and --rate caps messages per
+# second (AWS IoT allows about 100 publishes/s per connection). With
+# --batch-size above 1, each message carries that many readings as
+#   {"Batch": [{"Device_ID": ..., "Data": {...}}, ...]}
+# which is how a month of data fits through that limit in minutes.
+#
+# Progress is checkpointed to --checkpoint as the broker acknowledges
+# messages. Running the same command again continues after the last
+# acknowledged line, so an interrupted backfill re-sends at most --window
+# messages.
+
+import argparse
+import bz2
+import gzip
+import json
+import lzma
+import os
+import sys
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+from awscrt import exceptions
+from dotenv import load_dotenv
+
+from connection_builder import build_connection
+from inflight_publisher import InFlightPublisher
+from lora_packet import build_message, parse_lora_packet
+from rate_limit import TokenBucket
+
+load_dotenv()
+
+DEFAULT_CHECKPOINT = 'replay.checkpoint.json'
+DEFAULT_WINDOW = 100
+DEFAULT_RATE = 100
+PROGRESS_INTERVAL = 5
+CHECKPOINT_INTERVAL = 1
+
+parser = argparse.ArgumentParser(description="Re-publish archived LoRa packets.")
+parser.add_argument('paths', nargs='+', help='log segments, oldest first')
+parser.add_argument('--topic', default=os.getenv('PUBLISH_TOPIC', 'test/temp'))
+parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help='max messages per second, 0 for no limit')
+parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='max unacknowledged messages in flight')
+parser.add_argument('--batch-size', type=int, default=1, help='readings per message')
+parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help='file recording how far the replay got')
+parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the beginning')
+parser.add_argument('--dry-run', action='store_true', help='decode and count without publishing')
+
+
+def open_segment(path):
+    opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}.get(os.path.splitext(path)[1], open)
+    return opener(path, mode='rt', encoding='utf8', errors='replace')
+
+
+def read_batches(paths, batch_size, resume_from=None):
+    # Yields (path, last line number, [message, ...], stats). Batches never span two
+    # segments, so a checkpoint is always a (path, line) pair. With
+    # resume_from=(path, line), everything up to and including it is skipped.
+    skipping = resume_from is not None
+    stats = {'lines': 0, 'bad': 0}
+    for path in paths:
+        if skipping and path != resume_from[0]:
+            continue
+        skip_lines = resume_from[1] if skipping else 0
+        skipping = False
+        batch = []
+        line_number = 0
+        with open_segment(path) as f:
+            for line_number, line in enumerate(f, 1):
+                if line_number <= skip_lines or not line.strip():
+                    continue
+                stats['lines'] += 1
+                try:
+                    batch.append(build_message(parse_lora_packet(line)))
+                except (KeyError, ValueError):
+                    stats['bad'] += 1
+                    continue
+                if len(batch) >= batch_size:
+                    yield path, line_number, batch, stats
+                    batch = []
+        if batch:
+            yield path, line_number, batch, stats
+    if skipping:
+        raise ValueError('Checkpoint segment {} is not in the list of paths'.format(resume_from[0]))
+
+
+class Checkpoint:
+    # Publishes can be acknowledged out of order, so the checkpoint only moves
+    # up to the oldest message that is still unacknowledged
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._positions = {}  # seq -> (segment, line)
+        self._acked = set()
+        self._next_seq = 0
+        self._committed_seq = -1
+        self.position = None
+        self.failed = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            return saved['path'], saved['line']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def track(self, segment, line):
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._positions[seq] = (segment, line)
+            return seq
+
+    def ack(self, seq):
+        with self._lock:
+            self._acked.add(seq)
+            while self._committed_seq + 1 in self._acked:
+                self._committed_seq += 1
+                self._acked.discard(self._committed_seq)
+                self.position = self._positions.pop(self._committed_seq)
+
+    def fail(self, seq, error):
+        with self._lock:
+            if self.failed is None:
+                self.failed = (self._positions.get(seq), error)
+
+    def save(self):
+        with self._lock:
+            position = self.position
+        if position is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.replay.', dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'path': position[0], 'line': position[1]}, f)
+        os.replace(tmp_path, self.path)
+
+
+def replay(mqtt_connection, args):
+    checkpoint = Checkpoint(args.checkpoint)
+    resume_from = None if args.restart else checkpoint.load()
+    if resume_from:
+        print("Resuming after {} line {}".format(*resume_from))
+
+    publisher = InFlightPublisher(mqtt_connection, window=args.window)
+    bucket = TokenBucket(args.rate)
+    sent = readings = 0
+    start = last_progress = last_save = time.monotonic()
+    stats = {'lines': 0, 'bad': 0}
+
+    def on_publish_done(seq, error):
+        if error is None:
+            checkpoint.ack(seq)
+        else:
+            checkpoint.fail(seq, error)
+
+    for segment, line, batch, stats in read_batches(args.paths, args.batch_size, resume_from):
+        if checkpoint.failed:
+            break
+        payload = batch[0] if len(batch) == 1 else {'Batch': batch}
+        readings += len(batch)
+        if args.dry_run:
+            continue
+
+        bucket.acquire()
+        seq = checkpoint.track(segment, line)
+        publisher.publish(args.topic, json.dumps(payload),
+                          on_done=lambda error, seq=seq: on_publish_done(seq, error))
+        sent += 1
+
+        now = time.monotonic()
+        if now - last_save >= CHECKPOINT_INTERVAL:
+            checkpoint.save()
+            last_save = now
+        if now - last_progress >= PROGRESS_INTERVAL:
+            print("{} messages ({} readings) sent, {:.0f} msgs/s, at {} line {}".format(
+                sent, readings, sent / (now - start), segment, line))
+            last_progress = now
+
+    # Wait for everything still in flight
+    publisher.wait()
+    checkpoint.save()
+
+    elapsed = time.monotonic() - start
+    print("Replayed {} readings in {} messages in {:.1f}s ({:.0f} readings/s), {} undecodable lines skipped".format(
+        readings, sent, elapsed, readings / elapsed if elapsed else 0.0, stats['bad']))
+    if sent:
+        print("Publish stats: {}".format(publisher.stats()))
+    if checkpoint.failed:
+        position, error = checkpoint.failed
+        print("Publish failed at {}: {!r}. Run again to resume.".format(position, error))
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.dry_run:
+        sys.exit(0 if replay(None, args) else 1)
+
+    CLIENT_ID = 'replay' + str(uuid4())
+
+    mqtt_connection = build_connection(CLIENT_ID)
+
+    print("Connecting to {} with client ID '{}'...".format(
+        os.getenv('AWS_ENDPOINTS') or os.getenv('AWS_ENDPOINT'), CLIENT_ID))
+    try:
+        mqtt_connection.connect().result()
+    except exceptions.AwsCrtError as e:
+        sys.exit("Connection failed: {}".format(e))
+    print("Connected!")
+
+    ok = replay(mqtt_connection, args)
+    mqtt_connection.disconnect().result()
+    sys.exit(0 if ok else 1)
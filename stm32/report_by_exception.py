@@ -0,0 +1,190 @@
+# Report-by-exception for readings.
+#
+# Most readings repeat the last one within sensor noise, and temperature is
+# flat most of the time. With REPORT_MODE=exception a field is only sent
+# when it has moved more than its deadband from the last value sent, or
+# when it hasn't been sent for REPORT_MAX_SILENCE seconds (the heartbeat
+# that tells the cloud the animal is still there). Fields that didn't
+# change are left out of the message, and a reading where nothing changed
+# isn't published at all.
+#
+# The cloud side rebuilds the series by holding each field at its last
+# reported value (see reconstruct()). Every reconstructed point is then
+# within the field's deadband of what was measured. The deadbands and
+# heartbeat are published once, retained, on <topic>/reporting so
+# consumers know the error bound.
+#
+# SampleRateAdvisor works out how often each collar needs to sample. A
+# collar whose readings keep being suppressed is asked to sample less
+# often, and one that changes is asked to go back to the fast rate.
+#
+# Settings (.env):
+#   REPORT_MODE          all (default) or exception
+#   REPORT_DEADBANDS     e.g. "Temperature=0.1, Acceleration=0.05"
+#   REPORT_MAX_SILENCE   seconds, default 300
+#   SAMPLE_INTERVAL_MIN, SAMPLE_INTERVAL_MAX   collar sample interval range in seconds
+
+import bisect
+import os
+import time
+
+REPORT_ALL = 'all'
+REPORT_EXCEPTION = 'exception'
+DEFAULT_DEADBANDS = {'Temperature': 0.1, 'Tempurature': 0.1, 'Acceleration': 0.05}
+DEFAULT_MAX_SILENCE = 300
+DEFAULT_SAMPLE_INTERVAL_MIN = 30
+DEFAULT_SAMPLE_INTERVAL_MAX = 600
+# Suppressed readings in a row before a collar is asked to slow down
+STABLE_READINGS = 10
+# A collar gets at most one sample rate command this often (seconds), so a
+# borderline animal doesn't flip between rates and eat downlink airtime
+MIN_COMMAND_INTERVAL = 900
+
+
+def parse_deadbands(spec):
+    # 'Temperature=0.1, Acceleration=0.05' -> {'Temperature': 0.1, 'Acceleration': 0.05}
+    deadbands = {}
+    if not spec:
+        return deadbands
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        field, _, deadband = entry.partition('=')
+        if not deadband:
+            raise ValueError("Deadband '{}' must look like <field>=<value>".format(entry))
+        deadbands[field.strip()] = float(deadband)
+    return deadbands
+
+
+def signal_values(value):
+    # 38.6 -> (38.6,), '1.16 -1.91 0.2' -> (1.16, -1.91, 0.2), {'x': 1.16, ...} -> (1.16, ...)
+    # None for anything that isn't numeric
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return (float(value),)
+    try:
+        if isinstance(value, dict):
+            return tuple(float(value[axis]) for axis in sorted(value))
+        if isinstance(value, str):
+            return tuple(float(part) for part in value.split())
+    except ValueError:
+        pass
+    return None
+
+
+def exceeds(old, new, deadband):
+    if old is None or new is None or len(old) != len(new):
+        return old != new
+    return any(abs(a - b) > deadband for a, b in zip(old, new))
+
+
+class ReportByException:
+    def __init__(self, deadbands=None, max_silence=DEFAULT_MAX_SILENCE, default_deadband=0.0, last_sent=None):
+        self.deadbands = dict(DEFAULT_DEADBANDS if deadbands is None else deadbands)
+        self.max_silence = max_silence
+        self.default_deadband = default_deadband
+        # device_id -> {field: (values, raw value, time sent)}, e.g. a
+        # namespace of an AnimalStateStore
+        self.last_sent = {} if last_sent is None else last_sent
+        self.readings = 0
+        self.suppressed = 0
+        self.fields_seen = 0
+        self.fields_sent = 0
+        # Whether the last reading moved past a deadband, as opposed to
+        # being sent only as a heartbeat
+        self.last_changed = False
+
+    @classmethod
+    def from_env(cls, last_sent=None):
+        deadbands = dict(DEFAULT_DEADBANDS)
+        deadbands.update(parse_deadbands(os.getenv('REPORT_DEADBANDS')))
+        return cls(deadbands, float(os.getenv('REPORT_MAX_SILENCE', DEFAULT_MAX_SILENCE)), last_sent=last_sent)
+
+    def filter(self, device_id, data, now=None):
+        # Returns the fields of `data` that have to be reported, empty if
+        # the whole reading can be skipped
+        now = time.time() if now is None else now
+        sent = self.last_sent.setdefault(device_id, {})
+        report = {}
+        self.last_changed = False
+        for field, value in data.items():
+            values = signal_values(value)
+            previous = sent.get(field)
+            changed = (previous is None
+                       or exceeds(previous[0], values, self.deadbands.get(field, self.default_deadband))
+                       or (values is None and previous[1] != value))
+            if changed or now - previous[2] >= self.max_silence:
+                report[field] = value
+                sent[field] = (values, value, now)
+                self.last_changed = self.last_changed or changed
+        self.readings += 1
+        self.fields_seen += len(data)
+        self.fields_sent += len(report)
+        if not report:
+            self.suppressed += 1
+        return report
+
+    def forget(self, device_id):
+        self.last_sent.pop(device_id, None)
+
+    def declaration(self):
+        # What the cloud needs to know to rebuild the series
+        return {'mode': REPORT_EXCEPTION, 'deadbands': self.deadbands, 'max_silence': self.max_silence}
+
+    def stats(self):
+        return {
+            'readings': self.readings,
+            'suppressed': self.suppressed,
+            'fields_sent_pct': round(100.0 * self.fields_sent / self.fields_seen, 1) if self.fields_seen else None,
+        }
+
+
+def reconstruct(reports, times):
+    # Cloud side: rebuilds one field at the given times from its reports,
+    # [(ts, value), ...] oldest first, by holding the last reported value.
+    # Times before the first report come back as None.
+    report_times = [ts for ts, _ in reports]
+    series = []
+    for ts in times:
+        i = bisect.bisect_right(report_times, ts) - 1
+        series.append(reports[i][1] if i >= 0 else None)
+    return series
+
+
+class SampleRateAdvisor:
+    def __init__(self, fastest=DEFAULT_SAMPLE_INTERVAL_MIN, slowest=DEFAULT_SAMPLE_INTERVAL_MAX,
+                 stable_readings=STABLE_READINGS, min_command_interval=MIN_COMMAND_INTERVAL, devices=None):
+        self.fastest = fastest
+        self.slowest = slowest
+        self.stable_readings = stable_readings
+        self.min_command_interval = min_command_interval
+        # device_id -> [current interval, unchanged readings in a row, time of last command]
+        self.devices = {} if devices is None else devices
+
+    @classmethod
+    def from_env(cls, devices=None):
+        return cls(float(os.getenv('SAMPLE_INTERVAL_MIN', DEFAULT_SAMPLE_INTERVAL_MIN)),
+                   float(os.getenv('SAMPLE_INTERVAL_MAX', DEFAULT_SAMPLE_INTERVAL_MAX)),
+                   devices=devices)
+
+    def observe(self, device_id, changed, now=None):
+        # `changed` is whether the reading moved past a deadband. Returns the
+        # new sample interval for the collar if it should change, otherwise
+        # None. Slows down by doubling, speeds up in one step.
+        now = time.time() if now is None else now
+        state = self.devices.setdefault(device_id, [self.fastest, 0, None])
+        interval = state[0]
+        state[1] = 0 if changed else state[1] + 1
+        if state[2] is not None and now - state[2] < self.min_command_interval:
+            return None
+        if changed and interval > self.fastest:
+            state[0] = self.fastest
+        elif state[1] >= self.stable_readings and interval < self.slowest:
+            state[0] = min(self.slowest, interval * 2)
+            state[1] = 0
+        if state[0] == interval:
+            return None
+        state[2] = now
+        return state[0]
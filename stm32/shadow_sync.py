@@ -0,0 +1,177 @@
+# Keeps gateway settings in sync with the thing's Device Shadow.
+#
+# Set a value in the shadow's desired state, e.g.
+#   {"state": {"desired": {"SAMPLE_FREQUENCY": 10, "PUBLISH_TOPIC": "barn2/temp"}}}
+# and the gateway applies it to .env through LiveConfig, where the running
+# publishers pick it up without restarting (see live_config.py).
+#
+# Only delta documents are used, so a change costs the changed keys and not
+# the whole document. Deltas that arrive close together are merged and applied
+# once, and only the keys that were applied are reported back. The last
+# applied state and shadow version are cached on disk so a restart without
+# network comes back with the same settings and does not re-apply them later.
+
+from awscrt import mqtt
+from awsiot import iotshadow
+import json
+import os
+import tempfile
+import threading
+
+from gateway_paths import data_path
+
+DEFAULT_CACHE_FILE = 'shadow_cache.json'
+# Deltas arriving within this many seconds of each other are applied together
+DEFAULT_COALESCE_SECONDS = 2.0
+# Only these .env keys may be set from the cloud
+DEFAULT_SHADOW_KEYS = ('PUBLISH_TOPIC', 'SAMPLE_FREQUENCY', 'UART_PORT', 'BAUD_RATE', 'EDGE_RULES')
+
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        return cache.get('version'), cache.get('state', {})
+    except (FileNotFoundError, ValueError):
+        return None, {}
+
+
+def save_cache(path, version, state):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.shadow_cache.', dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'version': version, 'state': state}, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class ShadowSync:
+    def __init__(self, mqtt_connection, thing_name, config, cache_file=None,
+                 coalesce_seconds=DEFAULT_COALESCE_SECONDS, allowed_keys=None):
+        self.thing_name = thing_name
+        self.config = config
+        self.cache_file = cache_file or os.getenv('SHADOW_CACHE_FILE') or data_path(DEFAULT_CACHE_FILE)
+        self.coalesce_seconds = coalesce_seconds
+        if allowed_keys is None:
+            env_keys = os.getenv('SHADOW_CONFIG_KEYS')
+            allowed_keys = [k.strip() for k in env_keys.split(',')] if env_keys else DEFAULT_SHADOW_KEYS
+        self.allowed_keys = set(allowed_keys)
+        self.shadow_client = iotshadow.IotShadowClient(mqtt_connection)
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_version = None
+        self._timer = None
+        self.version, self.applied = load_cache(self.cache_file)
+
+    def start(self):
+        # Apply the cached state first so the gateway runs with the last known
+        # settings even if the shadow service can't be reached
+        if self.applied:
+            print("Applying cached shadow state (version {}): {}".format(self.version, self.applied))
+            self.config.apply({k: v for k, v in self.applied.items() if k in self.allowed_keys})
+
+        print("Subscribing to Shadow Delta events...")
+        delta_future, _ = self.shadow_client.subscribe_to_shadow_delta_updated_events(
+            request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing_name=self.thing_name),
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=self.on_shadow_delta_updated)
+        delta_future.result()
+
+        get_request = iotshadow.GetShadowSubscriptionRequest(thing_name=self.thing_name)
+        accepted_future, _ = self.shadow_client.subscribe_to_get_shadow_accepted(
+            request=get_request,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=self.on_get_shadow_accepted)
+        rejected_future, _ = self.shadow_client.subscribe_to_get_shadow_rejected(
+            request=get_request,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=self.on_shadow_request_rejected)
+        accepted_future.result()
+        rejected_future.result()
+
+        update_future, _ = self.shadow_client.subscribe_to_update_shadow_rejected(
+            request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=self.thing_name),
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=self.on_shadow_request_rejected)
+        update_future.result()
+
+        # Pick up anything that changed while we were offline. Only the delta
+        # part of the response is used.
+        self.shadow_client.publish_get_shadow(
+            iotshadow.GetShadowRequest(thing_name=self.thing_name),
+            mqtt.QoS.AT_LEAST_ONCE)
+
+    def on_get_shadow_accepted(self, response):
+        # type: (iotshadow.GetShadowResponse) -> None
+        delta = response.state.delta if response.state else None
+        if delta:
+            self.queue_changes(delta, response.version)
+        elif response.version != self.version:
+            # Nothing to change, but remember which version we are in sync with
+            with self._lock:
+                self.version = response.version
+                save_cache(self.cache_file, self.version, self.applied)
+
+    def on_shadow_delta_updated(self, delta):
+        # type: (iotshadow.ShadowDeltaUpdatedEvent) -> None
+        if delta.state:
+            self.queue_changes(delta.state, delta.version)
+
+    def on_shadow_request_rejected(self, error):
+        # type: (iotshadow.ErrorResponse) -> None
+        print("Shadow request was rejected. code:'{}' message:'{}'".format(error.code, error.message))
+
+    def queue_changes(self, state, version):
+        with self._lock:
+            # Deltas can arrive out of order, drop ones older than what we applied
+            if version is not None and self.version is not None and version < self.version:
+                return
+            self._pending.update(state)
+            self._pending_version = version
+            if self._timer is None:
+                self._timer = threading.Timer(self.coalesce_seconds, self.apply_pending)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def apply_pending(self):
+        with self._lock:
+            pending, version = self._pending, self._pending_version
+            self._pending, self._pending_version, self._timer = {}, None, None
+
+        accepted = {k: v for k, v in pending.items() if k in self.allowed_keys and not isinstance(v, (dict, list))}
+        ignored = sorted(set(pending) - set(accepted))
+        if ignored:
+            print("Ignoring shadow keys that can't be set remotely: {}".format(ignored))
+
+        changed = {k: v for k, v in accepted.items() if self.applied.get(k) != v}
+        if changed:
+            self.config.apply(changed)
+        with self._lock:
+            self.applied.update(changed)
+            if version is not None:
+                self.version = version
+            save_cache(self.cache_file, self.version, self.applied)
+
+        # A delta only holds keys where desired and reported differ, so
+        # reporting it back is all that's needed. Desired keys we won't apply
+        # are cleared so the service stops sending them in every delta.
+        reported = dict(accepted)
+        reported.update({k: None for k in ignored})
+        if reported:
+            self.report(reported)
+
+    def report(self, reported):
+        print("Reporting shadow state: {}".format(reported))
+        request = iotshadow.UpdateShadowRequest(
+            thing_name=self.thing_name,
+            state=iotshadow.ShadowState(
+                reported=reported,
+                desired={k: None for k, v in reported.items() if v is None} or None))
+        future = self.shadow_client.publish_update_shadow(request, mqtt.QoS.AT_LEAST_ONCE)
+        future.add_done_callback(self.on_publish_update_shadow)
+
+    def on_publish_update_shadow(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            print("Failed to publish shadow update: {!r}".format(e))
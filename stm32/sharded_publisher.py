@@ -0,0 +1,198 @@
+# Publishing over several MQTT connections at once.
+#
+# AWS IoT Core limits how many messages one connection may publish per
+# second, and a gateway for a large free-stall barn with several receivers
+# can outgrow a single connection. ShardedPublisher spreads the messages
+# over N connections, each with its own client ID and its own
+# InFlightPublisher window. Which connection a message takes is decided by
+# a consistent hash of its key, the Device_ID, so all of one animal's
+# messages go out over the same connection, in order.
+#
+# A shard is healthy while its connection is up. While it is down its keys
+# move to the next healthy shard on the ring (only its keys, every other
+# animal stays where it was) and the messages it still had waiting on a
+# PUBACK are saved to the outbox and re-sent by a healthy shard instead of
+# waiting for it to come back. Once it reconnects its keys go back to it.
+# As with any QoS 1 retry, a message caught up in that can arrive twice,
+# and an animal's re-sent backlog can arrive after its newer messages.
+#
+# The shards share one outbox, drained by one connected shard at a time.
+#
+#   publisher = ShardedPublisher.from_env(outbox=Outbox())
+#   publisher.shards[i].mqtt_connection = connection_i
+#   publisher.start(i)                  # as each connection comes up
+#   publisher.publish('test/temp', json.dumps(message), key=device_id)
+#   ...
+#   publisher.close(timeout=10)
+#
+# The connection callbacks go to on_connection_interrupted(i) and
+# on_connection_resumed(i). Without an index they are about shard 0, so a
+# ShardedPublisher can stand in for an InFlightPublisher.
+#
+# Settings (.env): PUBLISH_SHARDS, PUBLISH_WINDOW (per shard)
+
+import bisect
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from inflight_publisher import InFlightPublisher
+
+DEFAULT_SHARDS = 1
+# Points per shard on the hash ring, enough for an even split of a few
+# hundred animals
+VIRTUAL_NODES = 64
+# Keys whose ring position is remembered, well above the animals in a barn
+MAX_CACHED_KEYS = 100000
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+class ShardedPublisher:
+    def __init__(self, shards, outbox=None, virtual_nodes=VIRTUAL_NODES):
+        # shards: InFlightPublishers, one per connection, sharing `outbox`
+        self.shards = list(shards)
+        self.outbox = outbox
+        ring = sorted((_hash('shard-{}-{}'.format(index, node)), index)
+                      for index in range(len(self.shards)) for node in range(virtual_nodes))
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_shards = [index for _, index in ring]
+        self._positions = {}
+        self._lock = threading.Lock()
+        self._drainer = None
+        self._drain_gate = None
+        self.interruptions = [0] * len(self.shards)
+        self.counts = collections.Counter()
+        for shard in self.shards:
+            shard.drains_outbox = False
+            shard.outbox_peers = [peer for peer in self.shards if peer is not shard]
+
+    @classmethod
+    def from_env(cls, outbox=None, shards=None, window=None):
+        # Connections are attached later, see the example above
+        shards = shards or int(os.getenv('PUBLISH_SHARDS', DEFAULT_SHARDS))
+        return cls([InFlightPublisher(None, window=window, outbox=outbox) for _ in range(shards)], outbox)
+
+    @property
+    def drain_gate(self):
+        return self._drain_gate
+
+    @drain_gate.setter
+    def drain_gate(self, gate):
+        # Set by LaneScheduler, applies to whichever shard drains
+        self._drain_gate = gate
+        for shard in self.shards:
+            shard.drain_gate = gate
+
+    def home(self, key):
+        # The shard `key` belongs to while every shard is up
+        return self._ring_shards[self._position(key)]
+
+    def _position(self, key):
+        position = self._positions.get(key)
+        if position is None:
+            if len(self._positions) >= MAX_CACHED_KEYS:
+                self._positions.clear()
+            position = bisect.bisect(self._ring_hashes, _hash(key)) % len(self._ring_hashes)
+            self._positions[key] = position
+        return position
+
+    def shard_for(self, key):
+        # The first healthy shard at or after `key` on the ring, None if
+        # no shard is connected
+        if not any(shard.connected for shard in self.shards):
+            return None
+        position = self._position(key)
+        for offset in range(len(self._ring_shards)):
+            index = self._ring_shards[(position + offset) % len(self._ring_shards)]
+            if self.shards[index].connected:
+                return index
+        return None
+
+    def publish(self, topic, payload, qos=None, on_done=None, timeout=None, key=None):
+        # As InFlightPublisher.publish. Messages without a key are placed by
+        # their topic.
+        key = topic if key is None else key
+        index = self.shard_for(key)
+        if index is None:
+            # Nothing connected: the home shard spools it, or without an
+            # outbox its client queues it
+            index = self.home(key)
+        elif index != self.home(key):
+            self.counts['rerouted'] += 1
+        return self.shards[index].publish(topic, payload, qos, on_done=on_done, timeout=timeout)
+
+    def spool(self, topic, payload, qos):
+        self.shards[0].spool(topic, payload, qos)
+        if not self.shards[0].connected:
+            # Shard 0 can't start a drain, the drainer can if one is up
+            self._elect_drainer(kick=True)
+
+    def start(self, index=0):
+        # Call once shard `index` is connected
+        self.on_connection_resumed(index)
+
+    def on_connection_interrupted(self, index=0):
+        self.interruptions[index] += 1
+        self.shards[index].on_connection_interrupted()
+        # What it saved is re-sent by a shard that is still up
+        self._elect_drainer(kick=True)
+
+    def on_connection_resumed(self, index=0):
+        self.shards[index].on_connection_resumed()
+        self._elect_drainer()
+
+    def _elect_drainer(self, kick=False):
+        # The drainer only changes when it disconnects, so two shards never
+        # drain at the same time
+        with self._lock:
+            current = self._drainer
+            if current is None or not self.shards[current].connected:
+                current = next((i for i, shard in enumerate(self.shards) if shard.connected), None)
+                kick = kick or current != self._drainer
+                for i, shard in enumerate(self.shards):
+                    shard.drains_outbox = i == current
+                self._drainer = current
+        if current is not None and kick:
+            self.shards[current].drain()
+
+    def in_flight(self):
+        return sum(shard.in_flight() for shard in self.shards)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for shard in self.shards:
+            if not shard.wait(None if deadline is None else max(0, deadline - time.monotonic())):
+                return False
+        return True
+
+    def close(self, timeout=None):
+        # Returns the number of messages saved to the outbox
+        deadline = None if timeout is None else time.monotonic() + timeout
+        saved = 0
+        for shard in self.shards:
+            saved += shard.close(None if deadline is None else max(0, deadline - time.monotonic()))
+        return saved
+
+    def stats(self):
+        per_shard = [shard.stats() for shard in self.shards]
+        stats = collections.Counter()
+        for shard_stats in per_shard:
+            for name in ('sent', 'acked', 'failed', 'spooled', 'blocked', 'in_flight'):
+                stats[name] += shard_stats.get(name, 0)
+        stats = dict(stats, **self.counts)
+        stats['shards'] = [{
+            'connected': shard.connected,
+            'interruptions': self.interruptions[index],
+            'sent': shard_stats.get('sent', 0),
+            'in_flight': shard_stats['in_flight'],
+            'ack_p95_ms': shard_stats['ack_p95_ms'],
+        } for index, (shard, shard_stats) in enumerate(zip(self.shards, per_shard))]
+        stats['drainer'] = self._drainer
+        if self.outbox is not None:
+            stats['outbox'] = self.outbox.count()
+        return stats
@@ -0,0 +1,140 @@
+# Simulates downlink commands to a herd of collars, comparing
+# downlink.py's scheduler with sending every command as soon as it is made.
+#
+# Runs on a simulated clock, so hours of traffic take seconds. Each collar
+# sends an uplink every --interval seconds (with jitter) and listens for
+# DOWNLINK_RX_WINDOW seconds, DOWNLINK_RX_DELAY after it. Commands (sample
+# interval, data rate, acks) are made at --commands per second for random
+# collars.
+#
+# Reports for each policy:
+#   - commands delivered (sent while the collar was listening) and how long
+#     they waited
+#   - radio airtime and the worst duty cycle over any DUTY_WINDOW
+#   - uplinks missed because the gateway was transmitting at the time
+#
+# Example:
+#   python simulate_downlink.py --collars 1000 --hours 6 --commands 0.5
+
+import argparse
+import heapq
+import random
+
+from downlink import DownlinkScheduler, lora_airtime
+from inflight_publisher import percentile
+from lora_packet import build_downlink
+
+KINDS = ['sample_interval', 'sample_interval', 'spreading_factor', 'ack']
+
+parser = argparse.ArgumentParser(description="Simulate downlink scheduling for many collars.")
+parser.add_argument('--collars', type=int, default=500)
+parser.add_argument('--hours', type=float, default=4)
+parser.add_argument('--interval', type=float, default=300, help='seconds between uplinks from each collar')
+parser.add_argument('--commands', type=float, default=0.2, help='commands made per second, across all collars')
+parser.add_argument('--uplink-bytes', type=int, default=40)
+parser.add_argument('--duty-cycle', type=float, default=0.10)
+parser.add_argument('--seed', type=int, default=1)
+
+
+def simulate(args, policy):
+    rng = random.Random(args.seed)
+    end = args.hours * 3600
+    scheduler = DownlinkScheduler(duty_cycle=args.duty_cycle)
+    uplink_airtime = lora_airtime(args.uplink_bytes + scheduler.header_bytes)
+    events = []  # (time, order, kind, device_id, value)
+    order = 0
+
+    def push(at, kind, device_id=None, value=None):
+        nonlocal order
+        order += 1
+        heapq.heappush(events, (at, order, kind, device_id, value))
+
+    for device_id in range(args.collars):
+        push(rng.uniform(0, args.interval), 'uplink', device_id)
+    at = 0.0
+    while at < end:
+        at += rng.expovariate(args.commands)
+        push(at, 'command', rng.randrange(args.collars), rng.choice(KINDS))
+
+    listening = {}  # device_id -> (opens, closes)
+    transmissions = []  # (start, end)
+    made = delivered = missed_uplinks = 0
+    latencies = []
+    busy_until = 0.0
+    while events:
+        now, _, kind, device_id, value = heapq.heappop(events)
+        if now > end:
+            break
+        if kind == 'uplink':
+            if busy_until > now:
+                missed_uplinks += 1
+            else:
+                listening[device_id] = (now + uplink_airtime + scheduler.rx_delay,
+                                        now + uplink_airtime + scheduler.rx_delay + scheduler.rx_window)
+                if policy == 'scheduled':
+                    scheduler.on_uplink(device_id, now + uplink_airtime)
+                    push(now + uplink_airtime + scheduler.rx_delay, 'due')
+            push(now + args.interval * rng.uniform(0.9, 1.1), 'uplink', device_id)
+        elif kind == 'command':
+            made += 1
+            if policy == 'scheduled':
+                scheduler.queue(device_id, value, rng.randint(7, 600), now)
+                continue
+            # Immediate: one frame per command, whenever the radio is free
+            frame = build_downlink(device_id, [(value, rng.randint(7, 600))]).encode()
+            airtime = scheduler.airtime(len(frame) + scheduler.header_bytes)
+            start = max(now, busy_until)
+            busy_until = start + airtime
+            transmissions.append((start, busy_until))
+            opens, closes = listening.get(device_id, (-1, -1))
+            if opens <= start <= closes:
+                delivered += 1
+                latencies.append(start - now)
+        elif kind == 'due':
+            for device_id, frame in scheduler.pop_due(now):
+                airtime = scheduler.airtime(len(frame) + scheduler.header_bytes)
+                start = max(now, busy_until)
+                busy_until = start + airtime
+                transmissions.append((start, busy_until))
+                opens, closes = listening[device_id]
+                if opens <= start <= closes:
+                    # One command per field after the Device_ID
+                    delivered += frame.count(b' ')
+
+    if policy == 'scheduled':
+        latencies = list(scheduler._latencies)
+    airtime = sum(e - s for s, e in transmissions)
+    worst_duty = 0.0
+    window = scheduler.ledger.window
+    first = 0
+    used = 0.0
+    for start, finish in transmissions:
+        used += finish - start
+        while transmissions[first][0] <= start - window:
+            used -= transmissions[first][1] - transmissions[first][0]
+            first += 1
+        worst_duty = max(worst_duty, used / window)
+    return {
+        'made': made,
+        'delivered': delivered,
+        'frames': len(transmissions),
+        'airtime_s': round(airtime, 1),
+        'off_receive': '{:.3%}'.format(airtime / end),
+        'worst_duty': '{:.2%}'.format(worst_duty),
+        'missed_uplinks': missed_uplinks,
+        'wait_p50_s': None if not latencies else round(percentile(latencies, 0.5), 1),
+        'wait_p95_s': None if not latencies else round(percentile(latencies, 0.95), 1),
+        'scheduler': scheduler.stats(end) if policy == 'scheduled' else None,
+    }
+
+
+def main():
+    args = parser.parse_args()
+    print("{} collars, {} h, uplink every {}s, {} commands/s".format(
+        args.collars, args.hours, args.interval, args.commands))
+    for policy in ('immediate', 'scheduled'):
+        print("{:<10} {}".format(policy, simulate(args, policy)))
+
+
+if __name__ == '__main__':
+    main()
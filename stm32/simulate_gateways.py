@@ -0,0 +1,124 @@
+# Runs several gateways' coordinators on one host and feeds them the same
+# collar packets, to check gateway_coordination.py.
+#
+# Every simulated gateway has its own Coordinator and multicast socket on
+# the loopback interface, exactly as separate Pis would on a LAN. Each packet
+# is heard by each gateway with probability --hear, at an RSSI that depends
+# on the collar/gateway pair plus some noise, and reaches the coordinator
+# after a random delay of up to --jitter seconds (radio + UART).
+#
+# Reports:
+#   - cloud messages per packet: 1.0 is perfect, N is what N uncoordinated
+#     gateways send
+#   - packets lost: heard by some gateway but forwarded by none
+#   - how often the strongest receiver was the one that forwarded
+#   - added latency: first reception -> forwarded
+#
+# Example:
+#   python simulate_gateways.py --gateways 4 --collars 200 --packets 5000 --rate 200
+
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+
+from gateway_coordination import Coordinator, packet_key
+from inflight_publisher import percentile
+
+parser = argparse.ArgumentParser(description="Simulate several gateways sharing a pasture.")
+parser.add_argument('--gateways', type=int, default=3, help='number of simulated gateways')
+parser.add_argument('--collars', type=int, default=100, help='number of collars')
+parser.add_argument('--packets', type=int, default=2000, help='packets sent in total')
+parser.add_argument('--rate', type=float, default=100, help='packets per second across all collars')
+parser.add_argument('--hear', type=float, default=0.9, help='chance each gateway hears a packet')
+parser.add_argument('--jitter', type=float, default=0.02, help='max delay between gateways hearing a packet, in seconds')
+parser.add_argument('--window', type=float, default=0.15, help='COORDINATION_WINDOW')
+parser.add_argument('--port', type=int, default=None, help='multicast port (default: random)')
+parser.add_argument('--seed', type=int, default=None)
+
+
+def main():
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    port = args.port or rng.randint(40000, 60000)
+
+    lock = threading.Lock()
+    forwarded = defaultdict(list)  # packet id -> [(gateway, forwarded at)]
+    heard = defaultdict(dict)  # packet id -> {gateway: (rssi, heard at)}
+    ids = {}  # packet key -> packet id
+
+    coordinators = []
+    for i in range(args.gateways):
+        coordinator = Coordinator('gw{:02d}'.format(i), port=port, window=args.window, interface='127.0.0.1')
+        coordinator.start()
+        coordinators.append(coordinator)
+
+    def on_win(gateway, packet_id):
+        with lock:
+            forwarded[packet_id].append((gateway, time.monotonic()))
+
+    def receive(coordinator, packet, packet_id, rssi):
+        with lock:
+            heard[packet_id][coordinator.gateway_id] = (rssi, time.monotonic())
+        coordinator.offer(packet_key(packet), rssi,
+                          lambda: on_win(coordinator.gateway_id, packet_id))
+
+    # How well each gateway hears each collar
+    base_rssi = [[rng.uniform(-120, -60) for _ in coordinators] for _ in range(args.collars)]
+    started = time.monotonic()
+    for packet_id in range(args.packets):
+        collar = rng.randrange(args.collars)
+        packet = 'I{:02d} T{:.1f} A{:.2f} {:.2f} {:.2f}'.format(
+            collar, rng.uniform(37.5, 40), rng.uniform(-2, 2), rng.uniform(-2, 2), rng.uniform(-2, 2))
+        key = packet_key(packet)
+        if key in ids:
+            # Identical reading already in flight, real collars don't repeat that fast
+            continue
+        ids[key] = packet_id
+        for gateway, coordinator in enumerate(coordinators):
+            if rng.random() >= args.hear:
+                continue
+            rssi = int(round(base_rssi[collar][gateway] + rng.gauss(0, 3)))
+            threading.Timer(rng.uniform(0, args.jitter), receive,
+                            args=(coordinator, packet + ' R{}\n'.format(rssi), packet_id, rssi)).start()
+        time.sleep(max(0, started + (packet_id + 1) / args.rate - time.monotonic()))
+
+    # Let the last decisions finish
+    deadline = time.monotonic() + args.window * 4 + args.jitter + 1
+    while time.monotonic() < deadline and any(c.pending() for c in coordinators):
+        time.sleep(0.05)
+    time.sleep(0.2)
+    for coordinator in coordinators:
+        coordinator.stop()
+
+    heard_packets = [p for p in heard if heard[p]]
+    receptions = sum(len(heard[p]) for p in heard_packets)
+    messages = sum(len(forwarded[p]) for p in heard_packets)
+    lost = [p for p in heard_packets if not forwarded[p]]
+    duplicated = [p for p in heard_packets if len(forwarded[p]) > 1]
+    best = 0
+    latencies = []
+    for p in heard_packets:
+        if not forwarded[p]:
+            continue
+        strongest = max(heard[p], key=lambda g: (heard[p][g][0], g))
+        if any(gateway == strongest for gateway, _ in forwarded[p]):
+            best += 1
+        first_heard = min(at for _, at in heard[p].values())
+        latencies.append(min(at for _, at in forwarded[p]) - first_heard)
+
+    print("{} gateways, {} packets heard, {} receptions".format(len(coordinators), len(heard_packets), receptions))
+    print("cloud messages: {} ({:.3f} per packet, {:.2f} without coordination)".format(
+        messages, messages / max(1, len(heard_packets)), receptions / max(1, len(heard_packets))))
+    print("duplicated: {}  lost: {}  strongest forwarded: {:.1%}".format(
+        len(duplicated), len(lost), best / max(1, len(heard_packets) - len(lost))))
+    if latencies:
+        print("added latency ms: p50 {:.1f}  p95 {:.1f}  max {:.1f}".format(
+            1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.95), 1000 * max(latencies)))
+    for coordinator in coordinators:
+        print("{}: {}".format(coordinator.gateway_id, coordinator.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Runs many simulated devices, each with its own copy of the test_jobs.py
+# callback chain, against the in-memory jobs service in local_jobs_service.py.
+#
+# Every device loads a fresh instance of the test_jobs module, so each has its
+# own LockedData, JobExecutor and globals exactly as on a real Pi. The jobs
+# themselves only sleep, which keeps the run about the dispatch logic.
+#
+# Reports:
+#   - pickup latency: job created -> job marked IN_PROGRESS
+#   - throughput: finished jobs per second of wall time
+#   - contention on LockedData.lock: how often a thread had to wait and for how long
+#   - races: jobs started twice, updates after a job finished, and jobs left
+#     QUEUED on an idle device (a lost is_next_job_waiting wake-up)
+#
+# Example:
+#   python simulate_job_fleet.py --devices 200 --jobs-per-device 20 --max-delay 0.05
+
+import argparse
+import importlib.util
+import os
+import random
+import threading
+import time
+
+from job_executor import JobExecutor
+from local_jobs_service import LocalConnection, LocalJobsClient, LocalJobsService, TERMINAL_STATUSES
+
+TEST_JOBS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_jobs.py')
+
+parser = argparse.ArgumentParser(description="Simulate a fleet of job agents against a local jobs service.")
+parser.add_argument('--devices', type=int, default=50, help='number of simulated devices')
+parser.add_argument('--jobs-per-device', type=int, default=10, help='jobs queued for each device')
+parser.add_argument('--job-seconds', type=float, default=0.01, help='how long each simulated job runs')
+parser.add_argument('--workers', type=int, default=4, help='MAX_CONCURRENT_JOBS on each device')
+parser.add_argument('--max-delay', type=float, default=0.01, help='max random delay on each service message, in seconds')
+parser.add_argument('--duplicate-events', type=float, default=0.1, help='chance of a Next Job Execution Changed event being delivered twice')
+parser.add_argument('--delivery-threads', type=int, default=8, help='threads delivering service messages')
+parser.add_argument('--trickle', type=float, default=0.5, help='fraction of jobs created while devices are already running')
+parser.add_argument('--timeout', type=float, default=60.0, help='give up waiting for jobs to finish after this many seconds')
+parser.add_argument('--seed', type=int, default=None)
+
+
+class InstrumentedLock:
+    # threading.Lock that records how often and how long callers wait for it
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        if acquired:
+            waited = time.perf_counter() - start
+            self.acquisitions += 1
+            self.contended += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def simulated_handler(seconds):
+    def run(job_id, name, action_input):
+        time.sleep(float(action_input.get('simulatedSeconds', seconds)))
+        return 0, ''
+    return run
+
+
+def load_device(index, service, workers, job_seconds):
+    thing_name = 'sim-{:04d}'.format(index)
+    spec = importlib.util.spec_from_file_location('test_jobs_{}'.format(thing_name), TEST_JOBS_PATH)
+    device = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(device)
+
+    device.thing_name = thing_name
+    device.locked_data.lock = InstrumentedLock()
+    device.mqtt_connection = LocalConnection(service, thing_name)
+    device.job_executor = JobExecutor(
+        max_workers=workers,
+        step_runners={'runHandler': simulated_handler(job_seconds)})
+    return device
+
+
+def job_document(job_seconds):
+    return {
+        'steps': [{
+            'action': {
+                'name': 'simulated',
+                'type': 'runHandler',
+                'input': {'handler': 'simulated.py', 'simulatedSeconds': job_seconds}
+            }
+        }]
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    service = LocalJobsService(
+        delivery_threads=args.delivery_threads,
+        max_delay=args.max_delay,
+        duplicate_event_rate=args.duplicate_events,
+        seed=args.seed)
+
+    print("Loading {} simulated devices...".format(args.devices))
+    devices = [load_device(i, service, args.workers, args.job_seconds) for i in range(args.devices)]
+
+    # Part of the backlog is queued before the devices come up, the rest
+    # trickles in while they are working on it
+    upfront = int(round(args.jobs_per_device * (1 - args.trickle)))
+    for device in devices:
+        for n in range(upfront):
+            service.create_job(device.thing_name, 'job-{:04d}'.format(n), job_document(args.job_seconds))
+
+    start = time.monotonic()
+    for device in devices:
+        device.setup_job_listener(device.mqtt_connection, client_class=LocalJobsClient)
+
+    pending = [(device.thing_name, n) for device in devices for n in range(upfront, args.jobs_per_device)]
+    rng.shuffle(pending)
+    for thing_name, n in pending:
+        service.create_job(thing_name, 'job-{:04d}'.format(n), job_document(args.job_seconds))
+        time.sleep(rng.uniform(0, args.job_seconds / max(1, args.devices)))
+
+    total = args.devices * args.jobs_per_device
+    deadline = start + args.timeout
+    while time.monotonic() < deadline:
+        finished = sum(1 for e in service.executions() if e.status in TERMINAL_STATUSES)
+        if finished == total:
+            break
+        time.sleep(0.05)
+    elapsed = time.monotonic() - start
+
+    # Give late messages a moment to land before checking for stranded jobs
+    time.sleep(args.max_delay * 2 + 0.1)
+    report(args, service, devices, elapsed)
+
+    for device in devices:
+        device.job_executor.shutdown(wait=False)
+    service.stop()
+
+
+def report(args, service, devices, elapsed):
+    executions = service.executions()
+    finished = [e for e in executions if e.status in TERMINAL_STATUSES]
+    pickup = [e.started_at - e.queued_at for e in executions if e.started_at is not None]
+    completion = [e.finished_at - e.queued_at for e in finished]
+
+    stranded = []
+    for device in devices:
+        idle = not device.job_executor.running_job_ids()
+        for execution in service.executions(device.thing_name):
+            if idle and execution.status not in TERMINAL_STATUSES:
+                stranded.append('{}/{} left {}'.format(device.thing_name, execution.job_id, execution.status))
+
+    locks = [device.locked_data.lock for device in devices]
+    acquisitions = sum(lock.acquisitions for lock in locks)
+    contended = sum(lock.contended for lock in locks)
+    total_wait = sum(lock.total_wait for lock in locks)
+    exited = [device.thing_name for device in devices if device.mqtt_connection.disconnected]
+
+    print()
+    print("Devices: {}  jobs: {}  finished: {}  wall time: {:.2f}s".format(
+        len(devices), len(executions), len(finished), elapsed))
+    print("Throughput: {:.1f} jobs/s".format(len(finished) / elapsed if elapsed else 0.0))
+    print("Pickup latency (ms):     p50 {:.1f}  p95 {:.1f}  max {:.1f}".format(
+        1000 * percentile(pickup, 0.5), 1000 * percentile(pickup, 0.95), 1000 * max(pickup or [0])))
+    print("Completion latency (ms): p50 {:.1f}  p95 {:.1f}  max {:.1f}".format(
+        1000 * percentile(completion, 0.5), 1000 * percentile(completion, 0.95), 1000 * max(completion or [0])))
+    print("LockedData.lock: {} acquisitions, {} contended ({:.2%}), total wait {:.1f}ms, max wait {:.2f}ms".format(
+        acquisitions, contended, contended / acquisitions if acquisitions else 0.0,
+        1000 * total_wait, 1000 * max([lock.max_wait for lock in locks] or [0])))
+
+    problems = service.violations + stranded + ['{} exited'.format(name) for name in exited]
+    if problems:
+        print("Found {} problem(s):".format(len(problems)))
+        for problem in problems[:50]:
+            print("  " + problem)
+    else:
+        print("No races detected.")
+    return problems
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
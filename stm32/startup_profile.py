@@ -0,0 +1,190 @@
+# Measures how long the gateway scripts take to start.
+#
+#   python startup_profile.py                    # import time of every entry point
+#   python startup_profile.py --top 15 publishUARTData
+#   python startup_profile.py --uart             # time until the first reading is logged
+#   python startup_profile.py --save-budget      # record the current numbers
+#   python startup_profile.py --check            # exits 1 on a regression
+#
+# Each entry point is imported in a fresh interpreter with -X importtime
+# (the scripts only do work under __main__), --runs times, and the median
+# is reported along with the imports that cost the most by themselves.
+#
+# --uart runs publishUARTData.py against a pseudo terminal in a scratch
+# directory, writes a packet to it every UART_POLL seconds and reports how
+# long it took for a reading to reach loraPackets.log. No AWS connection is
+# needed, readings wait in the outbox until one is made.
+#
+# --check fails if an entry point imports one of its DEFERRED modules at
+# startup, or takes more than BUDGET_SLACK times its time in
+# startup_budget.json. Budgets depend on the machine, so save them on the
+# Pi itself.
+
+import argparse
+import json
+import os
+import pty
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BUDGET_FILE = os.path.join(HERE, 'startup_budget.json')
+BUDGET_SLACK = 1.25
+
+# Entry point -> modules it must not import before it needs them
+ENTRY_POINTS = {
+    'publishUARTData': ('awscrt.mqtt', 'awsiot'),
+    'publishFakeData': (),
+    'publishRPiIP': (),
+    'replay_packets': (),
+    'test_jobs': (),
+    'query_server': ('awscrt.mqtt', 'awsiot'),
+    'stm32_UART': ('awscrt.mqtt', 'awsiot'),
+    'updateConfiguration': ('awscrt.mqtt', 'awsiot'),
+    'supervisor': (),
+    'update_gateway': (),
+}
+
+UART_PACKET = b'I01 T38.5 A0.01 -0.02 0.98\n'
+UART_POLL = 0.005
+UART_TIMEOUT = 30
+
+
+def parse_importtime(stderr):
+    # -X importtime lines look like
+    #   import time:       412 |        873 |   awscrt.io
+    # Returns {module: (self_us, cumulative_us)}
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return imports
+
+
+def profile_import(module):
+    # Wall time of `import module` in a new interpreter and what it imported
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    code = 'import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)'.format(module)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=HERE, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr.strip().splitlines()[-1]))
+    return float(result.stdout.strip().splitlines()[-1]) * 1000, parse_importtime(result.stderr)
+
+
+def profile_entry_point(module, runs):
+    times = []
+    imports = {}
+    for _ in range(runs):
+        elapsed_ms, imports = profile_import(module)
+        times.append(elapsed_ms)
+    return statistics.median(times), imports
+
+
+def time_to_first_reading(timeout=UART_TIMEOUT):
+    # Starts publishUARTData.py on a pty and returns the seconds until the
+    # first packet written to the pty shows up in loraPackets.log
+    master, slave = pty.openpty()
+    workdir = tempfile.mkdtemp(prefix='startup_profile.')
+    env = dict(os.environ, UART_PORT=os.ttyname(slave), OUTBOX_DB=os.path.join(workdir, 'outbox.db'),
+               ANIMAL_STATE_FILE=os.path.join(workdir, 'animal_state.pickle'), GATEWAY_DATA_DIR=workdir,
+               AWS_ENDPOINT=os.getenv('AWS_ENDPOINT', 'localhost'))
+    env.pop('SUPERVISOR_HEARTBEAT_FILE', None)
+    log_path = os.path.join(workdir, 'loraPackets.log')
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'publishUARTData.py')], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while time.monotonic() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError('publishUARTData.py exited:\n{}'.format(process.stderr.read().decode()))
+            os.write(master, UART_PACKET)
+            time.sleep(UART_POLL)
+            if os.path.exists(log_path) and os.path.getsize(log_path):
+                return time.monotonic() - started
+        raise RuntimeError('No reading logged within {}s'.format(timeout))
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        os.close(master)
+        os.close(slave)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def load_budget(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long the gateway scripts take to start.")
+    parser.add_argument('entry_points', nargs='*', help="Modules to profile (default: all entry points)")
+    parser.add_argument('--runs', type=int, default=5, help="Imports per entry point, the median is reported")
+    parser.add_argument('--top', type=int, default=5, help="Slowest imports to list per entry point")
+    parser.add_argument('--uart', action='store_true', help="Also measure time to the first logged UART reading")
+    parser.add_argument('--budget', default=DEFAULT_BUDGET_FILE, help="Budget file for --check and --save-budget")
+    parser.add_argument('--check', action='store_true', help="Exit 1 if over budget or a deferred module is imported")
+    parser.add_argument('--save-budget', action='store_true', help="Write the measured times to the budget file")
+    args = parser.parse_args()
+
+    names = args.entry_points or list(ENTRY_POINTS)
+    budget = load_budget(args.budget)
+    results = {}
+    failures = []
+    for name in names:
+        try:
+            elapsed_ms, imports = profile_entry_point(name, args.runs)
+        except RuntimeError as e:
+            print("{:<22} {}".format(name, e))
+            failures.append(name)
+            continue
+        results[name] = round(elapsed_ms, 1)
+        print("{:<22} {:8.1f} ms  ({} modules)".format(name, elapsed_ms, len(imports)))
+        slowest = sorted(imports.items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+        for module, (self_us, cumulative_us) in slowest:
+            print("    {:<40} self {:7.1f} ms  cumulative {:7.1f} ms".format(module, self_us / 1000, cumulative_us / 1000))
+
+        for deferred in ENTRY_POINTS.get(name, ()):
+            loaded = [module for module in imports if module == deferred or module.startswith(deferred + '.')]
+            if loaded:
+                print("    FAIL: imports {} at startup".format(', '.join(loaded)))
+                failures.append(name)
+        limit = budget.get(name)
+        if limit is not None and elapsed_ms > limit * BUDGET_SLACK:
+            print("    FAIL: {:.1f} ms is over the {:.1f} ms budget".format(elapsed_ms, limit))
+            failures.append(name)
+
+    if args.uart:
+        seconds = time_to_first_reading()
+        results['uart_first_reading'] = round(seconds * 1000, 1)
+        print("{:<22} {:8.1f} ms".format('uart_first_reading', seconds * 1000))
+        limit = budget.get('uart_first_reading')
+        if limit is not None and seconds * 1000 > limit * BUDGET_SLACK:
+            print("    FAIL: over the {:.1f} ms budget".format(limit))
+            failures.append('uart_first_reading')
+
+    if args.save_budget:
+        budget.update(results)
+        with open(args.budget, 'w') as f:
+            json.dump(budget, f, indent=2, sort_keys=True)
+        print("Saved budget to {}".format(args.budget))
+
+    if args.check and failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+# Runs the gateway components and keeps them running.
+#
+#   python supervisor.py                         # components in SUPERVISED_COMPONENTS
+#   python supervisor.py --components uart,jobs
+#   python supervisor.py --status                # exits 0 if everything is up
+#
+# Every component is a script in this directory, started in its own process
+# group. A component that exits is restarted after a delay that doubles on
+# every quick failure (1s, 2s, 4s, ... up to a minute) and resets once it
+# has stayed up for a minute. A component is also restarted when:
+#   - its heartbeat file (see heartbeat.py) hasn't been touched for
+#     heartbeat_timeout seconds, i.e. its main loop is stuck
+#   - its resident memory goes over max_memory_mb
+#   - it uses more than max_cpu_percent of a core for CPU_GRACE seconds
+# Components run at a lower priority than the supervisor (nice).
+#
+# Restarts are graceful: SIGTERM first, so the publishers drain in-flight
+# messages to the outbox and snapshot their per-animal state, which the
+# next instance picks up. SIGKILL follows after STOP_GRACE seconds.
+#
+# The supervisor imports the modules the components share (awscrt, awsiot,
+# serial, the local helpers) once and forks each component from itself, so
+# a restart doesn't pay for those imports again. --no-preload starts each
+# component as a fresh interpreter instead. Because of the preloading, the
+# supervisor itself has to be restarted to pick up new code, which
+# update_gateway.py does through GATEWAY_RESTART_COMMAND.
+#
+# Use `python supervisor.py --status` as GATEWAY_HEALTH_CHECK.
+#
+# The supervisor reads its own settings from .env but doesn't load .env into
+# its environment: the children inherit that environment, and their own
+# load_dotenv() doesn't override what is already set, so every setting
+# would stay at its value from when the supervisor started. This way a
+# .env change (from a job or the Device Shadow) takes effect when the
+# component restarts. In fork mode the same goes for the preloaded
+# modules: they must not read settings at import time, only when a
+# component calls them (heartbeat.beat() and the from_env() helpers do).
+#
+# Settings (.env): SUPERVISED_COMPONENTS, SUPERVISOR_RUN_DIR
+
+import argparse
+import importlib
+import json
+import os
+import runpy
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from dotenv import dotenv_values
+
+from gateway_paths import data_path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# The supervisor's own settings, see above
+DOTENV = dotenv_values()
+
+# restart: 'always', or 'on-failure' for scripts that are meant to finish
+COMPONENTS = {
+    'uart': {'script': 'publishUARTData.py', 'restart': 'always', 'heartbeat_timeout': 30,
+             'max_memory_mb': 200, 'max_cpu_percent': 90, 'nice': 5},
+    'sampler': {'script': 'publishFakeData.py', 'restart': 'always', 'heartbeat_timeout': 600,
+                'max_memory_mb': 100, 'max_cpu_percent': 50, 'nice': 10},
+    'jobs': {'script': 'test_jobs.py', 'restart': 'always', 'heartbeat_timeout': 60,
+             'max_memory_mb': 150, 'max_cpu_percent': 90, 'nice': 10},
+    'ip': {'script': 'publishRPiIP.py', 'restart': 'always', 'heartbeat_timeout': 60,
+           'max_memory_mb': 100, 'max_cpu_percent': 50, 'nice': 10},
+}
+DEFAULT_COMPONENTS = 'uart,jobs,ip'
+
+# Imported before forking so components start with them already loaded
+PRELOAD_MODULES = (
+    'json', 'sqlite3', 'concurrent.futures',
+    'awscrt.io', 'awscrt.mqtt', 'awsiot.mqtt_connection_builder', 'awsiot.iotjobs', 'awsiot.iotshadow',
+    'dotenv', 'serial', 'serial.tools.list_ports',
+    'animal_state', 'heartbeat', 'inflight_publisher', 'job_executor', 'live_config', 'lora_packet',
+    'net_interfaces', 'outbox', 'priority_lanes', 'rate_limit', 'report_by_exception', 'shadow_sync',
+    'timeseries_store',
+)
+
+CHECK_INTERVAL = 1
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+# A component that ran at least this long is considered healthy again
+STABLE_RUNTIME = 60
+# Time between SIGTERM and SIGKILL, a bit more than the publishers' drain
+STOP_GRACE = 15
+CPU_GRACE = 30
+STATUS_MAX_AGE = 10
+DEFAULT_RUN_DIR = '.supervisor'
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def setting(key, default=None):
+    # The environment first, then .env, as load_dotenv() would have it
+    value = os.getenv(key)
+    if value is None:
+        value = DOTENV.get(key)
+    return default if value is None else value
+
+
+parser = argparse.ArgumentParser(description="Run the gateway components and restart them when they fail.")
+parser.add_argument('--components', default=setting('SUPERVISED_COMPONENTS', DEFAULT_COMPONENTS),
+                    help='comma separated, from: {}'.format(', '.join(COMPONENTS)))
+parser.add_argument('--run-dir', default=setting('SUPERVISOR_RUN_DIR') or data_path(DEFAULT_RUN_DIR,
+                                                                              setting('GATEWAY_DATA_DIR', '')),
+                    help='where heartbeat and status files are kept')
+parser.add_argument('--no-preload', action='store_true', help='start every component as a fresh interpreter')
+parser.add_argument('--status', action='store_true', help='print the running supervisor\'s status and exit')
+
+
+def preload():
+    start = time.perf_counter()
+    loaded = []
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except ImportError as e:
+            print("Not preloading {}: {}".format(name, e))
+    print("Preloaded {} modules in {:.2f}s".format(len(loaded), time.perf_counter() - start))
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def read_proc_usage(pid):
+    # (cpu seconds, resident bytes) from /proc, None if the process is gone
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # The command name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss_bytes = int(fields[21]) * PAGE_SIZE
+        return cpu_seconds, rss_bytes
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def run_in_child(script, heartbeat_file):
+    # Runs in the forked process and never returns
+    code = 0
+    try:
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        os.environ['SUPERVISOR_HEARTBEAT_FILE'] = heartbeat_file
+        sys.argv = [script]
+        runpy.run_path(script, run_name='__main__')
+        # What the interpreter does on exit: stop thread pools and wait for
+        # non-daemon threads
+        threading._shutdown()
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            code = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    os._exit(code & 0xff)
+
+
+class Component:
+    def __init__(self, name, spec, run_dir):
+        self.name = name
+        self.spec = spec
+        self.script = os.path.join(SCRIPT_DIR, spec['script'])
+        self.heartbeat_file = os.path.join(os.path.abspath(run_dir), '{}.heartbeat'.format(name))
+        self.pid = None
+        self.started_at = None
+        self.next_start = 0.0
+        self.backoff = MIN_BACKOFF
+        self.restarts = 0
+        self.last_exit = None
+        self.finished = False
+        self.stop_deadline = None
+        self.stop_reason = None
+        self.cpu_sample = None
+        self.cpu_over_since = None
+
+    def start(self, fork):
+        # Starting counts as a heartbeat, the component gets a full timeout
+        # to come up
+        with open(self.heartbeat_file, 'a'):
+            os.utime(self.heartbeat_file)
+        if fork:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                os.setpgid(0, 0)
+                os.nice(self.spec.get('nice', 0))
+                run_in_child(self.script, self.heartbeat_file)
+        else:
+            env = dict(os.environ, SUPERVISOR_HEARTBEAT_FILE=self.heartbeat_file)
+            nice = self.spec.get('nice', 0)
+            pid = subprocess.Popen(
+                [sys.executable, self.script], cwd=os.getcwd(), env=env, start_new_session=True,
+                preexec_fn=lambda: os.nice(nice)).pid
+        self.pid = pid
+        self.started_at = time.monotonic()
+        self.stop_deadline = self.stop_reason = self.cpu_sample = self.cpu_over_since = None
+        print("Started {} ({}) as pid {}".format(self.name, self.spec['script'], pid))
+
+    def stop(self, reason):
+        if self.pid is None or self.stop_deadline is not None:
+            return
+        print("Stopping {} (pid {}): {}".format(self.name, self.pid, reason))
+        self.stop_reason = reason
+        self.stop_deadline = time.monotonic() + STOP_GRACE
+        self.signal(signal.SIGTERM)
+
+    def signal(self, signum):
+        try:
+            # The whole process group, so job handlers go with the jobs agent
+            os.killpg(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def exited(self, status):
+        now = time.monotonic()
+        code = exit_code(status)
+        runtime = now - self.started_at
+        self.pid = None
+        self.last_exit = code
+        if runtime >= STABLE_RUNTIME:
+            self.backoff = MIN_BACKOFF
+        if self.finished:
+            print("{} exited with {}".format(self.name, code))
+            return
+        if code == 0 and self.spec.get('restart') == 'on-failure':
+            print("{} finished".format(self.name))
+            self.finished = True
+            return
+        self.next_start = now + self.backoff
+        print("{} exited with {} after {:.0f}s{}, restarting in {}s".format(
+            self.name, code, runtime, ' ({})'.format(self.stop_reason) if self.stop_reason else '', self.backoff))
+        self.backoff = min(MAX_BACKOFF, self.backoff * 2)
+        self.restarts += 1
+
+    def check(self, now):
+        # Liveness and resource limits of a running component
+        if self.stop_deadline is not None:
+            if now >= self.stop_deadline:
+                print("{} did not stop in {}s, killing it".format(self.name, STOP_GRACE))
+                self.signal(signal.SIGKILL)
+                self.stop_deadline = float('inf')
+            return
+        timeout = self.spec.get('heartbeat_timeout')
+        if timeout:
+            try:
+                age = time.time() - os.path.getmtime(self.heartbeat_file)
+            except OSError:
+                age = now - self.started_at
+            if age > timeout:
+                return self.stop('no heartbeat for {:.0f}s'.format(age))
+        usage = read_proc_usage(self.pid)
+        if usage is None:
+            return
+        cpu_seconds, rss_bytes = usage
+        if rss_bytes > self.spec.get('max_memory_mb', float('inf')) * 1024 * 1024:
+            return self.stop('using {:.0f} MB of memory'.format(rss_bytes / 1024 / 1024))
+        if self.cpu_sample is not None:
+            last_time, last_cpu = self.cpu_sample
+            percent = 100.0 * (cpu_seconds - last_cpu) / max(now - last_time, 1e-6)
+            if percent > self.spec.get('max_cpu_percent', 100):
+                self.cpu_over_since = self.cpu_over_since or now
+                if now - self.cpu_over_since >= CPU_GRACE:
+                    return self.stop('over {}% CPU for {}s'.format(self.spec['max_cpu_percent'], CPU_GRACE))
+            else:
+                self.cpu_over_since = None
+        self.cpu_sample = (now, cpu_seconds)
+
+    def status(self):
+        return {
+            'pid': self.pid,
+            'running': self.pid is not None and self.stop_deadline is None,
+            'finished': self.finished,
+            'uptime': round(time.monotonic() - self.started_at) if self.pid is not None else None,
+            'restarts': self.restarts,
+            'last_exit': self.last_exit,
+        }
+
+
+class Supervisor:
+    def __init__(self, names, run_dir, fork=True):
+        unknown = [name for name in names if name not in COMPONENTS]
+        if unknown:
+            raise ValueError('Unknown component(s): {}'.format(', '.join(unknown)))
+        os.makedirs(run_dir, exist_ok=True)
+        self.run_dir = run_dir
+        self.fork = fork
+        self.components = [Component(name, COMPONENTS[name], run_dir) for name in names]
+        self.stopping = False
+
+    def on_signal(self, signum, frame):
+        self.stopping = True
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for component in self.components:
+                if component.pid == pid:
+                    component.exited(status)
+
+    def write_status(self):
+        status = {'updated': time.time(), 'components': {c.name: c.status() for c in self.components}}
+        fd, tmp_path = tempfile.mkstemp(prefix='.status.', dir=self.run_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.run_dir, 'status.json'))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.on_signal)
+        signal.signal(signal.SIGINT, self.on_signal)
+        while not self.stopping:
+            self.reap()
+            now = time.monotonic()
+            for component in self.components:
+                if component.pid is None and not component.finished and now >= component.next_start:
+                    component.start(self.fork)
+                elif component.pid is not None:
+                    component.check(now)
+            self.write_status()
+            time.sleep(CHECK_INTERVAL)
+        self.shutdown()
+
+    def shutdown(self):
+        print("Stopping all components...")
+        for component in self.components:
+            # Not to be restarted
+            component.finished = True
+            component.stop('supervisor stopping')
+        while any(component.pid is not None for component in self.components):
+            self.reap()
+            now = time.monotonic()
+            for component in self.components:
+                if component.pid is not None:
+                    component.check(now)
+            time.sleep(0.1)
+        self.write_status()
+
+
+def print_status(run_dir):
+    # Exit status for health checks: 0 when every component is running or
+    # finished cleanly and the supervisor updated its status recently
+    try:
+        with open(os.path.join(run_dir, 'status.json')) as f:
+            status = json.load(f)
+    except (OSError, ValueError) as e:
+        print("No supervisor status: {}".format(e))
+        return 1
+    print(json.dumps(status, indent=2))
+    if time.time() - status['updated'] > STATUS_MAX_AGE:
+        print("Status is stale, the supervisor is not running")
+        return 1
+    healthy = all(c['running'] or c['finished'] for c in status['components'].values())
+    return 0 if healthy else 1
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.status:
+        sys.exit(print_status(args.run_dir))
+    names = [name.strip() for name in args.components.split(',') if name.strip()]
+    supervisor = Supervisor(names, args.run_dir, fork=not args.no_preload)
+    if supervisor.fork:
+        # Components import these from the script directory
+        sys.path.insert(0, SCRIPT_DIR)
+        preload()
+    supervisor.run()
@@ -0,0 +1,75 @@
+# Tests for FloodGuard in fair_queue.py with the UART lines a collar sends:
+# readings and fragmented bursts (fragments.py).
+#
+#   python -m unittest test_fair_queue
+
+import os
+import unittest
+
+from fair_queue import FloodGuard
+from fragments import MAX_FRAGMENTS, MAX_PACKET, Reassembler, fragment_burst, parse_fragment
+
+DEVICE = 8
+
+
+def full_burst(burst_id):
+    # As much as fits in MAX_FRAGMENTS full packets
+    chunk_size = len(parse_fragment(fragment_burst(DEVICE, burst_id, os.urandom(MAX_PACKET))[0])[-1])
+    blob = os.urandom(MAX_FRAGMENTS * chunk_size)
+    lines = fragment_burst(DEVICE, burst_id, blob)
+    assert len(lines) == MAX_FRAGMENTS
+    return blob, [line.encode() for line in lines]
+
+
+def reading(seq):
+    return 'I{:02d} T38.6 N{}\n'.format(DEVICE, seq).encode()
+
+
+class FloodGuardTest(unittest.TestCase):
+    def test_back_to_back_full_bursts(self):
+        guard = FloodGuard()
+        reassembler = Reassembler()
+        for burst_id in (17, 18):
+            blob, lines = full_burst(burst_id)
+            admitted = [line for line in lines if guard.admit_line(line)]
+            self.assertEqual(len(admitted), len(lines))
+            blobs = [reassembler.add(*parse_fragment(line.decode())) for line in admitted]
+            self.assertEqual(blobs[-1], blob)
+        # Readings in between aren't held up either
+        self.assertTrue(all(guard.admit_line(reading(seq)) for seq in range(20)))
+        self.assertEqual(guard.stats()['flagged'], [])
+
+    def test_repeated_fragments_are_admitted(self):
+        guard = FloodGuard()
+        _, lines = full_burst(17)
+        self.assertTrue(all(guard.admit_line(line) for line in lines + lines))
+        self.assertEqual(guard.stats()['flagged'], [])
+
+    def test_reading_flood_is_flagged(self):
+        guard = FloodGuard()
+        admitted = sum(guard.admit_line(reading(seq)) for seq in range(2000))
+        self.assertLess(admitted, 2000)
+        self.assertEqual(guard.stats()['flagged'], [DEVICE])
+        # Its bursts don't get through the offender limit either
+        _, lines = full_burst(17)
+        self.assertLess(sum(guard.admit_line(line) for line in lines), len(lines))
+
+    def test_burst_flood_is_flagged(self):
+        guard = FloodGuard()
+        for burst_id in range(50):
+            _, lines = full_burst(burst_id)
+            for line in lines:
+                guard.admit_line(line)
+        self.assertEqual(guard.stats()['flagged'], [DEVICE])
+
+    def test_fragment_flood_within_a_burst_is_flagged(self):
+        guard = FloodGuard()
+        _, lines = full_burst(17)
+        for _ in range(10):
+            for line in lines:
+                guard.admit_line(line)
+        self.assertEqual(guard.stats()['flagged'], [DEVICE])
+
+
+if __name__ == '__main__':
+    unittest.main()
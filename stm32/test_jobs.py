@@ -7,12 +7,15 @@ from awsiot import mqtt_connection_builder
 from concurrent.futures import Future
 import sys
 import threading
-import time
 import os
-import subprocess
 import traceback
 from uuid import uuid4
-from dotenv import load_dotenv
+from dotenv import find_dotenv, load_dotenv
+from artifacts import ArtifactCache, ArtifactError
+import heartbeat
+from job_executor import JobExecutor
+from live_config import LiveConfig, update_env_file
+from shadow_sync import ShadowSync
 
 # - Overview -
 # This sample uses the AWS IoT Jobs Service to receive and execute operations
@@ -24,16 +27,17 @@ from dotenv import load_dotenv
 # https://docs.aws.amazon.com/iot/latest/developerguide/create-manage-jobs.html
 #
 # - Detail -
-# On startup, the sample tries to start the next pending job execution.
-# If such a job exists, the sample emulates "doing work" by spawning a thread
-# that sleeps for several seconds before marking the job as SUCCEEDED. When no
-# pending job executions exist, the sample sits in an idle state.
+# On startup, the sample asks for the list of pending job executions and
+# fetches the job document of each one it is not already running. Jobs are
+# handed to a JobExecutor (see job_executor.py), which runs them on a worker
+# pool with per-job-type concurrency limits, and their real exit status and
+# duration are reported back when they finish. A job that does not fit in the
+# pool right now is left queued in the cloud and picked up again once a slot
+# frees up.
 #
 # The sample also subscribes to receive "Next Job Execution Changed" events.
-# If the sample is idle, this event wakes it to start the job. If the sample is
-# already working on a job, it remembers to try for another when it's done.
-# This event is sent by the service when the current job completes, so the
-# sample will be continually prompted to try another job until none remain.
+# Each event makes the sample check the pending job list again. If a check is
+# already in flight, it remembers to check again once that one is done.
 load_dotenv()
 
 # Using globals to simplify sample code
@@ -41,18 +45,22 @@ is_sample_done = threading.Event()
 
 mqtt_connection = None
 jobs_client = None
+job_executor = None
 thing_name = os.getenv('THING_NAME')
 
 class LockedData:
     def __init__(self):
         self.lock = threading.Lock()
         self.disconnect_called = False
-        self.is_working_on_job = False
+        self.is_checking_for_jobs = False
         self.is_next_job_waiting = False
+        # job_ids whose document has been requested but not yet received
+        self.jobs_being_described = set()
 
 locked_data = LockedData()
 
-processes = {}
+# How often the main thread reports it is alive to supervisor.py
+HEARTBEAT_INTERVAL = 5
 
 # Function for gracefully quitting this sample
 def exit(msg_or_exception):
@@ -70,27 +78,28 @@ def exit(msg_or_exception):
             future.add_done_callback(on_disconnected)
 
 def try_start_next_job():
-    print("Trying to start the next job...")
+    print("Checking for pending jobs...")
     with locked_data.lock:
-        if locked_data.is_working_on_job:
-            print("Nevermind, already working on a job.")
-            return
-
         if locked_data.disconnect_called:
             print("Nevermind, sample is disconnecting.")
             return
 
-        locked_data.is_working_on_job = True
+        if locked_data.is_checking_for_jobs:
+            print("Already checking, will check again once that is done.")
+            locked_data.is_next_job_waiting = True
+            return
+
+        locked_data.is_checking_for_jobs = True
         locked_data.is_next_job_waiting = False
 
-    print("Publishing request to start next job...")
-    request = iotjobs.StartNextPendingJobExecutionRequest(thing_name=os.getenv('THING_NAME'))
-    publish_future = jobs_client.publish_start_next_pending_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
-    publish_future.add_done_callback(on_publish_start_next_pending_job_execution)
+    print("Publishing request for pending jobs...")
+    request = iotjobs.GetPendingJobExecutionsRequest(thing_name=thing_name)
+    publish_future = jobs_client.publish_get_pending_job_executions(request, mqtt.QoS.AT_LEAST_ONCE)
+    publish_future.add_done_callback(on_publish_get_pending_job_executions)
 
-def done_working_on_job():
+def done_checking_for_jobs():
     with locked_data.lock:
-        locked_data.is_working_on_job = False
+        locked_data.is_checking_for_jobs = False
         try_again = locked_data.is_next_job_waiting
 
     if try_again:
@@ -110,17 +119,7 @@ def on_next_job_execution_changed(event):
         if execution:
             print("Received Next Job Execution Changed event. job_id:{} job_document:{}".format(
                 execution.job_id, execution.job_document))
-
-            # Start job now, or remember to start it when current job is done
-            start_job_now = False
-            with locked_data.lock:
-                if locked_data.is_working_on_job:
-                    locked_data.is_next_job_waiting = True
-                else:
-                    start_job_now = True
-
-            if start_job_now:
-                try_start_next_job()
+            try_start_next_job()
 
         else:
             print("Received Next Job Execution Changed event: None. Waiting for further jobs...")
@@ -128,56 +127,124 @@ def on_next_job_execution_changed(event):
     except Exception as e:
         exit(e)
 
-def on_publish_start_next_pending_job_execution(future):
+def on_publish_get_pending_job_executions(future):
     # type: (Future) -> None
     try:
         future.result() # raises exception if publish failed
 
-        print("Published request to start the next job.")
+        print("Published request for pending jobs.")
 
     except Exception as e:
         exit(e)
 
-def on_start_next_pending_job_execution_accepted(response):
-    # type: (iotjobs.StartNextJobExecutionResponse) -> None
+def on_get_pending_job_executions_accepted(response):
+    # type: (iotjobs.GetPendingJobExecutionsResponse) -> None
     try:
-        if response.execution:
-            execution = response.execution
-            print("Request to start next job was accepted. job_id:{} job_document:{}".format(
-                execution.job_id, execution.job_document))
-
-            # To emulate working on a job, spawn a thread that sleeps for a few seconds
-            job_thread = threading.Thread(
-                target=lambda: job_thread_fn(execution.job_id, execution.job_document),
-                name='job_thread')
-            job_thread.start()
-        else:
-            print("Request to start next job was accepted, but there are no jobs to be done. Waiting for further jobs...")
-            done_working_on_job()
+        # Jobs left IN_PROGRESS by a previous run of this sample are picked up
+        # again, followed by the QUEUED jobs in the order the service gave them
+        summaries = (response.in_progress_jobs or []) + (response.queued_jobs or [])
+        to_describe = []
+        with locked_data.lock:
+            for summary in summaries:
+                job_id = summary.job_id
+                if (job_executor.is_known(job_id, summary.execution_number)
+                        or job_id in locked_data.jobs_being_described):
+                    continue
+                locked_data.jobs_being_described.add(job_id)
+                to_describe.append(job_id)
+
+        if not to_describe:
+            print("No new pending jobs. Waiting for further jobs...")
+        for job_id in to_describe:
+            request = iotjobs.DescribeJobExecutionRequest(
+                thing_name=thing_name,
+                job_id=job_id,
+                include_job_document=True,
+                client_token=job_id)
+            publish_future = jobs_client.publish_describe_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+            publish_future.add_done_callback(on_publish_describe_job_execution)
+
+        done_checking_for_jobs()
 
     except Exception as e:
         exit(e)
 
-def on_start_next_pending_job_execution_rejected(rejected):
+def on_get_pending_job_executions_rejected(rejected):
     # type: (iotjobs.RejectedError) -> None
-    exit("Request to start next pending job rejected with code:'{}' message:'{}'".format(
+    exit("Request for pending jobs rejected with code:'{}' message:'{}'".format(
         rejected.code, rejected.message))
 
-def job_thread_fn(job_id, job_document):
+def on_publish_describe_job_execution(future):
+    # type: (Future) -> None
+    try:
+        future.result() # raises exception if publish failed
+
+    except Exception as e:
+        exit(e)
+
+def on_describe_job_execution_accepted(response):
+    # type: (iotjobs.DescribeJobExecutionResponse) -> None
     try:
-        print("Starting local work on job...")
-        print(job_document)
-        execute_from_job_document(job_document)
-        print("Done working on job.")
+        execution = response.execution
+        with locked_data.lock:
+            locked_data.jobs_being_described.discard(execution.job_id)
+
+        print("Received job document. job_id:{} job_document:{}".format(
+            execution.job_id, execution.job_document))
+
+        # The document may be stale: skip jobs this device already ran or that
+        # finished elsewhere since the pending list was fetched
+        if (job_executor.is_known(execution.job_id, execution.execution_number)
+                or execution.status not in (iotjobs.JobStatus.QUEUED, iotjobs.JobStatus.IN_PROGRESS)):
+            return
+
+        if not job_executor.submit(execution.job_id, execution.job_document, on_job_finished, on_job_started,
+                                   execution_number=execution.execution_number):
+            # No free slot for this job type, leave it queued. The pending list
+            # is checked again whenever one of the running jobs finishes.
+            print("No free slot for job {}, leaving it queued.".format(execution.job_id))
+
+    except Exception as e:
+        exit(e)
 
-        print("Publishing request to update job status to SUCCEEDED...")
+def on_describe_job_execution_rejected(rejected):
+    # type: (iotjobs.RejectedError) -> None
+    # The job may have been cancelled between listing and describing it.
+    # Describe requests carry the job_id as their client token.
+    print("Request to describe job {} was rejected. code:'{}' message:'{}'.".format(
+        rejected.client_token, rejected.code, rejected.message))
+    with locked_data.lock:
+        locked_data.jobs_being_described.discard(rejected.client_token)
+
+def on_job_started(job_id):
+    # Runs on the job's worker thread before its first step, so the
+    # IN_PROGRESS update is always published ahead of the final status
+    print("Publishing request to update job {} status to IN_PROGRESS...".format(job_id))
+    request = iotjobs.UpdateJobExecutionRequest(
+        thing_name=thing_name,
+        job_id=job_id,
+        status=iotjobs.JobStatus.IN_PROGRESS)
+    publish_future = jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+    publish_future.add_done_callback(on_publish_update_job_execution)
+
+def on_job_finished(result):
+    try:
+        status = iotjobs.JobStatus.SUCCEEDED if result.succeeded else iotjobs.JobStatus.FAILED
+        print("Done working on job {} (exit code {}, {:.1f}s).".format(
+            result.job_id, result.exit_code, result.duration))
+
+        print("Publishing request to update job {} status to {}...".format(result.job_id, status))
         request = iotjobs.UpdateJobExecutionRequest(
-            thing_name=os.getenv('THING_NAME'),
-            job_id=job_id,
-            status=iotjobs.JobStatus.SUCCEEDED)
+            thing_name=thing_name,
+            job_id=result.job_id,
+            status=status,
+            status_details=result.status_details())
         publish_future = jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
         publish_future.add_done_callback(on_publish_update_job_execution)
 
+        # A slot just freed up, so look for more work
+        try_start_next_job()
+
     except Exception as e:
         exit(e)
 
@@ -194,25 +261,27 @@ def on_update_job_execution_accepted(response):
     # type: (iotjobs.UpdateJobExecutionResponse) -> None
     try:
         print("Request to update job was accepted.")
-        done_working_on_job()
     except Exception as e:
         exit(e)
 
 def on_update_job_execution_rejected(rejected):
     # type: (iotjobs.RejectedError) -> None
-    exit("Request to update job status was rejected. code:'{}' message:'{}'.".format(
+    # Other jobs may still be running, so a single rejected update (e.g. for a
+    # job cancelled while it ran) is logged rather than ending the sample
+    print("Request to update job status was rejected. code:'{}' message:'{}'.".format(
         rejected.code, rejected.message))
 
-def setup_job_listener(mqtt_connection):
+def setup_job_listener(mqtt_connection, client_class=iotjobs.IotJobsClient):
+    # client_class lets simulate_job_fleet.py swap in a local jobs service
     global jobs_client
-    jobs_client = iotjobs.IotJobsClient(mqtt_connection)
+    jobs_client = client_class(mqtt_connection)
     try:
         # Subscribe to necessary topics.
         # Note that is **is** important to wait for "accepted/rejected" subscriptions
         # to succeed before publishing the corresponding "request".
         print("Subscribing to Next Changed events...")
         changed_subscription_request = iotjobs.NextJobExecutionChangedSubscriptionRequest(
-            thing_name=os.getenv('THING_NAME')
+            thing_name=thing_name
         )
 
         subscribed_future, _ = jobs_client.subscribe_to_next_job_execution_changed_events(
@@ -223,29 +292,48 @@ def setup_job_listener(mqtt_connection):
         # Wait for subscription to succeed
         subscribed_future.result()
 
-        print("Subscribing to Start responses...")
-        start_subscription_request = iotjobs.StartNextPendingJobExecutionSubscriptionRequest(
-            thing_name=os.getenv('THING_NAME')
+        print("Subscribing to Get Pending responses...")
+        get_pending_subscription_request = iotjobs.GetPendingJobExecutionsSubscriptionRequest(
+            thing_name=thing_name
         )
-        subscribed_accepted_future, _ = jobs_client.subscribe_to_start_next_pending_job_execution_accepted(
-            request=start_subscription_request,
+        subscribed_accepted_future, _ = jobs_client.subscribe_to_get_pending_job_executions_accepted(
+            request=get_pending_subscription_request,
             qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_start_next_pending_job_execution_accepted)
+            callback=on_get_pending_job_executions_accepted)
 
-        subscribed_rejected_future, _ = jobs_client.subscribe_to_start_next_pending_job_execution_rejected(
-            request=start_subscription_request,
+        subscribed_rejected_future, _ = jobs_client.subscribe_to_get_pending_job_executions_rejected(
+            request=get_pending_subscription_request,
             qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_start_next_pending_job_execution_rejected)
+            callback=on_get_pending_job_executions_rejected)
 
         # Wait for subscriptions to succeed
         subscribed_accepted_future.result()
         subscribed_rejected_future.result()
 
-        print("Subscribing to Update responses...")
+        print("Subscribing to Describe responses...")
         # Note that we subscribe to "+", the MQTT wildcard, to receive
         # responses about any job-ID.
+        describe_subscription_request = iotjobs.DescribeJobExecutionSubscriptionRequest(
+            thing_name=thing_name,
+            job_id='+'
+        )
+        subscribed_accepted_future, _ = jobs_client.subscribe_to_describe_job_execution_accepted(
+            request=describe_subscription_request,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_describe_job_execution_accepted)
+
+        subscribed_rejected_future, _ = jobs_client.subscribe_to_describe_job_execution_rejected(
+            request=describe_subscription_request,
+            qos=mqtt.QoS.AT_LEAST_ONCE,
+            callback=on_describe_job_execution_rejected)
+
+        # Wait for subscriptions to succeed
+        subscribed_accepted_future.result()
+        subscribed_rejected_future.result()
+
+        print("Subscribing to Update responses...")
         update_subscription_request = iotjobs.UpdateJobExecutionSubscriptionRequest(
-            thing_name=os.getenv('THING_NAME'),
+            thing_name=thing_name,
             job_id='+'
         )
 
@@ -263,38 +351,32 @@ def setup_job_listener(mqtt_connection):
         subscribed_accepted_future.result()
         subscribed_rejected_future.result()
 
-        # Make initial attempt to start next job. The service should reply with
-        # an "accepted" response, even if no jobs are pending. The response
-        # will contain data about the next job, if there is one.
+        # Make initial attempt to find pending jobs. The service should reply
+        # with an "accepted" response, even if no jobs are pending.
         try_start_next_job()
 
     except Exception as e:
         exit(e)
 
 
-# TODO error checking, also validate document?
-def execute_from_job_document(job_document):
-    try:
-        for step in job_document['steps']:
-            action = step['action']
-            actionType = action['type']
-            actionInput = action['input']
-            if actionType == "runHandler":
-                command = ['python', actionInput['handler']]
-                if actionInput.get('args'):
-                    command = [actionInput['handler']].append(actionInput.get('args'))
-                print(f"Popen with: {command}")
-                subprocess.Popen(command)
-            elif actionType == "updateConfigurations":
-                updateConfigurations(actionInput)
+def run_update_configurations_step(job_id, name, action_input):
+    # The step input is a {key: value} map, written to .env in one step.
+    # Scripts watching .env through LiveConfig apply it without restarting.
+    update_env_file(find_dotenv(), action_input)
+    return 0, 'Updated {}'.format(', '.join(sorted(action_input)))
 
-    except Exception as e:
-        exit(e)
 
-# TODO not yet tested
-def updateConfigurations(actionInput):
-    for key, value in actionInput:
-        os.system(['dotenv', 'set', key, value])
+def run_download_artifact_step(job_id, name, action_input):
+    # {"url": ..., "sha256": ..., "output": ...}: the file goes through the
+    # artifact cache, so a gateway that already has it doesn't download it
+    # again and a cut off download carries on (see artifacts.py)
+    try:
+        path = ArtifactCache.from_env().fetch(action_input['url'], action_input.get('sha256'),
+                                              action_input.get('output'))
+    except (ArtifactError, OSError) as e:
+        return 1, str(e)
+    return 0, 'Fetched {} into {}'.format(action_input['url'], action_input.get('output') or path)
+
 
 if __name__ == '__main__':
     # Wait for internet
@@ -326,9 +408,16 @@ if __name__ == '__main__':
     connected_future.result()
     print("Connected!")
 
-    # processes['publishFakeData.py'] = subprocess.Popen(
-    #     ['/usr/bin/python', 
-    #     '/home/pi/DairyCattleRaspberryPi/stm32/publishFakeData.py'])
+    # The publishers are run by supervisor.py, not from here
 
+    job_executor = JobExecutor.from_env(
+        step_runners={'updateConfigurations': run_update_configurations_step,
+                      'downloadArtifact': run_download_artifact_step})
     setup_job_listener(mqtt_connection)
-    is_sample_done.wait()
\ No newline at end of file
+
+    # Settings in the thing's shadow are applied to .env, where the
+    # publishers pick them up (see shadow_sync.py)
+    shadow_sync = ShadowSync(mqtt_connection, thing_name, LiveConfig(find_dotenv()))
+    shadow_sync.start()
+    while not is_sample_done.wait(HEARTBEAT_INTERVAL):
+        heartbeat.beat()
\ No newline at end of file
@@ -0,0 +1,117 @@
+# Tests for priority_lanes.py with InFlightPublisher/ShardedPublisher over a
+# fake connection that acknowledges every publish shortly after it is sent.
+#
+#   python -m unittest test_priority_lanes
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from inflight_publisher import InFlightPublisher
+from outbox import Outbox
+from priority_lanes import Lane, LaneScheduler
+from sharded_publisher import ShardedPublisher
+
+ACK_DELAY = 0.01
+
+
+class FakeConnection:
+    def __init__(self):
+        self.published = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload, qos):
+        future = Future()
+        with self._lock:
+            self.published.append(payload)
+        threading.Timer(ACK_DELAY, future.set_result, args=({},)).start()
+        return future, len(self.published)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class LaneSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox.db'))
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.directory)
+
+    def submit_all(self, lanes, count):
+        for seq in range(count):
+            lanes.submit('telemetry', 'dairy/north/telemetry', json.dumps({'Device_ID': seq % 7, 'Seq': seq}),
+                         key=seq % 7)
+
+    def delivered(self, *connections):
+        return set(json.loads(payload)['Seq'] for connection in connections for payload in connection.published)
+
+    def test_overflow_is_delivered_while_connected(self):
+        # More than max_queue at once: what overflows goes to the outbox and
+        # has to go out without waiting for a reconnect
+        connection = FakeConnection()
+        publisher = InFlightPublisher(connection, window=2, outbox=self.outbox)
+        publisher.start()
+        lanes = LaneScheduler(publisher, [Lane('telemetry', max_queue=5)])
+        lanes.start()
+        self.submit_all(lanes, 50)
+        self.assertTrue(wait_for(lambda: len(self.delivered(connection)) == 50),
+                        'delivered {} of 50, {} in the outbox'.format(len(self.delivered(connection)),
+                                                                      self.outbox.count()))
+        self.assertTrue(wait_for(lambda: self.outbox.count() == 0))
+        lanes.stop()
+
+    def test_overflow_is_delivered_by_another_shard(self):
+        # Shard 0 holds the spooled rows but is down, shard 1 has to send them
+        connections = [FakeConnection(), FakeConnection()]
+        publisher = ShardedPublisher([InFlightPublisher(connection, window=2, outbox=self.outbox)
+                                      for connection in connections], outbox=self.outbox)
+        publisher.start(1)
+        lanes = LaneScheduler(publisher, [Lane('telemetry', max_queue=5)])
+        lanes.start()
+        self.submit_all(lanes, 50)
+        self.assertTrue(wait_for(lambda: len(self.delivered(*connections)) == 50))
+        self.assertFalse(connections[0].published)
+        lanes.stop()
+
+    def test_dispatch_survives_a_failed_publish(self):
+        connection = FakeConnection()
+        publisher = InFlightPublisher(connection, window=2, outbox=self.outbox)
+        publisher.start()
+        failing = [True]
+        publish = publisher.publish
+
+        def publish_once_failing(*args, **kwargs):
+            if failing.pop() if failing else False:
+                raise AttributeError("module 'awscrt.mqtt' has no attribute 'QoS'")
+            return publish(*args, **kwargs)
+
+        publisher.publish = publish_once_failing
+        lanes = LaneScheduler(publisher, [Lane('telemetry', max_queue=100)])
+        lanes.start()
+        errors = []
+        lanes.submit('telemetry', 'dairy/north/telemetry', json.dumps({'Seq': -1}), on_done=errors.append)
+        self.submit_all(lanes, 10)
+        self.assertTrue(wait_for(lambda: len(self.delivered(connection)) == 10))
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], AttributeError)
+        self.assertTrue(lanes.alive())
+        self.assertEqual(lanes.stats()['telemetry']['failed'], 1)
+        lanes.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+# Local time-series store for readings received by the gateway.
+#
+# loraPackets.log only grows and has no index, so answering "what did cow 08
+# do in the last two days" means reading all of it. This keeps the numeric
+# fields of every reading in SQLite, indexed by (Device_ID, field, time), so a
+# query only touches the B-tree pages for that animal and time range.
+#
+# Next to the raw readings there are two rollup tiers, 5 minute and 1 hour
+# buckets holding count/sum/min/max, updated as readings come in. Long
+# ranges are answered from a rollup instead of thousands of raw rows, and
+# raw rows older than RAW_RETENTION are dropped to keep the SD card from
+# filling up.
+#
+#   store = TimeSeriesStore()
+#   store.add(8, {'Temperature': 38.6, 'Acceleration': '1.16 -1.91 0.2'})
+#   store.query(8, 'Temperature', start=time.time() - 48 * 3600)
+
+import os
+import sqlite3
+import threading
+import time
+
+from gateway_paths import data_path
+
+DEFAULT_DB = 'readings.db'
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# Rollup tiers as (name, bucket seconds, retention seconds or None to keep forever)
+ROLLUP_TIERS = (('5m', 5 * MINUTE, 90 * DAY), ('1h', HOUR, None))
+RAW_RETENTION = 7 * DAY
+# Ranges up to this long are served from raw rows, then from the tiers in order
+RESOLUTION_LIMITS = (('raw', 6 * HOUR), ('5m', 14 * DAY), ('1h', None))
+PRUNE_INTERVAL = HOUR
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS readings (
+    device_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    ts REAL NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS readings_by_device ON readings (device_id, field, ts);
+CREATE INDEX IF NOT EXISTS readings_by_time ON readings (ts);
+'''
+
+ROLLUP_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rollup_{name} (
+    device_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (device_id, field, bucket)
+) WITHOUT ROWID;
+'''
+
+ROLLUP_UPSERT = '''
+INSERT INTO rollup_{name} (device_id, field, bucket, count, sum, min, max)
+VALUES (?, ?, ?, 1, ?, ?, ?)
+ON CONFLICT (device_id, field, bucket) DO UPDATE SET
+    count = count + 1,
+    sum = sum + excluded.sum,
+    min = MIN(min, excluded.min),
+    max = MAX(max, excluded.max)
+'''
+
+
+def numeric_fields(data):
+    # {'Temperature': 38.6, 'Acceleration': '1.16 -1.91 0.2'}
+    #   -> {'Temperature': 38.6, 'Acceleration_x': 1.16, 'Acceleration_y': -1.91, 'Acceleration_z': 0.2}
+    fields = {}
+    for name, value in data.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            fields[name] = float(value)
+        elif isinstance(value, dict):
+            for axis, axis_value in value.items():
+                fields['{}_{}'.format(name, axis)] = float(axis_value)
+        elif isinstance(value, str):
+            try:
+                parts = [float(part) for part in value.split()]
+            except ValueError:
+                continue
+            for axis, axis_value in zip('xyz', parts):
+                fields['{}_{}'.format(name, axis)] = axis_value
+    return fields
+
+
+def pick_resolution(start, end):
+    span = end - start
+    for name, limit in RESOLUTION_LIMITS:
+        if limit is None or span <= limit:
+            return name
+
+
+class TimeSeriesStore:
+    def __init__(self, path=None):
+        self.path = path or os.getenv('TIMESERIES_DB') or data_path(DEFAULT_DB)
+        self._local = threading.local()
+        self._last_prune = 0.0
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+            for name, _, _ in ROLLUP_TIERS:
+                db.executescript(ROLLUP_SCHEMA.format(name=name))
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread
+        # (e.g. each query server request handler) gets its own
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            # WAL lets the query server read while the publisher writes
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def add(self, device_id, data, ts=None):
+        self.add_many([(device_id, data, ts)])
+
+    def add_many(self, readings):
+        # readings: iterable of (device_id, data dict, timestamp or None)
+        now = time.time()
+        db = self._connection()
+        with db:
+            for device_id, data, ts in readings:
+                ts = now if ts is None else ts
+                for field, value in numeric_fields(data).items():
+                    db.execute('INSERT INTO readings VALUES (?, ?, ?, ?)', (int(device_id), field, ts, value))
+                    for name, seconds, _ in ROLLUP_TIERS:
+                        bucket = int(ts // seconds) * seconds
+                        db.execute(ROLLUP_UPSERT.format(name=name),
+                                   (int(device_id), field, bucket, value, value, value))
+        if now - self._last_prune > PRUNE_INTERVAL:
+            self.prune(now)
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        self._last_prune = now
+        db = self._connection()
+        with db:
+            db.execute('DELETE FROM readings WHERE ts < ?', (now - RAW_RETENTION,))
+            for name, _, retention in ROLLUP_TIERS:
+                if retention is not None:
+                    db.execute('DELETE FROM rollup_{} WHERE bucket < ?'.format(name), (now - retention,))
+
+    def query(self, device_id, field, start=None, end=None, resolution=None):
+        # Returns (resolution, [(ts, avg, min, max, count), ...]) oldest first.
+        # Raw points have count 1 and min == max == avg.
+        end = time.time() if end is None else end
+        start = end - DAY if start is None else start
+        resolution = resolution or pick_resolution(start, end)
+        db = self._connection()
+        if resolution == 'raw':
+            rows = db.execute(
+                'SELECT ts, value, value, value, 1 FROM readings '
+                'WHERE device_id = ? AND field = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                (int(device_id), field, start, end)).fetchall()
+        elif resolution in set(name for name, _, _ in ROLLUP_TIERS):
+            rows = db.execute(
+                'SELECT bucket, sum / count, min, max, count FROM rollup_{} '
+                'WHERE device_id = ? AND field = ? AND bucket >= ? AND bucket < ? ORDER BY bucket'.format(resolution),
+                (int(device_id), field, start, end)).fetchall()
+        else:
+            raise ValueError("Unknown resolution '{}'".format(resolution))
+        return resolution, rows
+
+    def latest(self, device_id):
+        # Most recent value of every field for one animal
+        db = self._connection()
+        tier = ROLLUP_TIERS[-1][0]
+        fields = [row[0] for row in db.execute(
+            'SELECT DISTINCT field FROM rollup_{} WHERE device_id = ?'.format(tier), (int(device_id),))]
+        latest = {}
+        for field in fields:
+            # Walks the (device_id, field, ts) index backwards, one row per field
+            row = db.execute(
+                'SELECT ts, value FROM readings WHERE device_id = ? AND field = ? ORDER BY ts DESC LIMIT 1',
+                (int(device_id), field)).fetchone()
+            if row is not None:
+                latest[field] = {'ts': row[0], 'value': row[1]}
+        return latest
+
+    def devices(self):
+        # Device_IDs with their last reading time, from the 1h tier so this
+        # stays cheap however much raw data there is
+        tier = ROLLUP_TIERS[-1][0]
+        rows = self._connection().execute(
+            'SELECT device_id, MAX(bucket) FROM rollup_{} GROUP BY device_id'.format(tier)).fetchall()
+        return {device_id: last_bucket for device_id, last_bucket in rows}
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
@@ -0,0 +1,89 @@
+# Which topic each message from the gateway is published to.
+#
+# Without TOPIC_TEMPLATE everything goes where it always has: readings to
+# PUBLISH_TOPIC, alerts to ALERT_TOPIC, behaviour labels to BEHAVIOR_TOPIC
+# or <PUBLISH_TOPIC>/behavior and bursts under BURST_TOPIC or
+# <PUBLISH_TOPIC>/bursts. With a template, messages are split by barn,
+# animal and kind:
+#
+#   TOPIC_TEMPLATE=dairy/{barn}/{animal}/{kind}
+#     reading from collar 8   -> dairy/north/8/telemetry
+#     alert for collar 8      -> dairy/north/8/alert
+#     behaviour labels        -> dairy/north/herd/behavior
+#     burst 17 from collar 8  -> dairy/north/8/bursts/17
+#
+# {animal} is the Device_ID, or 'herd' for a message about several animals,
+# {barn} is BARN_ID (default: the host name) and {gateway} is GATEWAY_ID.
+# Per-animal topics are longer than one shared topic, and with more animals
+# than MQTT topic aliases (see connection_builder.py) they can't keep one,
+# so leave {animal} out where the link's bytes matter more than being able
+# to subscribe to a single animal.
+#
+# With PUBLISH_MODE=basic_ingest, messages are published to
+# $aws/rules/<INGEST_RULE>/<topic> instead. AWS IoT hands those straight to
+# the rule without going through the message broker, so there is no
+# messaging charge and one hop less, but nothing subscribed to the topic
+# gets them. Retained messages (the report-by-exception declaration) always
+# go through the broker since they are there for subscribers.
+#
+#   router = TopicRouter(config.get)
+#   router.topic('telemetry', device_id=8)
+#
+# Settings (.env): TOPIC_TEMPLATE, BARN_ID, GATEWAY_ID, PUBLISH_MODE,
+# INGEST_RULE, PUBLISH_TOPIC, ALERT_TOPIC, BEHAVIOR_TOPIC, BURST_TOPIC
+
+import os
+import platform
+
+DEFAULT_TOPIC = 'test/temp'
+DEFAULT_ALERT_TOPIC = 'alerts/temp'
+BROKER = 'broker'
+BASIC_INGEST = 'basic_ingest'
+HERD = 'herd'
+KINDS = ('telemetry', 'alert', 'behavior', 'bursts', 'reporting')
+
+
+def _getenv(key, default=None):
+    return os.getenv(key) or default
+
+
+class TopicRouter:
+    def __init__(self, get=_getenv):
+        # get(key, default) looks up a setting, LiveConfig.get so changes
+        # apply to the next message
+        self.get = get
+
+    def mode(self):
+        return self.get('PUBLISH_MODE', BROKER)
+
+    def topic(self, kind, device_id=None, suffix=None, retained=False):
+        if kind not in KINDS:
+            raise ValueError('Unknown message kind {!r}'.format(kind))
+        template = self.get('TOPIC_TEMPLATE')
+        if template:
+            topic = template.format(kind=kind,
+                                    animal=HERD if device_id is None else device_id,
+                                    barn=self.get('BARN_ID', platform.node()),
+                                    gateway=self.get('GATEWAY_ID', platform.node()))
+        else:
+            topic = self._legacy_topic(kind, device_id)
+        if suffix is not None:
+            topic = '{}/{}'.format(topic, suffix)
+        if not retained and self.mode() == BASIC_INGEST:
+            rule = self.get('INGEST_RULE')
+            if not rule:
+                raise ValueError('PUBLISH_MODE=basic_ingest needs INGEST_RULE')
+            topic = '$aws/rules/{}/{}'.format(rule, topic)
+        return topic
+
+    def _legacy_topic(self, kind, device_id):
+        telemetry = self.get('PUBLISH_TOPIC', DEFAULT_TOPIC)
+        if kind == 'telemetry':
+            return telemetry
+        if kind == 'alert':
+            return self.get('ALERT_TOPIC', DEFAULT_ALERT_TOPIC)
+        if kind == 'behavior':
+            return self.get('BEHAVIOR_TOPIC') or '{}/behavior'.format(telemetry)
+        if kind == 'bursts':
+            return '{}/{}'.format(self.get('BURST_TOPIC') or '{}/bursts'.format(telemetry), device_id)
+        return '{}/reporting'.format(telemetry)
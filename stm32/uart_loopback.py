@@ -0,0 +1,240 @@
+# Loopback check and throughput comparison for uart_protocol.py.
+#
+# A stand-in for the STM32 receiver runs on one end of a pseudo terminal and
+# a UartLink reads the other end, exactly as publishUARTData.py does with
+# the real port. Scenarios:
+#
+#   legacy    firmware that only speaks text: the HELLO is ignored and the
+#             link stays on text lines
+#   binary    firmware that answers the HELLO: readings arrive as READINGS
+#             frames, fragments as TEXT frames
+#   corrupt   binary, with a byte flipped in every --corrupt'th frame: those
+#             frames are dropped by the CRC, nothing wrong gets through
+#   no-pong   firmware that accepts the new baud but then goes quiet: the
+#             gateway goes back to text and readings keep coming
+#
+# Every scenario checks the readings against what was sent, and that a
+# downlink line reaches the receiver. A pty has no real baud rate, so the
+# throughput table works out readings per second from the bytes on the wire
+# (10 bits per byte for 8N1), next to how fast this machine decodes them.
+#
+# Example:
+#   python uart_loopback.py --readings 20000 --batch 8
+
+import argparse
+import os
+import pty
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+import serial
+
+from fragments import fragment_burst
+from lora_packet import parse_lora_packet
+from uart_protocol import (DOWNLINK, HELLO, HELLO_ACK, PING, PONG, READINGS, TEXT, UartLink, decode_frame,
+                           encode_frame, encode_reading)
+
+SCENARIOS = ['legacy', 'binary', 'corrupt', 'no-pong']
+TEXT_BAUD = 115200
+BAUD_RATES = [115200, 460800, 921600, 2000000]
+
+parser = argparse.ArgumentParser(description="Check the UART protocol over a pty and compare throughput.")
+parser.add_argument('--readings', type=int, default=5000)
+parser.add_argument('--batch', type=int, default=8, help='readings per READINGS frame')
+parser.add_argument('--corrupt', type=int, default=20, help='damage every n-th frame in the corrupt scenario')
+parser.add_argument('--seed', type=int, default=1)
+
+
+def make_readings(count, rng):
+    # As the collars would report them, already at the binary resolution
+    readings = []
+    for _ in range(count):
+        readings.append((rng.randrange(1, 300), round(rng.uniform(36.5, 41), 2),
+                         tuple(round(rng.uniform(-2, 2), 3) for _ in range(3)), rng.randint(-125, -40)))
+    return readings
+
+
+def text_line(reading):
+    # What the text firmware prints
+    device_id, temperature, acceleration, rssi = reading
+    return 'I{:02d} T{} A{} {} {} R{}\n'.format(device_id, temperature, *acceleration, rssi).encode()
+
+
+class FakeReceiver:
+    # The STM32's end of the pty
+    def __init__(self, master, scenario, batch, corrupt):
+        self.master = master
+        self.scenario = scenario
+        self.batch = batch
+        self.corrupt = corrupt
+        self.binary = False
+        self.downlinks = []
+        self.frames_sent = 0
+        self.corrupted = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            select.select([], [self.master], [])
+            view = view[os.write(self.master, view):]
+
+    def _listen(self):
+        buffer = b''
+        while not self._stop.is_set():
+            if not select.select([self.master], [], [], 0.05)[0]:
+                continue
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                return
+            while True:
+                zero = buffer.find(b'\x00')
+                newline = buffer.find(b'\n')
+                # Once binary, a newline is just another byte of a frame
+                if not self.binary and newline != -1 and (zero == -1 or newline < zero):
+                    line, buffer = buffer[:newline + 1], buffer[newline + 1:]
+                    if line.startswith(b'I'):
+                        self.downlinks.append(line)
+                    continue
+                if zero == -1:
+                    break
+                frame, buffer = buffer[:zero], buffer[zero + 1:]
+                if not frame or self.scenario == 'legacy':
+                    continue
+                try:
+                    kind, payload = decode_frame(frame)
+                except ValueError:
+                    continue
+                self._on_frame(kind, payload)
+
+    def _on_frame(self, kind, payload):
+        if kind == HELLO and not self.binary:
+            baud, flags = struct.unpack('<IB', payload)
+            self._write(b'\x00' + encode_frame(HELLO_ACK, struct.pack('<IB', baud, 0)))
+            # The no-pong firmware never makes it to the new baud
+            self.binary = self.scenario != 'no-pong'
+        elif kind == PING and self.binary:
+            self._write(encode_frame(PONG))
+        elif kind == DOWNLINK:
+            self.downlinks.append(payload)
+
+    def send_readings(self, readings, extra_lines):
+        if not self.binary:
+            for reading in readings:
+                self._write(text_line(reading))
+            for line in extra_lines:
+                self._write(line)
+            return
+        for start in range(0, len(readings), self.batch):
+            payload = b''.join(encode_reading(*r) for r in readings[start:start + self.batch])
+            frame = bytearray(encode_frame(READINGS, payload))
+            self.frames_sent += 1
+            if self.scenario == 'corrupt' and self.frames_sent % self.corrupt == 0:
+                frame[len(frame) // 2] ^= 0x10
+                self.corrupted.extend(readings[start:start + self.batch])
+            self._write(bytes(frame))
+        for line in extra_lines:
+            self._write(encode_frame(TEXT, line))
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def expected(reading):
+    return parse_lora_packet(text_line(reading).decode(), acceleration_as_dict=True)
+
+
+def run_scenario(scenario, readings, fragment_lines, args):
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    ser = serial.Serial(os.ttyname(slave), baudrate=TEXT_BAUD, timeout=0.05)
+    receiver = FakeReceiver(master, scenario, args.batch, args.corrupt)
+    link = UartLink(ser, timeout=0.5, keepalive=60)
+    received = []
+    deadline = time.monotonic() + 2
+    # Negotiation happens within the first reads
+    while time.monotonic() < deadline and (link.negotiating or not link.counts['hellos']):
+        received.extend(link.read_lines())
+    link.send(b'I08 S600\n')
+    started = time.monotonic()
+    sender = threading.Thread(target=receiver.send_readings, args=(readings, fragment_lines))
+    sender.start()
+    wanted = len(readings) + len(fragment_lines)
+    idle_until = time.monotonic() + 2
+    while time.monotonic() < idle_until:
+        lines = link.read_lines()
+        if lines:
+            received.extend(lines)
+            idle_until = time.monotonic() + (0.5 if len(received) >= wanted - len(receiver.corrupted) else 2)
+        elif not sender.is_alive() and len(received) >= wanted - len(receiver.corrupted):
+            break
+    elapsed = time.monotonic() - started
+    sender.join()
+    receiver.stop()
+    ser.close()
+    os.close(master)
+    os.close(slave)
+
+    fragments = [line for line in received if b' B' in line and b' P' in line]
+    got = [parse_lora_packet(line.decode(), acceleration_as_dict=True) for line in received if line not in fragments]
+    want = [expected(r) for r in readings if r not in receiver.corrupted]
+    problems = []
+    if got != want:
+        problems.append('{} of {} readings differ or are missing'.format(
+            sum(1 for a, b in zip(got, want) if a != b) + abs(len(got) - len(want)), len(want)))
+    if fragments != fragment_lines:
+        problems.append('fragments changed')
+    if not any(line.rstrip(b'\n') == b'I08 S600' for line in receiver.downlinks):
+        problems.append('downlink not received')
+    if (scenario in ('binary', 'corrupt')) != link.binary:
+        problems.append('ended up on {}'.format(link.stats()['protocol']))
+    return {
+        'readings': len(got),
+        'dropped_by_crc': len(receiver.corrupted),
+        'decode_per_s': int(len(got) / elapsed) if elapsed else None,
+        'link': link.stats(),
+        'result': 'ok' if not problems else '; '.join(problems),
+    }
+
+
+def throughput(readings, batch):
+    text_bytes = sum(len(text_line(r)) for r in readings) / len(readings)
+    frames = [encode_frame(READINGS, b''.join(encode_reading(*r) for r in readings[i:i + batch]))
+              for i in range(0, len(readings), batch)]
+    single = [encode_frame(READINGS, encode_reading(*r)) for r in readings]
+    binary_bytes = sum(len(f) for f in frames) / len(readings)
+    single_bytes = sum(len(f) for f in single) / len(readings)
+    print("\nbytes per reading: text {:.1f}, binary {:.1f} (one per frame), {:.1f} ({} per frame)".format(
+        text_bytes, single_bytes, binary_bytes, batch))
+    print("{:>9}  {:>12}  {:>12}".format('baud', 'text/s', 'binary/s'))
+    base = TEXT_BAUD / 10 / text_bytes
+    for baud in BAUD_RATES:
+        print("{:>9}  {:>12.0f}  {:>12.0f}  ({:.1f}x text at {})".format(
+            baud, baud / 10 / text_bytes, baud / 10 / binary_bytes, baud / 10 / binary_bytes / base, TEXT_BAUD))
+
+
+def main():
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    readings = make_readings(args.readings, rng)
+    fragment_lines = [line.encode() for line in fragment_burst(8, 17, bytes(rng.randrange(256) for _ in range(600)))]
+    failed = False
+    for scenario in SCENARIOS:
+        result = run_scenario(scenario, readings, fragment_lines, args)
+        failed = failed or result['result'] != 'ok'
+        print("{:<8} {}".format(scenario, result))
+    throughput(readings, args.batch)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+# Binary framing for the UART between the STM32 receiver and the gateway.
+#
+# The receiver's original output is one text line per packet at BAUD_RATE
+# (115200), e.g. 'I08 T38.62 A0.123 -0.981 0.052 R-87\n'. That's 37 bytes
+# for 7 numbers and nothing catches a flipped bit. Firmware that knows the
+# binary protocol still starts in text mode, so old and new firmware look
+# the same until the gateway asks:
+#
+#   gateway -> HELLO(version, baud, flags)     at BAUD_RATE, as text would be
+#   stm32   -> HELLO_ACK(baud, flags)          then switches to that baud
+#   gateway -> PING                            at the new baud
+#   stm32   -> PONG                            and starts sending frames
+#
+# Old firmware never answers the HELLO, so after UART_NEGOTIATE_TIMEOUT the
+# gateway carries on reading text and asks again every
+# UART_RENEGOTIATE_INTERVAL seconds (0 to never ask again). It also falls
+# back to text if there's no PONG at the new baud.
+#
+# Frames on the wire are COBS encoded and end with a 0x00 byte. A frame
+# sent in the middle of text (HELLO, HELLO_ACK) also starts with one. The
+# HELLO ends with a newline as well, so old firmware sees one line of
+# garbage and ignores it. Decoded, a frame is
+#
+#   version (1 byte) | type (1 byte) | payload | CRC-16/CCITT-FALSE (2 bytes, big endian)
+#
+# and a frame with the wrong version or CRC is dropped. Types:
+#
+#   HELLO, HELLO_ACK  '<IB' baud, flags (FLOW_CONTROL: RTS/CTS)
+#   PING, PONG        no payload
+#   READINGS          one or more readings, back to back:
+#                       '<BH' fields present, Device_ID
+#                       '<h'  Temperature in 0.01 C       if HAS_TEMPERATURE
+#                       '<3h' Acceleration in 0.001 g     if HAS_ACCELERATION
+#                       '<b'  RSSI in dBm                 if HAS_RSSI
+#   TEXT              a text line as is (fragments, anything without a binary form)
+#   DOWNLINK          a command line for a collar (gateway -> stm32)
+#
+# Readings are handed on as the text line they stand for, so loraPackets.log,
+# the local store and everything downstream don't change. The gateway sends
+# a PING every UART_KEEPALIVE seconds once it's binary. Without a PONG it
+# goes back to BAUD_RATE and text, which is also what the firmware must do
+# after 3 keepalives without a frame from the gateway (e.g. the gateway
+# restarted).
+#
+# A reading with all fields is 18 bytes in a frame of its own and about 13
+# when the receiver puts 8 in a frame, against ~37 as text; see
+# uart_loopback.py for what that means at each baud rate.
+#
+# Settings (.env): UART_PROTOCOL (auto or text), UART_FAST_BAUD,
+# UART_FLOW_CONTROL, UART_NEGOTIATE_TIMEOUT, UART_RENEGOTIATE_INTERVAL,
+# UART_KEEPALIVE
+
+import binascii
+import os
+import struct
+import threading
+import time
+from collections import Counter
+
+VERSION = 1
+
+HELLO = 0x01
+HELLO_ACK = 0x02
+PING = 0x03
+PONG = 0x04
+READINGS = 0x10
+TEXT = 0x11
+DOWNLINK = 0x20
+
+FLOW_CONTROL = 0x01
+
+HAS_TEMPERATURE = 0x01
+HAS_ACCELERATION = 0x02
+HAS_RSSI = 0x04
+
+AUTO = 'auto'
+TEXT_ONLY = 'text'
+DEFAULT_FAST_BAUD = 921600
+DEFAULT_NEGOTIATE_TIMEOUT = 0.5
+DEFAULT_RENEGOTIATE_INTERVAL = 300
+DEFAULT_KEEPALIVE = 5
+# Longest frame or text line kept while waiting for its end
+MAX_PENDING = 4096
+
+_HEADER = struct.Struct('<BB')
+_HELLO = struct.Struct('<IB')
+_READING = struct.Struct('<BH')
+_TEMPERATURE = struct.Struct('<h')
+_ACCELERATION = struct.Struct('<3h')
+_RSSI = struct.Struct('<b')
+_CRC = struct.Struct('>H')
+
+
+def crc16(data):
+    # CRC-16/CCITT-FALSE, the STM32's CRC unit can do the same
+    return binascii.crc_hqx(data, 0xffff)
+
+
+def cobs_encode(data):
+    out = bytearray()
+    for piece in data.split(b'\x00'):
+        while len(piece) >= 254:
+            out.append(0xff)
+            out += piece[:254]
+            piece = piece[254:]
+        out.append(len(piece) + 1)
+        out += piece
+    return bytes(out)
+
+
+def cobs_decode(data):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        code = data[i]
+        end = i + code
+        if code == 0 or end > len(data):
+            raise ValueError('Bad COBS block at {}'.format(i))
+        out += data[i + 1:end]
+        i = end
+        if code < 0xff and i < len(data):
+            out.append(0)
+    return bytes(out)
+
+
+def encode_frame(kind, payload=b''):
+    # Ready to write, including the closing 0x00
+    body = _HEADER.pack(VERSION, kind) + payload
+    return cobs_encode(body + _CRC.pack(crc16(body))) + b'\x00'
+
+
+def decode_frame(data):
+    # COBS bytes without the 0x00 -> (type, payload). ValueError if damaged.
+    body = cobs_decode(data)
+    if len(body) < _HEADER.size + _CRC.size:
+        raise ValueError('Frame too short')
+    if _CRC.unpack_from(body, len(body) - _CRC.size)[0] != crc16(body[:-_CRC.size]):
+        raise ValueError('Bad CRC')
+    version, kind = _HEADER.unpack_from(body)
+    if version != VERSION:
+        raise ValueError('Protocol version {}'.format(version))
+    return kind, body[_HEADER.size:-_CRC.size]
+
+
+def encode_reading(device_id, temperature=None, acceleration=None, rssi=None):
+    # The receiver's side, for tests and simulators. Concatenate several for
+    # one READINGS frame.
+    fields = 0
+    parts = []
+    if temperature is not None:
+        fields |= HAS_TEMPERATURE
+        parts.append(_TEMPERATURE.pack(int(round(temperature * 100))))
+    if acceleration is not None:
+        fields |= HAS_ACCELERATION
+        parts.append(_ACCELERATION.pack(*(int(round(a * 1000)) for a in acceleration)))
+    if rssi is not None:
+        fields |= HAS_RSSI
+        parts.append(_RSSI.pack(int(rssi)))
+    return _READING.pack(fields, device_id) + b''.join(parts)
+
+
+def decode_readings(payload):
+    # READINGS payload -> the text lines the readings stand for, e.g.
+    # b'I08 T38.62 A0.123 -0.981 0.052 R-87\n'
+    lines = []
+    offset = 0
+    while offset < len(payload):
+        fields, device_id = _READING.unpack_from(payload, offset)
+        offset += _READING.size
+        line = 'I{:02d}'.format(device_id)
+        if fields & HAS_TEMPERATURE:
+            line += ' T{:g}'.format(_TEMPERATURE.unpack_from(payload, offset)[0] / 100)
+            offset += _TEMPERATURE.size
+        if fields & HAS_ACCELERATION:
+            line += ' A{:g} {:g} {:g}'.format(*(a / 1000 for a in _ACCELERATION.unpack_from(payload, offset)))
+            offset += _ACCELERATION.size
+        if fields & HAS_RSSI:
+            line += ' R{}'.format(_RSSI.unpack_from(payload, offset)[0])
+            offset += _RSSI.size
+        lines.append((line + '\n').encode())
+    return lines
+
+
+# Link states
+_TEXT = 'text'
+_HELLO_SENT = 'hello_sent'
+_VERIFYING = 'verifying'
+_BINARY = 'binary'
+
+
+class UartLink:
+    # Reads lines from the receiver whichever protocol it speaks, and writes
+    # downlink lines to it. read_lines() is meant for a single reader thread;
+    # send() may be called from any thread.
+    def __init__(self, ser, mode=AUTO, fast_baud=DEFAULT_FAST_BAUD, flow_control=False,
+                 timeout=DEFAULT_NEGOTIATE_TIMEOUT, renegotiate_interval=DEFAULT_RENEGOTIATE_INTERVAL,
+                 keepalive=DEFAULT_KEEPALIVE):
+        self.mode = mode
+        self.fast_baud = fast_baud
+        self.flow_control = flow_control
+        self.timeout = timeout
+        self.renegotiate_interval = renegotiate_interval
+        self.keepalive = keepalive
+        self._write_lock = threading.Lock()
+        self.counts = Counter()
+        self.attach(ser)
+
+    @classmethod
+    def from_env(cls, ser):
+        return cls(ser,
+                   mode=os.getenv('UART_PROTOCOL', AUTO),
+                   fast_baud=int(os.getenv('UART_FAST_BAUD', DEFAULT_FAST_BAUD)),
+                   flow_control=os.getenv('UART_FLOW_CONTROL', '0').lower() in ('1', 'true', 'yes'),
+                   timeout=float(os.getenv('UART_NEGOTIATE_TIMEOUT', DEFAULT_NEGOTIATE_TIMEOUT)),
+                   renegotiate_interval=float(os.getenv('UART_RENEGOTIATE_INTERVAL', DEFAULT_RENEGOTIATE_INTERVAL)),
+                   keepalive=float(os.getenv('UART_KEEPALIVE', DEFAULT_KEEPALIVE)))
+
+    def attach(self, ser):
+        # Starts over in text mode on ser (a new port, or a new BAUD_RATE)
+        with self._write_lock:
+            self.ser = ser
+            self.text_baud = ser.baudrate
+            self._state = _TEXT
+        self._buffer = bytearray()
+        self._deadline = None
+        self._next_hello = time.monotonic() if self.mode == AUTO else None
+        self._next_ping = None
+
+    @property
+    def binary(self):
+        return self._state == _BINARY
+
+    @property
+    def negotiating(self):
+        return self._state in (_HELLO_SENT, _VERIFYING)
+
+    def read_lines(self):
+        # Complete lines (bytes ending in a newline) received since the last
+        # call. Waits up to the port's read timeout for the first byte.
+        lines = []
+        self._check_timers(time.monotonic())
+        data = self.ser.read(max(1, self.ser.in_waiting))
+        if data:
+            self.counts['bytes'] += len(data)
+            self._buffer += data
+            if self._state in (_VERIFYING, _BINARY):
+                self._read_frames(lines)
+            else:
+                self._read_text(lines)
+        return lines
+
+    def send(self, line):
+        # A downlink line, e.g. b'I08 S600\n'
+        with self._write_lock:
+            if self._state in (_VERIFYING, _BINARY):
+                self.ser.write(encode_frame(DOWNLINK, line))
+            else:
+                self.ser.write(line)
+
+    def _read_text(self, lines):
+        buffer = self._buffer
+        while buffer:
+            start = buffer.find(b'\x00')
+            text_end = len(buffer) if start == -1 else start
+            newline = buffer.rfind(b'\n', 0, text_end)
+            if newline != -1:
+                lines.extend(bytes(line) + b'\n' for line in buffer[:newline].split(b'\n'))
+                del buffer[:newline + 1]
+                continue
+            if start == -1:
+                if len(buffer) > MAX_PENDING:
+                    self.counts['dropped_bytes'] += len(buffer)
+                    del buffer[:]
+                break
+            # A frame from firmware that speaks the binary protocol. Anything
+            # before it that isn't a whole line is lost.
+            end = buffer.find(b'\x00', start + 1)
+            if end == -1:
+                if len(buffer) - start > MAX_PENDING:
+                    self.counts['dropped_bytes'] += len(buffer)
+                    del buffer[:]
+                break
+            self.counts['dropped_bytes'] += start
+            frame = bytes(buffer[start + 1:end])
+            del buffer[:end + 1]
+            if frame:
+                self._handle_frame(frame, lines)
+                if self._state != _TEXT and self._state != _HELLO_SENT:
+                    # Switched baud, the rest was read at the old one
+                    break
+
+    def _read_frames(self, lines):
+        buffer = self._buffer
+        while True:
+            end = buffer.find(b'\x00')
+            if end == -1:
+                if len(buffer) > MAX_PENDING:
+                    self.counts['bad_frames'] += 1
+                    del buffer[:]
+                break
+            frame = bytes(buffer[:end])
+            del buffer[:end + 1]
+            if frame:
+                self._handle_frame(frame, lines)
+                if self._state == _TEXT:
+                    break
+
+    def _handle_frame(self, frame, lines):
+        try:
+            kind, payload = decode_frame(frame)
+        except (ValueError, struct.error):
+            self.counts['bad_frames'] += 1
+            return
+        self.counts['frames'] += 1
+        if kind == READINGS:
+            try:
+                readings = decode_readings(payload)
+            except struct.error:
+                self.counts['bad_frames'] += 1
+                return
+            self.counts['readings'] += len(readings)
+            lines.extend(readings)
+        elif kind == TEXT:
+            lines.append(payload if payload.endswith(b'\n') else payload + b'\n')
+        elif kind == HELLO_ACK and self._state == _HELLO_SENT and len(payload) == _HELLO.size:
+            self._switch(*_HELLO.unpack(payload))
+        elif kind == PONG:
+            self._deadline = None
+            if self._state == _VERIFYING:
+                self._state = _BINARY
+                self.counts['negotiated'] += 1
+                print("UART: binary protocol at {} baud{}".format(
+                    self.ser.baudrate, ' with RTS/CTS' if self.ser.rtscts else ''))
+
+    def _switch(self, baud, flags):
+        with self._write_lock:
+            self.ser.baudrate = baud
+            self.ser.rtscts = bool(flags & FLOW_CONTROL)
+            self.ser.reset_input_buffer()
+            # Starts with a 0x00 too, which ends the HELLO's newline as a bad frame
+            self.ser.write(b'\x00' + encode_frame(PING))
+            self._state = _VERIFYING
+        del self._buffer[:]
+        now = time.monotonic()
+        self._deadline = now + self.timeout
+        self._next_ping = now + self.keepalive
+
+    def _fall_back(self, reason, retry_in):
+        print("UART: back to text at {} baud, {}".format(self.text_baud, reason))
+        with self._write_lock:
+            self.ser.baudrate = self.text_baud
+            self.ser.rtscts = False
+            self.ser.reset_input_buffer()
+            self._state = _TEXT
+        del self._buffer[:]
+        self.counts['fallbacks'] += 1
+        self._deadline = None
+        self._next_hello = time.monotonic() + retry_in if retry_in is not None else None
+
+    def _send_hello(self, now):
+        flags = FLOW_CONTROL if self.flow_control else 0
+        with self._write_lock:
+            self.ser.write(b'\x00' + encode_frame(HELLO, _HELLO.pack(self.fast_baud, flags)) + b'\n')
+            self._state = _HELLO_SENT
+        self.counts['hellos'] += 1
+        self._deadline = now + self.timeout
+
+    def _check_timers(self, now):
+        if self._deadline is not None and now >= self._deadline:
+            self._deadline = None
+            if self._state == _HELLO_SENT:
+                # Old firmware, or not listening yet
+                self._state = _TEXT
+                self._next_hello = now + self.renegotiate_interval if self.renegotiate_interval else None
+            elif self._state == _VERIFYING:
+                self._fall_back('no answer at {} baud'.format(self.ser.baudrate), self.renegotiate_interval or None)
+            elif self._state == _BINARY:
+                # Missed keepalive: the firmware restarted or the link is
+                # broken. The firmware gives up on binary after 3 keepalives.
+                self._fall_back('receiver stopped answering', 3 * self.keepalive + self.timeout)
+        if self._state == _TEXT and self._next_hello is not None and now >= self._next_hello:
+            self._next_hello = None
+            self._send_hello(now)
+        if self._state == _BINARY and self._deadline is None and now >= self._next_ping:
+            with self._write_lock:
+                self.ser.write(encode_frame(PING))
+            self._deadline = now + self.timeout
+            self._next_ping = now + self.keepalive
+
+    def stats(self):
+        stats = dict(self.counts)
+        stats.update({'protocol': 'binary' if self.binary else 'text', 'baud': self.ser.baudrate})
+        return stats
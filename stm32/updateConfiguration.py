@@ -1,12 +1,19 @@
-import argparse
 import dotenv
 import sys
 
-dotenv_file = dotenv.find_dotenv()
-dotenv.load_dotenv(dotenv_file)
+from live_config import update_env_file
 
-for key, value in zip(sys.argv[1::2], sys.argv[2::2]):
-    if not key.startswith('--'):
-        raise ValueError('Missing -- in environment key')
-    key = key.strip('--')
-    dotenv.set_key(dotenv_file, key, value)
+# Usage: python updateConfiguration.py --SAMPLE_FREQUENCY 10 --PUBLISH_TOPIC barn1/temp
+# All keys are written to .env in a single step. Running scripts that watch
+# the file through LiveConfig pick the new values up without restarting.
+if __name__ == '__main__':
+    dotenv_file = dotenv.find_dotenv()
+
+    updates = {}
+    for key, value in zip(sys.argv[1::2], sys.argv[2::2]):
+        if not key.startswith('--'):
+            raise ValueError('Missing -- in environment key')
+        key = key[2:]
+        updates[key] = value
+
+    update_env_file(dotenv_file, updates)
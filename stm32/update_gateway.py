@@ -0,0 +1,389 @@
+# Updates the gateway code from git with verification and rollback.
+#
+# Layout under GATEWAY_HOME (default /home/pi/gateway):
+#
+#   repo.git/            bare copy of the repository, only ever fetched into
+#   releases/<commit>/   one checked out tree per version
+#   current -> releases/<commit>    what the services run from
+#   previous -> releases/<commit>   what to roll back to
+#   data/                outbox, readings, animal state, ... shared by every
+#                        release (see gateway_paths.py)
+#   .env                 settings, linked into every release as stm32/.env;
+#                        the first update copies it from where it runs
+#
+# An update fetches the target ref into repo.git (git only transfers the
+# objects we don't have, so a small change costs a small download), checks
+# the commit is the one asked for and optionally that it is signed, and
+# unpacks it next to the running version. Nothing running is touched
+# until the new tree compiles. Then `current` is switched with a single
+# rename, the services are restarted (they drain their in-flight messages
+# on SIGTERM) and the health check is run. If it fails, `current` goes back
+# to the previous release and the services are restarted again.
+#
+# The restart stops whoever started the update: a job handler runs in the
+# jobs agent's process group, and the supervisor stops that whole group. So
+# the switch, restart, health check and rollback are handed to a copy of
+# this script in a session of its own (started through
+# GATEWAY_DETACH_COMMAND if set, e.g. "systemd-run --scope --quiet" when
+# restarting the systemd unit would take its whole cgroup down), which
+# logs to GATEWAY_HOME/update.log and leaves the outcome in
+# GATEWAY_HOME/update-status.json. The original process waits for that
+# outcome and exits with it. If the restart took it down, the jobs agent
+# runs the job again once it is back (it picks up jobs left IN_PROGRESS),
+# and this script, asked for the same update, waits for and reports the
+# recorded outcome instead of updating again. The update step should come
+# first in its job document for that reason.
+#
+# Run from a job document:
+#   {"action": {"type": "runHandler",
+#               "input": {"handler": "update_gateway.py", "args": ["--ref", "main"]}}}
+#
+# Settings (.env):
+#   GATEWAY_HOME, GATEWAY_REPO_URL
+#   GATEWAY_RESTART_COMMAND   e.g. "sudo systemctl restart gateway.target"
+#   GATEWAY_HEALTH_CHECK      command that exits 0 when the new version is healthy
+#   GATEWAY_REQUIRE_SIGNED    set to 1 to only accept commits with a valid GPG signature
+#   GATEWAY_DETACH_COMMAND    prefix for starting the detached part, default none
+
+import argparse
+import compileall
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+
+from dotenv import find_dotenv, load_dotenv
+
+load_dotenv()
+
+DEFAULT_GATEWAY_HOME = '/home/pi/gateway'
+DEFAULT_REF = 'main'
+KEEP_RELEASES = 3
+HEALTH_CHECK_TIMEOUT = 60
+HEALTH_CHECK_INTERVAL = 5
+STATUS_FILE = 'update-status.json'
+UPDATE_LOG = 'update.log'
+# Longest the detached part may take: restart, health check and a rollback
+FINISH_TIMEOUT = 600
+FINISH_POLL_INTERVAL = 1
+# An outcome older than this isn't waiting for the same job to come back
+RESUME_WINDOW = 3600
+# Written next to the code by releases from before the shared data/
+STATE_FILES = ('outbox.db', 'readings.db', 'animal_state.pickle', 'shadow_cache.json')
+
+parser = argparse.ArgumentParser(description="Update the gateway code to a new git revision.")
+parser.add_argument('--ref', default=DEFAULT_REF, help='branch or tag to update to')
+parser.add_argument('--commit', help='expected commit hash, the update is refused if the ref points elsewhere')
+parser.add_argument('--repo-url', default=os.getenv('GATEWAY_REPO_URL'), help='where to fetch from')
+parser.add_argument('--home', default=os.getenv('GATEWAY_HOME', DEFAULT_GATEWAY_HOME))
+parser.add_argument('--rollback', action='store_true', help='switch back to the previous release and exit')
+# The detached part: 'update:<commit>' or 'rollback'
+parser.add_argument('--finish', help=argparse.SUPPRESS)
+
+
+class UpdateError(Exception):
+    pass
+
+
+def git(repo, *args):
+    result = subprocess.run(
+        ['git', '--git-dir', repo] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise UpdateError('git {} failed: {}'.format(' '.join(args), result.stderr.strip()))
+    return result.stdout.strip()
+
+
+def run_command(command, timeout=None):
+    if not command:
+        return True
+    print("Running: {}".format(command))
+    try:
+        return subprocess.run(shlex.split(command), timeout=timeout).returncode == 0
+    except subprocess.TimeoutExpired:
+        return False
+
+
+def release_of(link):
+    try:
+        return os.path.basename(os.readlink(link))
+    except OSError:
+        return None
+
+
+def switch_link(link, target):
+    # os.replace() of a symlink is a single rename, so readers always see
+    # either the old or the new target
+    tmp_link = link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+
+
+def fetch(repo, repo_url, ref):
+    if not os.path.isdir(repo):
+        if not repo_url:
+            raise UpdateError('GATEWAY_REPO_URL is not set and {} does not exist'.format(repo))
+        print("Creating local repository cache {}".format(repo))
+        subprocess.check_call(['git', 'init', '--bare', '--quiet', repo])
+        git(repo, 'remote', 'add', 'origin', repo_url)
+    print("Fetching {}...".format(ref))
+    git(repo, 'fetch', '--no-tags', '--quiet', 'origin', ref)
+    return git(repo, 'rev-parse', 'FETCH_HEAD^{commit}')
+
+
+def verify(repo, commit, expected):
+    if expected and not commit.startswith(expected.lower()):
+        raise UpdateError('Ref points at {}, expected {}'.format(commit, expected))
+    if os.getenv('GATEWAY_REQUIRE_SIGNED') == '1':
+        git(repo, 'verify-commit', commit)
+    # git checks every object's hash as it reads it, so this fails on any
+    # corrupted or missing object in the new tree
+    git(repo, 'ls-tree', '-r', '--full-tree', commit)
+
+
+def stage(repo, releases, commit):
+    path = os.path.join(releases, commit)
+    if os.path.isdir(path):
+        print("Release {} is already staged".format(commit))
+        return path
+    tmp_path = path + '.partial'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    archive = subprocess.Popen(['git', '--git-dir', repo, 'archive', commit], stdout=subprocess.PIPE)
+    with tarfile.open(fileobj=archive.stdout, mode='r|') as tar:
+        tar.extractall(tmp_path)
+    if archive.wait() != 0:
+        shutil.rmtree(tmp_path)
+        raise UpdateError('git archive {} failed'.format(commit))
+    if not compileall.compile_dir(tmp_path, quiet=1):
+        shutil.rmtree(tmp_path)
+        raise UpdateError('Release {} does not compile'.format(commit))
+    os.rename(tmp_path, path)
+    return path
+
+
+def share_env(home, release):
+    # The release's stm32/.env is a link to GATEWAY_HOME/.env, so settings
+    # (and changes made to them by jobs or the Device Shadow) carry over
+    shared = os.path.join(home, '.env')
+    if not os.path.exists(shared):
+        running = find_dotenv()
+        if not running:
+            print("No .env to carry into the release, create {}".format(shared))
+            return
+        print("Carrying {} over to {}".format(running, shared))
+        shutil.copy2(os.path.realpath(running), shared)
+    link = os.path.join(release, 'stm32', '.env')
+    if os.path.lexists(link) and os.path.realpath(link) == os.path.realpath(shared):
+        return
+    switch_link(link, shared)
+
+
+def health_check():
+    command = os.getenv('GATEWAY_HEALTH_CHECK')
+    if not command:
+        return True
+    deadline = time.monotonic() + HEALTH_CHECK_TIMEOUT
+    while time.monotonic() < deadline:
+        if run_command(command, timeout=HEALTH_CHECK_INTERVAL * 2):
+            return True
+        time.sleep(HEALTH_CHECK_INTERVAL)
+    return False
+
+
+def left_behind(release):
+    # State a release from before GATEWAY_HOME/data wrote next to its code
+    stm32 = os.path.join(release, 'stm32')
+    return [name for name in STATE_FILES if os.path.lexists(os.path.join(stm32, name))]
+
+
+def prune(releases, keep):
+    for name in sorted(os.listdir(releases), key=lambda n: os.path.getmtime(os.path.join(releases, n)), reverse=True):
+        if name not in keep and left_behind(os.path.join(releases, name)):
+            print("Keeping old release {}, it still holds {}; move them to data/ if they are needed".format(
+                name, ', '.join(left_behind(os.path.join(releases, name)))))
+        elif name not in keep and len(os.listdir(releases)) > KEEP_RELEASES:
+            print("Removing old release {}".format(name))
+            shutil.rmtree(os.path.join(releases, name), ignore_errors=True)
+
+
+def read_status(home):
+    try:
+        with open(os.path.join(home, STATUS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(home, **changes):
+    # Replaced in one go, so a reader sees the old status or the new one
+    status = read_status(home) or {}
+    status.update(changes)
+    path = os.path.join(home, STATUS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f)
+    os.replace(path + '.tmp', path)
+
+
+def clear_status(home):
+    try:
+        os.remove(os.path.join(home, STATUS_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def detach(home, request, finish):
+    # Starts the detached part and waits for its outcome
+    write_status(home, request=request, state='running', message='', pid=None, started=time.time())
+    command = shlex.split(os.getenv('GATEWAY_DETACH_COMMAND', ''))
+    command += [sys.executable, os.path.realpath(__file__), '--home', home, '--finish', finish]
+    print("Handing over to a detached updater, see {}".format(os.path.join(home, UPDATE_LOG)))
+    with open(os.path.join(home, UPDATE_LOG), 'a') as log:
+        # Not writing to the jobs agent's pipe, which goes away with it
+        process = subprocess.Popen(command, cwd=home, stdin=subprocess.DEVNULL, stdout=log,
+                                   stderr=subprocess.STDOUT, start_new_session=True)
+    wait_for_outcome(home, process)
+
+
+def wait_for_outcome(home, process=None):
+    # The detached part's outcome once it is recorded, after which it is
+    # cleared. Raises UpdateError if it failed.
+    deadline = time.monotonic() + FINISH_TIMEOUT
+    while True:
+        # Checked before reading the status, which it writes last
+        if process is not None:
+            alive = process.poll() is None
+        else:
+            pid = (read_status(home) or {}).get('pid')
+            alive = not pid or pid_alive(pid)
+        status = read_status(home) or {}
+        if status.get('state') in ('succeeded', 'failed'):
+            break
+        if not alive or time.monotonic() >= deadline:
+            # Gone, or hung, without saying how it went
+            status = dict(status, state='failed', message='Detached updater stopped before finishing, see {}'.format(
+                os.path.join(home, UPDATE_LOG)))
+            break
+        time.sleep(FINISH_POLL_INTERVAL)
+    clear_status(home)
+    if status['state'] == 'failed':
+        raise UpdateError(status['message'])
+    print(status['message'])
+
+
+def resume(home, request):
+    # True if the outcome of this request was already waited for and
+    # reported, i.e. this is the job run again after the restart
+    status = read_status(home)
+    if status is None:
+        return False
+    if status.get('request') == request and time.time() - status.get('started', 0) < RESUME_WINDOW:
+        print("{} was already started, waiting for its outcome".format(request.capitalize()))
+        wait_for_outcome(home)
+        return True
+    if status.get('state') == 'running' and status.get('pid') and pid_alive(status['pid']):
+        raise UpdateError('Another update ({}) is in progress'.format(status.get('request')))
+    # An outcome nobody picked up, for a request that isn't coming back
+    clear_status(home)
+    return False
+
+
+def finish(home, action):
+    # The detached part
+    write_status(home, pid=os.getpid())
+    try:
+        if action == 'rollback':
+            message = rollback(home)
+        else:
+            message = switch_to(home, action.split(':', 1)[1])
+        write_status(home, state='succeeded', message=message)
+    except Exception as e:
+        print("Update failed: {}".format(e))
+        write_status(home, state='failed', message=str(e))
+
+
+def rollback(home):
+    current = os.path.join(home, 'current')
+    previous = release_of(os.path.join(home, 'previous'))
+    if previous is None:
+        raise UpdateError('No previous release to roll back to')
+    print("Rolling back to {}".format(previous))
+    switch_link(current, os.path.join(home, 'releases', previous))
+    run_command(os.getenv('GATEWAY_RESTART_COMMAND'))
+    return 'Rolled back to {}'.format(previous)
+
+
+def switch_to(home, commit):
+    releases = os.path.join(home, 'releases')
+    current = os.path.join(home, 'current')
+    running = release_of(current)
+    if running:
+        switch_link(os.path.join(home, 'previous'), os.path.join(releases, running))
+    print("Switching {} -> {}".format(running, commit))
+    switch_link(current, os.path.join(releases, commit))
+
+    if not run_command(os.getenv('GATEWAY_RESTART_COMMAND')) or not health_check():
+        if running:
+            rollback(home)
+        raise UpdateError('Release {} failed its health check'.format(commit))
+
+    prune(releases, keep={commit, running})
+    return 'Now running {}'.format(commit)
+
+
+def update(args):
+    repo = os.path.join(args.home, 'repo.git')
+    releases = os.path.join(args.home, 'releases')
+    current = os.path.join(args.home, 'current')
+    os.makedirs(releases, exist_ok=True)
+
+    commit = fetch(repo, args.repo_url, args.ref)
+    verify(repo, commit, args.commit)
+    running = release_of(current)
+    if running == commit:
+        print("Already running {}".format(commit))
+        return
+
+    os.makedirs(os.path.join(args.home, 'data'), exist_ok=True)
+    share_env(args.home, stage(repo, releases, commit))
+    detach(args.home, request_of(args), 'update:{}'.format(commit))
+
+
+def request_of(args):
+    # What was asked for, to recognise the same job run again
+    if args.rollback:
+        return 'rollback'
+    return 'update to {}{}'.format(args.ref, ' ({})'.format(args.commit) if args.commit else '')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.finish:
+        finish(args.home, args.finish)
+        sys.exit(0)
+    try:
+        if not resume(args.home, request_of(args)):
+            if args.rollback:
+                detach(args.home, request_of(args), 'rollback')
+            else:
+                update(args)
+    except (UpdateError, subprocess.CalledProcessError) as e:
+        print("Update failed: {}".format(e))
+        sys.exit(1)